@@ -0,0 +1,376 @@
+"""Run gensystem commands in a long-lived agent, over a Unix socket.
+
+Every gensystem run starts cold: the interpreter starts, the modules are
+imported, the mirror list and catalog are loaded, mirror hosts are
+resolved and the public IP and GeoIP country are looked up, only to be
+thrown away when the run ends. An agent ('gensystem agent') is one
+process that keeps all of that warm and runs the commands other
+gensystem invocations send it.
+
+bin/gensystem sends its command line to the agent's socket
+(GENSYSTEM_AGENT_SOCKET, default: agent.sock in the cache directory; set
+it empty to never use an agent) and runs the command itself when no agent
+answers. The protocol is newline-delimited JSON:
+
+* the client sends {"argv": [...], "cwd": ..., "env": {...}};
+* the agent answers {"stdout": data} and {"stderr": data} as the command
+  writes, then {"exit": code}; or {"fallback": reason} straight away when
+  it will not run the command (e.g. it was started with different
+  settings), in which case the client runs it itself.
+
+The agent runs one command at a time: output goes through sys.stdout and
+files are saved to the working directory, and both are per process.
+Commands waiting their turn are queued. The socket is only accessible to
+the user running the agent.
+
+"""
+
+import json
+import os
+import socket
+import StringIO
+import sys
+import threading
+import time
+import traceback
+
+import gensystem.cache as gensystem_cache
+
+SOCKET_FILE = 'agent.sock'
+CONNECT_TIMEOUT = 0.5
+WAIT = 1.0
+STATE_TTL = 10 * 60
+# Settings read from the environment when gensystem starts
+ENVIRONMENT = ('GEOIP_FILE', 'XDG_CACHE_HOME')
+ENVIRONMENT_PREFIX = 'GENSYSTEM_'
+
+
+def get_socket_path():
+    """Get the path of the agent's socket, None if agents are not used."""
+    path = os.environ.get(
+        'GENSYSTEM_AGENT_SOCKET', gensystem_cache.get_cache_path(SOCKET_FILE))
+    return path or None
+
+
+def get_environment(environ=None):
+    """Get the settings gensystem reads from the environment.
+
+    Args:
+        environ (Optional[dict]): Environment (default: os.environ).
+
+    Returns:
+        dict: Values of the variables that change how gensystem runs.
+
+    """
+    environ = os.environ if environ is None else environ
+    return dict(
+        (name, value) for name, value in environ.items()
+        if name in ENVIRONMENT or (
+            name.startswith(ENVIRONMENT_PREFIX) and
+            name != 'GENSYSTEM_AGENT_SOCKET'))
+
+
+def _send(connection, message):
+    """Send one message (see the protocol above)."""
+    connection.sendall(json.dumps(message) + '\n')
+
+
+class StreamWriter(object):
+
+    """File-like object sending what is written to an agent's client."""
+
+    def __init__(self, connection, stream):
+        """Send writes as `stream` ('stdout' or 'stderr') messages."""
+        self.connection = connection
+        self.stream = stream
+        self.softspace = 0
+
+    def write(self, data):
+        """Send `data` to the client.
+
+        Raises:
+            IOError: When the client has gone, which ends the command.
+
+        """
+        if not data:
+            return
+        if isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+        try:
+            _send(self.connection, {self.stream: data})
+        except socket.error as error:
+            raise IOError("The client has gone (%s)." % error)
+
+    def writelines(self, lines):
+        """Send each of `lines` to the client."""
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        """Do nothing; every write is sent at once."""
+
+    def isatty(self):
+        """Tell the client's stream is not a terminal we can query."""
+        return False
+
+
+class WarmState(object):
+
+    """Values worth keeping between commands, forgotten after a while.
+
+    Mirrors move and machines roam, so what an agent remembers is
+    forgotten every `ttl` seconds.
+
+    """
+
+    def __init__(self, ttl=STATE_TTL, clock=time.time):
+        """Start empty.
+
+        Args:
+            ttl (Optional[float]): Seconds values are kept.
+            clock (Optional[fn]): Function returning the time in seconds.
+
+        """
+        self.ttl = ttl
+        self._clock = clock
+        self._values = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._started = clock()
+
+    def add_listener(self, listener):
+        """Call `listener` (with no arguments) whenever values expire."""
+        self._listeners.append(listener)
+
+    def get(self, key, function, *args):
+        """Get a remembered value, or the value of `function(*args)`.
+
+        None is not remembered, so a failed lookup is tried again.
+
+        """
+        with self._lock:
+            if key in self._values:
+                return self._values[key]
+        value = function(*args)
+        if value is not None:
+            with self._lock:
+                self._values[key] = value
+        return value
+
+    def expire(self, force=False):
+        """Forget everything if it is older than the TTL (or `force`).
+
+        Returns:
+            bool: Whether it was forgotten.
+
+        """
+        with self._lock:
+            if not force and self._clock() - self._started < self.ttl:
+                return False
+            self._values.clear()
+            self._started = self._clock()
+        for listener in self._listeners:
+            listener()
+        return True
+
+
+class Agent(object):
+
+    """Runs the commands sent to a Unix socket, one at a time."""
+
+    def __init__(self, handler, path=None, log=None):
+        """Serve `handler` at `path`.
+
+        Args:
+            handler (fn): Function running a command line (a list of
+                arguments), returning its exit code. It writes its output
+                to sys.stdout and sys.stderr.
+            path (Optional[str]): Socket path (default: get_socket_path).
+            log (Optional[file]): Stream to log requests to (default: the
+                agent's stdout).
+
+        """
+        self.handler = handler
+        self.path = path or get_socket_path()
+        self.log = log or sys.stdout
+        self.environment = get_environment()
+        self._socket = None
+        self._stopped = threading.Event()
+        self._run_lock = threading.Lock()
+
+    def bind(self):
+        """Listen on the socket, taking the place of a dead agent.
+
+        Raises:
+            RuntimeError: When no socket path is set or another agent
+                serves it.
+
+        """
+        if self.path is None:
+            raise RuntimeError("No agent socket is set.")
+        if os.path.exists(self.path):
+            if connect(self.path) is not None:
+                raise RuntimeError("An agent already serves %s." % self.path)
+            os.remove(self.path)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        listener.listen(16)
+        listener.settimeout(WAIT)
+        self._socket = listener
+
+    def serve_forever(self):
+        """Serve requests until shutdown is called."""
+        if self._socket is None:
+            self.bind()
+        try:
+            while not self._stopped.is_set():
+                try:
+                    connection, _ = self._socket.accept()
+                except socket.timeout:
+                    continue
+                connection.settimeout(None)
+                thread = threading.Thread(
+                    target=self._handle, args=(connection,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self._socket.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def shutdown(self):
+        """Stop serving (requests running are not waited for)."""
+        self._stopped.set()
+
+    def _handle(self, connection):
+        """Answer one request."""
+        try:
+            request = json.loads(connection.makefile('rb').readline())
+            argv, cwd = list(request['argv']), request['cwd']
+            if get_environment(request.get('env', {})) != self.environment:
+                _send(connection, {'fallback': 'different settings'})
+                return
+
+            with self._run_lock:
+                self.log.write("Running gensystem %s\n" % ' '.join(argv))
+                self.log.flush()
+                code = self._run(connection, argv, cwd)
+            _send(connection, {'exit': code})
+        except (ValueError, KeyError, TypeError, EnvironmentError):
+            pass  # A bad request or the client went away
+        finally:
+            connection.close()
+
+    def _run(self, connection, argv, cwd):
+        """Run a command, its output going to the client (lock held)."""
+        saved = (
+            sys.stdout, sys.stderr, sys.stdin, sys.__stdout__, os.getcwd())
+        stdout = StreamWriter(connection, 'stdout')
+        stderr = StreamWriter(connection, 'stderr')
+        try:
+            os.chdir(cwd)
+            # JSON progress events go to the "real" stdout
+            sys.stdout = sys.__stdout__ = stdout
+            sys.stderr = stderr
+            sys.stdin = StringIO.StringIO()  # The client cannot be asked
+            code = self.handler(argv)
+        except SystemExit as exit_:
+            code = exit_.code
+            if code is not None and not isinstance(code, int):
+                _write_quietly(stderr, "%s\n" % code)
+                code = 1
+        except Exception:
+            _write_quietly(stderr, traceback.format_exc())
+            code = 1
+        finally:
+            sys.stdout, sys.stderr, sys.stdin, sys.__stdout__ = saved[:4]
+            os.chdir(saved[4])
+
+        return code or 0
+
+
+def _write_quietly(stream, data):
+    """Write to a client stream, ignoring a client that has gone."""
+    try:
+        stream.write(data)
+    except IOError:
+        pass
+
+
+def connect(path=None):
+    """Connect to a running agent.
+
+    Args:
+        path (Optional[str]): Socket path (default: get_socket_path).
+
+    Returns:
+        socket.socket: Connection to the agent, None if none answers.
+
+    """
+    path = path or get_socket_path()
+    if path is None or not os.path.exists(path):
+        return None
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(CONNECT_TIMEOUT)
+    try:
+        connection.connect(path)
+    except socket.error:
+        connection.close()
+        return None
+    connection.settimeout(None)
+    return connection
+
+
+def forward(argv, path=None, stdout=None, stderr=None):
+    """Run a command line in a running agent, streaming its output.
+
+    Args:
+        argv (list): Command line arguments (without the program).
+        path (Optional[str]): Socket path (default: get_socket_path).
+        stdout (Optional[file]): Stream for the command's output (default:
+            sys.stdout).
+        stderr (Optional[file]): Stream for its errors (default:
+            sys.stderr).
+
+    Returns:
+        int: Exit code of the command, or None if no agent ran it (the
+        caller should run it itself).
+
+    """
+    connection = connect(path)
+    if connection is None:
+        return None
+
+    streams = {
+        'stdout': stdout or sys.stdout, 'stderr': stderr or sys.stderr}
+    try:
+        _send(connection, {
+            'argv': argv, 'cwd': os.getcwd(), 'env': get_environment()})
+        for line in connection.makefile('rb'):
+            message = json.loads(line)
+            if 'fallback' in message:
+                return None
+            if 'exit' in message:
+                return message['exit']
+            for name, stream in streams.items():
+                if name in message:
+                    stream.write(message[name].encode('utf-8'))
+                    stream.flush()
+    except (socket.error, ValueError) as error:
+        streams['stderr'].write("\nError: The agent failed (%s).\n" % error)
+        return 1
+    finally:
+        connection.close()
+
+    streams['stderr'].write(
+        "\nError: The agent stopped before the command finished.\n")
+    return 1
@@ -0,0 +1,313 @@
+"""Share a capped download rate between downloads, by priority.
+
+Downloads compete for the uplink with no coordination otherwise: every
+segment of every download in the process reads as fast as it can. Once a
+limit is set, every body read from a mirror (see transfer.get_body_reader)
+is paid for through the process's Scheduler instead:
+
+* a token bucket holds the global rate (GENSYSTEM_RATE_LIMIT, bytes/s),
+  and optional buckets hold per-mirror rates;
+* reads that must wait are let through in weighted fair order ("start-time
+  fair queuing"): each flow (a download, named after its media file) is
+  charged bytes / priority of virtual time, and the read of the flow with
+  the least virtual time charged goes first. A stage3 at priority 4 gets
+  four times the bandwidth of an ISO prefetch at priority 1 while both
+  run, and all of it once the other is done.
+
+Buckets may go into debt: a read is let through once its buckets hold any
+tokens, and the next waits until the debt is paid off. Reads are at most
+one receive buffer, so the rate is kept to within one buffer.
+
+Limits and priorities can be changed while downloads run by editing the
+control file (GENSYSTEM_BANDWIDTH_FILE, default: bandwidth.json in the
+cache directory), checked every CONTROL_INTERVAL seconds, or at once on
+SIGHUP (see install_signal_handler), e.g.
+
+    {"rate": 2000000, "mirrors": {"distfiles.gentoo.org": 500000},
+     "priorities": {"stage3": 4, "minimal": 1}}
+
+With no limits set, reads are not scheduled at all. Limits are per
+process; each gensystem process on a host enforces them on its own.
+
+"""
+
+import collections
+import contextlib
+import itertools
+import json
+import os
+import signal
+import threading
+import time
+
+import gensystem.cache as gensystem_cache
+import gensystem.metrics as gensystem_metrics
+import gensystem.settings as gensystem_settings
+
+CONTROL_FILE = 'bandwidth.json'
+CONTROL_INTERVAL = 1.0
+DEFAULT_PRIORITY = 1
+BURST_SECONDS = 0.25
+MAX_WAIT = 1.0
+
+Flow = collections.namedtuple('Flow', 'name priority')
+DEFAULT_FLOW = Flow('default', None)
+
+_local = threading.local()
+
+
+def get_rate_limit():
+    """Get the global rate limit set in the environment (None if unset)."""
+    return gensystem_settings.get_positive_int('GENSYSTEM_RATE_LIMIT')
+
+
+@contextlib.contextmanager
+def flow(name, priority=None):
+    """Attribute the downloads made in this thread to a flow.
+
+    Args:
+        name (str): Name of the flow, e.g. the media file (priorities in
+            the control file are looked up by it).
+        priority (Optional[int]): Share of the bandwidth relative to other
+            flows (default: DEFAULT_PRIORITY).
+
+    """
+    previous = getattr(_local, 'flow', None)
+    _local.flow = Flow(name, priority)
+    try:
+        yield _local.flow
+    finally:
+        _local.flow = previous
+
+
+def get_flow():
+    """Get the flow of this thread (see flow)."""
+    return getattr(_local, 'flow', None) or DEFAULT_FLOW
+
+
+class TokenBucket(object):
+
+    """Bytes that may be read at a rate, with a burst allowance."""
+
+    def __init__(self, rate, clock=time.time):
+        """Start full.
+
+        Args:
+            rate (int): Bytes per second.
+            clock (Optional[fn]): Function returning the time in seconds.
+
+        """
+        self.rate = rate
+        self.burst = max(1, int(rate * BURST_SECONDS))
+        self.tokens = self.burst
+        self._clock = clock
+        self._refilled = clock()
+
+    def refill(self):
+        """Add the tokens earned since the last refill."""
+        now = self._clock()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def get_delay(self):
+        """Get the seconds until the bucket holds tokens again."""
+        return 0.0 if self.tokens > 0 else -self.tokens / float(self.rate)
+
+
+class Scheduler(object):
+
+    """Lets reads through at the rates set, in weighted fair order."""
+
+    def __init__(self, rate=None, mirror_rates=None, priorities=None,
+                 control_file=None, clock=time.time):
+        """Set the limits.
+
+        Args:
+            rate (Optional[int]): Global bytes per second, None for none.
+            mirror_rates (Optional[dict]): Bytes per second by mirror host.
+            priorities (Optional[dict]): Priority by flow name.
+            control_file (Optional[str]): File to reload the limits from
+                when it changes (default: CONTROL_FILE in the cache
+                directory).
+            clock (Optional[fn]): Function returning the time in seconds.
+
+        """
+        self.control_file = control_file
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._finish_tags = {}
+        self._virtual_time = 0.0
+        self._checked = None
+        self._control_mtime = None
+        self._reload_requested = False
+        self.configure(rate, mirror_rates, priorities)
+
+    def configure(self, rate=None, mirror_rates=None, priorities=None):
+        """Replace the limits and priorities (waiting reads are kept).
+
+        A rate that is not a positive integer is no limit at all.
+
+        """
+        mirror_rates = dict(
+            (mirror, gensystem_settings.to_positive_int(mirror_rate))
+            for mirror, mirror_rate in (mirror_rates or {}).items())
+        with self._condition:
+            self.rate = gensystem_settings.to_positive_int(rate)
+            self.mirror_rates = dict(
+                (mirror, mirror_rate)
+                for mirror, mirror_rate in mirror_rates.items()
+                if mirror_rate)
+            self.priorities = dict(priorities or {})
+            self._bucket = (
+                TokenBucket(self.rate, self._clock) if self.rate else None)
+            self._mirror_buckets = dict(
+                (mirror, TokenBucket(mirror_rate, self._clock))
+                for mirror, mirror_rate in self.mirror_rates.items())
+            self._condition.notify_all()
+
+    def get_control_file(self):
+        """Get the path of the control file."""
+        return self.control_file or os.environ.get(
+            'GENSYSTEM_BANDWIDTH_FILE',
+            gensystem_cache.get_cache_path(CONTROL_FILE))
+
+    def request_reload(self, *args):
+        """Have the control file read again before the next read.
+
+        Only sets a flag, so it is safe to call from a signal handler.
+
+        """
+        self._reload_requested = True
+
+    def reload(self):
+        """Read the limits from the control file, if it changed.
+
+        A missing control file leaves the limits as they are; a damaged
+        one is ignored.
+
+        """
+        path = self.get_control_file()
+        try:
+            mtime = os.stat(path).st_mtime
+            if mtime == self._control_mtime and not self._reload_requested:
+                return
+            with open(path) as control:
+                settings = json.load(control)
+            self.configure(
+                settings.get('rate', get_rate_limit()),
+                settings.get('mirrors'), settings.get('priorities'))
+        except (EnvironmentError, ValueError, AttributeError, TypeError):
+            return
+        finally:
+            self._reload_requested = False
+        self._control_mtime = mtime
+        gensystem_metrics.count('bandwidth_reloads')
+
+    def acquire(self, count, mirror=None, flow_=None):
+        """Pay for bytes read, waiting for their turn if limits are set.
+
+        Args:
+            count (int): Bytes read.
+            mirror (Optional[str]): Mirror host they were read from.
+            flow_ (Optional[Flow]): Flow they were read for (default: the
+                thread's, see get_flow).
+
+        """
+        now = self._clock()
+        if self._reload_requested or self._checked is None or (
+                now - self._checked >= CONTROL_INTERVAL):
+            self._checked = now
+            self.reload()
+        if self._bucket is None and mirror not in self._mirror_buckets:
+            return  # Nothing to share out
+
+        flow_ = flow_ or get_flow()
+        waited = self._clock()
+        with self._condition:
+            priority = max(1, self.priorities.get(
+                flow_.name, flow_.priority or DEFAULT_PRIORITY))
+            start = max(
+                self._virtual_time, self._finish_tags.get(flow_.name, 0.0))
+            finish = start + count / float(priority)
+            self._finish_tags[flow_.name] = finish
+            waiter = {
+                'order': (finish, next(self._sequence)), 'start': start,
+                'flow': flow_.name, 'mirror': mirror, 'count': count,
+                'granted': False}
+            self._waiters.append(waiter)
+            while not waiter['granted']:
+                delay = self._grant()
+                if waiter['granted']:
+                    break
+                self._condition.wait(min(MAX_WAIT, max(0.001, delay)))
+
+        waited = self._clock() - waited
+        if waited > 0:
+            gensystem_metrics.count(
+                'bandwidth_wait_seconds', waited, flow=flow_.name)
+
+    def _grant(self):
+        """Let through the waiters whose turn it is (lock held).
+
+        Returns:
+            float: Seconds until another may be let through.
+
+        """
+        if self._bucket is not None:
+            self._bucket.refill()
+        for bucket in self._mirror_buckets.values():
+            bucket.refill()
+
+        granted = False
+        delay = MAX_WAIT
+        for waiter in sorted(self._waiters, key=lambda item: item['order']):
+            if self._bucket is not None and self._bucket.tokens <= 0:
+                delay = self._bucket.get_delay()
+                break
+            bucket = self._mirror_buckets.get(waiter['mirror'])
+            if bucket is not None and bucket.tokens <= 0:
+                # Its mirror is out of tokens, reads from others may go
+                delay = min(delay, bucket.get_delay())
+                continue
+
+            if self._bucket is not None:
+                self._bucket.tokens -= waiter['count']
+            if bucket is not None:
+                bucket.tokens -= waiter['count']
+            self._virtual_time = max(self._virtual_time, waiter['start'])
+            waiter['granted'] = granted = True
+            self._waiters.remove(waiter)
+
+        if granted:
+            self._forget_finished_flows()
+            self._condition.notify_all()
+        return delay
+
+    def _forget_finished_flows(self):
+        """Drop the finish tags virtual time has caught up with (lock held).
+
+        A flow without one starts at the virtual time, which is where such
+        a tag would have it start anyway, so flows that come and go (e.g.
+        one per download) are not remembered for ever.
+
+        """
+        waiting = set(waiter['flow'] for waiter in self._waiters)
+        for name, finish in self._finish_tags.items():
+            if finish <= self._virtual_time and name not in waiting:
+                del self._finish_tags[name]
+
+
+SCHEDULER = Scheduler(get_rate_limit())
+
+
+def acquire(count, mirror=None, flow_=None):
+    """Pay for bytes read through the process's scheduler."""
+    SCHEDULER.acquire(count, mirror, flow_)
+
+
+def install_signal_handler():
+    """Reload the control file on SIGHUP (call from the main thread)."""
+    signal.signal(signal.SIGHUP, SCHEDULER.request_reload)
@@ -0,0 +1,6 @@
+"""CPU micro-benchmarks for gensystem's hot paths.
+
+Run them with ``python -m gensystem.benchmarks``. See suite for the
+benchmarks and runner for how they are measured and compared.
+
+"""
@@ -0,0 +1,77 @@
+"""Run the gensystem benchmarks from the command line."""
+
+import argparse
+import sys
+
+import gensystem.benchmarks.runner as benchmarks_runner
+import gensystem.benchmarks.suite as benchmarks_suite
+
+
+def main():
+    """Run benchmarks, optionally saving or comparing with a baseline.
+
+    Returns:
+        int: An exit code; 0 (success) | 1 (failure or regression).
+
+    """
+    names = [benchmark.name for benchmark in benchmarks_suite.BENCHMARKS]
+    parser = argparse.ArgumentParser(
+        prog='python -m gensystem.benchmarks',
+        description='Benchmark gensystem parsing, hashing and choices')
+
+    parser.add_argument(
+        "-b", "--benchmark", help='benchmark B (repeat for more): {%s}' % (
+            '|'.join(names)),
+        action='append', choices=names, metavar='<B>')
+
+    parser.add_argument(
+        "--size", help="size of synthetic files in MB (default: %d)" % (
+            benchmarks_runner.SIZE),
+        type=float, metavar='<MB>', default=benchmarks_runner.SIZE)
+
+    parser.add_argument(
+        "--min-time", help="seconds to repeat each benchmark (default: %s)" % (
+            benchmarks_runner.MIN_TIME),
+        type=float, metavar='<S>', default=benchmarks_runner.MIN_TIME)
+
+    parser.add_argument(
+        "--save", help="store results as baseline F", metavar='<F>')
+
+    parser.add_argument(
+        "--compare", help="compare results with baseline F", metavar='<F>')
+
+    parser.add_argument(
+        "--threshold",
+        help="percent change flagged as a regression (default: %s)" % (
+            benchmarks_runner.THRESHOLD),
+        type=float, metavar='<P>', default=benchmarks_runner.THRESHOLD)
+
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        baseline = benchmarks_runner.load_results(args.compare)
+
+    results = benchmarks_runner.run_benchmarks(
+        args.benchmark, args.size, args.min_time)
+    print benchmarks_runner.format_results(results)
+
+    if args.save:
+        benchmarks_runner.save_results(results, args.save)
+        print "\nSaved results to %s" % args.save
+
+    failed = any(
+        'error' in result for result in results['benchmarks'].values())
+    if baseline is not None:
+        comparisons = benchmarks_runner.compare(
+            results, baseline, args.threshold)
+        print "\nCompared with %s:" % args.compare
+        print benchmarks_runner.format_comparisons(comparisons)
+        failed = failed or any(
+            comparison['regression'] for comparison in comparisons)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,389 @@
+"""Local HTTP servers laid out, and misbehaving, like Gentoo mirrors.
+
+A fake mirror serves a directory laid out like a Gentoo mirror (autobuild
+listings, media and DIGESTS, see make_layout) and is shaped to degrade
+like a real one: bandwidth caps per connection or for the whole server,
+latency, connection resets, stalls, busy responses and missing Range
+support. Faults are only injected into media transfers, so listings and
+DIGESTS always arrive.
+
+"""
+
+import BaseHTTPServer
+import cgi
+import contextlib
+import email.utils
+import hashlib
+import os
+import socket
+import SocketServer
+import struct
+import sys
+import threading
+import time
+
+import gensystem.media as gensystem_media
+import gensystem.mirror as gensystem_mirror
+import gensystem.serve as gensystem_serve
+
+SEND_SIZE = 16 * 1024
+BLOCK_SIZE = 1024 * 1024
+MB = 1024 * 1024
+STAMP = '20160414'
+
+
+class Shape(object):
+
+    """How a fake mirror degrades its service."""
+
+    def __init__(
+            self, bandwidth=None, total_bandwidth=None, latency=0,
+            resets=0, reset_after=0.5, stalls=0, stall_after=0.5,
+            stall_time=5, errors=0, error_status=503, ranges=True):
+        """Describe a shape; the default is a perfect mirror.
+
+        Args:
+            bandwidth (Optional[float]): Bytes/s cap per connection.
+            total_bandwidth (Optional[float]): Bytes/s cap for the server.
+            latency (Optional[float]): Seconds before every response.
+            resets (Optional[int]): Media responses to reset mid-body.
+            reset_after (Optional[float]): Fraction of the body sent
+                before a reset.
+            stalls (Optional[int]): Media responses to stall mid-body.
+            stall_after (Optional[float]): Fraction of the body sent
+                before a stall.
+            stall_time (Optional[float]): Seconds a stall lasts.
+            errors (Optional[int]): Media requests answered with
+                `error_status` before any succeed.
+            error_status (Optional[int]): Status of error responses.
+            ranges (Optional[bool]): Whether Range requests are honoured.
+
+        """
+        self.bandwidth = bandwidth
+        self.total_bandwidth = total_bandwidth
+        self.latency = latency
+        self.resets = resets
+        self.reset_after = reset_after
+        self.stalls = stalls
+        self.stall_after = stall_after
+        self.stall_time = stall_time
+        self.errors = errors
+        self.error_status = error_status
+        self.ranges = ranges
+
+
+SHAPES = {
+    'perfect': Shape(),
+    'dsl': Shape(total_bandwidth=2 * MB, latency=0.05),
+    'per-connection': Shape(bandwidth=1 * MB, total_bandwidth=8 * MB),
+    'far': Shape(latency=0.3),
+    'flaky': Shape(resets=1),
+    'stalling': Shape(stalls=1, stall_time=3),
+    'busy': Shape(errors=2),
+    'no-ranges': Shape(ranges=False)}
+
+
+class Pacer(object):
+
+    """Pace sends so they average no more than `rate` bytes/s."""
+
+    def __init__(self, rate):
+        """Pace at `rate` bytes/s."""
+        self.rate = float(rate)
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self, size):
+        """Wait until `size` more bytes may be sent."""
+        with self._lock:
+            now = time.time()
+            self._next = max(self._next, now) + size / self.rate
+            delay = self._next - now
+        time.sleep(delay)
+
+
+class ShapedMirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """Serve the server's root directory as shaped by its Shape."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        """Keep benchmark output quiet."""
+
+    def do_GET(self):
+        """Serve a listing or a file."""
+        self.serve(send_body=True)
+
+    def do_HEAD(self):
+        """Serve headers of a listing or a file."""
+        self.serve(send_body=False)
+
+    def serve(self, send_body):
+        """Serve the requested path, injecting the server's faults."""
+        shape = self.server.shape
+        path = os.path.normpath(os.path.join(
+            self.server.root, self.path.split('?')[0].lstrip('/')))
+        media = os.path.isfile(path) and path in self.server.media
+        self.server.record('requests', media)
+        time.sleep(shape.latency)
+
+        if os.path.isdir(path):
+            if not self.path.endswith('/'):
+                # Directories are redirected to their slashed path like Apache
+                self.send_response(301)
+                self.send_header('Location', self.path + '/')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_listing(path, send_body)
+            return
+
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        if media and self.server.take_fault('errors'):
+            self.send_response(shape.error_status)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        size = os.path.getsize(path)
+        last_modified = email.utils.formatdate(
+            os.path.getmtime(path), usegmt=True)
+        range_header = self.headers.get('Range') if shape.ranges else None
+        if self.headers.get('If-Range') not in (None, last_modified):
+            range_header = None  # Changed since, so send all of it
+        try:
+            byte_range = gensystem_serve.get_range(range_header, size)
+        except ValueError:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start, end = byte_range or (0, size)
+        if byte_range:
+            self.send_response(206)
+            self.send_header(
+                'Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size))
+        else:
+            self.send_response(200)
+        if shape.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        if send_body:
+            self.send_file(path, start, end, media)
+
+    def send_listing(self, path, send_body):
+        """Send an Apache style index of a directory."""
+        title = cgi.escape('Index of %s' % self.path)
+        # Directories are slashed, like Apache lists them
+        names = [
+            name + '/' if os.path.isdir(os.path.join(path, name)) else name
+            for name in sorted(os.listdir(path))]
+        links = ''.join(
+            '<tr><td><a href="%s">%s</a></td></tr>\n' % (
+                cgi.escape(name, quote=True), cgi.escape(name))
+            for name in names)
+        body = (
+            '<html><head><title>%s</title></head><body><h1>%s</h1>'
+            '<table>\n<tr><td><a href="../">Parent Directory</a></td></tr>\n'
+            '%s</table></body></html>\n' % (title, title, links))
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def send_file(self, path, start, end, media):
+        """Send part of a file, paced, stalled or reset as shaped."""
+        shape = self.server.shape
+        length = end - start
+        reset_at = stall_at = None
+        if media and self.server.take_fault('resets'):
+            reset_at = int(length * shape.reset_after)
+        if media and self.server.take_fault('stalls'):
+            stall_at = int(length * shape.stall_after)
+        pacer = Pacer(shape.bandwidth) if shape.bandwidth else None
+
+        sent = 0
+        with open(path, 'rb') as served:
+            served.seek(start)
+            while sent < length:
+                size = min(SEND_SIZE, length - sent)
+                if reset_at is not None and sent + size > reset_at:
+                    self.reset()
+                    return
+                if stall_at is not None and sent + size > stall_at:
+                    time.sleep(shape.stall_time)
+                    stall_at = None
+                if pacer is not None:
+                    pacer.wait(size)
+                if self.server.pacer is not None:
+                    self.server.pacer.wait(size)
+                self.wfile.write(served.read(size))
+                sent += size
+                if media:
+                    self.server.record('media_sent', size)
+
+    def reset(self):
+        """Abort the connection with a TCP reset."""
+        self.connection.setsockopt(
+            socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.close_connection = 1
+        self.wfile.close()
+        self.rfile.close()
+        self.connection.close()
+
+
+class ShapedMirrorServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+
+    """Fake mirror serving `root` as shaped by `shape`."""
+
+    daemon_threads = True
+
+    def __init__(self, root, shape=None, media=()):
+        """Listen on a free port of 127.0.0.1.
+
+        Args:
+            root (str): Directory laid out like a mirror.
+            shape (Optional[Shape]): How to degrade service.
+            media (Optional[list]): Paths of media files to inject
+                faults into.
+
+        """
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), ShapedMirrorHandler)
+        self.root = root
+        self.shape = shape or Shape()
+        self.media = set(os.path.normpath(path) for path in media)
+        self.url = 'http://127.0.0.1:%d/' % self.server_address[1]
+        self.pacer = (
+            Pacer(self.shape.total_bandwidth)
+            if self.shape.total_bandwidth else None)
+        self.stats = {
+            'requests': 0, 'media_requests': 0, 'media_sent': 0, 'resets': 0,
+            'stalls': 0, 'errors': 0}
+        self._lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        """Ignore clients hanging up early, as segmented downloads do."""
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(
+                self, request, client_address)
+
+    def record(self, stat, value):
+        """Count a request (`value`: whether for media) or media sent."""
+        with self._lock:
+            if stat == 'requests':
+                self.stats['requests'] += 1
+                self.stats['media_requests'] += int(value)
+            else:
+                self.stats[stat] += value
+
+    def take_fault(self, fault):
+        """Take one of the faults left to inject.
+
+        Args:
+            fault (str): One of resets, stalls or errors.
+
+        Returns:
+            bool: Whether the fault should be injected.
+
+        """
+        with self._lock:
+            if self.stats[fault] >= getattr(self.shape, fault):
+                return False
+            self.stats[fault] += 1
+            return True
+
+
+@contextlib.contextmanager
+def shaped_mirror(root, shape=None, media=()):
+    """Run a fake mirror in a background thread.
+
+    Args:
+        root (str): Directory laid out like a mirror.
+        shape (Optional[Shape]): How to degrade service.
+        media (Optional[list]): Paths of media files to inject faults into.
+
+    Yields:
+        ShapedMirrorServer: The running server (see its url and stats).
+
+    """
+    server = ShapedMirrorServer(root, shape, media)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def get_media_path(media_file, arch='amd64', stamp=STAMP):
+    """Get where a media file lives relative to a mirror's root.
+
+    Args:
+        media_file (str): Media file, e.g. stage3.
+        arch (Optional[str]): Architecture of the media file.
+        stamp (Optional[str]): Build date of the media file.
+
+    Returns:
+        str: Relative path of the media file.
+
+    """
+    folder, regex = getattr(
+        gensystem_media.SUPPORTED_ARCH[arch], media_file).split('::')
+    name = regex.replace('\\d{8}', stamp).rstrip('$')
+    return os.path.join(
+        gensystem_mirror.GENTOO_RELEASES_TEMPLATE % (arch, folder), name)
+
+
+def make_layout(root, media_file, size, arch='amd64', stamp=STAMP):
+    """Lay out a media file (with DIGESTS and CONTENTS) like a mirror.
+
+    The media file is `size` bytes of incompressible synthetic data.
+
+    Args:
+        root (str): Directory to lay the mirror out in.
+        media_file (str): Media file, e.g. stage3.
+        size (int): Size of the media file in bytes.
+        arch (Optional[str]): Architecture of the media file.
+        stamp (Optional[str]): Build date of the media file.
+
+    Returns:
+        str: Full path of the media file.
+
+    """
+    path = os.path.join(root, get_media_path(media_file, arch, stamp))
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    block = os.urandom(BLOCK_SIZE)
+    hasher = hashlib.sha512()
+    with open(path, 'wb') as media:
+        for offset in range(0, size, BLOCK_SIZE):
+            # Vary blocks so the file is no easier to move than real media
+            data = (struct.pack('>Q', offset) + block)[:min(
+                BLOCK_SIZE, size - offset)]
+            hasher.update(data)
+            media.write(data)
+
+    name = os.path.basename(path)
+    with open(path + '.DIGESTS', 'w') as digests:
+        digests.write('# SHA512 HASH\n%s  %s\n' % (hasher.hexdigest(), name))
+    with open(path + '.CONTENTS', 'w') as contents:
+        contents.write('dir ./\n')
+
+    return path
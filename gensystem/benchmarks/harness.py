@@ -0,0 +1,242 @@
+"""Measure downloads end to end against shaped local fake mirrors.
+
+Each run lays a mirror out in a temporary directory, serves it with a
+fake mirror of the chosen shape (see fake_mirror.SHAPES) and downloads
+and verifies a media file with the gensystem command's own
+download_media_file, recording wall time, throughput, retries and what
+the mirror saw. Nothing leaves the machine, so runs are reproducible
+offline.
+
+"""
+
+import argparse
+import contextlib
+import imp
+import json
+import os
+import sys
+import timeit
+
+import gensystem.benchmarks.fake_mirror as fake_mirror
+import gensystem.cache as gensystem_cache
+import gensystem.metrics as gensystem_metrics
+import gensystem.temp as gensystem_temp
+
+CLI_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.realpath(__file__)))), 'bin', 'gensystem')
+SIZE = 32
+RUNS = 1
+
+
+def load_cli(path=CLI_PATH):
+    """Load the gensystem command as a module.
+
+    Args:
+        path (Optional[str]): Path of the gensystem script.
+
+    Returns:
+        module: The loaded script.
+
+    Raises:
+        RuntimeError: When the script cannot be found (e.g. when not
+            running from a source checkout).
+
+    """
+    if not os.path.isfile(path):
+        raise RuntimeError("gensystem command not found at %s." % path)
+
+    return imp.load_source('gensystem_cli', path)
+
+
+@contextlib.contextmanager
+def working_directory(path):
+    """Run with `path` as the working directory."""
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+@contextlib.contextmanager
+def quiet():
+    """Send stdout to /dev/null."""
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+@contextlib.contextmanager
+def cache_directory(path):
+    """Keep gensystem's cache in `path`."""
+    previous = gensystem_cache.CACHE_DIR
+    gensystem_cache.CACHE_DIR = path
+    try:
+        yield
+    finally:
+        gensystem_cache.CACHE_DIR = previous
+
+
+def get_retries(recorder):
+    """Sum the retries counted during a run, over all labels.
+
+    Args:
+        recorder (gensystem.metrics.Recorder): Recorder of the run.
+
+    Returns:
+        int: Number of retries.
+
+    """
+    return sum(
+        value for (name, _), value in recorder.counters.items()
+        if name == 'retries')
+
+
+def run_download(shape, size=SIZE, media_file='stage3', cli=None):
+    """Download and verify a media file from a shaped fake mirror.
+
+    Runs start from an empty cache directory, so nothing learned about
+    mirrors in earlier runs (or by the user's own downloads) carries over.
+
+    Args:
+        shape (fake_mirror.Shape): How the fake mirror degrades service.
+        size (Optional[float]): Size of the media file in MB.
+        media_file (Optional[str]): Media file to download, e.g. stage3.
+        cli (Optional[module]): The gensystem command, see load_cli.
+
+    Returns:
+        dict: Whether the download succeeded, its wall time in seconds,
+        throughput in MB/s, retries counted by gensystem, any error raised
+        and the fake mirror's stats (requests, bytes sent and faults
+        injected).
+
+    """
+    cli = cli or load_cli()
+    size_bytes = int(size * fake_mirror.MB)
+    with gensystem_temp.temp_directory() as temp_dir:
+        mirror_root = os.path.join(temp_dir, 'mirror')
+        download_dir = os.path.join(temp_dir, 'download')
+        os.mkdir(download_dir)
+        media_path = fake_mirror.make_layout(
+            mirror_root, media_file, size_bytes)
+
+        recorder = gensystem_metrics.RECORDER = gensystem_metrics.Recorder()
+        with fake_mirror.shaped_mirror(
+                mirror_root, shape, [media_path]) as server:
+            with working_directory(download_dir), quiet(), cache_directory(
+                    os.path.join(temp_dir, 'cache')):
+                started = timeit.default_timer()
+                error = None
+                try:
+                    success = cli.download_media_file(
+                        media_file, server.url, progress_mode='none')
+                except Exception as error:
+                    success = False
+                seconds = timeit.default_timer() - started
+
+    return {
+        'success': bool(success),
+        'seconds': seconds,
+        'size': size,
+        'throughput': size / seconds if success else 0,
+        'retries': get_retries(recorder),
+        'error': str(error) if error is not None else None,
+        'mirror': dict(server.stats)}
+
+
+def run_shapes(names, size=SIZE, runs=RUNS, media_file='stage3'):
+    """Run downloads from mirrors of each named shape.
+
+    Args:
+        names (list): Names of shapes in fake_mirror.SHAPES.
+        size (Optional[float]): Size of the media file in MB.
+        runs (Optional[int]): Downloads per shape.
+        media_file (Optional[str]): Media file to download, e.g. stage3.
+
+    Returns:
+        dict: Lists of run results by shape name.
+
+    """
+    cli = load_cli()
+    return {
+        name: [
+            run_download(fake_mirror.SHAPES[name], size, media_file, cli)
+            for _ in range(runs)]
+        for name in names}
+
+
+def format_runs(results):
+    """Format run results as a table for humans.
+
+    Args:
+        results (dict): Results from run_shapes.
+
+    Returns:
+        str: One line per run.
+
+    """
+    lines = []
+    for name, runs in sorted(results.items()):
+        for run in runs:
+            lines.append(
+                '%-15s %-6s %8.2fs %8.2f MB/s  retries %d  requests %d  '
+                'resets %d  stalls %d  errors %d' % (
+                    name, 'ok' if run['success'] else 'FAILED',
+                    run['seconds'], run['throughput'], run['retries'],
+                    run['mirror']['media_requests'],
+                    run['mirror']['resets'], run['mirror']['stalls'],
+                    run['mirror']['errors']))
+
+    return '\n'.join(lines)
+
+
+def main():
+    """Run end-to-end downloads against shaped fake mirrors.
+
+    Returns:
+        int: An exit code; 0 (every download succeeded) | 1 (failure).
+
+    """
+    shapes = sorted(fake_mirror.SHAPES)
+    parser = argparse.ArgumentParser(
+        prog='python -m gensystem.benchmarks.harness',
+        description='Download from shaped local fake Gentoo mirrors')
+
+    parser.add_argument(
+        "--shape", help='mirror shape S (repeat for more): {%s}' % (
+            '|'.join(shapes)),
+        action='append', choices=shapes, metavar='<S>')
+
+    parser.add_argument(
+        "--size", help="size of the media file in MB (default: %d)" % SIZE,
+        type=float, metavar='<MB>', default=SIZE)
+
+    parser.add_argument(
+        "--runs", help="downloads per shape (default: %d)" % RUNS,
+        type=int, metavar='<N>', default=RUNS)
+
+    parser.add_argument(
+        "--report", help="write results as JSON to R", metavar='<R>')
+
+    args = parser.parse_args()
+
+    results = run_shapes(args.shape or shapes, args.size, args.runs)
+    print format_runs(results)
+
+    if args.report:
+        with open(args.report, 'w') as report:
+            json.dump(results, report, indent=4, sort_keys=True)
+
+    failed = any(
+        not run['success'] for runs in results.values() for run in runs)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+"""Measure benchmarks, store results and compare them to a baseline.
+
+Each benchmark runs in its own child process, so its peak memory (the
+child's maximum resident set size) is not hidden by earlier benchmarks.
+A benchmark is repeated until it has run for a minimum time, and the
+best run is kept as the one least disturbed by the rest of the machine.
+
+"""
+
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import time
+import timeit
+
+import gensystem.benchmarks.harness as benchmarks_harness
+import gensystem.benchmarks.suite as benchmarks_suite
+import gensystem.metrics as gensystem_metrics
+import gensystem.temp as gensystem_temp
+
+SIZE = 256
+MIN_TIME = 1.0
+MIN_RUNS = 3
+THRESHOLD = 10.0
+
+
+def measure(benchmark, size=SIZE, min_time=MIN_TIME, min_runs=MIN_RUNS):
+    """Measure a benchmark in this process.
+
+    Args:
+        benchmark (Benchmark): Benchmark to measure.
+        size (Optional[float]): Size in MB of synthetic files.
+        min_time (Optional[float]): Seconds to keep repeating runs for.
+        min_runs (Optional[int]): Fewest runs to make.
+
+    Returns:
+        dict: Best run in seconds, number of runs, throughput by unit
+        (e.g. MB/s) and peak memory in bytes.
+
+    """
+    with gensystem_temp.temp_directory() as work_dir:
+        # A fresh catalog in the user's cache would skip what is measured
+        with benchmarks_harness.cache_directory(
+                os.path.join(work_dir, 'cache')):
+            run, amounts = benchmark.setup(work_dir, size)
+            timings = []
+            started = timeit.default_timer()
+            while (len(timings) < min_runs or
+                   timeit.default_timer() - started < min_time):
+                # Keep recorded spans from piling up over thousands of runs
+                gensystem_metrics.RECORDER = gensystem_metrics.Recorder()
+                start = timeit.default_timer()
+                run()
+                timings.append(timeit.default_timer() - start)
+
+    best = min(timings)
+    return {
+        'seconds': best,
+        'runs': len(timings),
+        'throughput': {
+            '%s/s' % unit: amount / best if best else 0
+            for unit, amount in amounts.items()},
+        # Linux reports ru_maxrss in KiB
+        'peak_memory': resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+
+def _measure_in_child(connection, name, size, min_time, min_runs):
+    """Measure the benchmark called `name`, sending back its result."""
+    benchmark = get_benchmark(name)
+    try:
+        connection.send(measure(benchmark, size, min_time, min_runs))
+    except Exception as error:
+        connection.send({'error': str(error)})
+    finally:
+        connection.close()
+
+
+def get_benchmark(name):
+    """Get a benchmark by name.
+
+    Args:
+        name (str): Name of the benchmark.
+
+    Returns:
+        Benchmark: The benchmark.
+
+    Raises:
+        RuntimeError: When there is no such benchmark.
+
+    """
+    for benchmark in benchmarks_suite.BENCHMARKS:
+        if benchmark.name == name:
+            return benchmark
+
+    raise RuntimeError("No benchmark named %s." % name)
+
+
+def run_benchmarks(
+        names=None, size=SIZE, min_time=MIN_TIME, min_runs=MIN_RUNS):
+    """Measure benchmarks, each in a fresh child process.
+
+    Args:
+        names (Optional[list]): Names of benchmarks to run (default: all).
+        size (Optional[float]): Size in MB of synthetic files.
+        min_time (Optional[float]): Seconds to keep repeating runs for.
+        min_runs (Optional[int]): Fewest runs to make.
+
+    Returns:
+        dict: Results by benchmark name plus facts about the machine.
+
+    """
+    names = names or [
+        benchmark.name for benchmark in benchmarks_suite.BENCHMARKS]
+    results = {}
+    for name in names:
+        get_benchmark(name)
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        child = multiprocessing.Process(
+            target=_measure_in_child,
+            args=(sender, name, size, min_time, min_runs))
+        child.start()
+        sender.close()
+        try:
+            results[name] = receiver.recv()
+        except EOFError:
+            results[name] = {'error': 'Benchmark process died.'}
+        child.join()
+
+    return {
+        'created': time.time(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'size': size,
+        'benchmarks': results}
+
+
+def save_results(results, path):
+    """Store results (e.g. as a baseline) as JSON.
+
+    Args:
+        results (dict): Results from run_benchmarks.
+        path (str): Path of the results file.
+
+    """
+    with open(path, 'w') as results_file:
+        json.dump(results, results_file, indent=4, sort_keys=True)
+
+
+def load_results(path):
+    """Load results stored with save_results.
+
+    Args:
+        path (str): Path of the results file.
+
+    Returns:
+        dict: The stored results.
+
+    Raises:
+        RuntimeError: When the file is missing or not valid JSON.
+
+    """
+    try:
+        with open(path, 'r') as results_file:
+            return json.load(results_file)
+    except (IOError, ValueError):
+        raise RuntimeError("Results %s could NOT be loaded." % path)
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """Compare results with a baseline, finding regressions.
+
+    Throughput falling, or peak memory growing, by more than `threshold`
+    percent is a regression. Benchmarks missing from either side are
+    skipped.
+
+    Args:
+        results (dict): Results from run_benchmarks.
+        baseline (dict): Earlier results to compare with.
+        threshold (Optional[float]): Percent change tolerated.
+
+    Returns:
+        list: Comparisons as dicts with name, metric, baseline, result,
+        change (percent, positive is better) and regression keys.
+
+    """
+    comparisons = []
+    for name, result in sorted(results['benchmarks'].items()):
+        before = baseline['benchmarks'].get(name)
+        if before is None or 'error' in result or 'error' in before:
+            continue
+
+        metrics = [
+            (metric, before['throughput'][metric], value, 1)
+            for metric, value in sorted(result['throughput'].items())
+            if before['throughput'].get(metric)]
+        if before.get('peak_memory'):
+            metrics.append((
+                'peak_memory', before['peak_memory'],
+                result['peak_memory'], -1))
+
+        for metric, old, new, direction in metrics:
+            change = direction * (new - old) * 100.0 / old
+            comparisons.append({
+                'name': name, 'metric': metric, 'baseline': old,
+                'result': new, 'change': change,
+                'regression': change < -threshold})
+
+    return comparisons
+
+
+def format_results(results):
+    """Format results as a table for humans.
+
+    Args:
+        results (dict): Results from run_benchmarks.
+
+    Returns:
+        str: One line per benchmark.
+
+    """
+    lines = []
+    for name, result in sorted(results['benchmarks'].items()):
+        if 'error' in result:
+            lines.append('%-16s ERROR %s' % (name, result['error']))
+            continue
+        throughput = '  '.join(
+            '%.1f %s' % (value, unit)
+            for unit, value in sorted(result['throughput'].items()))
+        lines.append('%-16s %9.4fs  %-34s  peak %.1f MB' % (
+            name, result['seconds'], throughput,
+            result['peak_memory'] / benchmarks_suite.MB))
+
+    return '\n'.join(lines)
+
+
+def format_comparisons(comparisons):
+    """Format comparisons as a table for humans.
+
+    Args:
+        comparisons (list): Comparisons from compare.
+
+    Returns:
+        str: One line per compared metric, regressions marked.
+
+    """
+    return '\n'.join(
+        '%-16s %-14s %+7.1f%%%s' % (
+            comparison['name'], comparison['metric'], comparison['change'],
+            '  REGRESSION' if comparison['regression'] else '')
+        for comparison in comparisons)
@@ -0,0 +1,132 @@
+"""Benchmarks of parsing, hashing and choice handling.
+
+Pages are read from recorded fixtures (the gentoo.org mirrors page and a
+mirror's autobuild listing) instead of the network, and files to verify
+are synthetic sparse files, so multi-GB runs cost no disk space and time
+hashing rather than disk reads.
+
+"""
+
+from collections import namedtuple
+import contextlib
+import os
+
+import gensystem.media as gensystem_media
+import gensystem.mirror as gensystem_mirror
+import gensystem.utils as gensystem_utils
+
+FIXTURES_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), 'fixtures')
+FAKE_MIRROR = 'http://mirror.example.org/gentoo/'
+DIGESTS_FIXTURE = 'stage3-amd64-20160414.tar.bz2.DIGESTS'
+CHOICES = 1000
+LOOKUPS = 1000
+MB = 1024.0 * 1024
+
+# Setup takes (work_dir, size_mb) and returns (run, amounts), where
+# amounts is {unit: amount processed by one run}
+Benchmark = namedtuple('Benchmark', 'name description setup')
+
+
+def get_fixture(name):
+    """Read a recorded fixture.
+
+    Args:
+        name (str): File name of the fixture.
+
+    Returns:
+        str: Contents of the fixture.
+
+    """
+    with open(os.path.join(FIXTURES_DIR, name), 'r') as fixture:
+        return fixture.read()
+
+
+@contextlib.contextmanager
+def serving_webpage(contents):
+    """Answer every read_webpage (and read_hedged) call with `contents`."""
+    read_webpage = gensystem_utils.read_webpage
+    read_hedged = gensystem_utils.read_hedged
+    gensystem_utils.read_webpage = lambda url_path: contents
+    gensystem_utils.read_hedged = (
+        lambda url_path, kind, hedge_url=None: (url_path, contents))
+    try:
+        yield
+    finally:
+        gensystem_utils.read_webpage = read_webpage
+        gensystem_utils.read_hedged = read_hedged
+
+
+def setup_parse_mirrors(work_dir, size):
+    """Parse the gentoo.org mirrors page with get_mirrors_from_web."""
+    page = get_fixture('mirrors.html')
+
+    def run():
+        with serving_webpage(page):
+            gensystem_mirror.get_mirrors_from_web()
+
+    return run, {'MB': len(page) / MB, 'links': page.count('<a href=')}
+
+
+def setup_scan_listing(work_dir, size):
+    """Scan an autobuild listing for a stage3 with get_media_file_url."""
+    page = get_fixture('stage3-listing.html')
+
+    def run():
+        with serving_webpage(page):
+            gensystem_media.get_media_file_url(FAKE_MIRROR, 'amd64', 'stage3')
+
+    return run, {'MB': len(page) / MB, 'links': page.count('<a href=')}
+
+
+def setup_parse_digests(work_dir, size):
+    """Look up the last SHA512 of a DIGESTS file (the worst case)."""
+    digest_path = os.path.join(FIXTURES_DIR, DIGESTS_FIXTURE)
+    name = DIGESTS_FIXTURE.replace('.DIGESTS', '.CONTENTS')
+
+    def run():
+        # One lookup is too quick to time on its own
+        for _ in range(LOOKUPS):
+            gensystem_utils.get_sha512_digest(digest_path, name)
+
+    return run, {
+        'MB': LOOKUPS * os.path.getsize(digest_path) / MB, 'lookups': LOOKUPS}
+
+
+def setup_verify_download(work_dir, size):
+    """Verify a synthetic `size` MB download with verify_download."""
+    download_path = os.path.join(work_dir, 'stage3-amd64-20160414.tar.bz2')
+    with open(download_path, 'wb') as download:
+        download.truncate(int(size * MB))
+
+    digest_path = os.path.join(work_dir, DIGESTS_FIXTURE)
+    with open(digest_path, 'w') as digest:
+        digest.write(get_fixture(DIGESTS_FIXTURE))
+
+    def run():
+        gensystem_utils.verify_download(download_path, digest_path, force=True)
+
+    return run, {'MB': size}
+
+
+def setup_choices(work_dir, size):
+    """Build mirror choices, then look up the value of every choice."""
+    items = ['Mirror %04d (http)' % number for number in range(CHOICES)]
+
+    def run():
+        choices = gensystem_utils.get_choices(items)
+        for choice in range(1, len(items) + 1):
+            gensystem_utils.get_choice_value(choice, choices)
+
+    return run, {'choices': len(items)}
+
+
+BENCHMARKS = [
+    Benchmark('parse_mirrors', setup_parse_mirrors.__doc__,
+              setup_parse_mirrors),
+    Benchmark('scan_listing', setup_scan_listing.__doc__, setup_scan_listing),
+    Benchmark('parse_digests', setup_parse_digests.__doc__,
+              setup_parse_digests),
+    Benchmark('verify_download', setup_verify_download.__doc__,
+              setup_verify_download),
+    Benchmark('choices', setup_choices.__doc__, setup_choices)]
@@ -0,0 +1,524 @@
+"""Index .tar.bz2 tarballs so members can be extracted without the rest.
+
+bzip2 compresses in independent blocks of up to 900k, each starting with a
+48 bit magic number at any bit offset (blocks are not byte aligned). An
+index records where every block starts and ends in the compressed file
+(in bits) and where its data starts in the tar stream, plus where every
+tar member's record (headers and data) lies in the tar stream. It is kept
+next to the tarball as <tarball>.bzindex and rebuilt when the tarball
+changes.
+
+A block is decompressed on its own by wrapping its bits in a stream of
+its own: a stream header, the block, and an end of stream marker whose
+combined CRC, for a single block, is the block's CRC. bz2 then checks the
+block's CRC as usual. Blocks are found by searching for their magic, so a
+magic number occurring in compressed data by chance is told apart by the
+block around it failing to decompress.
+
+Extracting a few members then decompresses only the blocks holding their
+records, and extracting many can be split into runs of members, one per
+thread (bz2 decompresses without holding the GIL).
+
+"""
+
+import binascii
+import bisect
+import contextlib
+import copy
+import gzip
+import json
+import operator
+import os
+import tarfile
+import threading
+
+import gensystem.metrics as gensystem_metrics
+
+BLOCK_MAGIC = 0x314159265359
+END_MAGIC = 0x177245385090
+MAGIC_BITS = 48
+CRC_BITS = 32
+STREAM_HEADER = 'BZh9'
+INDEX_SUFFIX = '.bzindex'
+INDEX_VERSION = 1
+SCAN_CHUNK = 8 * 1024 * 1024
+RECORD_SIZE = tarfile.BLOCKSIZE
+
+
+class IndexingError(ValueError):
+
+    """A tarball cannot be indexed (e.g. it is not bzip2 compressed)."""
+
+
+def find_magics(data, magic):
+    """Find a 48 bit magic number at any bit offset in some data.
+
+    Args:
+        data (str): Data to search.
+        magic (int): Magic number, e.g. BLOCK_MAGIC.
+
+    Returns:
+        list: Bit offsets of the magic number in `data`, in order.
+
+    """
+    found = set()
+    for shift in range(8):
+        # The bytes the magic fills whole when it starts `shift` bits in
+        pattern = binascii.unhexlify('%014x' % (magic << (8 - shift)))
+        middle = pattern[1:6] if shift else pattern[:6]
+        position = data.find(middle)
+        while position != -1:
+            start = position - 1 if shift else position
+            if start >= 0 and read_bits(
+                    data[start:start + 7], shift,
+                    shift + MAGIC_BITS) == magic:
+                found.add(start * 8 + shift)
+            position = data.find(middle, position + 1)
+
+    return sorted(found)
+
+
+def read_bits(data, start, end):
+    """Read bits [start, end) of some data as a number (most significant
+    bit first).
+
+    Returns:
+        int: The bits, or -1 if `data` is too short to hold them.
+
+    """
+    first, last = start // 8, (end + 7) // 8
+    if last > len(data):
+        return -1
+    value = int(binascii.hexlify(data[first:last]) or '0', 16)
+    return (value >> (last * 8 - end)) & ((1 << (end - start)) - 1)
+
+
+def scan(path):
+    """Find where blocks and streams may start and end in a bzip2 file.
+
+    Args:
+        path (str): Path of the file.
+
+    Returns:
+        tuple: Bit offsets of block magic numbers, and of every magic
+        number (where blocks may end), both in order.
+
+    """
+    overlap = MAGIC_BITS // 8
+    starts, boundaries = set(), set()
+    with open(path, 'rb') as compressed:
+        offset, tail = 0, ''
+        for chunk in iter(lambda: compressed.read(SCAN_CHUNK), ''):
+            data = tail + chunk
+            base = (offset - len(tail)) * 8
+            for bit in find_magics(data, BLOCK_MAGIC):
+                starts.add(base + bit)
+                boundaries.add(base + bit)
+            for bit in find_magics(data, END_MAGIC):
+                boundaries.add(base + bit)
+            offset += len(chunk)
+            tail = data[-overlap:]
+
+    return sorted(starts), sorted(boundaries)
+
+
+def decode_block(compressed, start, end):
+    """Decompress one block of a bzip2 file.
+
+    Args:
+        compressed (file): The bzip2 file.
+        start (int): Bit offset of the block's magic number.
+        end (int): Bit offset just past the block.
+
+    Returns:
+        str: The block's data.
+
+    Raises:
+        IOError: When [start, end) is not exactly one intact block.
+
+    """
+    first = start // 8
+    compressed.seek(first)
+    data = compressed.read((end + 7) // 8 - first)
+    length = end - start
+    if length <= MAGIC_BITS + CRC_BITS:
+        raise IOError("A bzip2 block cannot be %d bits long." % length)
+    block = read_bits(data, start - first * 8, end - first * 8)
+    if block < 0:
+        raise IOError("The bzip2 file was cut short.")
+
+    crc = (block >> (length - MAGIC_BITS - CRC_BITS)) & 0xffffffff
+    stream = (((block << MAGIC_BITS) | END_MAGIC) << CRC_BITS) | crc
+    bits = length + MAGIC_BITS + CRC_BITS
+    padding = -bits % 8
+    stream_bytes = binascii.unhexlify(
+        '%0*x' % ((bits + padding) // 4, stream << padding))
+
+    import bz2  # Imported late, as bz2 can be missing from a Python build
+    try:
+        return bz2.decompress(STREAM_HEADER + stream_bytes)
+    except EOFError:
+        raise IOError("The bzip2 block at bit %d is NOT intact." % start)
+
+
+def iter_blocks(path, blocks=None):
+    """Decompress a bzip2 file block by block.
+
+    Args:
+        path (str): Path of the file.
+        blocks (Optional[list]): List to append (start, end, offset) of
+            every block to, offset being where its data starts.
+
+    Yields:
+        str: Data of each block in order.
+
+    Raises:
+        IndexingError: When the file is not bzip2 compressed, or damaged.
+
+    """
+    starts, boundaries = scan(path)
+    if not starts:
+        raise IndexingError("%s is NOT bzip2 compressed." % path)
+
+    offset = 0
+    index = 0
+    with open(path, 'rb') as compressed:
+        while index < len(starts):
+            start = starts[index]
+            # A magic number found by chance inside the block is skipped
+            for end in boundaries[bisect.bisect_right(boundaries, start):]:
+                try:
+                    data = decode_block(compressed, start, end)
+                    break
+                except IOError:
+                    continue
+            else:
+                raise IndexingError(
+                    "%s is damaged at bit %d." % (path, start))
+
+            if blocks is not None:
+                blocks.append((start, end, offset))
+            offset += len(data)
+            yield data
+            index = bisect.bisect_left(starts, end)
+
+
+class ChunkReader(object):
+
+    """File-like object reading from an iterable of str chunks."""
+
+    def __init__(self, chunks):
+        """Read from `chunks`, an iterable of str."""
+        self._chunks = iter(chunks)
+        self._chunk = ''
+        self._offset = 0
+
+    def read(self, size=-1):
+        """Read up to `size` bytes (all remaining if negative)."""
+        pieces = []
+        while size != 0:
+            if self._offset >= len(self._chunk):
+                self._chunk = next(self._chunks, None)
+                self._offset = 0
+                if self._chunk is None:
+                    self._chunk = ''
+                    break
+                continue
+
+            end = len(self._chunk)
+            if size > 0:
+                end = min(end, self._offset + size)
+                size -= end - self._offset
+            pieces.append(self._chunk[self._offset:end])
+            self._offset = end
+
+        return ''.join(pieces)
+
+
+def get_record_end(tarinfo):
+    """Get where a member's record (header and padded data) ends."""
+    return tarinfo.offset_data + -(-tarinfo.size // RECORD_SIZE) * RECORD_SIZE
+
+
+def build_index(path):
+    """Index a .tar.bz2 tarball.
+
+    Args:
+        path (str): Path of the tarball.
+
+    Returns:
+        dict: The index: the tarball's size and mtime, its blocks as
+        [start bit, end bit, tar offset] and its members as [name, record
+        offset, record end, hard link target or None], in order.
+
+    Raises:
+        IndexingError: When the tarball is not a .tar.bz2, or damaged.
+
+    """
+    blocks = []
+    members = []
+    stat = os.stat(path)
+    with gensystem_metrics.span('build_bzindex', file=os.path.basename(path)):
+        try:
+            with contextlib.closing(tarfile.open(
+                    fileobj=ChunkReader(iter_blocks(path, blocks)),
+                    mode='r|')) as tar:
+                for tarinfo in tar:
+                    members.append([
+                        tarinfo.name, tarinfo.offset, get_record_end(tarinfo),
+                        tarinfo.linkname if tarinfo.islnk() else None])
+        except tarfile.TarError as error:
+            raise IndexingError("%s is NOT a tarball (%s)." % (path, error))
+
+    return {
+        'version': INDEX_VERSION, 'size': stat.st_size,
+        'mtime': stat.st_mtime, 'blocks': [list(block) for block in blocks],
+        'members': members}
+
+
+def save_index(path, index):
+    """Save the index of a tarball next to it (atomically)."""
+    temp_path = '%s%s.%d.tmp' % (path, INDEX_SUFFIX, os.getpid())
+    try:
+        with contextlib.closing(gzip.open(temp_path, 'wb')) as saved:
+            json.dump(index, saved)
+        os.rename(temp_path, path + INDEX_SUFFIX)
+    except EnvironmentError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def load_index(path):
+    """Load the index of a tarball, unless it is missing or out of date.
+
+    Returns:
+        dict: The index (see build_index), or None.
+
+    """
+    try:
+        stat = os.stat(path)
+        with contextlib.closing(gzip.open(path + INDEX_SUFFIX, 'rb')) as saved:
+            index = json.load(saved)
+    except (EnvironmentError, ValueError):
+        return None
+
+    if not isinstance(index, dict) or (
+            index.get('version') != INDEX_VERSION or
+            index.get('size') != stat.st_size or
+            index.get('mtime') != stat.st_mtime):
+        return None
+    return index
+
+
+def get_index(path):
+    """Get the index of a tarball, building and saving it if need be.
+
+    Raises:
+        IndexingError: When the tarball cannot be indexed.
+
+    """
+    index = load_index(path)
+    if index is None:
+        index = build_index(path)
+        try:
+            save_index(path, index)
+        except EnvironmentError:
+            pass  # e.g. a read-only directory; it is rebuilt next time
+    return index
+
+
+def get_member_path(name):
+    """Get a member's path relative to the root, e.g. etc/portage."""
+    return os.path.normpath(name).lstrip('/')
+
+
+def select_members(index, paths):
+    """Select the members at, or under, some paths.
+
+    Hard links in the selection bring the members they link to along.
+
+    Args:
+        index (dict): Index of the tarball (see build_index).
+        paths (list): Paths, e.g. /etc/portage/make.conf or etc/portage.
+
+    Returns:
+        tuple: Selected members (as in the index) in tarball order, and
+        the paths matching none.
+
+    """
+    wanted = [get_member_path(path) for path in paths]
+    by_path = dict(
+        (get_member_path(member[0]), member) for member in index['members'])
+    selected = {}
+    missing = []
+    for path in wanted:
+        matches = [
+            member for member_path, member in by_path.items()
+            if path in ('', '.') or member_path == path or
+            member_path.startswith(path + '/')]
+        if not matches:
+            missing.append(path)
+        for member in matches:
+            selected[member[1]] = member
+            if member[3] is not None:
+                target = by_path.get(get_member_path(member[3]))
+                if target is not None:
+                    selected[target[1]] = target
+
+    return [selected[offset] for offset in sorted(selected)], missing
+
+
+def get_block(index, offset):
+    """Get the index of the block holding a tar stream offset."""
+    return bisect.bisect_right(
+        [block[2] for block in index['blocks']], offset) - 1
+
+
+def split_members(members, parts):
+    """Split members into runs of about equal size.
+
+    Runs are decompressed apart, so each costs at most one block decoded
+    twice (where it meets the next).
+
+    Args:
+        members (list): Members (as in the index) in tarball order.
+        parts (int): Most runs wanted.
+
+    Returns:
+        list: Lists of members, in tarball order.
+
+    """
+    total = sum(member[2] - member[1] for member in members)
+    share = max(1, -(-total // max(1, parts)))
+    units = []
+    size = 0
+    for member in members:
+        if not units or (size >= share and len(units) < parts):
+            units.append([])
+            size = 0
+        units[-1].append(member)
+        size += member[2] - member[1]
+
+    return units
+
+
+class MemberReader(object):
+
+    """File-like tar stream of just some members of an indexed tarball.
+
+    Only the blocks holding the members' records are decompressed, each
+    once. The stream ends with the two zero records ending a tarball.
+
+    """
+
+    def __init__(self, path, index, members):
+        """Read the records of `members` from the tarball at `path`."""
+        self._path = path
+        self._index = index
+        self._reader = ChunkReader(self._chunks(members))
+
+    def read(self, size=-1):
+        """Read up to `size` bytes (all remaining if negative)."""
+        return self._reader.read(size)
+
+    def _chunks(self, members):
+        """Yield the members' records, then the end of the tarball."""
+        blocks = self._index['blocks']
+        cached = (None, '')
+        with open(self._path, 'rb') as compressed:
+            for _, start, end, _ in members:
+                number = get_block(self._index, start)
+                while start < end:
+                    if cached[0] != number:
+                        block = blocks[number]
+                        cached = (number, decode_block(
+                            compressed, block[0], block[1]))
+                        gensystem_metrics.count(
+                            'bzindex_blocks_decoded', len(cached[1]))
+                    block_offset = blocks[number][2]
+                    data = cached[1][start - block_offset:end - block_offset]
+                    if not data:
+                        raise IOError("%s is shorter than its index." % (
+                            self._path))
+                    yield data
+                    start += len(data)
+                    number += 1
+
+        yield '\0' * (2 * RECORD_SIZE)
+
+
+def _extract_unit(path, index, members, target, directories, errors):
+    """Extract some members, deferring directories' attributes."""
+    try:
+        with contextlib.closing(tarfile.open(
+                fileobj=MemberReader(path, index, members), mode='r|')) as tar:
+            for tarinfo in tar:
+                if tarinfo.isdir():
+                    # Extracted with a safe mode, as in TarFile.extractall
+                    directories.append(tarinfo)
+                    tarinfo = copy.copy(tarinfo)
+                    tarinfo.mode = 0700
+                tar.extract(tarinfo, target)
+    except (tarfile.TarError, EnvironmentError) as error:
+        errors.append(str(error))
+
+
+def extract(path, target, paths=None, threads=1):
+    """Extract members of a .tar.bz2 tarball using its index.
+
+    Args:
+        path (str): Path of the tarball.
+        target (str): Directory to extract into.
+        paths (Optional[list]): Paths to extract (with what is under
+            them); None for all.
+        threads (Optional[int]): Units to extract at once.
+
+    Returns:
+        tuple: Number of members extracted, the paths matching none and
+        error messages.
+
+    Raises:
+        IndexingError: When the tarball cannot be indexed.
+
+    """
+    index = get_index(path)
+    if paths:
+        members, missing = select_members(index, paths)
+    else:
+        members, missing = index['members'], []
+    # Hard links go last, once what they link to is extracted
+    links = [member for member in members if member[3] is not None]
+    files = [member for member in members if member[3] is None]
+
+    directories = []
+    errors = []
+    with gensystem_metrics.span(
+            'bzindex_extract', members=len(members), threads=threads):
+        workers = [
+            threading.Thread(target=_extract_unit, args=(
+                path, index, unit, target, directories, errors))
+            for unit in split_members(files, threads)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(1)
+        if links:
+            _extract_unit(path, index, links, target, directories, errors)
+
+        # Any TarFile sets attributes; one reading an empty tarball will do
+        tar = tarfile.open(
+            fileobj=ChunkReader(['\0' * (2 * RECORD_SIZE)]), mode='r|')
+        for tarinfo in sorted(
+                directories, key=operator.attrgetter('name'), reverse=True):
+            directory = os.path.join(target, tarinfo.name)
+            try:
+                tar.chown(tarinfo, directory)
+                tar.utime(tarinfo, directory)
+                tar.chmod(tarinfo, directory)
+            except tarfile.ExtractError as error:
+                errors.append(str(error))
+
+    return len(members), missing, errors
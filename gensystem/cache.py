@@ -0,0 +1,90 @@
+"""Keep small bits of state between runs in the user's cache directory."""
+
+import json
+import os
+
+CACHE_DIR = os.environ.get(
+    'GENSYSTEM_CACHE_DIR',
+    os.path.join(
+        os.environ.get(
+            'XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+        'gensystem'))
+
+
+def get_cache_path(name):
+    """Get the path of a file in the cache directory.
+
+    Args:
+        name (str): File name.
+
+    Returns:
+        str: Path of `name` in CACHE_DIR.
+
+    """
+    return os.path.join(CACHE_DIR, name)
+
+
+def is_writable():
+    """Check whether the cache directory can be written (or created).
+
+    Returns:
+        bool: Whether files can be saved in CACHE_DIR.
+
+    """
+    directory = os.path.abspath(CACHE_DIR)
+    while not os.path.exists(directory):
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return False
+        directory = parent
+
+    return os.path.isdir(directory) and os.access(
+        directory, os.W_OK | os.X_OK)
+
+
+def load_json(name, default=None):
+    """Load a JSON file from the cache directory.
+
+    A missing or damaged file is not an error; the cache is only a hint.
+
+    Args:
+        name (str): File name.
+        default (Optional[object]): Value if the file cannot be loaded.
+
+    Returns:
+        object: Contents of the file or `default`.
+
+    """
+    try:
+        with open(get_cache_path(name), 'r') as cached:
+            return json.load(cached)
+    except (IOError, ValueError):
+        return default
+
+
+def save_json(name, data):
+    """Save data as a JSON file in the cache directory.
+
+    The file is replaced atomically, so concurrent gensystem processes
+    never read half of it. Failing to save is not an error.
+
+    Args:
+        name (str): File name.
+        data (object): JSON serializable data.
+
+    Returns:
+        bool: Whether the data was saved.
+
+    """
+    path = get_cache_path(name)
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        with open(temp_path, 'w') as cached:
+            json.dump(data, cached, indent=4, sort_keys=True)
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        return False
+
+    return True
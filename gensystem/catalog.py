@@ -0,0 +1,422 @@
+"""Keep a local catalog of the media every architecture has autobuilt.
+
+`gensystem catalog update` crawls releases/*/autobuilds/ on one mirror
+with a few concurrent requests, recording for every architecture and
+variant (e.g. stage3-amd64-hardened) the newest build, its path, size and
+DIGESTS. Media URLs (and the choices the command line offers) are then
+looked up in the catalog rather than scraped from listings on each run.
+
+Recrawls are incremental. Every listing is requested with the validators
+(ETag, Last-Modified) it was last sent with, and a build folder whose row
+(date and size) in its parent listing has not changed is not requested at
+all, so a recrawl mostly fetches the folders that did change.
+
+"""
+
+import contextlib
+import Queue
+import re
+import threading
+import time
+import urllib2
+import urlparse
+
+from bs4 import BeautifulSoup
+
+import gensystem.cache as gensystem_cache
+import gensystem.metrics as gensystem_metrics
+import gensystem.retry as gensystem_retry
+import gensystem.segments as gensystem_segments
+import gensystem.transfer as gensystem_transfer
+
+CATALOG_FILE = 'media-catalog.json'
+MAX_AGE = 24 * 60 * 60
+THREADS = 8
+TIMEOUT = 30
+RELEASES = 'releases/'
+AUTOBUILDS_TEMPLATE = 'releases/%s/autobuilds/'
+DIRECTORY_REGEX = re.compile(r'^[\w.+-]+/$')
+BUILD_FOLDER_REGEX = re.compile(r'^current-[\w.+-]+/$')
+MEDIA_REGEX = re.compile(
+    r'^(?P<variant>[\w.+-]+?)-(?P<stamp>\d{8})(T\d{6}Z)?'
+    r'\.(tar\.(bz2|xz|gz)|iso)$')
+DIGESTS_SUFFIX = '.DIGESTS'
+# Media files named by gensystem before the catalog, by their variant
+MEDIA_VARIANTS = {
+    'stage3': 'stage3-%s',
+    'hardened': 'stage3-%s-hardened',
+    'nomultilib': 'stage3-%s-nomultilib',
+    'minimal': 'install-%s-minimal'}
+
+
+def get_variant(arch, media_file):
+    """Get the catalog variant of a media file.
+
+    Args:
+        arch (str): Name of the architecture, e.g. amd64.
+        media_file (str): Media file, e.g. stage3 or stage3-amd64-systemd.
+
+    Returns:
+        str: Variant, e.g. stage3-amd64.
+
+    """
+    template = MEDIA_VARIANTS.get(media_file)
+    return template % arch if template else media_file
+
+
+def get_links(listing):
+    """Get the links of a directory listing and the rows they are on.
+
+    Args:
+        listing (str): Apache (or similar) style directory listing.
+
+    Returns:
+        dict: Row text (e.g. date and size, '' when the listing shows
+        none) by href.
+
+    """
+    links = {}
+    for link in BeautifulSoup(listing, 'html.parser').find_all(href=True):
+        href = link['href']
+        if href.startswith(('?', '/', '../')) or '://' in href:
+            continue
+        row = link.find_parent('tr')
+        if row is not None:
+            text = row.get_text(' ')
+        else:
+            # <pre> listings, where the row follows the link up to the newline
+            text = unicode(link.next_sibling or '').split('\n')[0]
+        links[href] = ' '.join(text.replace(link.get_text(), '', 1).split())
+    return links
+
+
+def read_listing(url, record=None):
+    """Read a directory listing, unless it is unchanged since last time.
+
+    Args:
+        url (str): URL of the directory (with its trailing slash).
+        record (Optional[dict]): What was recorded for it last time.
+
+    Returns:
+        tuple: Listing (None if unchanged) and its validators.
+
+    Raises:
+        IOError: When the listing cannot be read (urllib2.HTTPError on
+            bad status).
+
+    """
+    headers = {}
+    if record and record.get('etag'):
+        headers['If-None-Match'] = record['etag']
+    if record and record.get('last_modified'):
+        headers['If-Modified-Since'] = record['last_modified']
+
+    def read(url):
+        response = gensystem_transfer.open_url(url, headers, TIMEOUT)
+        with contextlib.closing(response):
+            validators = {
+                'etag': response.getheader('ETag'),
+                'last_modified': response.getheader('Last-Modified')}
+            if response.status == 304:
+                return None, validators
+            return response.read(), validators
+
+    gensystem_metrics.count('catalog_requests')
+    return gensystem_retry.call(read, url)
+
+
+def get_size(url):
+    """Get the size of a file with a one byte Range request.
+
+    Returns:
+        int: Size in bytes, or None if the mirror did not say.
+
+    """
+    def probe(url):
+        response = gensystem_transfer.open_url(
+            url, {'Range': 'bytes=0-0'}, TIMEOUT)
+        with contextlib.closing(response):
+            content_range = gensystem_segments.get_content_range(response)
+            return content_range[2] if content_range else response.length
+
+    gensystem_metrics.count('catalog_requests')
+    return gensystem_retry.call(probe, url)
+
+
+def map_concurrently(function, items, threads=THREADS):
+    """Call a function with each item, a few at a time.
+
+    Args:
+        function (fn): Function taking one item.
+        items (list): Items to call `function` with.
+        threads (Optional[int]): Most calls at once.
+
+    Returns:
+        list: What each call returned, or the exception it raised, in the
+        order of `items`.
+
+    """
+    work = Queue.Queue()
+    for index, item in enumerate(items):
+        work.put((index, item))
+    results = [None] * len(items)
+
+    def run():
+        while True:
+            try:
+                index, item = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = function(item)
+            except Exception as error:
+                results[index] = error
+
+    workers = [
+        threading.Thread(target=run) for _ in range(min(threads, len(items)))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        while worker.is_alive():
+            worker.join(1)
+
+    return results
+
+
+class Crawl(object):
+
+    """One (incremental) crawl of a mirror's autobuilds."""
+
+    def __init__(self, mirror, previous=None, threads=THREADS):
+        """Prepare to crawl `mirror`.
+
+        Args:
+            mirror (str): Gentoo (base) mirror.
+            previous (Optional[dict]): Catalog of the last crawl of the
+                same mirror, whose unchanged directories are reused.
+            threads (Optional[int]): Most requests at once.
+
+        """
+        self.mirror = mirror.rstrip('/') + '/'
+        self.threads = threads
+        self.previous = {}
+        if previous and previous.get('mirror') == self.mirror:
+            self.previous = previous.get('directories', {})
+        self.directories = {}
+        self.unchanged = 0
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def run(self):
+        """Crawl the mirror.
+
+        Returns:
+            dict: The catalog (see build_catalog).
+
+        Raises:
+            IOError: When the releases listing cannot be read.
+
+        """
+        with gensystem_metrics.span(
+                'catalog_update',
+                mirror=gensystem_metrics.get_mirror(self.mirror)) as span:
+            arches = [
+                href.rstrip('/') for href in self._list(RELEASES)
+                if DIRECTORY_REGEX.match(href)]
+            folders = []
+            for arch, result in zip(arches, map_concurrently(
+                    self._list_autobuilds, arches, self.threads)):
+                if isinstance(result, Exception):
+                    self._record_error(AUTOBUILDS_TEMPLATE % arch, result)
+                else:
+                    folders.extend(result)
+
+            for (path, _), result in zip(folders, map_concurrently(
+                    self._crawl_folder, folders, self.threads)):
+                if isinstance(result, Exception):
+                    self._record_error(path, result)
+
+            span.set(unchanged=self.unchanged, errors=len(self.errors))
+
+        return self.build_catalog()
+
+    def _record_error(self, path, error):
+        """Note a directory that could not be crawled."""
+        if not (isinstance(error, urllib2.HTTPError) and error.code == 404):
+            self.errors[path] = str(error) or error.__class__.__name__
+
+    def _list(self, path, signature=None):
+        """Get the links of a directory, reusing its last crawl if unchanged.
+
+        Args:
+            path (str): Path of the directory relative to the mirror.
+            signature (Optional[str]): Its row in the parent listing.
+
+        Returns:
+            dict: Row text by href (see get_links).
+
+        """
+        record = self.previous.get(path)
+        if record and signature and record.get('signature') == signature:
+            self._record(path, record, True)
+            return record['links']
+
+        listing, validators = read_listing(self.mirror + path, record)
+        if listing is None:
+            # Not modified, though the validators may be new
+            for name, value in validators.items():
+                validators[name] = value or record.get(name)
+            links = record['links']
+        else:
+            links = get_links(listing)
+
+        self._record(
+            path, dict(validators, signature=signature, links=links),
+            listing is None)
+        return links
+
+    def _record(self, path, record, unchanged):
+        """Record a directory crawled."""
+        with self._lock:
+            self.directories[path] = record
+            self.unchanged += unchanged
+
+    def _list_autobuilds(self, arch):
+        """Get the build folders of an architecture and their rows."""
+        path = AUTOBUILDS_TEMPLATE % arch
+        return [
+            (path + href, signature)
+            for href, signature in self._list(path).items()
+            if BUILD_FOLDER_REGEX.match(href)]
+
+    def _crawl_folder(self, folder):
+        """Catalog the newest build of each variant in a build folder."""
+        path, signature = folder
+        links = self._list(path, signature)
+        record = self.directories[path]
+        known = dict(
+            (media['path'], media['size'])
+            for media in self.previous.get(path, {}).get('media', {}).values())
+
+        newest = {}
+        for href in links:
+            match = MEDIA_REGEX.match(href)
+            if match and href > newest.get(match.group('variant'), ''):
+                newest[match.group('variant')] = href
+
+        media = {}
+        for variant, href in newest.items():
+            media_path = path + href
+            size = known.get(media_path)
+            if size is None:
+                size = get_size(self.mirror + media_path)
+            media[variant] = {
+                'stamp': MEDIA_REGEX.match(href).group('stamp'),
+                'path': media_path,
+                'size': size,
+                'digests': media_path + DIGESTS_SUFFIX if (
+                    href + DIGESTS_SUFFIX in links) else None}
+        record['media'] = media
+
+    def build_catalog(self):
+        """Build the catalog from the directories crawled.
+
+        Returns:
+            dict: The mirror, when it was crawled, media by variant by
+            architecture, the directories crawled (for the next crawl) and
+            any errors by directory.
+
+        """
+        catalog = {}
+        for path, record in self.directories.items():
+            for variant, media in record.get('media', {}).items():
+                arch = path.split('/')[1]
+                known = catalog.setdefault(arch, {}).get(variant)
+                if known is None or media['stamp'] > known['stamp']:
+                    catalog[arch][variant] = media
+
+        return {
+            'mirror': self.mirror, 'updated': time.time(),
+            'media': catalog, 'directories': self.directories,
+            'errors': self.errors}
+
+
+def update(mirror, threads=THREADS):
+    """Crawl a mirror and keep the catalog in the cache directory.
+
+    Args:
+        mirror (str): Gentoo (base) mirror.
+        threads (Optional[int]): Most requests at once.
+
+    Returns:
+        tuple: The catalog, directories unchanged since the last crawl and
+        whether the catalog was saved.
+
+    Raises:
+        IOError: When the mirror's releases cannot be listed.
+
+    """
+    crawl = Crawl(
+        mirror, gensystem_cache.load_json(CATALOG_FILE, {}), threads)
+    catalog = crawl.run()
+    return (
+        catalog, crawl.unchanged,
+        gensystem_cache.save_json(CATALOG_FILE, catalog))
+
+
+def load(max_age=MAX_AGE):
+    """Load the catalog, unless it is too old to trust.
+
+    Builds are replaced in their folders, so an old catalog points at
+    files that are gone.
+
+    Args:
+        max_age (Optional[float]): Most seconds since the crawl.
+
+    Returns:
+        dict: Catalog (empty if missing or too old).
+
+    """
+    catalog = gensystem_cache.load_json(CATALOG_FILE, {})
+    if not isinstance(catalog, dict) or (
+            time.time() - catalog.get('updated', 0) > max_age):
+        return {}
+    return catalog
+
+
+def get_media(arch, media_file, catalog=None):
+    """Look a media file up in the catalog.
+
+    Args:
+        arch (str): Name of the architecture, e.g. amd64.
+        media_file (str): Media file, e.g. stage3 or stage3-amd64-systemd.
+        catalog (Optional[dict]): Catalog (default: load()).
+
+    Returns:
+        dict: Stamp, path (relative to a base mirror), size and DIGESTS
+        path of the newest build, or None if it is not catalogued.
+
+    """
+    catalog = load() if catalog is None else catalog
+    return catalog.get('media', {}).get(arch, {}).get(
+        get_variant(arch, media_file))
+
+
+def get_arches(catalog=None):
+    """Get the architectures catalogued."""
+    catalog = load() if catalog is None else catalog
+    return sorted(catalog.get('media', {}))
+
+
+def get_variants(catalog=None):
+    """Get the variants catalogued, of every architecture."""
+    catalog = load() if catalog is None else catalog
+    return sorted(set(
+        variant for variants in catalog.get('media', {}).values()
+        for variant in variants))
+
+
+def get_media_url(mirror, media):
+    """Get the URL of catalogued media on a mirror."""
+    return urlparse.urljoin(mirror.rstrip('/') + '/', media['path'])
@@ -0,0 +1,350 @@
+"""Resolve mirror hosts ahead of time and race IPv6 and IPv4 connections.
+
+Host names are resolved once per process, and prefetch resolves many of
+them concurrently at the start of a run, so no connection waits on DNS
+and no host is looked up twice.
+
+create_connection races a host's addresses in the manner of RFC 8305
+("Happy Eyeballs"): addresses are interleaved by family, the family that
+worked last time first, and while earlier attempts are still pending a new
+one starts every CONNECTION_ATTEMPT_DELAY seconds (at once if one fails).
+The first to connect wins and the others are closed, so a broken IPv6
+route costs a quarter of a second rather than a connect timeout. Which
+family won each host is kept in the cache directory for later runs.
+
+"""
+
+import errno
+import os
+import Queue
+import select
+import socket
+import threading
+import time
+import urlparse
+
+import gensystem.cache as gensystem_cache
+import gensystem.metrics as gensystem_metrics
+
+CONNECTION_ATTEMPT_DELAY = 0.25
+PREFETCH_THREADS = 16
+WAIT = 1.0
+REACHABILITY_FILE = 'mirror-reachability.json'
+FAMILIES = {socket.AF_INET: 'ipv4', socket.AF_INET6: 'ipv6'}
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class Resolution(object):
+
+    """Addresses of a host, once resolved."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.addresses = None
+        self.error = None
+
+
+_resolutions = {}
+_resolutions_lock = threading.Lock()
+
+
+def resolve(host, port):
+    """Resolve a host's stream addresses, once per process.
+
+    Concurrent lookups of the same host wait for the first. Failed lookups
+    are not remembered.
+
+    Args:
+        host (str): Host name or address.
+        port (int): Port to connect to.
+
+    Returns:
+        list: (family, sockaddr) tuples in the resolver's order.
+
+    Raises:
+        socket.error: When the host cannot be resolved.
+
+    """
+    key = (host, port)
+    with _resolutions_lock:
+        resolution = _resolutions.get(key)
+        owner = resolution is None
+        if owner:
+            resolution = _resolutions[key] = Resolution()
+
+    if owner:
+        try:
+            addresses = []
+            for family, _, _, _, sockaddr in socket.getaddrinfo(
+                    host, port, 0, socket.SOCK_STREAM):
+                if (family, sockaddr) not in addresses:
+                    addresses.append((family, sockaddr))
+            resolution.addresses = addresses
+        except socket.error as error:
+            resolution.error = error
+            with _resolutions_lock:
+                del _resolutions[key]
+        finally:
+            resolution.done.set()
+    else:
+        while not resolution.done.wait(WAIT):
+            pass
+
+    if resolution.error is not None:
+        raise resolution.error
+    return list(resolution.addresses)
+
+
+def forget_resolutions():
+    """Forget every address resolved so far."""
+    with _resolutions_lock:
+        _resolutions.clear()
+
+
+def get_address(url):
+    """Get the host and port a URL connects to.
+
+    Args:
+        url (str): HTTP(S) URL.
+
+    Returns:
+        tuple: Host and port, or None for other URLs.
+
+    """
+    parsed = urlparse.urlsplit(url)
+    if parsed.scheme not in DEFAULT_PORTS or not parsed.hostname:
+        return None
+
+    return parsed.hostname, parsed.port or DEFAULT_PORTS[parsed.scheme]
+
+
+def prefetch(urls, threads=PREFETCH_THREADS):
+    """Resolve the hosts of some URLs concurrently, in the background.
+
+    Args:
+        urls (list): URLs whose hosts will be connected to.
+        threads (Optional[int]): Most lookups at once.
+
+    Returns:
+        list: The (daemon) threads resolving, to join if need be.
+
+    """
+    addresses = Queue.Queue()
+    for address in set(filter(None, [get_address(url) for url in urls])):
+        addresses.put(address)
+
+    def work():
+        # A bare except, as no names can be looked up once the interpreter
+        # exits under a lookup (not even Exception)
+        try:
+            while True:
+                host, port = addresses.get_nowait()
+                try:
+                    resolve(host, port)
+                except socket.error:
+                    pass  # Reported when (if) the host is connected to
+        except:  # noqa: E722 (Queue.Empty, or exiting)
+            return
+
+    workers = []
+    for _ in range(min(threads, addresses.qsize())):
+        worker = threading.Thread(target=work)
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    return workers
+
+
+class Reachability(object):
+
+    """Which address family last worked for each host."""
+
+    def __init__(self, hosts=None):
+        """Start from `hosts`, a dict of {family name: connected} by host."""
+        self.hosts = hosts or {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls):
+        """Load what is kept in the cache directory."""
+        hosts = gensystem_cache.load_json(REACHABILITY_FILE, {})
+        return cls(hosts if isinstance(hosts, dict) else {})
+
+    def save(self):
+        """Keep what is known in the cache directory."""
+        with self._lock:
+            hosts = dict(self.hosts)
+        gensystem_cache.save_json(REACHABILITY_FILE, hosts)
+
+    def get_score(self, host, family):
+        """Score a family for a host: 1 worked, 0 unknown, -1 failed."""
+        with self._lock:
+            connected = self.hosts.get(host, {}).get(FAMILIES.get(family))
+        return 0 if connected is None else (1 if connected else -1)
+
+    def record(self, host, family, connected):
+        """Record whether a family worked for a host.
+
+        Returns:
+            bool: Whether this changed what was known.
+
+        """
+        name = FAMILIES.get(family)
+        if name is None:
+            return False
+        with self._lock:
+            families = self.hosts.setdefault(host, {})
+            changed = families.get(name) != connected
+            families[name] = connected
+        return changed
+
+
+_reachability = None
+_reachability_lock = threading.Lock()
+
+
+def get_reachability():
+    """Get what is known about hosts, loading it on first use."""
+    global _reachability
+    with _reachability_lock:
+        if _reachability is None:
+            _reachability = Reachability.load()
+        return _reachability
+
+
+def order_addresses(host, addresses, reachability):
+    """Order addresses to try, interleaving families (RFC 8305).
+
+    Args:
+        host (str): Host the addresses are of.
+        addresses (list): (family, sockaddr) tuples in the resolver's
+            order.
+        reachability (Reachability): What worked before.
+
+    Returns:
+        list: (family, sockaddr) tuples, in the order to try them.
+
+    """
+    families = []
+    for family, _ in addresses:
+        if family not in families:
+            families.append(family)
+    # Stable, so the resolver's preference breaks ties
+    families.sort(key=lambda family: -reachability.get_score(host, family))
+
+    by_family = [
+        [address for address in addresses if address[0] == family]
+        for family in families]
+    ordered = []
+    while any(by_family):
+        for family_addresses in by_family:
+            if family_addresses:
+                ordered.append(family_addresses.pop(0))
+    return ordered
+
+
+def create_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                      source_address=None):
+    """Connect to a host, racing its addresses (see module docstring).
+
+    A drop-in replacement for socket.create_connection.
+
+    Args:
+        address (tuple): Host and port.
+        timeout (Optional[float]): Socket timeout in seconds, which also
+            bounds connecting.
+        source_address (Optional[tuple]): Address to bind to first.
+
+    Returns:
+        socket.socket: The connected socket.
+
+    Raises:
+        socket.error: When no address can be connected to.
+
+    """
+    host, port = address
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+        timeout = socket.getdefaulttimeout()
+    reachability = get_reachability()
+    addresses = order_addresses(host, resolve(host, port), reachability)
+    dual_stack = len(set(family for family, _ in addresses)) > 1
+    deadline = time.time() + timeout if timeout is not None else None
+
+    pending = {}
+    started = []
+    errors = []
+    winner = None
+    next_start = 0
+    try:
+        while winner is None and (addresses or pending):
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                errors.append(socket.timeout("timed out"))
+                break
+
+            if addresses and (now >= next_start or not pending):
+                family, sockaddr = addresses.pop(0)
+                started.append(family)
+                next_start = now + CONNECTION_ATTEMPT_DELAY
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                try:
+                    if source_address:
+                        sock.bind(source_address)
+                    sock.setblocking(0)
+                    code = sock.connect_ex(sockaddr)
+                except socket.error as error:
+                    code = error.errno or errno.EINVAL
+                if code == 0:
+                    winner = sock, family
+                elif code in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    pending[sock] = family
+                else:
+                    sock.close()
+                    errors.append(socket.error(code, os.strerror(code)))
+                    next_start = now
+                continue
+
+            waits = [WAIT]
+            if addresses:
+                waits.append(next_start - now)
+            if deadline is not None:
+                waits.append(deadline - now)
+            _, writable, _ = select.select(
+                [], list(pending), [], max(0, min(waits)))
+            for sock in writable:
+                family = pending.pop(sock)
+                code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if code == 0 and winner is None:
+                    winner = sock, family
+                    continue
+                sock.close()
+                if code:
+                    errors.append(socket.error(code, os.strerror(code)))
+                    next_start = now  # Try the next address at once
+    finally:
+        for sock in pending:
+            sock.close()
+
+    if winner is None:
+        raise errors[-1] if errors else socket.error(
+            "No addresses found for %s." % host)
+
+    sock, family = winner
+    sock.setblocking(1)
+    sock.settimeout(timeout)
+    if dual_stack:
+        record_race(reachability, host, family, started)
+    return sock
+
+
+def record_race(reachability, host, family, started):
+    """Record which family won a race, and which lost it."""
+    changed = reachability.record(host, family, True)
+    # A family tried before the winner's first attempt and beaten by it
+    for loser in set(started[:started.index(family)]):
+        if loser != family:
+            changed = reachability.record(host, loser, False) or changed
+            gensystem_metrics.count(
+                'family_fallbacks', mirror=host, family=FAMILIES.get(loser))
+    if changed:
+        reachability.save()
@@ -0,0 +1,378 @@
+"""Rebuild a new release from a previous one, fetching only what changed.
+
+Consecutive builds of a media file share much of their content, so rather
+than downloading a whole new release, update rebuilds it zsync-style from
+a previous release kept locally (the seed). A block map of the new release
+lists a weak (rolling Adler-32, as in rsync) and a strong checksum for every
+BLOCK_SIZE block. The seed is scanned with the rolling checksum, so blocks
+are found at any offset, and only the blocks it does not hold are fetched,
+as byte ranges merged into as few requests as possible.
+
+Upstream mirrors publish no block maps, so `gensystem serve` makes them
+(see make_block_map) and serves them next to the files as
+<file>.blockmap. The rebuilt file is only as good as its SHA512, which
+update returns for checking against DIGESTS before the file is used.
+
+Compressed media changes throughout when little of its content does, so
+how much is reused depends on how the release was compressed.
+
+"""
+
+import contextlib
+import hashlib
+import json
+import mmap
+import os
+import re
+import zlib
+
+import gensystem.metrics as gensystem_metrics
+import gensystem.retry as gensystem_retry
+import gensystem.segments as gensystem_segments
+import gensystem.transfer as gensystem_transfer
+import gensystem.utils as gensystem_utils
+
+BLOCK_SIZE = 16 * 1024
+BLOCK_MAP_SUFFIX = '.blockmap'
+BLOCK_MAP_VERSION = 1
+MAX_RUN = 64  # Most blocks fetched per request, so retries lose little
+ADLER_MODULUS = 65521
+SCAN_CHUNK = 1024 * 1024
+STAMP_REGEX = re.compile(r'\d{8}')
+
+
+class DeltaError(ValueError):
+
+    """A release cannot be rebuilt from a seed (nor would retrying help)."""
+
+
+def get_weak_sums(data):
+    """Get the two halves of the Adler-32 (rolling) checksum of a block.
+
+    Args:
+        data (str): Block of data.
+
+    Returns:
+        tuple: One plus the sum of the bytes, and the sum of those running
+        sums, both modulo ADLER_MODULUS.
+
+    """
+    checksum = get_weak_checksum(data)
+    return checksum & 0xffff, checksum >> 16
+
+
+def get_weak_checksum(data):
+    """Get the rolling checksum of a block as one number."""
+    return zlib.adler32(data) & 0xffffffff
+
+
+def get_strong_checksum(data):
+    """Get the checksum confirming a rolling checksum match."""
+    return hashlib.md5(data).hexdigest()[:16]
+
+
+def make_block_map(path, block_size=BLOCK_SIZE):
+    """Make the block map of a file.
+
+    Args:
+        path (str): File to map.
+        block_size (Optional[int]): Size of the blocks in bytes.
+
+    Returns:
+        dict: Size, block size and weak and strong checksums of every
+        block of the file.
+
+    """
+    blocks = []
+    with open(path, 'rb') as mapped:
+        for block in iter(lambda: mapped.read(block_size), ''):
+            blocks.append(
+                [get_weak_checksum(block), get_strong_checksum(block)])
+        size = mapped.tell()
+
+    return {
+        'version': BLOCK_MAP_VERSION, 'size': size,
+        'block_size': block_size, 'blocks': blocks}
+
+
+def load_block_map(body):
+    """Load a block map sent by a mirror.
+
+    Args:
+        body (str): Block map as JSON.
+
+    Returns:
+        dict: The block map (see make_block_map).
+
+    Raises:
+        DeltaError: When the block map is damaged or of another version.
+
+    """
+    try:
+        block_map = json.loads(body)
+        size, block_size = block_map['size'], block_map['block_size']
+        blocks = block_map['blocks']
+        version = block_map.get('version')
+    except (ValueError, TypeError, KeyError):
+        raise DeltaError("The block map is damaged.")
+
+    if version != BLOCK_MAP_VERSION or block_size <= 0 or (
+            len(blocks) != -(-size // block_size)):
+        raise DeltaError("The block map is NOT usable.")
+
+    return block_map
+
+
+def get_block_map(url):
+    """Get the block map of a file from its mirror.
+
+    Raises:
+        RuntimeError: When the mirror has no block map for `url`.
+        DeltaError: When the block map is not usable.
+
+    """
+    return load_block_map(
+        gensystem_utils.read_webpage(url + BLOCK_MAP_SUFFIX))
+
+
+def find_blocks(seed_path, block_map):
+    """Find the blocks of a file held anywhere in a seed file.
+
+    Args:
+        seed_path (str): File sharing content with the mapped file.
+        block_map (dict): Block map of the file (see make_block_map).
+
+    Returns:
+        dict: Offsets in the seed by block index, for the blocks found.
+
+    """
+    size, block_size = block_map['size'], block_map['block_size']
+    blocks = block_map['blocks']
+    full_blocks = size // block_size
+    wanted = {}
+    for index, (weak, _) in enumerate(blocks[:full_blocks]):
+        wanted.setdefault(weak, []).append(index)
+
+    found = {}
+    with open(seed_path, 'rb') as seed:
+        seed_size = os.fstat(seed.fileno()).st_size
+        if not seed_size:
+            return found
+        data = mmap.mmap(seed.fileno(), 0, access=mmap.ACCESS_READ)
+        with contextlib.closing(data):
+            _scan(data, seed_size, block_size, blocks, wanted, found)
+
+            # A short last block cannot roll; look where it most likely is
+            tail = size - full_blocks * block_size
+            if tail:
+                strong = blocks[full_blocks][1]
+                for offset in (full_blocks * block_size, seed_size - tail):
+                    if 0 <= offset <= seed_size - tail and strong == (
+                            get_strong_checksum(data[offset:offset + tail])):
+                        found[full_blocks] = offset
+                        break
+
+    return found
+
+
+def _scan(data, size, block_size, blocks, wanted, found):
+    """Roll a checksum over the seed `data`, recording wanted blocks."""
+    position = _roll(data, 0, size, block_size, wanted)
+    while position is not None:
+        end = position + block_size
+        weak = get_weak_checksum(data[position:end])
+        strong = get_strong_checksum(data[position:end])
+        indices = wanted[weak]
+        missing = [index for index in indices if blocks[index][1] != strong]
+        for index in indices:
+            if blocks[index][1] == strong:
+                found[index] = position
+        if len(missing) < len(indices):
+            if missing:
+                wanted[weak] = missing
+            else:
+                del wanted[weak]
+            # Blocks do not overlap, so carry on past this one
+            position = _roll(data, end, size, block_size, wanted)
+        else:
+            position = _roll(data, position + 1, size, block_size, wanted)
+
+
+def _roll(data, position, size, block_size, wanted):
+    """Find the next offset from `position` whose weak checksum is wanted.
+
+    The inner loop works on SCAN_CHUNK bytes copied out of the seed at a
+    time, as a bytearray indexes to ints and is much faster to roll over.
+
+    Returns:
+        int: Offset of the block, or None if the seed has no more.
+
+    """
+    if not wanted or position + block_size > size:
+        return None
+
+    a, b = get_weak_sums(data[position:position + block_size])
+    if a | b << 16 in wanted:
+        return position
+
+    while position + block_size < size:
+        stop = min(size - block_size, position + SCAN_CHUNK)
+        window = bytearray(data[position:stop + block_size])
+        offset, last = 0, stop - position
+        while offset < last:
+            removed, added = window[offset], window[offset + block_size]
+            a = (a - removed + added) % ADLER_MODULUS
+            b = (b - block_size * removed + a - 1) % ADLER_MODULUS
+            offset += 1
+            if a | b << 16 in wanted:
+                return position + offset
+        position = stop
+
+    return None
+
+
+def get_runs(count, found, max_run=MAX_RUN):
+    """Group the blocks of a file into runs to copy or fetch.
+
+    Args:
+        count (int): Number of blocks in the file.
+        found (dict): Offsets in the seed by block index (see find_blocks).
+        max_run (Optional[int]): Most blocks fetched in one run.
+
+    Returns:
+        list: (first block, last block + 1, found) tuples in file order.
+
+    """
+    runs = []
+    for index in range(count):
+        local = index in found
+        if runs and runs[-1][2] == local and (
+                local or index - runs[-1][0] < max_run):
+            runs[-1][1] = index + 1
+        else:
+            runs.append([index, index + 1, local])
+
+    return [tuple(run) for run in runs]
+
+
+def find_seed(destination):
+    """Find the newest previous release next to a download's destination.
+
+    Args:
+        destination (str): Path the new release is saved to, e.g.
+            ./stage3-amd64-20160414.tar.bz2.
+
+    Returns:
+        str: Path of an older build of the same media file, or None.
+
+    """
+    folder, name = os.path.split(destination)
+    stamp = STAMP_REGEX.search(name)
+    if stamp is None:
+        return None
+
+    regex = re.compile('^%s$' % STAMP_REGEX.pattern.join(
+        re.escape(part) for part in STAMP_REGEX.split(name, 1)))
+    seeds = sorted(
+        other for other in os.listdir(folder or '.')
+        if regex.match(other) and other < name)
+    return os.path.join(folder, seeds[-1]) if seeds else None
+
+
+def update(url, destination, seed, hook=None):
+    """Rebuild the file at `url` from a seed, fetching only what is missing.
+
+    Args:
+        url (str): URL of the new release.
+        destination (str): Path to save the rebuilt file to.
+        seed (str): Previous release (see find_seed).
+        hook (Optional[fn]): Hook taking (blocks, block_size, total),
+            called with the bytes written so far.
+
+    Returns:
+        tuple: Hex SHA512 of the rebuilt file and bytes taken from the
+        seed.
+
+    Raises:
+        RuntimeError: When the block map cannot be had.
+        DeltaError: When the file cannot be rebuilt from the seed.
+        IOError: When fetching the missing blocks fails.
+
+    """
+    mirror = gensystem_metrics.get_mirror(url)
+    with gensystem_metrics.span(
+            'delta_update', url=url, mirror=mirror) as span:
+        block_map = get_block_map(url)
+        size, block_size = block_map['size'], block_map['block_size']
+        found = find_blocks(seed, block_map)
+        if not found:
+            # A plain (segmented) download is faster than fetching runs
+            raise DeltaError("%s shares nothing with %s." % (seed, url))
+        hasher = hashlib.sha512()
+        written = [0, 0]  # From the seed, and fetched
+
+        def write(output, data):
+            output.write(data)
+            hasher.update(data)
+            if hook is not None:
+                hook(1, sum(written), size)
+
+        with open(seed, 'rb') as seed_file, open(destination, 'wb') as output:
+            if hook is not None:
+                hook(1, 0, size)
+            for first, end, local in get_runs(
+                    len(block_map['blocks']), found):
+                if local:
+                    for index in range(first, end):
+                        seed_file.seek(found[index])
+                        data = seed_file.read(
+                            min(block_size, size - index * block_size))
+                        written[0] += len(data)
+                        write(output, data)
+                    continue
+
+                done = [first]
+
+                def fetch(url):
+                    for index, data in _fetch_blocks(
+                            url, block_map, done[0], end):
+                        done[0] = index + 1
+                        written[1] += len(data)
+                        write(output, data)
+
+                gensystem_retry.call(fetch, url)
+
+        span.set(reused=written[0], fetched=written[1])
+        gensystem_metrics.count(
+            'delta_reused_bytes', written[0], mirror=mirror)
+        gensystem_metrics.count(
+            'delta_fetched_bytes', written[1], mirror=mirror)
+
+    return hasher.hexdigest(), written[0]
+
+
+def _fetch_blocks(url, block_map, first, end):
+    """Fetch a run of blocks, checking each against the block map.
+
+    Yields:
+        tuple: Index and data of each block, in order.
+
+    """
+    size, block_size = block_map['size'], block_map['block_size']
+    start, stop = first * block_size, min(end * block_size, size)
+    response = gensystem_transfer.open_url(
+        url, {'Range': 'bytes=%d-%d' % (start, stop - 1)})
+    with contextlib.closing(response):
+        if gensystem_segments.get_content_range(response) != (
+                start, stop, size):
+            raise DeltaError("%s does NOT serve byte ranges." % url)
+
+        for index in range(first, end):
+            length = min(block_size, size - index * block_size)
+            data = response.read(length)
+            if len(data) != length:
+                raise gensystem_retry.TransferError(
+                    "Blocks of %s were cut short." % url)
+            if get_strong_checksum(data) != block_map['blocks'][index][1]:
+                raise DeltaError("%s changed since it was mapped." % url)
+            yield index, data
@@ -0,0 +1,247 @@
+"""Write media straight to a block device (or any file), hashing inline.
+
+Install media used to be downloaded to a file and then copied to a USB
+stick or disk with dd, writing it twice and reading it once. write
+streams the download to the target instead, in WRITE_SIZE writes aligned
+to the start of the target, hashing the data as it goes. Once the target
+is synced, read_back can hash exactly the bytes written again, with the
+target's cached pages dropped first so they come from the device itself.
+
+Failed requests are resumed from the last byte written (with If-Range, so
+a file replaced on the mirror is not spliced into the old one). Targets
+that are mounted, or too small for the media, are refused before anything
+is written.
+
+"""
+
+import contextlib
+import errno
+import hashlib
+import os
+import stat
+
+import gensystem.metrics as gensystem_metrics
+import gensystem.posix as gensystem_posix
+import gensystem.retry as gensystem_retry
+import gensystem.segments as gensystem_segments
+import gensystem.transfer as gensystem_transfer
+
+WRITE_SIZE = 4 * 1024 * 1024
+MOUNTS_FILE = '/proc/mounts'
+
+
+class TargetError(ValueError):
+
+    """Media cannot be written to a target (nor would retrying help)."""
+
+
+def is_block_device(path):
+    """Check whether a path is a block device."""
+    try:
+        return stat.S_ISBLK(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+def get_mounted(target, mounts_file=MOUNTS_FILE):
+    """Get the mounted filesystems on a device or its partitions.
+
+    Args:
+        target (str): Path of the device, e.g. /dev/sdb.
+        mounts_file (Optional[str]): Table of mounted filesystems.
+
+    Returns:
+        list: Mount points of the device and its partitions.
+
+    """
+    device = os.path.realpath(target)
+    mounted = []
+    try:
+        with open(mounts_file) as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 2 or not fields[0].startswith('/'):
+                    continue
+                source = os.path.realpath(fields[0])
+                # Partitions: /dev/sdb1, /dev/nvme0n1p1, /dev/mmcblk0p1
+                if source == device or (
+                        source.startswith(device) and
+                        source[len(device):].lstrip('p').isdigit()):
+                    mounted.append(fields[1])
+    except IOError as error:
+        if error.errno != errno.ENOENT:
+            raise
+    return mounted
+
+
+def open_target(target, size=None):
+    """Open a target for writing, refusing ones media must not go to.
+
+    Block devices are written in place; other paths are (re)created.
+
+    Args:
+        target (str): Path of a block device or file.
+        size (Optional[int]): Bytes that will be written, if known.
+
+    Returns:
+        int: Descriptor of the target, open for writing.
+
+    Raises:
+        TargetError: When the target cannot be opened, or is mounted or
+            too small.
+
+    """
+    block_device = is_block_device(target)
+    mounted = get_mounted(target) if block_device else []
+    if mounted:
+        raise TargetError("%s is mounted (%s), NOT writing to it." % (
+            target, ', '.join(mounted)))
+
+    try:
+        if not block_device:
+            return os.open(
+                target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        # O_EXCL: refused while the kernel has the device in use
+        fd = os.open(target, os.O_WRONLY | os.O_EXCL)
+    except OSError as error:
+        raise TargetError("Could NOT open %s (%s)." % (
+            target, error.strerror))
+
+    capacity = os.lseek(fd, 0, os.SEEK_END)
+    if size is not None and size > capacity:
+        os.close(fd)
+        raise TargetError("%s holds %d bytes, the media is %d." % (
+            target, capacity, size))
+    return fd
+
+
+def write(url, target, hook=None, write_size=WRITE_SIZE):
+    """Stream a file to a target, hashing it as it is written.
+
+    Args:
+        url (str): URL of the file (e.g. an ISO).
+        target (str): Path of a block device or file to write it to.
+        hook (Optional[fn]): Hook taking (blocks, block_size, total),
+            called with the bytes written so far.
+        write_size (Optional[int]): Bytes per write.
+
+    Returns:
+        tuple: Hex SHA512 of the data written and how many bytes it is.
+
+    Raises:
+        TargetError: When the target must not (or cannot) be written to.
+        IOError: When the download fails.
+
+    """
+    mirror = gensystem_metrics.get_mirror(url)
+    buffer_ = bytearray(write_size)
+    view = memoryview(buffer_)
+    state = {
+        'fd': None, 'written': 0, 'total': None, 'validator': None,
+        'hasher': hashlib.sha512()}
+
+    def stream(url):
+        headers = {}
+        if state['written']:
+            # Resume after the last write, unless the file changed since
+            headers['Range'] = 'bytes=%d-' % state['written']
+            if state['validator']:
+                headers['If-Range'] = state['validator']
+        response = gensystem_transfer.open_url(url, headers)
+        with contextlib.closing(response):
+            if state['written']:
+                content_range = gensystem_segments.get_content_range(response)
+                if content_range is None and response.status == 200:
+                    # Replaced on the mirror (or no ranges): start over
+                    state.update(written=0, hasher=hashlib.sha512())
+                elif content_range is None or (
+                        content_range[0] != state['written']):
+                    raise gensystem_segments.RangeNotHonoured(
+                        "Range of %s was NOT honoured." % url)
+            if not state['written']:
+                state['total'] = response.length
+                state['validator'] = (
+                    response.getheader('ETag') or
+                    response.getheader('Last-Modified'))
+                if state['fd'] is None:
+                    state['fd'] = open_target(target, state['total'])
+                if hook is not None:
+                    hook(1, 0, state['total'] or -1)
+
+            read_into = gensystem_transfer.get_body_reader(response)
+            while True:
+                # Fill the whole buffer so every write is a large one
+                filled = 0
+                while filled < write_size:
+                    count = read_into(view[filled:])
+                    if not count:
+                        break
+                    filled += count
+                if not filled:
+                    break
+
+                try:
+                    gensystem_posix.pwrite(
+                        state['fd'], buffer_, filled, state['written'])
+                except OSError as error:
+                    raise TargetError("Could NOT write to %s (%s)." % (
+                        target, error.strerror))
+                state['hasher'].update(view[:filled])
+                state['written'] += filled
+                if hook is not None:
+                    hook(1, state['written'], state['total'] or -1)
+
+        if state['total'] is not None and state['written'] != state['total']:
+            raise IOError("Download of %s was cut short (%d of %d bytes)." % (
+                url, state['written'], state['total']))
+
+    with gensystem_metrics.span(
+            'write_device', url=url, mirror=mirror) as span:
+        try:
+            gensystem_retry.call(stream, url)
+            if state['fd'] is not None:
+                os.fsync(state['fd'])
+        finally:
+            if state['fd'] is not None:
+                os.close(state['fd'])
+        span.set(bytes=state['written'])
+        gensystem_metrics.count(
+            'device_written_bytes', state['written'], mirror=mirror)
+
+    return state['hasher'].hexdigest(), state['written']
+
+
+def read_back(target, length, hook=None, read_size=WRITE_SIZE):
+    """Hash the first `length` bytes of a target, as stored on it.
+
+    Args:
+        target (str): Path of a block device or file written to.
+        length (int): Number of bytes written.
+        hook (Optional[fn]): Hook taking (blocks, block_size, total),
+            called with the bytes read so far.
+        read_size (Optional[int]): Bytes per read.
+
+    Returns:
+        str: Hex SHA512 of the bytes read.
+
+    Raises:
+        IOError: When the target holds fewer bytes.
+
+    """
+    hasher = hashlib.sha512()
+    read = 0
+    with gensystem_metrics.span('read_back', target=target):
+        with open(target, 'rb') as written:
+            gensystem_posix.drop_cache(written.fileno(), 0, length)
+            while read < length:
+                data = written.read(min(read_size, length - read))
+                if not data:
+                    raise IOError("%s holds only %d of %d bytes." % (
+                        target, read, length))
+                hasher.update(data)
+                read += len(data)
+                if hook is not None:
+                    hook(1, read, length)
+        gensystem_metrics.count('device_verified_bytes', read)
+
+    return hasher.hexdigest()
@@ -0,0 +1,167 @@
+"""Remember the digests of files gensystem has hashed.
+
+Hashing a stage3 reads hundreds of megabytes, so a digest is kept, keyed
+by the file's device, inode, size, modification and change times (in
+nanoseconds) and the hash algorithm. A file hashed again with none of
+those changed gets its digest back without being read. A file replaced
+(new inode) or rewritten in place (new times) misses the memo and is
+hashed again.
+
+Times have limited resolution, so a file could be written again within
+the tick it was hashed in without its times changing. Entries for files
+modified within RACY_WINDOW seconds of being recorded are therefore not
+trusted ("racily clean", as git calls it) until the file is hashed again
+later.
+
+The memo lives in the cache directory. Concurrent gensystem processes
+update it under an flock(2) lock, so none of their entries are lost.
+
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import os
+import time
+
+import gensystem.cache as gensystem_cache
+import gensystem.metrics as gensystem_metrics
+
+MEMO_FILE = 'digest-memo.json'
+LOCK_FILE = 'digest-memo.lock'
+MAX_ENTRIES = 256
+RACY_WINDOW = 2.0
+READ_SIZE = 1024 * 1024
+
+
+def get_file_key(stat, algorithm):
+    """Get the memo key of a file.
+
+    Args:
+        stat (posix.stat_result): The file's status.
+        algorithm (str): Name of the hash algorithm, e.g. sha512.
+
+    Returns:
+        str: Key, changing whenever the file may have.
+
+    """
+    return '%d:%d:%d:%d:%d:%s' % (
+        stat.st_dev, stat.st_ino, stat.st_size,
+        int(stat.st_mtime * 1e9), int(stat.st_ctime * 1e9), algorithm)
+
+
+@contextlib.contextmanager
+def locked_memo():
+    """Hold the memo lock, yielding the memo to read and update.
+
+    The memo is saved when the block exits without an error.
+
+    Yields:
+        dict: Entries ({digest, recorded, mtime}) by file key.
+
+    """
+    if not os.path.isdir(gensystem_cache.CACHE_DIR):
+        os.makedirs(gensystem_cache.CACHE_DIR)
+    fd = os.open(
+        gensystem_cache.get_cache_path(LOCK_FILE), os.O_RDWR | os.O_CREAT,
+        0644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        memo = gensystem_cache.load_json(MEMO_FILE, {})
+        if not isinstance(memo, dict):
+            memo = {}
+        yield memo
+        gensystem_cache.save_json(MEMO_FILE, memo)
+    finally:
+        os.close(fd)  # Releases the lock
+
+
+def lookup(path, algorithm='sha512'):
+    """Get the digest of a file if it is unchanged since it was hashed.
+
+    Args:
+        path (str): Path of the file.
+        algorithm (Optional[str]): Name of the hash algorithm.
+
+    Returns:
+        str: Hex digest, or None if it must be hashed.
+
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    memo = gensystem_cache.load_json(MEMO_FILE, {})
+    entry = memo.get(get_file_key(stat, algorithm)) if isinstance(
+        memo, dict) else None
+    if entry is None or entry['mtime'] >= entry['recorded'] - RACY_WINDOW:
+        return None
+    return entry['digest']
+
+
+def record(path, digest, stat, algorithm='sha512'):
+    """Remember the digest of a file.
+
+    Nothing is remembered if the file changed since `stat` was taken.
+
+    Args:
+        path (str): Path of the file.
+        digest (str): Hex digest of the file.
+        stat (posix.stat_result): The file's status before it was hashed.
+        algorithm (Optional[str]): Name of the hash algorithm.
+
+    Returns:
+        bool: Whether the digest was remembered.
+
+    """
+    key = get_file_key(stat, algorithm)
+    try:
+        if get_file_key(os.stat(path), algorithm) != key:
+            return False
+        with locked_memo() as memo:
+            memo[key] = {
+                'digest': digest, 'recorded': time.time(),
+                'mtime': stat.st_mtime}
+            for old_key in sorted(
+                    memo, key=lambda k: memo[k]['recorded'])[:-MAX_ENTRIES]:
+                del memo[old_key]
+    except (IOError, OSError):
+        return False
+
+    return True
+
+
+def hash_file(path, algorithm='sha512', force=False):
+    """Hash a file, unless its digest is remembered.
+
+    Args:
+        path (str): Path of the file.
+        algorithm (Optional[str]): Name of the hash algorithm.
+        force (Optional[bool]): Whether to hash the file even if its digest
+            is remembered.
+
+    Returns:
+        tuple: Hex digest and bytes read to get it (0 if remembered).
+
+    """
+    digest = None if force else lookup(path, algorithm)
+    if digest is not None:
+        gensystem_metrics.count('digest_memo_hits')
+        return digest, 0
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        stat = None
+    hasher = getattr(hashlib, algorithm)()
+    read = 0
+    with open(path, 'rb') as hashed:
+        for data in iter(lambda: hashed.read(READ_SIZE), ''):
+            hasher.update(data)
+            read += len(data)
+
+    digest = hasher.hexdigest()
+    if stat is not None:
+        record(path, digest, stat, algorithm)
+    return digest, read
@@ -0,0 +1,283 @@
+"""Find mirrors lagging behind with their autobuilds.
+
+Some mirrors sync days behind the others, so their current autobuild
+folders hold older builds (or none). check_mirrors reads the autobuild
+listing of every media file from every mirror concurrently, recording the
+newest build each has, how long it took to answer and any error, and the
+results are kept as a freshness index in the cache directory. Mirror
+selection consults the index (see filter_fresh), so stale mirrors are
+passed over without spending a request on them.
+
+"""
+
+import contextlib
+import posixpath
+import Queue
+import re
+import threading
+import time
+
+from bs4 import BeautifulSoup
+
+import gensystem.cache as gensystem_cache
+import gensystem.catalog as gensystem_catalog
+import gensystem.media as gensystem_media
+import gensystem.transfer as gensystem_transfer
+
+INDEX_FILE = 'mirror-freshness.json'
+MAX_AGE = 2 * 24 * 60 * 60
+THREADS = 16
+TIMEOUT = 15
+STAMP_REGEX = re.compile(r'\d{8}')
+
+
+def get_build_key(arch, media_file):
+    """Get the index key of a media file, e.g. amd64/stage3."""
+    return '%s/%s' % (arch, media_file)
+
+
+def get_media_files(arch, catalog=None):
+    """Get the media files autobuilt for an architecture.
+
+    Architectures gensystem has no names for get the variants catalogued
+    (see gensystem.catalog).
+
+    Args:
+        arch (str): Name of the architecture, e.g. amd64.
+        catalog (Optional[dict]): Catalog (default: loaded).
+
+    Returns:
+        list: Media file names, e.g. stage3 or stage3-x86.
+
+    """
+    if arch in gensystem_media.SUPPORTED_ARCH:
+        return list(gensystem_media.SUPPORTED_ARCH[arch]._fields[1:])
+
+    catalog = gensystem_catalog.load() if catalog is None else catalog
+    return sorted(catalog.get('media', {}).get(arch, {}))
+
+
+def get_build_folder(mirror, arch, media_file):
+    """Get the autobuild folder of a media file and the regex of its builds.
+
+    Media gensystem has no name for is looked up in the catalog.
+
+    Args:
+        mirror (str): Gentoo (base) mirror.
+        arch (str): Name of the architecture, e.g. amd64.
+        media_file (str): Media file, e.g. stage3.
+
+    Returns:
+        tuple: URL of the folder and the regex of build file names.
+
+    Raises:
+        RuntimeError: When the media file is neither known nor catalogued.
+
+    """
+    if media_file in getattr(
+            gensystem_media.SUPPORTED_ARCH.get(arch), '_fields', ()):
+        return gensystem_media.get_media_folder(mirror, arch, media_file)
+
+    media = gensystem_catalog.get_media(arch, media_file)
+    if media is None:
+        raise RuntimeError("%s %s is not catalogued." % (arch, media_file))
+    variant = gensystem_catalog.get_variant(arch, media_file)
+    return (
+        posixpath.dirname(gensystem_catalog.get_media_url(mirror, media)),
+        r'^%s-\d{8}' % re.escape(variant))
+
+
+def check_build(mirror, arch, media_file):
+    """Find the newest build of a media file on a mirror.
+
+    Args:
+        mirror (str): Gentoo (base) mirror.
+        arch (str): Name of the architecture, e.g. amd64.
+        media_file (str): Media file, e.g. stage3.
+
+    Returns:
+        dict: Newest build date (stamp, None if there is no build), seconds
+        the mirror took to answer and the error if it failed (or None).
+
+    """
+    result = {'stamp': None, 'seconds': None, 'error': None}
+
+    started = time.time()
+    try:
+        folder, regex = get_build_folder(mirror, arch, media_file)
+        response = gensystem_transfer.open_url(
+            folder + '/', timeout=TIMEOUT)
+        with contextlib.closing(response):
+            listing = response.read()
+    except Exception as error:
+        result['error'] = str(error) or error.__class__.__name__
+        return result
+    finally:
+        result['seconds'] = time.time() - started
+
+    stamps = [
+        STAMP_REGEX.search(link['href']).group()
+        for link in BeautifulSoup(listing).find_all(
+            href=re.compile(regex))]
+    result['stamp'] = max(stamps) if stamps else None
+    return result
+
+
+def check_mirrors(mirrors, builds, threads=THREADS):
+    """Check the newest builds on many mirrors concurrently.
+
+    Args:
+        mirrors (list): Gentoo (base) mirrors.
+        builds (list): (arch, media file) tuples to check.
+        threads (Optional[int]): Most requests at once.
+
+    Returns:
+        dict: Freshness index: when it was checked and, by mirror, the
+        results of check_build by build key.
+
+    """
+    checks = Queue.Queue()
+    for mirror in mirrors:
+        for arch, media_file in builds:
+            checks.put((mirror, arch, media_file))
+    index = {
+        'checked': time.time(),
+        'mirrors': dict((mirror, {}) for mirror in mirrors)}
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            try:
+                mirror, arch, media_file = checks.get_nowait()
+            except Queue.Empty:
+                return
+            result = check_build(mirror, arch, media_file)
+            with lock:
+                index['mirrors'][mirror][
+                    get_build_key(arch, media_file)] = result
+
+    workers = [
+        threading.Thread(target=work)
+        for _ in range(min(threads, checks.qsize()))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        while worker.is_alive():
+            worker.join(1)
+
+    return index
+
+
+def get_newest_stamps(index):
+    """Get the newest build date any mirror has, by build key.
+
+    Args:
+        index (dict): Freshness index.
+
+    Returns:
+        dict: Newest stamps by build key.
+
+    """
+    newest = {}
+    for results in index.get('mirrors', {}).values():
+        for key, result in results.items():
+            if result.get('stamp') and result['stamp'] > newest.get(key, ''):
+                newest[key] = result['stamp']
+    return newest
+
+
+def is_stale(index, mirror, arch, media_file):
+    """Check whether a mirror lags behind with a media file.
+
+    A mirror that failed to answer counts as stale; one the index knows
+    nothing about does not.
+
+    Args:
+        index (dict): Freshness index.
+        mirror (str): Gentoo (base) mirror.
+        arch (str): Name of the architecture, e.g. amd64.
+        media_file (str): Media file, e.g. stage3.
+
+    Returns:
+        bool: Whether the mirror is known to be stale.
+
+    """
+    key = get_build_key(arch, media_file)
+    result = index.get('mirrors', {}).get(mirror, {}).get(key)
+    if result is None:
+        return False
+
+    newest = get_newest_stamps(index).get(key)
+    return result.get('stamp') is None or (
+        newest is not None and result['stamp'] < newest)
+
+
+def format_index(index):
+    """Format a freshness index as a table for humans.
+
+    Args:
+        index (dict): Freshness index.
+
+    Returns:
+        str: One line per mirror and build.
+
+    """
+    lines = []
+    for mirror, results in sorted(index.get('mirrors', {}).items()):
+        for key, result in sorted(results.items()):
+            arch, media_file = key.split('/')
+            if result['error']:
+                status = 'error: %s' % result['error']
+            elif is_stale(index, mirror, arch, media_file):
+                status = 'STALE'
+            else:
+                status = 'ok'
+            lines.append('%-55s %-17s %-8s %6.2fs  %s' % (
+                mirror, key, result['stamp'] or '-', result['seconds'],
+                status))
+
+    return '\n'.join(lines)
+
+
+def save_index(index):
+    """Keep a freshness index in the cache directory."""
+    return gensystem_cache.save_json(INDEX_FILE, index)
+
+
+def load_index(max_age=MAX_AGE):
+    """Load the freshness index, unless it is too old to trust.
+
+    Args:
+        max_age (Optional[float]): Most seconds since the check.
+
+    Returns:
+        dict: Freshness index (empty if missing or too old).
+
+    """
+    index = gensystem_cache.load_json(INDEX_FILE, {})
+    if not isinstance(index, dict) or (
+            time.time() - index.get('checked', 0) > max_age):
+        return {}
+    return index
+
+
+def filter_fresh(mirrors, arch, media_file, index=None):
+    """Leave out mirrors known to be stale.
+
+    Args:
+        mirrors (dict): Mirror URLs by name.
+        arch (str): Name of the architecture, e.g. amd64.
+        media_file (str): Media file, e.g. stage3.
+        index (Optional[dict]): Freshness index (default: load_index()).
+
+    Returns:
+        dict: Mirrors not known to be stale, or all of them if every one
+        is.
+
+    """
+    index = load_index() if index is None else index
+    fresh = dict(
+        (name, url) for name, url in mirrors.items()
+        if not is_stale(index, url, arch, media_file))
+    return fresh or mirrors
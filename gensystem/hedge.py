@@ -0,0 +1,288 @@
+"""Hedge small, latency-critical GETs by racing a second request.
+
+Small fetches (mirror listings, DIGESTS, the public IP lookup) decide how
+long a run takes to get going, and their slowest tail is mostly requests
+stuck on one server or connection. A hedged read sends the request, and if
+no answer has come after the PERCENTILE latency seen for that kind of
+fetch, sends it again to a second server (or the same one over a fresh
+connection). The first successful response wins and the other request is
+cancelled.
+
+Hedges are budgeted: beyond a small BURST, at most MAX_EXTRA_LOAD hedges
+are sent per request, so a slow network cannot double the load hedging
+puts on mirrors. Latencies are kept in the cache directory so the delay
+fits the host's network from the first fetch of a run.
+
+"""
+
+import Queue
+import socket
+import threading
+import time
+
+import gensystem.cache as gensystem_cache
+import gensystem.metrics as gensystem_metrics
+import gensystem.transfer as gensystem_transfer
+
+DEFAULT_DELAY = 1.0
+MIN_DELAY = 0.05
+MAX_DELAY = 3.0
+PERCENTILE = 95
+MIN_SAMPLES = 5
+SAMPLES = 50
+MAX_EXTRA_LOAD = 0.1
+BURST = 2
+TIMEOUT = 30
+WAIT = 1.0
+LATENCY_FILE = 'hedge-latency.json'
+
+
+def get_percentile(samples, percentile):
+    """Get a percentile of some samples (nearest rank).
+
+    Args:
+        samples (list): Numbers.
+        percentile (float): Percentile from 0 to 100.
+
+    Returns:
+        float: The percentile, or None without samples.
+
+    """
+    if not samples:
+        return None
+
+    ordered = sorted(samples)
+    rank = int(round(percentile / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(len(ordered) - 1, rank))]
+
+
+class Budget(object):
+
+    """Cap hedges to a share of the requests made."""
+
+    def __init__(self, ratio=MAX_EXTRA_LOAD, burst=BURST):
+        """Allow `burst` hedges plus `ratio` hedges per request.
+
+        Args:
+            ratio (Optional[float]): Hedges allowed per request.
+            burst (Optional[int]): Hedges allowed before any requests.
+
+        """
+        self.ratio = ratio
+        self.burst = burst
+        self.requests = 0
+        self.hedges = 0
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        """Count a request that may be hedged."""
+        with self._lock:
+            self.requests += 1
+
+    def spend(self):
+        """Take a hedge from the budget.
+
+        Returns:
+            bool: Whether a hedge may be sent.
+
+        """
+        with self._lock:
+            if self.hedges >= self.burst + self.ratio * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+
+class LatencyTracker(object):
+
+    """Recent latencies of each kind of hedged fetch."""
+
+    def __init__(self, samples=None):
+        """Start from `samples`, a dict of latency lists by kind."""
+        self.samples = samples or {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls):
+        """Load the latencies kept in the cache directory."""
+        samples = gensystem_cache.load_json(LATENCY_FILE, {})
+        return cls(samples if isinstance(samples, dict) else {})
+
+    def save(self):
+        """Keep the latencies in the cache directory."""
+        with self._lock:
+            samples = dict(self.samples)
+        gensystem_cache.save_json(LATENCY_FILE, samples)
+
+    def get_delay(self, kind):
+        """Get how long to wait for a request before hedging it.
+
+        Args:
+            kind (str): Kind of fetch, e.g. listing.
+
+        Returns:
+            float: Seconds to wait.
+
+        """
+        with self._lock:
+            samples = self.samples.get(kind, [])
+            if len(samples) < MIN_SAMPLES:
+                return DEFAULT_DELAY
+            delay = get_percentile(samples, PERCENTILE)
+
+        return max(MIN_DELAY, min(MAX_DELAY, delay))
+
+    def record(self, kind, seconds):
+        """Record how long a fetch took.
+
+        Args:
+            kind (str): Kind of fetch, e.g. listing.
+            seconds (float): Seconds until a response was read.
+
+        """
+        with self._lock:
+            samples = self.samples.setdefault(kind, [])
+            samples.append(seconds)
+            del samples[:-SAMPLES]
+
+
+class Attempt(threading.Thread):
+
+    """One of the racing requests of a hedged read."""
+
+    def __init__(self, url, finished, timeout=TIMEOUT):
+        """Prepare to GET `url`, putting the attempt on `finished` when done.
+
+        Args:
+            url (str): URL to read.
+            finished (Queue.Queue): Queue finished attempts are put on.
+            timeout (Optional[float]): Socket timeout in seconds.
+
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.url = url
+        self.body = None
+        self.error = None
+        self.cancelled = False
+        self._finished = finished
+        self._timeout = timeout
+        self._connection = None
+
+    def run(self):
+        """Read the response body."""
+        try:
+            response = gensystem_transfer.open_url(
+                self.url, timeout=self._timeout,
+                on_connection=self._set_connection)
+            try:
+                self.url = response.url
+                self.body = response.read()
+            finally:
+                response.close()
+        except Exception as error:
+            self.error = error
+        self._finished.put(self)
+
+    def cancel(self):
+        """Abort the request, if it is still being made."""
+        self.cancelled = True
+        sock = getattr(self._connection, 'sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass  # Already closed
+
+    def _set_connection(self, connection):
+        """Remember the connection in use, so it can be aborted."""
+        self._connection = connection
+        if self.cancelled:
+            self.cancel()
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+BUDGET = Budget()
+
+
+def get_tracker():
+    """Get the latency tracker, loading it on first use."""
+    global _tracker
+    with _tracker_lock:
+        if _tracker is None:
+            _tracker = LatencyTracker.load()
+        return _tracker
+
+
+def _wait(finished):
+    """Wait for the next finished attempt (interruptibly)."""
+    while True:
+        try:
+            return finished.get(True, WAIT)
+        except Queue.Empty:
+            continue
+
+
+def read(url, kind, hedge_url=None, budget=None, tracker=None):
+    """Read a small response, hedging the request if it is slow.
+
+    Args:
+        url (str): URL to read.
+        kind (str): Kind of fetch (e.g. listing), keeping latencies and
+            counters apart.
+        hedge_url (Optional[str]): Same response elsewhere, e.g. on
+            another mirror (default: `url` over a fresh connection).
+        budget (Optional[Budget]): Budget hedges are taken from.
+        tracker (Optional[LatencyTracker]): Latencies hedging delays
+            are taken from.
+
+    Returns:
+        tuple: URL that answered first (after redirects) and its body.
+
+    Raises:
+        Exception: What the first request failed with, if none succeeded.
+
+    """
+    budget = budget or BUDGET
+    tracker = tracker or get_tracker()
+    budget.record_request()
+    finished = Queue.Queue()
+    started = time.time()
+    attempts = [Attempt(url, finished)]
+    attempts[0].start()
+
+    with gensystem_metrics.span('hedged_read', kind=kind) as span:
+        try:
+            winner = finished.get(True, tracker.get_delay(kind))
+        except Queue.Empty:
+            winner = None
+            if budget.spend():
+                attempts.append(Attempt(hedge_url or url, finished))
+                attempts[-1].start()
+                gensystem_metrics.count('hedges_sent', kind=kind)
+            else:
+                gensystem_metrics.count('hedges_denied', kind=kind)
+
+        failed = 0
+        while True:
+            winner = winner or _wait(finished)
+            if winner.error is None:
+                break
+            failed += 1
+            if failed == len(attempts):
+                raise attempts[0].error
+            winner = None
+
+        for attempt in attempts:
+            if attempt is not winner:
+                attempt.cancel()
+
+        hedge_won = winner is not attempts[0]
+        if hedge_won:
+            gensystem_metrics.count('hedges_won', kind=kind)
+        span.set(hedged=len(attempts) > 1, hedge_won=hedge_won)
+
+    tracker.record(kind, time.time() - started)
+    tracker.save()
+    return winner.url, winner.body
@@ -0,0 +1,418 @@
+"""Install Gentoo Linux stage tarballs into one or more target roots."""
+
+import bz2
+import contextlib
+import os
+import Queue
+import shutil
+import subprocess
+import tarfile
+import threading
+import zlib
+
+import gensystem.metrics as gensystem_metrics
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None  # .xz tarballs are not supported
+
+CHUNK_SIZE = 1024 * 1024
+QUEUE_CHUNKS = 8
+LINK_MODES = ('hardlink', 'reflink')
+REPOSITORY_DIR = 'var/db/repos/gentoo'
+
+
+class MultiStreamBZ2Decompressor(object):
+
+    """Decompress bzip2 data made up of one or more concatenated streams.
+
+    Gentoo stage tarballs are compressed with parallel bzip2 tools which
+    write many streams back to back, and bz2.BZ2Decompressor stops at the
+    end of the first one.
+
+    """
+
+    def __init__(self):
+        """Start decompressing the first stream."""
+        self._decompressor = bz2.BZ2Decompressor()
+
+    def decompress(self, data):
+        """Decompress `data`, starting new streams as they are reached.
+
+        Args:
+            data (str): Compressed data.
+
+        Returns:
+            str: Decompressed data (possibly empty).
+
+        """
+        chunks = []
+        while data:
+            try:
+                chunks.append(self._decompressor.decompress(data))
+            except EOFError:
+                # Previous stream ended exactly on a chunk boundary
+                self._decompressor = bz2.BZ2Decompressor()
+                continue
+            data = self._decompressor.unused_data
+            if data:
+                self._decompressor = bz2.BZ2Decompressor()
+
+        return ''.join(chunks)
+
+
+class HashingReader(object):
+
+    """File-like wrapper that hashes everything read through it."""
+
+    def __init__(self, fileobj, hasher, hook=None):
+        """Wrap `fileobj`, feeding every chunk read to `hasher`.
+
+        Args:
+            fileobj (file): File-like object to read from.
+            hasher (hashlib.HASH): Hash object to update.
+            hook (Optional[fn]): Function called with the bytes read so far.
+
+        """
+        self.fileobj = fileobj
+        self.hasher = hasher
+        self.hook = hook
+        self.transferred = 0
+
+    def read(self, size=-1):
+        """Read and hash up to `size` bytes."""
+        data = self.fileobj.read(size)
+        self.hasher.update(data)
+        self.transferred += len(data)
+        if self.hook is not None:
+            self.hook(self.transferred)
+        return data
+
+
+class QueueReader(object):
+
+    """File-like object reading chunks from a bounded queue.
+
+    A None chunk marks the end of the stream. The bounded queue is what
+    gives backpressure: the producer blocks while a reader lags behind.
+
+    """
+
+    def __init__(self, chunks):
+        """Read from `chunks`.
+
+        Args:
+            chunks (Queue.Queue): Queue of str chunks ending with None.
+
+        """
+        self._chunks = chunks
+        self._chunk = ''
+        self._offset = 0
+        self._eof = False
+
+    def read(self, size=-1):
+        """Read up to `size` bytes (all remaining if negative)."""
+        pieces = []
+        while size != 0 and not self._eof:
+            if self._offset >= len(self._chunk):
+                chunk = self._chunks.get()
+                if chunk is None:
+                    self._eof = True
+                else:
+                    self._chunk, self._offset = chunk, 0
+                continue
+
+            end = len(self._chunk)
+            if size > 0:
+                end = min(end, self._offset + size)
+                size -= end - self._offset
+            pieces.append(self._chunk[self._offset:end])
+            self._offset = end
+
+        return ''.join(pieces)
+
+    def drain(self):
+        """Discard the rest of the stream so the producer never blocks."""
+        while not self._eof:
+            self._eof = self._chunks.get() is None
+
+
+def get_decompressor(path):
+    """Get a streaming decompressor suited to a tarball's file name.
+
+    Args:
+        path (str): Path or URL of a tarball.
+
+    Returns:
+        object: Object with a decompress method or None if uncompressed.
+
+    Raises:
+        RuntimeError: When the compression format is not supported.
+
+    """
+    if path.endswith('.bz2'):
+        return MultiStreamBZ2Decompressor()
+    if path.endswith(('.gz', '.tgz')):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if path.endswith('.tar'):
+        return None
+    if path.endswith('.xz') and lzma is not None:
+        return lzma.LZMADecompressor()
+
+    raise RuntimeError("Tarball compression not supported for %s." % path)
+
+
+def strip_members(tar, strip):
+    """Yield the members of a tarball with leading path components removed.
+
+    Args:
+        tar (tarfile.TarFile): Tarball (may be a stream).
+        strip (int): Leading components to remove, e.g. 1 for portage/.
+
+    Yields:
+        tarfile.TarInfo: Members with `strip` components left after it.
+
+    """
+    for tarinfo in tar:
+        parts = tarinfo.name.strip('/').split('/')
+        if len(parts) <= strip:
+            continue
+        tarinfo.name = '/'.join(parts[strip:])
+        if tarinfo.islnk():
+            tarinfo.linkname = '/'.join(
+                tarinfo.linkname.strip('/').split('/')[strip:])
+        yield tarinfo
+
+
+def _extract(reader, target, errors, strip=0):
+    """Extract a tar stream into `target`, recording any failure."""
+    try:
+        with contextlib.closing(
+                tarfile.open(fileobj=reader, mode='r|')) as tar:
+            tar.extractall(target, strip_members(tar, strip))
+    except (tarfile.TarError, EnvironmentError) as error:
+        errors[target] = str(error)
+    finally:
+        reader.drain()
+
+
+def link_tree(source_root, target_root, mode):
+    """Populate `target_root` from an already extracted `source_root`.
+
+    Args:
+        source_root (str): Root extracted from the tarball.
+        target_root (str): Root to populate.
+        mode (str): One of LINK_MODES.
+
+    Raises:
+        RuntimeError: When the filesystem does not support `mode`.
+
+    """
+    if mode == 'reflink':
+        # cp knows the clone ioctls and preserves ownership, modes and times
+        try:
+            subprocess.check_call([
+                'cp', '-a', '--reflink=always',
+                os.path.join(source_root, '.'), target_root])
+        except (OSError, subprocess.CalledProcessError):
+            raise RuntimeError(
+                "Could NOT reflink %s to %s." % (source_root, target_root))
+        return
+
+    directories = []
+    try:
+        for dirpath, dirnames, filenames in os.walk(source_root):
+            relative = os.path.relpath(dirpath, source_root)
+            target_dir = os.path.normpath(os.path.join(target_root, relative))
+            if not os.path.isdir(target_dir):
+                os.mkdir(target_dir)
+            directories.append((dirpath, target_dir))
+
+            for name in dirnames + filenames:
+                source = os.path.join(dirpath, name)
+                target = os.path.join(target_dir, name)
+                if os.path.islink(source):
+                    os.symlink(os.readlink(source), target)
+                    _copy_owner(source, target)
+                elif not os.path.isdir(source):
+                    os.link(source, target)
+    except OSError as error:
+        raise RuntimeError(
+            "Could NOT hardlink %s to %s (%s)." % (
+                source_root, target_root, error))
+
+    # Deepest first so setting times is not undone by later changes
+    for source_dir, target_dir in reversed(directories):
+        shutil.copystat(source_dir, target_dir)
+        _copy_owner(source_dir, target_dir)
+
+
+def _copy_owner(source, target):
+    """Copy ownership of `source` to `target` when permitted."""
+    stat = os.lstat(source)
+    try:
+        os.lchown(target, stat.st_uid, stat.st_gid)
+    except OSError:
+        pass  # Only root can give files away
+
+
+def install_stage(
+        source, targets, decompressor=None, link=None,
+        chunk_size=CHUNK_SIZE, queue_chunks=QUEUE_CHUNKS, strip=0):
+    """Install one tarball stream into every target root.
+
+    The stream is read and decompressed once, then teed to one extractor
+    thread per target. Each extractor reads from its own queue holding at
+    most `queue_chunks` chunks, so the slowest target paces the stream.
+    With `link`, only the first target is extracted and the others are
+    populated from it afterwards.
+
+    Args:
+        source (file): File-like object of the (compressed) tarball.
+        targets (list): Target root directories.
+        decompressor (Optional[object]): From get_decompressor or None.
+        link (Optional[str]): One of LINK_MODES or None.
+        chunk_size (Optional[int]): Bytes read from `source` at a time.
+        queue_chunks (Optional[int]): Chunks buffered per target.
+        strip (Optional[int]): Leading path components to remove from
+            member names (see strip_members).
+
+    Returns:
+        dict: Error messages by target; empty when all targets installed.
+
+    """
+    with gensystem_metrics.span(
+            'install_stage', targets=len(targets), link=link) as span:
+        errors = _install_stage(
+            source, targets, decompressor, link, chunk_size, queue_chunks,
+            strip)
+        span.set(failed=len(errors))
+
+    return errors
+
+
+def install_with_snapshot(
+        stage, snapshot, targets, link=None, repository=REPOSITORY_DIR,
+        chunk_size=CHUNK_SIZE, queue_chunks=QUEUE_CHUNKS):
+    """Install a stage tarball and a Portage snapshot at the same time.
+
+    The snapshot is read, decompressed and extracted into each target's
+    `repository` on its own thread while the stage tarball is, so the two
+    overlap rather than run back to back. The target roots are made first;
+    the stage's directories get their modes and owners once extracted.
+    With `link`, both go into the first target only, and the others are
+    populated from it once both are done.
+
+    Args:
+        stage (tuple): File-like object of the stage tarball and its
+            decompressor (see install_stage).
+        snapshot (tuple): File-like object of the snapshot tarball, whose
+            members are under one top directory (e.g. portage/), and its
+            decompressor.
+        targets (list): Target root directories.
+        link (Optional[str]): One of LINK_MODES or None.
+        repository (Optional[str]): Directory of the Gentoo repository,
+            relative to the root.
+        chunk_size (Optional[int]): Bytes read at a time.
+        queue_chunks (Optional[int]): Chunks buffered per target.
+
+    Returns:
+        dict: Error messages by target; empty when all targets installed.
+
+    """
+    for target in targets:
+        if not os.path.isdir(target):
+            os.makedirs(target)
+    extract_targets = targets[:1] if link else targets
+    repositories = dict(
+        (os.path.join(target, repository), target)
+        for target in extract_targets)
+    snapshot_errors = {}
+
+    def install_snapshot():
+        try:
+            snapshot_errors.update(install_stage(
+                snapshot[0], sorted(repositories), snapshot[1],
+                chunk_size=chunk_size, queue_chunks=queue_chunks, strip=1))
+        except (EnvironmentError, RuntimeError, ValueError) as error:
+            # e.g. the download failed, or the data is not what it claims
+            snapshot_errors.update(
+                (path, str(error)) for path in repositories)
+
+    with gensystem_metrics.span(
+            'install_with_snapshot', targets=len(targets), link=link) as span:
+        worker = threading.Thread(target=install_snapshot)
+        worker.daemon = True
+        worker.start()
+        try:
+            errors = install_stage(
+                stage[0], extract_targets, stage[1],
+                chunk_size=chunk_size, queue_chunks=queue_chunks)
+        finally:
+            while worker.is_alive():
+                worker.join(1)
+
+        for path, error in snapshot_errors.items():
+            target = repositories[path]
+            errors.setdefault(target, "Portage snapshot: %s" % error)
+        _link_targets(targets, link, errors)
+        span.set(failed=len(errors))
+
+    return errors
+
+
+def _install_stage(
+        source, targets, decompressor, link, chunk_size, queue_chunks,
+        strip=0):
+    """Install one tarball stream into every target root (see above)."""
+    for target in targets:
+        if not os.path.isdir(target):
+            os.makedirs(target)
+
+    errors = {}
+    extract_targets = targets[:1] if link else targets
+    queues = [Queue.Queue(maxsize=queue_chunks) for _ in extract_targets]
+    threads = [
+        threading.Thread(
+            target=_extract,
+            args=(QueueReader(chunks), target, errors, strip))
+        for chunks, target in zip(queues, extract_targets)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while True:
+            data = source.read(chunk_size)
+            if not data:
+                break
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            if data:
+                for chunks in queues:
+                    chunks.put(data)
+    finally:
+        for chunks in queues:
+            chunks.put(None)
+        for thread in threads:
+            thread.join()
+
+    _link_targets(targets, link, errors)
+    return errors
+
+
+def _link_targets(targets, link, errors):
+    """Populate the targets after the first from it, if linking."""
+    if link and targets[0] not in errors:
+        for target in targets[1:]:
+            try:
+                link_tree(targets[0], target, link)
+            except RuntimeError as error:
+                errors[target] = str(error)
+    elif link:
+        for target in targets[1:]:
+            errors[target] = "Not linked, %s failed." % targets[0]
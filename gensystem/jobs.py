@@ -0,0 +1,623 @@
+"""Download, verify and install as jobs, for embedding gensystem.
+
+bin/gensystem reports to a terminal: it prints as it goes and its commands
+only return whether they succeeded. Provisioning tools embed a JobRunner
+instead, one per process, and submit jobs to it. Each submission returns a
+Job right away, which reports structured progress (to listeners, and as
+snapshots) and ends with a result or an error, much like a future.
+
+Jobs run on the runner's worker threads (at most `workers` at once) and
+share what the process has learned so far: resolved hosts and the address
+family that reached them (gensystem.connect), the settings and throughput
+remembered for each mirror (gensystem.segments), the catalog, freshness
+index and digest memo, and, kept by the runner, the country found by GeoIP
+and the media URLs already looked up. Nothing is printed and nothing is
+asked of the user.
+
+Example:
+    >>> runner = JobRunner(workers=2)
+    >>> job = runner.submit_download('stage3', directory='/srv/media')
+    >>> job.add_listener(lambda job, event: log(job.snapshot()))
+    >>> job.result().sha512
+    'f1a3...'
+    >>> runner.shutdown()
+
+"""
+
+import collections
+import contextlib
+import hashlib
+import httplib
+import itertools
+import os
+import Queue
+import random
+import threading
+import time
+
+import gensystem.bandwidth as gensystem_bandwidth
+import gensystem.digests as gensystem_digests
+import gensystem.freshness as gensystem_freshness
+import gensystem.install as gensystem_install
+import gensystem.lock as gensystem_lock
+import gensystem.media as gensystem_media
+import gensystem.metrics as gensystem_metrics
+import gensystem.mirror as gensystem_mirror
+import gensystem.retry as gensystem_retry
+import gensystem.segments as gensystem_segments
+import gensystem.snapshot as gensystem_snapshot
+import gensystem.temp as gensystem_temp
+import gensystem.transcode as gensystem_transcode
+import gensystem.transfer as gensystem_transfer
+import gensystem.utils as gensystem_utils
+
+WORKERS = 2
+URL_TTL = 10 * 60
+WAIT = 1.0
+STATES = ('pending', 'running', 'succeeded', 'failed', 'cancelled')
+# GeoIP data does not map 100% accurately to Gentoo countries ;(
+COUNTRY_DISCREPANCIES = {'US': 'USA'}
+
+Download = collections.namedtuple('Download', 'path url sha512 size')
+Install = collections.namedtuple('Install', 'source sha512 targets snapshot')
+
+
+class JobError(RuntimeError):
+
+    """A job failed; its message says why."""
+
+
+class JobCancelled(JobError):
+
+    """A job was cancelled before it started."""
+
+
+class Job(object):
+
+    """Handle of work submitted to a JobRunner."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, kind, function, args, flow=None):
+        """Describe work that is yet to run.
+
+        Args:
+            kind (str): download, verify or install.
+            function (fn): Function taking the job (to report progress on)
+                and `args`, returning the job's result.
+            args (tuple): Arguments of `function`.
+            flow (Optional[gensystem.bandwidth.Flow]): Flow its downloads
+                share bandwidth as.
+
+        """
+        self.id = next(self._ids)
+        self.kind = kind
+        self.flow = flow or gensystem_bandwidth.DEFAULT_FLOW
+        self.state = 'pending'
+        self.phase = None
+        self.transferred = 0
+        self.total = None
+        self.error = None
+        self._result = None
+        self._function = function
+        self._args = args
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def add_listener(self, listener):
+        """Call a function on every change of state, phase or progress.
+
+        Listeners are called from the worker running the job (or at once,
+        if the job is done already) and must not block it for long.
+
+        Args:
+            listener (fn): Function taking the job and the event: state,
+                phase or progress.
+
+        """
+        with self._lock:
+            self._listeners.append(listener)
+            done = self._done.is_set()
+        if done:
+            listener(self, 'state')
+
+    def snapshot(self):
+        """Get the state of the job.
+
+        Returns:
+            dict: id, kind, state, phase, transferred, total and error
+            (message or None).
+
+        """
+        return {
+            'id': self.id, 'kind': self.kind, 'state': self.state,
+            'phase': self.phase, 'transferred': self.transferred,
+            'total': self.total,
+            'error': str(self.error) if self.error is not None else None}
+
+    def done(self):
+        """Check whether the job has succeeded, failed or been cancelled."""
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the job to be done.
+
+        Args:
+            timeout (Optional[float]): Most seconds to wait, None for ever.
+
+        Returns:
+            bool: Whether the job is done.
+
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while not self._done.is_set():
+            remaining = WAIT if deadline is None else min(
+                WAIT, deadline - time.time())
+            if remaining <= 0:
+                break
+            # Waiting in slices, so KeyboardInterrupt is not held up
+            self._done.wait(remaining)
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the job and get its result.
+
+        Args:
+            timeout (Optional[float]): Most seconds to wait, None for ever.
+
+        Returns:
+            object: Result of the job (see the JobRunner.submit_* methods).
+
+        Raises:
+            JobError: When the job failed (or was cancelled), or is not done
+                within `timeout`.
+
+        """
+        if not self.wait(timeout):
+            raise JobError("Job %d is still %s." % (self.id, self.state))
+        if self.error is not None:
+            raise self.error
+        return self._result
+
+    def cancel(self):
+        """Cancel the job, unless it has started.
+
+        Returns:
+            bool: Whether the job was cancelled.
+
+        """
+        with self._lock:
+            if self.state != 'pending':
+                return self.state == 'cancelled'
+            self.state = 'cancelled'
+            self.error = JobCancelled("Job %d was cancelled." % self.id)
+        self._finish()
+        return True
+
+    def set_phase(self, phase, total=None):
+        """Start a phase of the job (e.g. downloading, verifying).
+
+        Args:
+            phase (str): Name of the phase.
+            total (Optional[int]): Bytes the phase will transfer, if known.
+
+        """
+        self.phase = phase
+        self.transferred = 0
+        self.total = total
+        self._notify('phase')
+
+    def hook(self, blocks, block_size, total):
+        """Record progress, as reported by download hooks."""
+        self.transferred = blocks * block_size
+        if total is not None and total >= 0:
+            self.total = total
+        self._notify('progress')
+
+    def update(self, transferred, total=None):
+        """Record the bytes the current phase has transferred so far."""
+        self.hook(1, transferred, total)
+
+    def run(self):
+        """Run the job (on a worker), keeping its result or error."""
+        with self._lock:
+            if self.state != 'pending':
+                return
+            self.state = 'running'
+        self._notify('state')
+
+        # Even a bug must not leave waiters waiting for ever
+        error = JobError("Job %d stopped unexpectedly." % self.id)
+        try:
+            with gensystem_metrics.span('job', kind=self.kind) as span:
+                try:
+                    with gensystem_bandwidth.flow(*self.flow):
+                        self._result = self._function(self, *self._args)
+                    error = None
+                except JobError as failure:
+                    error = failure
+                except (RuntimeError, ValueError, EnvironmentError,
+                        httplib.HTTPException) as failure:
+                    error = JobError(str(failure))
+                except Exception as failure:
+                    # A bug in one job must not take its worker down
+                    error = JobError("%s: %s" % (
+                        type(failure).__name__, failure))
+                span.set(failed=error is not None)
+        finally:
+            self.error = error
+            self.state = 'failed' if error is not None else 'succeeded'
+            gensystem_metrics.count('jobs', kind=self.kind, state=self.state)
+            self._finish()
+
+    def _finish(self):
+        """Wake waiters and tell listeners the job is done."""
+        self._done.set()
+        self._notify('state')
+
+    def _notify(self, event):
+        """Call the listeners with an event."""
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(self, event)
+
+
+class JobRunner(object):
+
+    """Runs jobs on a pool of workers, sharing state between them."""
+
+    def __init__(self, workers=WORKERS, listener=None):
+        """Start a runner (its workers start with the first job).
+
+        Args:
+            workers (Optional[int]): Most jobs running at once.
+            listener (Optional[fn]): Listener added to every job before
+                it is queued (see Job.add_listener).
+
+        """
+        self.workers = workers
+        self.listener = listener
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._country = None
+        self._urls = {}
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def submit_download(
+            self, media_file, arch='amd64', mirror=None, directory='.',
+            rehash=False, priority=None):
+        """Download media and verify it against its DIGESTS.
+
+        Media already in `directory` that verifies is not downloaded again,
+        and a download already being made by another process is followed
+        rather than repeated (see gensystem.lock).
+
+        Args:
+            media_file (str): Media file, e.g. stage3 or minimal.
+            arch (Optional[str]): Architecture of the media.
+            mirror (Optional[str]): Mirror (base URL), default: one in the
+                country GeoIP places this machine in.
+            directory (Optional[str]): Directory to save the media in.
+            rehash (Optional[bool]): Whether to hash media already saved
+                even if it is unchanged since it was last hashed.
+            priority (Optional[int]): Share of the bandwidth relative to
+                other jobs, when limited (see gensystem.bandwidth).
+
+        Returns:
+            Job: Job whose result is a Download.
+
+        """
+        return self._submit('download', self._download, (
+            media_file, arch, mirror, directory, rehash),
+            gensystem_bandwidth.Flow(media_file, priority))
+
+    def submit_verify(self, path, digests=None, rehash=False):
+        """Verify a file against a DIGESTS file.
+
+        Args:
+            path (str): Path of the file.
+            digests (Optional[str]): Path or URL of the DIGESTS file
+                (default: the file's path with .DIGESTS appended).
+            rehash (Optional[bool]): Whether to hash the file even if it is
+                unchanged since it was last hashed.
+
+        Returns:
+            Job: Job whose result is the file's hex SHA512.
+
+        """
+        return self._submit('verify', self._verify, (path, digests, rehash))
+
+    def submit_install(
+            self, targets, media_file='stage3', arch='amd64', mirror=None,
+            tarball=None, link=None, priority=None, snapshot=True):
+        """Install a stage tarball into one or more target roots.
+
+        Args:
+            targets (list): Target root directories.
+            media_file (Optional[str]): Stage media file to download.
+            arch (Optional[str]): Architecture of the media.
+            mirror (Optional[str]): Mirror (base URL), default: as for
+                submit_download.
+            tarball (Optional[str]): Local tarball to install instead (or
+                the copy transcoded from it, see gensystem.transcode).
+            link (Optional[str]): One of gensystem.install.LINK_MODES to
+                populate targets after the first from it.
+            priority (Optional[int]): As for submit_download.
+            snapshot (Optional[bool]): Whether to install the latest Portage
+                snapshot from the same mirror along with a downloaded stage
+                (see gensystem.snapshot); not done for a local tarball.
+
+        Returns:
+            Job: Job whose result is an Install.
+
+        """
+        return self._submit('install', self._install, (
+            list(targets), media_file, arch, mirror, tarball, link,
+            snapshot),
+            gensystem_bandwidth.Flow(media_file, priority))
+
+    def shutdown(self, wait=True):
+        """Stop taking jobs, and stop the workers once the queue is empty.
+
+        Args:
+            wait (Optional[bool]): Whether to wait for queued jobs.
+
+        """
+        with self._lock:
+            self._closed = True
+            threads = list(self._threads)
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(WAIT)
+
+    def choose_mirror(self, arch='amd64', media_file='stage3'):
+        """Choose a mirror for media without asking the user.
+
+        Mirrors known to be stale are left out (see gensystem.freshness).
+        Of the rest, the one that was fastest for this machine is chosen,
+        or a random one if none has been used.
+
+        Args:
+            arch (Optional[str]): Architecture of the media.
+            media_file (Optional[str]): Media file, e.g. stage3.
+
+        Returns:
+            str: Base URL of the mirror.
+
+        Raises:
+            JobError: When no mirrors are known for this machine's country.
+
+        """
+        mirrors = gensystem_mirror.GENTOO_MIRRORS.get(self._get_country())
+        if not mirrors:
+            raise JobError(
+                "No mirrors are known for this machine's country, "
+                "a mirror must be given.")
+
+        urls = sorted(gensystem_freshness.filter_fresh(
+            mirrors, arch, media_file).values())
+        throughputs = dict(
+            (url, gensystem_segments.load_tuning(
+                gensystem_metrics.get_mirror(url)).get('throughput'))
+            for url in urls)
+        scored = [url for url in urls if throughputs[url]]
+        if scored:
+            return max(scored, key=throughputs.get)
+        return random.choice(urls)
+
+    def get_media_url(self, mirror, arch, media_file):
+        """Get the URL of media, remembered for URL_TTL seconds.
+
+        Raises:
+            RuntimeError: When the media file cannot be found.
+
+        """
+        key = (mirror, arch, media_file)
+        with self._lock:
+            url, found = self._urls.get(key, (None, 0))
+        if url is None or time.time() - found > URL_TTL:
+            url = gensystem_media.get_media_file_url(mirror, arch, media_file)
+            with self._lock:
+                self._urls[key] = (url, time.time())
+        return url
+
+    def _get_country(self):
+        """Get the (Gentoo) country of this machine, found once."""
+        if self._country is None:
+            country = gensystem_utils.get_country_code_by_ip(
+                gensystem_utils.get_public_ip())
+            self._country = COUNTRY_DISCREPANCIES.get(country, country)
+        return self._country
+
+    def _submit(self, kind, function, args, flow=None):
+        """Queue a job, starting a worker if fewer than `workers` run."""
+        job = Job(kind, function, args, flow)
+        if self.listener is not None:
+            job.add_listener(self.listener)
+        with self._lock:
+            if self._closed:
+                raise JobError("The runner is shut down.")
+            self._threads = [
+                thread for thread in self._threads if thread.is_alive()]
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        self._queue.put(job)
+        return job
+
+    def _work(self):
+        """Run jobs from the queue until told to stop."""
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.run()
+
+    def _find_media(self, job, media_file, arch, mirror):
+        """Get the mirror and URL of media, choosing a mirror if need be."""
+        job.set_phase('finding')
+        try:
+            mirror = mirror or self.choose_mirror(arch, media_file)
+            return mirror, self.get_media_url(mirror, arch, media_file)
+        except RuntimeError as error:
+            raise JobError(str(error))
+
+    def _get_valid_sha512(self, media_url):
+        """Get the SHA512 of media listed in its DIGESTS.
+
+        Raises:
+            JobError: When the DIGESTS cannot be downloaded or do not list
+                the media.
+
+        """
+        name = os.path.basename(media_url)
+        digest_url = media_url + '.DIGESTS'
+        with gensystem_temp.temp_directory() as temp_dir:
+            digest_file = os.path.join(temp_dir, name + '.DIGESTS')
+            digest_downloaded, error = gensystem_utils.download_small_file(
+                digest_url, digest_file, 'digests',
+                gensystem_mirror.get_alternate_url(digest_url))
+            if not digest_downloaded:
+                raise JobError("Digest of %s could NOT be downloaded (%s)." % (
+                    name, error))
+            valid_sha512 = gensystem_utils.get_sha512_digest(
+                digest_file, name)
+        if valid_sha512 is None:
+            raise JobError("%s is NOT listed in its DIGESTS." % name)
+        return valid_sha512
+
+    def _download(self, job, media_file, arch, mirror, directory, rehash):
+        """Download and verify media (see submit_download)."""
+        _, media_url = self._find_media(job, media_file, arch, mirror)
+        path = os.path.join(directory, os.path.basename(media_url))
+        job.set_phase('digests')
+        valid_sha512 = self._get_valid_sha512(media_url)
+
+        if os.path.isfile(path):
+            job.set_phase('verifying')
+            sha512, _ = gensystem_digests.hash_file(path, force=rehash)
+            if sha512 == valid_sha512:
+                return Download(
+                    path, media_url, sha512, os.path.getsize(path))
+
+        job.set_phase('downloading')
+        sha512 = error = None
+        lock = gensystem_lock.DownloadLock(path)
+        try:
+            while not lock.acquire():
+                sha512 = gensystem_lock.follow(path, lock, job.hook)
+                if sha512 is not None:
+                    break
+            if lock.owned:
+                downloaded, error = gensystem_utils.download_file(
+                    media_url, path, lock.wrap_hook(job.hook),
+                    lock.record_ready)
+                lock.release(downloaded)
+                if not downloaded:
+                    raise JobError("%s could NOT be downloaded (%s)." % (
+                        media_url, error))
+        finally:
+            lock.close()
+
+        if sha512 is None:
+            job.set_phase('verifying')
+            sha512, _ = gensystem_digests.hash_file(path, force=True)
+        if sha512 != valid_sha512:
+            raise JobError("%s did NOT verify." % path)
+        return Download(path, media_url, sha512, os.path.getsize(path))
+
+    def _verify(self, job, path, digests, rehash):
+        """Verify a file (see submit_verify)."""
+        name = os.path.basename(path)
+        digests = digests or path + '.DIGESTS'
+        job.set_phase('digests')
+        with gensystem_temp.temp_directory() as temp_dir:
+            if digests.startswith(('http://', 'https://')):
+                digest_file = os.path.join(temp_dir, name + '.DIGESTS')
+                digest_downloaded, error = gensystem_utils.download_small_file(
+                    digests, digest_file, 'digests')
+                if not digest_downloaded:
+                    raise JobError("%s could NOT be downloaded (%s)." % (
+                        digests, error))
+                digests = digest_file
+            valid_sha512 = gensystem_utils.get_sha512_digest(digests, name)
+        if valid_sha512 is None:
+            raise JobError("%s is NOT listed in %s." % (name, digests))
+
+        job.set_phase('verifying', os.path.getsize(path))
+        sha512, _ = gensystem_digests.hash_file(path, force=rehash)
+        job.update(os.path.getsize(path))
+        if sha512 != valid_sha512:
+            raise JobError("%s did NOT verify." % path)
+        return sha512
+
+    def _install(
+            self, job, targets, media_file, arch, mirror, tarball, link,
+            snapshot):
+        """Install a stage tarball (see submit_install)."""
+        valid_sha512 = None
+        if tarball:
+            snapshot = None
+            # A transcoded copy is quicker to read (see gensystem.transcode)
+            name = gensystem_transcode.find_copy(tarball) or tarball
+            source, decompressor = gensystem_transcode.open_tarball(name)
+            size = None if isinstance(
+                source, gensystem_transcode.ZstdReader) else (
+                    os.path.getsize(name))
+        else:
+            mirror, media_url = self._find_media(
+                job, media_file, arch, mirror)
+            name = os.path.basename(media_url)
+            job.set_phase('digests')
+            valid_sha512 = self._get_valid_sha512(media_url)
+            snapshot = snapshot and gensystem_snapshot.Snapshot(mirror)
+            if snapshot and snapshot.fetch_checksum() is None:
+                raise JobError(
+                    "Checksum of %s could NOT be downloaded." % snapshot.name)
+            source = gensystem_retry.call(
+                gensystem_transfer.open_url, media_url)
+            size = source.length
+            decompressor = gensystem_install.get_decompressor(name)
+
+        job.set_phase('installing', size)
+        hasher = hashlib.sha512()
+        with contextlib.closing(source):
+            stage = (
+                gensystem_install.HashingReader(
+                    source, hasher,
+                    lambda transferred: job.update(transferred, size)),
+                decompressor)
+            if snapshot:
+                snapshot_stage = snapshot.open()
+                with contextlib.closing(snapshot_stage[0].fileobj):
+                    errors = gensystem_install.install_with_snapshot(
+                        stage, snapshot_stage, targets, link)
+            else:
+                errors = gensystem_install.install_stage(
+                    stage[0], targets, stage[1], link)
+        if errors:
+            raise JobError("Could NOT install into %s." % ', '.join(
+                '%s (%s)' % (target, errors[target])
+                for target in targets if target in errors))
+        if valid_sha512 is not None and hasher.hexdigest() != valid_sha512:
+            raise JobError("%s did NOT verify, targets are untrusted." % name)
+        if snapshot and not snapshot.is_verified():
+            raise JobError("%s did NOT verify, targets are untrusted." % (
+                snapshot.name))
+        return Install(
+            name, hasher.hexdigest(), targets,
+            snapshot.name if snapshot else None)
@@ -0,0 +1,237 @@
+"""Deduplicate concurrent downloads of the same file on one host.
+
+The first process to lock a destination downloads it. Other processes
+follow along, reading (and hashing) the file as it grows, instead of
+opening their own upstream connections. Locks are flock(2) locks, which
+the kernel drops when their owner exits, so a crashed owner is noticed by
+its followers and one of them takes the download over.
+
+Lock files are kept in locks/ in the user's cache directory (see
+gensystem.cache), or next to the destination when the cache directory
+cannot be written.
+
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import time
+
+import gensystem.cache as gensystem_cache
+import gensystem.metrics as gensystem_metrics
+
+LOCK_DIR = 'locks'
+POLL_INTERVAL = 0.5
+READ_SIZE = 1024 * 1024
+STATE_SIZE = 256
+
+
+class DownloadLock(object):
+
+    """Advisory lock (plus shared state) for one download destination."""
+
+    def __init__(self, destination, lock_dir=None):
+        """Open the lock for `destination` without taking it.
+
+        Args:
+            destination (str): Path the download is saved to.
+            lock_dir (Optional[str]): Directory for lock files (default:
+                locks/ in the cache directory).
+
+        Raises:
+            OSError: When no lock file can be opened.
+
+        """
+        name = hashlib.sha1(os.path.realpath(destination)).hexdigest()
+        lock_dir = lock_dir or gensystem_cache.get_cache_path(LOCK_DIR)
+        self.path = os.path.join(lock_dir, '%s.lock' % name)
+        self.owned = False
+        self._size = None
+        self._ready = None
+        try:
+            if not os.path.isdir(lock_dir):
+                os.makedirs(lock_dir, 0700)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        except OSError as error:
+            if error.errno not in (errno.EACCES, errno.EPERM, errno.EROFS):
+                raise
+            # The destination's directory is writable, or nothing is
+            self.path = destination + '.lock'
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+
+    def acquire(self):
+        """Try to become the process that downloads the destination.
+
+        Returns:
+            bool: Whether the lock was taken.
+
+        """
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as error:
+            if error.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+
+        self.owned = True
+        self._size = self._ready = None
+        self.write_state('downloading')
+        return True
+
+    def release(self, complete):
+        """Record how the download ended and let followers finish.
+
+        Args:
+            complete (bool): Whether the download completed.
+
+        """
+        self.write_state('complete' if complete else 'failed', self._size)
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self.owned = False
+
+    def close(self):
+        """Close the lock, releasing it if still held."""
+        os.close(self._fd)
+
+    def is_held(self):
+        """Check whether a (live) process holds the lock.
+
+        Returns:
+            bool: Whether the lock is held by another process.
+
+        """
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError as error:
+            if error.errno in (errno.EAGAIN, errno.EACCES):
+                return True
+            raise
+
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return False
+
+    def read_state(self):
+        """Read the state the owner last recorded.
+
+        Returns:
+            dict: State with pid, state and size keys (empty if unknown).
+
+        """
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        try:
+            return json.loads(os.read(self._fd, 4096))
+        except ValueError:
+            return {}
+
+    def write_state(self, state, size=None, ready=None):
+        """Record the download state for followers.
+
+        The state is written as one fixed size record, so followers never
+        read a truncated or half-replaced state.
+
+        Args:
+            state (str): One of downloading, complete or failed.
+            size (Optional[int]): Total size of the download if known.
+            ready (Optional[int]): Bytes from the start of the file that
+                are written, if the file is not written in order.
+
+        """
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.write(self._fd, json.dumps({
+            'pid': os.getpid(), 'state': state, 'size': size,
+            'ready': ready}).ljust(STATE_SIZE))
+
+    def record_ready(self, ready):
+        """Record how much of the file followers may read.
+
+        Downloads written out of order (e.g. over several connections)
+        must call this, or followers would read holes not yet written.
+
+        Args:
+            ready (int): Bytes from the start of the file that are written.
+
+        """
+        self._ready = ready
+        self.write_state('downloading', self._size, ready)
+
+    def wrap_hook(self, hook=None):
+        """Wrap a download hook so followers learn the download size.
+
+        Args:
+            hook (Optional[fn]): Hook taking (blocks, block_size, total).
+
+        Returns:
+            fn: Hook recording the total size before calling `hook`.
+
+        """
+        def recording_hook(blocks, block_size, total):
+            if total > 0 and total != self._size:
+                self._size = total
+                self.write_state('downloading', total, self._ready)
+            if hook is not None:
+                hook(blocks, block_size, total)
+
+        return recording_hook
+
+
+def follow(destination, lock, hook=None, poll_interval=POLL_INTERVAL):
+    """Follow another process's download of `destination` to its end.
+
+    The file is hashed as it grows so it can be verified as soon as the
+    owner finishes. Only the part the owner records as ready is read while
+    it is still downloading.
+
+    Args:
+        destination (str): Path the owner is downloading to.
+        lock (DownloadLock): Lock for `destination`, held by the owner.
+        hook (Optional[fn]): Hook taking (blocks, block_size, total).
+        poll_interval (Optional[float]): Seconds between checks.
+
+    Returns:
+        str: Hex SHA512 of the completed download, or None if the owner
+        failed or died and the download should be taken over.
+
+    """
+    with gensystem_metrics.span(
+            'follow_download', file=os.path.basename(destination)) as span:
+        hasher = hashlib.sha512()
+        offset = 0
+        while True:
+            # Checked before reading so the last read sees every byte written
+            held = lock.is_held()
+            state = lock.read_state()
+            if not held or state.get('state') == 'downloading':
+                # None (read it all) unless written out of order
+                limit = state.get('ready') if held else None
+            else:
+                limit = offset  # Nothing can be trusted yet
+
+            try:
+                with open(destination, 'rb') as followed:
+                    if os.fstat(followed.fileno()).st_size < offset:
+                        # Restarted by a new owner
+                        hasher, offset = hashlib.sha512(), 0
+                    followed.seek(offset)
+                    while limit is None or offset < limit:
+                        data = followed.read(
+                            READ_SIZE if limit is None else
+                            min(READ_SIZE, limit - offset))
+                        if not data:
+                            break
+                        hasher.update(data)
+                        offset += len(data)
+            except IOError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+
+            if hook is not None and state.get('size'):
+                hook(1, offset, state['size'])
+
+            if not held:
+                span.set(bytes=offset, state=state.get('state'))
+                return hasher.hexdigest() if (
+                    state.get('state') == 'complete') else None
+
+            time.sleep(poll_interval)
@@ -4,6 +4,10 @@ from collections import namedtuple
 import os
 import re
 
+from bs4 import BeautifulSoup
+
+import gensystem.catalog as gensystem_catalog
+import gensystem.metrics as gensystem_metrics
 import gensystem.mirror as gensystem_mirror
 import gensystem.utils as gensystem_utils
 
@@ -24,13 +28,35 @@ AMD64 = Arch(
 SUPPORTED_ARCH = {'amd64': AMD64}
 
 
+def get_media_folder(mirror, arch, media_file):
+    """Get the autobuild folder of gentoo media and how its files are named.
+
+    Args:
+        mirror (str): Gentoo (base) mirror.
+        arch (str): The name of the architecture download is for.
+        media_file (str): The name of the media file download is for.
+
+    Returns:
+        tuple: URL of the folder (without a trailing slash) and a regular
+        expression matching the media file's name.
+
+    """
+    releases = gensystem_mirror.GENTOO_RELEASES_TEMPLATE % (
+        arch, getattr(SUPPORTED_ARCH[arch], media_file))
+    folder, regex = os.path.join(mirror, releases[:-1]).split('::')
+    return folder, regex
+
+
 def get_media_file_url(mirror, arch, media_file):
     """Get the URL path to gentoo media.
 
-    To get the media file URL, this function builds the releases folder URL
-    that houses the downloads. Then using a regular expression, it matches
-    the specified media file in that folder and returns the URL path to the
-    file.
+    Media in the catalog (see gensystem.catalog) is looked up there,
+    without any requests. Otherwise, to get the media file URL, this
+    function builds the releases folder URL that houses the downloads. Then
+    using a regular expression, it matches the specified media file in that
+    folder and returns the URL path to the file. A slow listing is hedged
+    with another mirror's, in which case the file is downloaded from that
+    mirror.
 
     Args:
         mirror (str): Gentoo (base) mirror.
@@ -40,15 +66,29 @@ def get_media_file_url(mirror, arch, media_file):
     Returns:
         str: URL path to the specified media file.
 
+    Raises:
+        RuntimeError: When the media file cannot be found.
+
     """
-    releases = gensystem_mirror.GENTOO_RELEASES_TEMPLATE % (
-        arch, getattr(SUPPORTED_ARCH[arch], media_file))
-    folder, regex = os.path.join(mirror, releases[:-1]).split('::')
+    media = gensystem_catalog.get_media(arch, media_file)
+    if media is not None:
+        gensystem_metrics.count('catalog_hits')
+        return gensystem_catalog.get_media_url(mirror, media)
+    if media_file not in getattr(SUPPORTED_ARCH.get(arch), '_fields', ()):
+        raise RuntimeError(
+            "%s %s is not catalogued (try 'gensystem catalog update')." % (
+                arch, media_file))
+
+    folder, regex = get_media_folder(mirror, arch, media_file)
 
-    soupified_folder = gensystem_utils.soupify(folder)
-    links = soupified_folder.find_all(href=re.compile(regex))
-    try:
-        # Use -1 index to avoid image links
-        return os.path.join(folder, links[-1]['href'])
-    except (IndexError, KeyError):
-        raise RuntimeError("Gentoo media file not found in %s." % folder)
+    with gensystem_metrics.span(
+            'get_media_file_url', mirror=gensystem_metrics.get_mirror(mirror),
+            media=media_file):
+        folder_read, listing = gensystem_utils.read_hedged(
+            folder, 'listing', gensystem_mirror.get_alternate_url(folder))
+        links = BeautifulSoup(listing).find_all(href=re.compile(regex))
+        try:
+            # Use -1 index to avoid image links
+            return os.path.join(folder_read, links[-1]['href'])
+        except (IndexError, KeyError):
+            raise RuntimeError("Gentoo media file not found in %s." % folder)
@@ -0,0 +1,311 @@
+"""Time the phases of a gensystem run and count what they move.
+
+Library functions open nested timing spans around each phase (public IP
+lookup, GeoIP, finding the media URL, transfers, verification) and bump
+counters such as bytes downloaded per mirror. At the end of a run the
+recorder can be written out as a JSON report or as a Prometheus textfile
+collector file.
+
+The default recorder only keeps counters: a process using gensystem as a
+library (e.g. running jobs, see gensystem.jobs) for ever would otherwise
+keep every span it ever opened. A gensystem run (and a benchmark) puts a
+recorder keeping spans in its place.
+
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+import urlparse
+
+# Spans whose bytes and duration count towards mirror throughput
+TRANSFER_SPANS = ('download_file',)
+
+
+class Span(object):
+
+    """One timed phase of a run, possibly holding nested phases."""
+
+    def __init__(self, name, attributes, start):
+        """Start a span.
+
+        Args:
+            name (str): Name of the phase.
+            attributes (dict): Extra facts about the phase.
+            start (float): Time the phase started.
+
+        """
+        self.name = name
+        self.attributes = attributes
+        self.start = start
+        self.end = None
+        self.children = []
+
+    @property
+    def duration(self):
+        """float: Seconds the span took (so far, if still open)."""
+        return (self.end if self.end is not None else time.time()) - (
+            self.start)
+
+    def set(self, **attributes):
+        """Add facts learned during the phase (e.g. bytes moved)."""
+        self.attributes.update(attributes)
+
+    def walk(self):
+        """Yield this span and every span nested in it."""
+        yield self
+        for child in self.children:
+            for span in child.walk():
+                yield span
+
+    def to_dict(self):
+        """Get the span (and its children) as plain data.
+
+        Returns:
+            dict: Span name, start, duration, attributes and children.
+
+        """
+        return {
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'attributes': self.attributes,
+            'children': [child.to_dict() for child in self.children]}
+
+
+class Recorder(object):
+
+    """Collect spans and counters for a run."""
+
+    def __init__(self, clock=time.time, keep_spans=True):
+        """Start recording.
+
+        Args:
+            clock (Optional[fn]): Function returning the time in seconds.
+            keep_spans (Optional[bool]): Whether to keep the spans timed,
+                or only the counters.
+
+        """
+        self.keep_spans = keep_spans
+        self.spans = []
+        self.counters = {}
+        self.started = clock()
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """Time a phase, nesting it in the current thread's open span.
+
+        Args:
+            name (str): Name of the phase.
+            **attributes: Extra facts about the phase.
+
+        Yields:
+            Span: The open span, to add attributes to.
+
+        """
+        stack = self._local.__dict__.setdefault('stack', [])
+        span = Span(name, attributes, self._clock())
+        if stack:
+            stack[-1].children.append(span)
+        elif self.keep_spans:
+            with self._lock:
+                self.spans.append(span)
+
+        stack.append(span)
+        try:
+            yield span
+        except Exception as error:
+            span.set(error=str(error))
+            raise
+        finally:
+            span.end = self._clock()
+            stack.pop()
+
+    def count(self, name, value=1, **labels):
+        """Add `value` to a counter.
+
+        Args:
+            name (str): Name of the counter.
+            value (Optional[float]): Amount to add.
+            **labels: Labels distinguishing counters of the same name.
+
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def get_phase_durations(self):
+        """Get the total seconds spent in each phase, by phase name.
+
+        Returns:
+            dict: Seconds by phase name.
+
+        """
+        durations = {}
+        for root in self.spans:
+            for span in root.walk():
+                durations[span.name] = (
+                    durations.get(span.name, 0) + span.duration)
+
+        return durations
+
+    def get_mirror_throughput(self):
+        """Get bytes, seconds and throughput of transfers by mirror.
+
+        Returns:
+            dict: {mirror: {'bytes': ..., 'seconds': ..., 'throughput': ...}}
+
+        """
+        mirrors = {}
+        for root in self.spans:
+            for span in root.walk():
+                mirror = span.attributes.get('mirror')
+                if span.name not in TRANSFER_SPANS or not mirror:
+                    continue
+                stats = mirrors.setdefault(mirror, {'bytes': 0, 'seconds': 0})
+                stats['bytes'] += span.attributes.get('bytes', 0)
+                stats['seconds'] += span.duration
+
+        for stats in mirrors.values():
+            stats['throughput'] = (
+                stats['bytes'] / stats['seconds'] if stats['seconds'] else 0)
+
+        return mirrors
+
+    def report(self, success=None):
+        """Get everything recorded as plain data.
+
+        Args:
+            success (Optional[bool]): Whether the run succeeded.
+
+        Returns:
+            dict: The run report.
+
+        """
+        return {
+            'started': self.started,
+            'duration': self._clock() - self.started,
+            'success': success,
+            'spans': [span.to_dict() for span in self.spans],
+            'phases': self.get_phase_durations(),
+            'counters': [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self.counters.items())],
+            'mirrors': self.get_mirror_throughput()}
+
+    def write_report(self, path, success=None):
+        """Write the run report as JSON.
+
+        Args:
+            path (str): Path of the report file.
+            success (Optional[bool]): Whether the run succeeded.
+
+        """
+        _write_atomically(
+            path, json.dumps(self.report(success), indent=4, sort_keys=True))
+
+    def write_prometheus(self, path, success=None):
+        """Write the run as a Prometheus textfile collector file.
+
+        Args:
+            path (str): Path of the .prom file.
+            success (Optional[bool]): Whether the run succeeded.
+
+        """
+        lines = []
+
+        def gauge(name, help_text, samples):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s gauge' % name)
+            for labels, value in samples:
+                lines.append('%s%s %r' % (
+                    name, format_labels(labels), float(value)))
+
+        gauge('gensystem_last_run_timestamp_seconds',
+              'When the last gensystem run started.', [({}, self.started)])
+        gauge('gensystem_last_run_duration_seconds',
+              'How long the last gensystem run took.',
+              [({}, self._clock() - self.started)])
+        if success is not None:
+            gauge('gensystem_last_run_success',
+                  'Whether the last gensystem run succeeded.',
+                  [({}, int(success))])
+        gauge('gensystem_phase_duration_seconds',
+              'Seconds the last run spent in each phase.',
+              [({'phase': phase}, seconds) for phase, seconds in sorted(
+                  self.get_phase_durations().items())])
+
+        mirrors = sorted(self.get_mirror_throughput().items())
+        gauge('gensystem_mirror_throughput_bytes_per_second',
+              'Transfer throughput of each mirror in the last run.',
+              [({'mirror': mirror}, stats['throughput'])
+               for mirror, stats in mirrors])
+
+        names = sorted(set(name for name, _ in self.counters))
+        for name in names:
+            gauge('gensystem_%s' % name, '%s in the last run.' % (
+                name.replace('_', ' ').capitalize()),
+                [(dict(labels), value)
+                 for (counter, labels), value in sorted(
+                     self.counters.items()) if counter == name])
+
+        _write_atomically(path, '\n'.join(lines) + '\n')
+
+
+def format_labels(labels):
+    """Format Prometheus labels, escaping their values.
+
+    Args:
+        labels (dict): Label values by name.
+
+    Returns:
+        str: Labels as {name="value",...} or '' if there are none.
+
+    """
+    if not labels:
+        return ''
+
+    escaped = [
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for name, value in sorted(labels.items())]
+    return '{%s}' % ','.join(escaped)
+
+
+def get_mirror(url):
+    """Get the mirror (host) part of a URL for labelling.
+
+    Args:
+        url (str): URL on a mirror.
+
+    Returns:
+        str: Host (and port) of `url`.
+
+    """
+    return urlparse.urlsplit(url).netloc
+
+
+def _write_atomically(path, contents):
+    """Write `contents` to `path` so readers never see a partial file."""
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'w') as temp_file:
+        temp_file.write(contents)
+    os.rename(temp_path, path)
+
+
+RECORDER = Recorder(keep_spans=False)
+
+
+def span(name, **attributes):
+    """Time a phase with the default recorder (see Recorder.span)."""
+    return RECORDER.span(name, **attributes)
+
+
+def count(name, value=1, **labels):
+    """Add to a counter of the default recorder (see Recorder.count)."""
+    RECORDER.count(name, value, **labels)
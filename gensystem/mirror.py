@@ -1,13 +1,36 @@
-"""Collect Gentoo mirrors from gentoo.org."""
+"""Collect Gentoo mirrors from gentoo.org.
 
+The mirror list (GENTOO_MIRRORS) is read at start-up from a copy in the
+cache directory, or from data/mirrors.json bundled with the package until
+there is one, so no run waits on gentoo.org. Once the copy is MAX_AGE old,
+refresh_in_background starts a detached process that scrapes gentoo.org
+(see get_mirrors_from_web) and replaces the copy atomically for the next
+run. The refresh holds a lock, so concurrent runs do not refresh at once,
+and a failed refresh is not tried again for RETRY_INTERVAL.
+
+"""
+
+import contextlib
+import errno
+import fcntl
 import json
 import os
+import random
+import subprocess
+import sys
+import time
 from urlparse import urlparse
 
+import gensystem.cache as gensystem_cache
+import gensystem.metrics as gensystem_metrics
 import gensystem.utils as gensystem_utils
 
 GENTOO_MIRRORS_URL = 'https://www.gentoo.org/downloads/mirrors/'
 GENTOO_RELEASES_TEMPLATE = 'releases/%s/autobuilds/%s/'
+MIRRORS_FILE = 'mirrors.json'
+LOCK_FILE = 'mirrors.lock'
+MAX_AGE = 7 * 24 * 60 * 60
+RETRY_INTERVAL = 60 * 60
 
 SUPPORTED_COUNTRIES = [
     'CA', 'US', 'AR', 'BR', 'AT', 'BG', 'CZ', 'FI', 'FR', 'DE', 'GR', 'IE',
@@ -67,7 +90,8 @@ def get_mirrors_from_web(country=None):
     mirrors = {}
     country_name = None
 
-    mirrors_soup = gensystem_utils.soupify(GENTOO_MIRRORS_URL)
+    with gensystem_metrics.span('get_mirrors_from_web'):
+        mirrors_soup = gensystem_utils.soupify(GENTOO_MIRRORS_URL)
     for tag in mirrors_soup.find_all(True):
 
         if tag.name == 'h3' and tag.get('id') in SUPPORTED_COUNTRIES:
@@ -120,4 +144,156 @@ def get_mirrors_from_json(country=None):
             "Mirrors file was not found or could not be loaded.")
 
 
-GENTOO_MIRRORS = get_mirrors_from_json()
+def get_alternate_url(url, mirrors=None):
+    """Get the same file on another mirror in the same country.
+
+    Args:
+        url (str): URL of a file on a known mirror.
+        mirrors (Optional[dict]): Mirrors by country (default:
+            GENTOO_MIRRORS).
+
+    Returns:
+        str: URL of the file on another HTTP(S) mirror, or None when the
+        mirror is unknown or has no neighbour.
+
+    """
+    for country_mirrors in (mirrors or GENTOO_MIRRORS).values():
+        bases = [base.rstrip('/') + '/' for base in country_mirrors.values()]
+        for base in bases:
+            if url.startswith(base):
+                others = [
+                    other for other in bases if other != base and
+                    urlparse(other).scheme in ('http', 'https')]
+                if not others:
+                    return None
+                return random.choice(others) + url[len(base):]
+
+    return None
+
+
+def load_cached_mirrors():
+    """Load the copy of the mirror list kept in the cache directory.
+
+    Returns:
+        dict: When it was fetched and last attempted, and the mirrors by
+        country (empty if there is no copy).
+
+    """
+    cached = gensystem_cache.load_json(MIRRORS_FILE, {})
+    return cached if isinstance(cached, dict) else {}
+
+
+def get_mirrors():
+    """Get mirrors by country, from the cached copy or the bundled one."""
+    mirrors = load_cached_mirrors().get('mirrors')
+    if isinstance(mirrors, dict) and mirrors:
+        return mirrors
+    return get_mirrors_from_json()
+
+
+def is_stale(cached=None, now=None):
+    """Check whether the cached mirror list is due a refresh.
+
+    Args:
+        cached (Optional[dict]): From load_cached_mirrors (default: loaded).
+        now (Optional[float]): Time in seconds (default: now).
+
+    Returns:
+        bool: Whether it is MAX_AGE old (or missing) and no refresh was
+        attempted for RETRY_INTERVAL.
+
+    """
+    cached = load_cached_mirrors() if cached is None else cached
+    now = time.time() if now is None else now
+    return (
+        now - cached.get('fetched', 0) >= MAX_AGE and
+        now - cached.get('attempted', 0) >= RETRY_INTERVAL)
+
+
+@contextlib.contextmanager
+def refresh_lock():
+    """Try to take the refresh lock.
+
+    Yields:
+        bool: Whether the lock was taken (it is held until the block exits).
+
+    """
+    if not os.path.isdir(gensystem_cache.CACHE_DIR):
+        os.makedirs(gensystem_cache.CACHE_DIR)
+    fd = os.open(
+        gensystem_cache.get_cache_path(LOCK_FILE), os.O_RDWR | os.O_CREAT,
+        0644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as error:
+            if error.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+        else:
+            yield True
+    finally:
+        os.close(fd)  # Releases the lock
+
+
+def refresh():
+    """Replace the cached mirror list with gentoo.org's, if it is stale.
+
+    Returns:
+        bool: Whether the mirror list was refreshed.
+
+    """
+    with refresh_lock() as locked:
+        cached = load_cached_mirrors()
+        # Another process may have refreshed it while this one started
+        if not locked or not is_stale(cached):
+            return False
+
+        cached['attempted'] = time.time()
+        try:
+            mirrors = dict(
+                (country, country_mirrors) for country, country_mirrors in
+                get_mirrors_from_web().items() if country_mirrors)
+        except (RuntimeError, EnvironmentError, AttributeError, IndexError,
+                KeyError, TypeError):
+            mirrors = None  # gentoo.org is down, or its layout changed
+
+        if mirrors:
+            cached.update(fetched=cached['attempted'], mirrors=mirrors)
+        gensystem_cache.save_json(MIRRORS_FILE, cached)
+        gensystem_metrics.count(
+            'mirror_list_refreshes', result='ok' if mirrors else 'failed')
+        return bool(mirrors)
+
+
+def refresh_in_background():
+    """Start refreshing the cached mirror list in a detached process, if it
+    is stale. The refresh outlives this process if need be.
+
+    Nothing is started when the cache directory cannot be written: the
+    refresh could not be saved, nor its attempt recorded, so every run
+    would start one.
+
+    Returns:
+        bool: Whether a refresh was started.
+
+    """
+    if not is_stale() or not gensystem_cache.is_writable():
+        return False
+
+    try:
+        with open(os.devnull, 'r+') as devnull:
+            subprocess.Popen(
+                [sys.executable, '-m', 'gensystem.mirror'],
+                stdin=devnull, stdout=devnull, stderr=devnull,
+                close_fds=True, preexec_fn=os.setsid)
+    except OSError:
+        return False
+    return True
+
+
+GENTOO_MIRRORS = get_mirrors()
+
+
+if __name__ == '__main__':
+    refresh()
@@ -0,0 +1,153 @@
+"""Wrappers for POSIX calls missing from Python 2's os module.
+
+Each wrapper calls libc through ctypes when it can and falls back to plain
+Python file operations otherwise, so callers never need to check.
+
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+
+try:
+    _LIBC = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:  # pragma: no cover
+    _LIBC = None
+
+FALLOC_FL_KEEP_SIZE = 0x01
+POSIX_FADV_DONTNEED = 4
+
+_off_t = ctypes.c_longlong
+
+
+def _libc_function(name, restype, argtypes):
+    """Get a libc function by name or None if unavailable."""
+    function = getattr(_LIBC, name, None)
+    if function is not None:
+        function.restype = restype
+        function.argtypes = argtypes
+
+    return function
+
+
+_sendfile = _libc_function(
+    'sendfile', ctypes.c_ssize_t,
+    [ctypes.c_int, ctypes.c_int, ctypes.POINTER(_off_t), ctypes.c_size_t])
+_fallocate = _libc_function(
+    'fallocate', ctypes.c_int, [ctypes.c_int, ctypes.c_int, _off_t, _off_t])
+_pwrite = _libc_function(
+    'pwrite', ctypes.c_ssize_t,
+    [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, _off_t])
+_fadvise = _libc_function(
+    'posix_fadvise', ctypes.c_int,
+    [ctypes.c_int, _off_t, _off_t, ctypes.c_int])
+
+
+def sendfile(out_fd, in_fd, offset, count):
+    """Copy bytes from a file to a socket (or file) inside the kernel.
+
+    Args:
+        out_fd (int): Descriptor to write to.
+        in_fd (int): Descriptor of the file to read from.
+        offset (int): Offset in `in_fd` to start reading at.
+        count (int): Maximum number of bytes to copy.
+
+    Returns:
+        int: Number of bytes copied (0 at end of file).
+
+    Raises:
+        OSError: When the copy fails.
+
+    """
+    if _sendfile is not None:
+        c_offset = _off_t(offset)
+        sent = _sendfile(out_fd, in_fd, ctypes.byref(c_offset), count)
+        if sent >= 0:
+            return sent
+        error = ctypes.get_errno()
+        if error not in (errno.EINVAL, errno.ENOSYS):
+            raise OSError(error, os.strerror(error))
+
+    # Not supported for these descriptors, copy through userspace instead
+    os.lseek(in_fd, offset, os.SEEK_SET)
+    data = os.read(in_fd, min(count, 1024 * 1024))
+    return os.write(out_fd, data) if data else 0
+
+
+def fallocate(fd, offset, length):
+    """Reserve disk blocks for a file without changing its size.
+
+    Reserving the whole download up front avoids fragmentation. The size
+    is kept so readers of a growing file still see only what is written.
+
+    Args:
+        fd (int): Descriptor of the file.
+        offset (int): Offset the reservation starts at.
+        length (int): Number of bytes to reserve.
+
+    Returns:
+        bool: Whether the blocks were reserved (False if unsupported).
+
+    Raises:
+        OSError: When there is not enough space.
+
+    """
+    if _fallocate is None:
+        return False
+
+    if _fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length) == 0:
+        return True
+
+    error = ctypes.get_errno()
+    if error in (errno.ENOSPC, errno.EFBIG):
+        raise OSError(error, os.strerror(error))
+    return False  # Filesystem cannot do it, carry on without
+
+
+def pwrite(fd, data, length, offset):
+    """Write the first `length` bytes of a bytearray at an explicit offset.
+
+    Args:
+        fd (int): Descriptor of the file.
+        data (bytearray): Buffer to write from (not copied).
+        length (int): Number of bytes of `data` to write.
+        offset (int): Offset in the file to write at.
+
+    Raises:
+        OSError: When the write fails.
+
+    """
+    written = 0
+    while written < length:
+        if _pwrite is not None:
+            pointer = ctypes.addressof(
+                (ctypes.c_char * length).from_buffer(data)) + written
+            count = _pwrite(fd, pointer, length - written, offset + written)
+            if count < 0:
+                error = ctypes.get_errno()
+                if error == errno.EINTR:
+                    continue
+                raise OSError(error, os.strerror(error))
+        else:
+            os.lseek(fd, offset + written, os.SEEK_SET)
+            count = os.write(fd, buffer(data, written, length - written))
+        written += count
+
+
+def drop_cache(fd, offset, length):
+    """Drop the cached pages of part of a file, so reads hit the disk.
+
+    Dirty pages are not dropped, so the file should be synced first.
+
+    Args:
+        fd (int): Descriptor of the file.
+        offset (int): Offset the part starts at.
+        length (int): Number of bytes in the part.
+
+    Returns:
+        bool: Whether the pages were dropped (False if unsupported).
+
+    """
+    return _fadvise is not None and (
+        _fadvise(fd, offset, length, POSIX_FADV_DONTNEED) == 0)
@@ -0,0 +1,295 @@
+"""Report transfer progress at a fixed refresh rate.
+
+Transfers report every block they move, but the display is only redrawn
+(or an event emitted) once per refresh interval, so reporting costs next
+to nothing however small the blocks are. Transfers running side by side
+(e.g. a stage and its Portage snapshot) report as separate sources, and a
+download over several connections reports each connection as a part of
+its source; throughput is tracked per source and part as well as overall.
+
+"""
+
+import json
+import sys
+import threading
+import time
+
+BAR_LENGTH = 20
+REFRESH_INTERVAL = 0.2
+RATE_SMOOTHING = 0.3
+PROGRESS_MODES = ('bar', 'json', 'none')
+
+
+def format_size(size):
+    """Format a number of bytes for humans (e.g. 12.3 MB).
+
+    Args:
+        size (float): Number of bytes.
+
+    Returns:
+        str: Size with a unit.
+
+    """
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1000:
+            return '%.1f %s' % (size, unit)
+        size /= 1000.0
+
+    return '%.1f TB' % size
+
+
+def format_eta(seconds):
+    """Format an estimated time remaining as H:MM:SS.
+
+    Args:
+        seconds (float): Seconds remaining or None if unknown.
+
+    Returns:
+        str: Formatted time, or --:--:-- if unknown.
+
+    """
+    if seconds is None:
+        return '--:--:--'
+
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+class Progress(object):
+
+    """Progress of one transfer made up of one or more sources."""
+
+    def __init__(
+            self, name, renderer, interval=REFRESH_INTERVAL,
+            clock=time.time):
+        """Track progress of `name`, rendering it with `renderer`.
+
+        Args:
+            name (str): Name of what is being transferred.
+            renderer (object): Renderer with a render(snapshot, event)
+                method, see get_renderer.
+            interval (Optional[float]): Seconds between renders.
+            clock (Optional[fn]): Function returning the time in seconds.
+
+        """
+        self.name = name
+        self.renderer = renderer
+        self.interval = interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._started = clock()
+        self._last_render = None
+        self._sources = {}
+
+    def update(self, transferred, total=None, source=None, part=False):
+        """Record the bytes a source has transferred so far.
+
+        Args:
+            transferred (int): Bytes transferred by `source` in total.
+            total (Optional[int]): Bytes `source` will transfer if known.
+            source (Optional[str]): Source name, None if the transfer has
+                a single source.
+            part (Optional[bool]): Whether `source` is part of another
+                source (e.g. one connection), shown but not added up.
+
+        """
+        now = self._clock()
+        with self._lock:
+            state = self._sources.setdefault(
+                source, {'transferred': 0, 'total': None, 'rate': 0.0,
+                         'sampled': self._started, 'sampled_bytes': 0,
+                         'part': part})
+            state['transferred'] = transferred
+            if total is not None and total >= 0:
+                state['total'] = total
+
+            due = (
+                self._last_render is None or
+                now - self._last_render >= self.interval)
+            if due:
+                self._render(now, 'progress')
+
+    def finish(self, success=True):
+        """Render the final state of the transfer.
+
+        Args:
+            success (Optional[bool]): Whether the transfer succeeded.
+
+        """
+        with self._lock:
+            self._render(self._clock(), 'done' if success else 'failed')
+
+    def hook(self, source=None):
+        """Get a download hook reporting to this progress.
+
+        Args:
+            source (Optional[str]): Source the hook reports for.
+
+        Returns:
+            fn: Hook taking (blocks, block_size, total).
+
+        """
+        def progress_hook(blocks, block_size, total):
+            self.update(blocks * block_size, total, source)
+
+        return progress_hook
+
+    def part_hook(self, part):
+        """Get a download hook reporting one part of the transfer.
+
+        Args:
+            part (str): Name of the part, e.g. a connection.
+
+        Returns:
+            fn: Hook taking (blocks, block_size, total).
+
+        """
+        def progress_hook(blocks, block_size, total):
+            self.update(blocks * block_size, total, part, part=True)
+
+        return progress_hook
+
+    def snapshot(self):
+        """Get the current state without rendering it.
+
+        Returns:
+            dict: State as passed to renderers.
+
+        """
+        with self._lock:
+            return self._snapshot(self._clock(), sample=False)
+
+    def _snapshot(self, now, sample=True):
+        """Build the state passed to renderers, sampling source rates."""
+        sources = []
+        for source, state in sorted(self._sources.items()):
+            elapsed = now - state['sampled']
+            if sample and elapsed > 0:
+                rate = (
+                    state['transferred'] - state['sampled_bytes']) / elapsed
+                # Smooth so the rate and ETA do not jump about
+                state['rate'] = (
+                    rate if state['sampled'] == self._started else
+                    RATE_SMOOTHING * rate +
+                    (1 - RATE_SMOOTHING) * state['rate'])
+                state['sampled'] = now
+                state['sampled_bytes'] = state['transferred']
+            sources.append({
+                'source': source, 'transferred': state['transferred'],
+                'total': state['total'], 'rate': state['rate'],
+                'part': state['part']})
+
+        # Parts are already counted by the source they are part of
+        wholes = [source for source in sources if not source['part']]
+        transferred = sum(source['transferred'] for source in wholes)
+        totals = [source['total'] for source in wholes]
+        total = sum(totals) if totals and None not in totals else None
+        rate = sum(source['rate'] for source in wholes)
+        eta = (total - transferred) / rate if total and rate > 0 else None
+
+        return {
+            'name': self.name,
+            'transferred': transferred,
+            'total': total,
+            'rate': rate,
+            'eta': eta,
+            'elapsed': now - self._started,
+            'sources': [
+                source for source in sources if source['source'] is not None]}
+
+    def _render(self, now, event):
+        """Render the current state (the lock must be held)."""
+        self._last_render = now
+        self.renderer.render(self._snapshot(now), event)
+
+
+class BarRenderer(object):
+
+    """Redraw a progress bar with throughput and ETA on one line."""
+
+    def __init__(self, stream=None, length=BAR_LENGTH):
+        """Draw on `stream` (default: stdout).
+
+        Args:
+            stream (Optional[file]): Stream to draw on.
+            length (Optional[int]): Length of the bar in characters.
+
+        """
+        self.stream = stream
+        self.length = length
+        self._drawn = 0
+
+    def render(self, snapshot, event):
+        """Redraw the bar for `snapshot`."""
+        total = snapshot['total']
+        if total:
+            progress = min(float(snapshot['transferred']) / total, 1.0)
+            hashes = '#' * int(round(progress * self.length))
+            line = 'Progress: [{0}] {1}%'.format(
+                hashes.ljust(self.length), int(progress * 100))
+        else:
+            line = 'Progress: %s' % format_size(snapshot['transferred'])
+
+        line += '  %s/s  ETA %s' % (
+            format_size(snapshot['rate']), format_eta(snapshot['eta']))
+        if snapshot['sources']:
+            line += '  (%s)' % ', '.join(
+                '%s %s/s' % (source['source'], format_size(source['rate']))
+                for source in snapshot['sources'])
+
+        stream = self.stream or sys.stdout
+        # Pad to wipe out the end of a longer previous line
+        stream.write('\r' + line.ljust(self._drawn))
+        stream.flush()
+        self._drawn = len(line)
+
+
+class JsonRenderer(object):
+
+    """Emit progress as newline-delimited JSON events."""
+
+    def __init__(self, stream=None):
+        """Write events to `stream` (default: the process's real stdout).
+
+        The real stdout is used even when sys.stdout has been redirected,
+        so other output can be moved out of the way of the events.
+
+        Args:
+            stream (Optional[file]): Stream to write events to.
+
+        """
+        self.stream = stream
+
+    def render(self, snapshot, event):
+        """Write one event for `snapshot`."""
+        stream = self.stream or sys.__stdout__
+        stream.write(json.dumps(dict(snapshot, event=event)) + '\n')
+        stream.flush()
+
+
+class NullRenderer(object):
+
+    """Render nothing."""
+
+    def render(self, snapshot, event):
+        """Do nothing."""
+
+
+def get_renderer(mode, stream=None):
+    """Get a renderer for a progress mode.
+
+    Args:
+        mode (str): One of PROGRESS_MODES.
+        stream (Optional[file]): Stream to render to (default: stdout).
+
+    Returns:
+        object: Renderer for `mode`.
+
+    """
+    if mode == 'json':
+        return JsonRenderer(stream)
+    if mode == 'none':
+        return NullRenderer()
+
+    return BarRenderer(stream)
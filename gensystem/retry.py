@@ -0,0 +1,302 @@
+"""Retry requests to mirrors with backoff, and stop using failing mirrors.
+
+Every request made to a mirror goes through one RetryPolicy. Failed
+attempts that may succeed when repeated (connection errors, timeouts,
+responses cut short and 408/429/5xx statuses) are retried after a jittered
+exponential delay ("full jitter"), or after the delay a Retry-After header
+asks for. Other failures (e.g. 404) are raised at once, and so are local
+errors, such as a full disk or a missing destination directory: they are
+not the mirror's fault, and it is not counted against it.
+
+Only GETs are ever sent, so repeating a request is safe; ranged GETs are
+retried for just the bytes still missing (see segments.SegmentedDownload).
+
+Each mirror has a CircuitBreaker. After FAILURE_THRESHOLD failures in a row
+the breaker opens and requests to that mirror fail straight away, without
+being sent, for COOL_DOWN seconds. One trial request is then let through:
+success closes the breaker, failure opens it again.
+
+"""
+
+import httplib
+import random
+import socket
+import threading
+import time
+import urllib2
+
+import gensystem.metrics as gensystem_metrics
+import gensystem.settings as gensystem_settings
+
+ATTEMPTS = gensystem_settings.get_positive_int('GENSYSTEM_RETRIES', 5)
+BASE_DELAY = 0.5
+MAX_DELAY = 30.0
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+FAILURE_THRESHOLD = 5
+COOL_DOWN = 60.0
+
+
+class TransferError(IOError):
+
+    """A mirror's response could not be used, e.g. it was cut short."""
+
+
+class CircuitOpenError(IOError):
+
+    """A request was not sent because its mirror's breaker is open."""
+
+
+class RetriesExhausted(IOError):
+
+    """Every attempt failed, so trying once more would not help."""
+
+
+class CircuitBreaker(object):
+
+    """Track consecutive failures of one mirror (see module docstring)."""
+
+    def __init__(
+            self, mirror, threshold=FAILURE_THRESHOLD, cool_down=COOL_DOWN,
+            clock=time.time):
+        """Start closed.
+
+        Args:
+            mirror (str): Mirror host.
+            threshold (Optional[int]): Failures in a row that open it.
+            cool_down (Optional[float]): Seconds it stays open.
+            clock (Optional[fn]): Function returning the time in seconds.
+
+        """
+        self.mirror = mirror
+        self.threshold = threshold
+        self.cool_down = cool_down
+        self.failures = 0
+        self.opened_at = None
+        self._clock = clock
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """str: One of closed, open or half-open."""
+        if self.opened_at is None:
+            return 'closed'
+        if self._clock() - self.opened_at < self.cool_down:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        """Check whether a request may be sent to the mirror.
+
+        Only one trial request is let through once the cool-down is over;
+        the thread sending it must end it with record_success,
+        record_failure or release_trial.
+
+        Returns:
+            bool: Whether to send the request.
+
+        """
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._trial:
+                self._trial = threading.current_thread().ident
+                return True
+            return False
+
+    def check(self):
+        """Raise unless a request may be sent to the mirror.
+
+        Raises:
+            CircuitOpenError: When the breaker is open.
+
+        """
+        if not self.allow():
+            raise CircuitOpenError(
+                "%s failed %d times in a row, NOT using it for %ds." % (
+                    self.mirror, self.failures, self.cool_down))
+
+    def record_success(self):
+        """Close the breaker."""
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def release_trial(self):
+        """End this thread's trial request, if any, without a verdict.
+
+        A trial that failed for reasons of its own (e.g. a full disk) says
+        nothing about the mirror, so another one is let through.
+
+        """
+        with self._lock:
+            if self._trial == threading.current_thread().ident:
+                self._trial = False
+
+    def record_failure(self):
+        """Count a failure, opening the breaker if there were too many."""
+        with self._lock:
+            self.failures += 1
+            if self._trial or (
+                    self.opened_at is None and
+                    self.failures >= self.threshold):
+                self.opened_at = self._clock()
+                self._trial = False
+                gensystem_metrics.count('circuit_opened', mirror=self.mirror)
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(mirror):
+    """Get the circuit breaker of a mirror.
+
+    Args:
+        mirror (str): Mirror host.
+
+    Returns:
+        CircuitBreaker: The breaker, shared by everything in this process.
+
+    """
+    with _breakers_lock:
+        breaker = _breakers.get(mirror)
+        if breaker is None:
+            breaker = _breakers[mirror] = CircuitBreaker(mirror)
+        return breaker
+
+
+def reset_breakers():
+    """Forget every mirror's failures."""
+    with _breakers_lock:
+        _breakers.clear()
+
+
+def get_retry_after(error):
+    """Get the delay a response asked for in its Retry-After header.
+
+    Args:
+        error (Exception): Error a request failed with.
+
+    Returns:
+        float: Seconds to wait, or None if no (numeric) delay was given.
+
+    """
+    headers = getattr(error, 'hdrs', None)
+    try:
+        return max(0.0, float(headers.getheader('Retry-After')))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def is_retryable(error):
+    """Check whether a failed request may succeed when repeated.
+
+    Args:
+        error (Exception): Error the request failed with.
+
+    Returns:
+        bool: Whether to retry.
+
+    """
+    if isinstance(error, (CircuitOpenError, RetriesExhausted)):
+        return False
+    if isinstance(error, urllib2.HTTPError):
+        return error.code in RETRY_STATUSES
+
+    # Not any EnvironmentError: local ones (ENOSPC, ENOENT...) would recur
+    return isinstance(error, (
+        TransferError, urllib2.URLError, httplib.HTTPException,
+        socket.error))
+
+
+class RetryPolicy(object):
+
+    """How often, and how long after, failed requests are repeated."""
+
+    def __init__(
+            self, attempts=ATTEMPTS, base_delay=BASE_DELAY,
+            max_delay=MAX_DELAY, sleep=time.sleep, random=random.random):
+        """Describe a policy.
+
+        Args:
+            attempts (Optional[int]): Most attempts per request.
+            base_delay (Optional[float]): Most seconds before the first
+                retry, doubled for each retry after it.
+            max_delay (Optional[float]): Most seconds before any retry.
+            sleep (Optional[fn]): Function sleeping for some seconds.
+            random (Optional[fn]): Function returning a float in [0, 1).
+
+        """
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self._random = random
+
+    def get_delay(self, retry, error=None):
+        """Get how long to wait before a retry.
+
+        Args:
+            retry (int): Retries made so far.
+            error (Optional[Exception]): Error the last attempt failed
+                with, which may carry a Retry-After delay.
+
+        Returns:
+            float: Seconds to wait.
+
+        """
+        ceiling = min(self.max_delay, self.base_delay * 2 ** retry)
+        delay = self._random() * ceiling
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(self.max_delay, retry_after))
+        return delay
+
+    def call(self, function, url, *args, **kwargs):
+        """Call `function(url, *args, **kwargs)`, retrying as needed.
+
+        Args:
+            function (fn): Function making a request for `url`.
+            url (str): URL requested, whose mirror's breaker is used.
+
+        Returns:
+            object: Whatever `function` returns.
+
+        Raises:
+            Exception: The last error `function` raised, or
+            CircuitOpenError when the mirror is not being used.
+
+        """
+        mirror = gensystem_metrics.get_mirror(url)
+        breaker = get_breaker(mirror)
+        for attempt in range(self.attempts):
+            breaker.check()
+            try:
+                result = function(url, *args, **kwargs)
+            except Exception as error:
+                if not is_retryable(error):
+                    if isinstance(error, urllib2.HTTPError):
+                        breaker.record_success()  # It is up, it answered
+                    raise
+                breaker.record_failure()
+                if attempt + 1 >= self.attempts:
+                    raise
+                gensystem_metrics.count('retries', mirror=mirror)
+                delay = self.get_delay(attempt, error)
+            else:
+                breaker.record_success()
+                return result
+            finally:
+                breaker.release_trial()
+            self.sleep(delay)
+
+
+POLICY = RetryPolicy()
+
+
+def call(function, url, *args, **kwargs):
+    """Call `function(url, *args, **kwargs)` with the default policy."""
+    return POLICY.call(function, url, *args, **kwargs)
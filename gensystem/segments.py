@@ -0,0 +1,641 @@
+"""Download files over several connections, tuning how many as it goes.
+
+Files are fetched as byte range segments by a pool of connections whose
+size is steered by an AIMD controller: a connection is added while each
+addition raises aggregate throughput, the count falls back to the best
+setting when one does not, and errors or throttling responses (429/503)
+halve it. Segments are sized to last a couple of seconds at the measured
+rate and shrink towards the end of the file; once nothing is left to
+hand out, idle connections split the largest segment still downloading,
+so one slow connection cannot hold up the tail. The best setting found
+for each mirror is remembered for the next run.
+
+Mirrors that ignore Range requests are downloaded over one connection.
+
+Failed segments are put back and retried for the bytes still missing, after
+the delay the retry policy (see gensystem.retry) gives. Segment requests
+carry If-Range, so a file replaced on the mirror mid-download is never
+spliced into the old one; the download starts over instead.
+
+The start of a file may already be at hand (a Head, e.g. fetched while the
+user was still choosing it), in which case it is written first and only
+the rest is requested.
+
+"""
+
+import bisect
+from collections import namedtuple
+import httplib
+import os
+import re
+import threading
+import time
+import urllib2
+
+import gensystem.bandwidth as gensystem_bandwidth
+import gensystem.cache as gensystem_cache
+import gensystem.metrics as gensystem_metrics
+import gensystem.posix as gensystem_posix
+import gensystem.retry as gensystem_retry
+import gensystem.settings as gensystem_settings
+import gensystem.transfer as gensystem_transfer
+
+MAX_CONNECTIONS = gensystem_settings.get_positive_int(
+    'GENSYSTEM_MAX_CONNECTIONS', 8)
+INITIAL_CONNECTIONS = 2
+INITIAL_CHUNK_SIZE = 4 * 1024 * 1024
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+CHUNK_SECONDS = 2.0
+WINDOW = 1.0
+IMPROVEMENT = 0.05
+DECREASE = 0.5
+SMOOTHING = 0.3
+REPROBE_WINDOWS = 10
+THROTTLE_STATUSES = (429, 503)
+TUNING_FILE = 'mirror-tuning.json'
+CONTENT_RANGE_REGEX = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+# The first bytes of a file fetched ahead of its download, with the size of
+# the whole file and the validator (ETag or Last-Modified) they came with
+Head = namedtuple('Head', 'data total validator')
+
+
+class AimdController(object):
+
+    """Choose a number of connections from measured throughput (AIMD)."""
+
+    def __init__(
+            self, connections=INITIAL_CONNECTIONS,
+            max_connections=MAX_CONNECTIONS):
+        """Start with `connections` connections.
+
+        Args:
+            connections (Optional[int]): Connections to start with.
+            max_connections (Optional[int]): Most connections to use.
+
+        """
+        self.max_connections = max_connections
+        self.connections = max(1, min(connections, max_connections))
+        self.best_connections = self.connections
+        self.best_throughput = 0.0
+        self.updates = 0
+        self._held = 0
+
+    def update(self, throughput):
+        """Adjust to the aggregate throughput of the last window.
+
+        Args:
+            throughput (float): Bytes/s over the last window.
+
+        Returns:
+            int: Connections to use now.
+
+        """
+        self.updates += 1
+        if throughput > self.best_throughput * (1 + IMPROVEMENT):
+            self.best_connections = self.connections
+            self.best_throughput = throughput
+            self._grow()
+        elif self.connections > self.best_connections:
+            # The last connection added did not pay for itself
+            self.connections = self.best_connections
+            self._held = 0
+        else:
+            # Follow the link's speed so an old peak cannot stop probing
+            self.best_throughput += SMOOTHING * (
+                throughput - self.best_throughput)
+            self._held += 1
+            if self._held >= REPROBE_WINDOWS:
+                self._grow()
+
+        return self.connections
+
+    def back_off(self, throttled=False):
+        """Halve the connections after an error.
+
+        Args:
+            throttled (Optional[bool]): Whether the mirror asked us to
+                slow down (429/503), in which case the halved count also
+                becomes the most it will use.
+
+        Returns:
+            int: Connections to use now.
+
+        """
+        self.connections = max(1, int(self.connections * DECREASE))
+        self.best_connections = min(self.best_connections, self.connections)
+        if throttled:
+            self.max_connections = self.connections
+        self._held = 0
+        return self.connections
+
+    def _grow(self):
+        """Add a connection (if allowed)."""
+        self._held = 0
+        if self.connections < self.max_connections:
+            self.connections += 1
+
+
+class RangeNotHonoured(gensystem_retry.TransferError):
+
+    """A mirror answered a Range request with other bytes than asked for."""
+
+
+class Segment(object):
+
+    """Byte range of a file [offset, end) still to be downloaded."""
+
+    def __init__(self, offset, end):
+        """Describe the range from `offset` up to (not including) `end`."""
+        self.offset = offset
+        self.end = end
+
+    @property
+    def remaining(self):
+        """int: Bytes of the segment not yet downloaded."""
+        return self.end - self.offset
+
+
+def get_content_range(response):
+    """Get the range a partial (206) response holds.
+
+    Args:
+        response (httplib.HTTPResponse): Response to a Range request.
+
+    Returns:
+        tuple: Start, end (exclusive) and total size, or None when the
+        response is not a partial one (e.g. Range was ignored).
+
+    """
+    match = CONTENT_RANGE_REGEX.match(
+        response.getheader('Content-Range') or '')
+    if response.status != 206 or match is None:
+        return None
+
+    start, last, total = [int(number) for number in match.groups()]
+    return start, last + 1, total
+
+
+class SegmentedDownload(object):
+
+    """One download over a pool of connections (see module docstring)."""
+
+    def __init__(
+            self, url, destination, hook=None, ready_hook=None,
+            controller=None, chunk_size=INITIAL_CHUNK_SIZE,
+            buffer_size=gensystem_transfer.BUFFER_SIZE, policy=None,
+            clock=time.time, head=None, part_hook=None):
+        """Prepare to download `url` to `destination`.
+
+        Args:
+            url (str): URL of file to download.
+            destination (str): Path on file system to save downloaded file.
+            hook (Optional[fn]): Hook taking (blocks, block_size, total),
+                called with the bytes downloaded so far.
+            ready_hook (Optional[fn]): Function called with the bytes from
+                the start of the file that are written, as they grow.
+            controller (Optional[AimdController]): Connection controller.
+            chunk_size (Optional[int]): Size of the first segments.
+            buffer_size (Optional[int]): Bytes received per write.
+            policy (Optional[gensystem.retry.RetryPolicy]): How failed
+                requests are retried.
+            clock (Optional[fn]): Function returning the time in seconds.
+            head (Optional[Head]): Start of the file, already fetched.
+            part_hook (Optional[fn]): Function taking a connection's name
+                and returning a hook like `hook` for the bytes it receives,
+                e.g. gensystem.progress.Progress.part_hook.
+
+        """
+        self.url = url
+        self.destination = destination
+        self.hook = hook
+        self.ready_hook = ready_hook
+        self.controller = controller or AimdController()
+        self.chunk_size = chunk_size
+        self.buffer_size = buffer_size
+        self.policy = policy or gensystem_retry.POLICY
+        self.mirror = gensystem_metrics.get_mirror(url)
+        self.breaker = gensystem_retry.get_breaker(self.mirror)
+        self.validator = None
+        self.head = head
+        self.part_hook = part_hook
+        self._part_hooks = {}
+        # Segments are read on other threads, for the caller's flow
+        self.flow = gensystem_bandwidth.get_flow()
+        self._clock = clock
+        self._lock = threading.Condition()
+        self._rate = 0.0
+
+    def run(self):
+        """Download the file, starting over if an attempt fails early.
+
+        Returns:
+            int: Number of bytes downloaded.
+
+        Raises:
+            IOError: When the download fails.
+
+        """
+        return self.policy.call(lambda url: self._attempt(), self.url)
+
+    def _attempt(self):
+        """Download the file from the start."""
+        self.total = None
+        self.transferred = 0
+        self.ready = 0
+        self.workers = 0
+        self.error = None
+        self._pending = []
+        self._active = []
+        self._written = []
+        self._slots = set()
+        self._received = {}
+        self._failures = 0
+        self._window_bytes = 0
+        # Only the first attempt uses the head; if the file was replaced
+        # since, segments are refused (If-Range) and the next one probes
+        head, self.head = self.head, None
+        if self.breaker.state != 'closed':
+            # The trial must answer before segments go out at once
+            head = None
+
+        if head is not None:
+            probe = None
+            first_end, self.total = len(head.data), head.total
+            self.validator = head.validator
+        else:
+            try:
+                probe = gensystem_transfer.open_url(
+                    self.url,
+                    {'Range': 'bytes=0-%d' % (self.chunk_size - 1)})
+            except urllib2.HTTPError as error:
+                if error.code in THROTTLE_STATUSES:
+                    self.controller.back_off(throttled=True)
+                if error.code != 416:
+                    raise
+                # Empty files have no ranges to ask for
+                return self._fetch()
+
+            content_range = get_content_range(probe)
+            if content_range is None:
+                # Range is not supported, so one connection it is
+                return self._fetch(probe)
+            if content_range[0] != 0:
+                probe.close()
+                raise RangeNotHonoured(
+                    "Range of %s was NOT honoured." % self.url)
+
+            _, first_end, self.total = content_range
+            self.validator = (
+                probe.getheader('ETag') or probe.getheader('Last-Modified'))
+            # It answered: end any trial, or the segments would be refused
+            self.breaker.record_success()
+
+        fd = os.open(
+            self.destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            gensystem_posix.fallocate(fd, 0, self.total)
+            if head is not None and first_end:
+                gensystem_posix.pwrite(fd, bytearray(head.data), first_end, 0)
+        finally:
+            os.close(fd)
+
+        first = Segment(0, first_end)
+        if probe is not None:
+            self._active.append(first)
+        if first_end < self.total:
+            self._pending.append(Segment(first_end, self.total))
+        if self.ready_hook is not None:
+            self.ready_hook(0)
+        if self.hook is not None:
+            self.hook(1, 0, self.total)
+
+        with self._lock:
+            if probe is not None:
+                self._start_worker(first, probe)
+            elif first_end:
+                self._record(0, first_end)
+                self._window_bytes = 0  # Not fetched at today's rate
+            try:
+                self._coordinate()
+            except BaseException:
+                self.error = self.error or IOError("Download interrupted.")
+                raise
+
+            while self.workers:
+                self._lock.wait(WINDOW)
+
+        if self.error is not None:
+            # Only the part written in order is worth keeping
+            with open(self.destination, 'r+b') as download:
+                download.truncate(self.ready)
+            raise self.error
+
+        return self.transferred
+
+    def _fetch(self, response=None):
+        """Download the file over one connection."""
+        if self.ready_hook is not None:
+            self.ready_hook(None)  # Written in order from the start
+        return gensystem_transfer.fetch(
+            self.url, self.destination, self.hook, self.buffer_size,
+            response=response)
+
+    def _coordinate(self):
+        """Feed the controller and keep the pool sized (lock held)."""
+        window_start = self._clock()
+        while self.transferred < self.total and self.error is None:
+            while (self.workers < self.controller.connections and
+                   self._has_work()):
+                self._start_worker()
+
+            self._lock.wait(WINDOW)
+            now = self._clock()
+            if now - window_start >= WINDOW:
+                self._rate = self._window_bytes / (now - window_start)
+                # Tail windows (nothing left to hand out) say little
+                if self._pending:
+                    self.controller.update(self._rate)
+                self._window_bytes = 0
+                window_start = now
+
+    def _has_work(self):
+        """Check whether another connection would get a segment."""
+        return bool(self._pending) or any(
+            segment.remaining >= 2 * MIN_CHUNK_SIZE
+            for segment in self._active)
+
+    def _start_worker(self, segment=None, response=None):
+        """Start a connection, optionally with its first segment."""
+        self.workers += 1
+        # Numbered from 1 up, reusing the numbers of connections that ended
+        slot = min(set(range(1, self.workers + 1)) - self._slots)
+        self._slots.add(slot)
+        worker = threading.Thread(
+            target=self._work, args=(slot, segment, response))
+        worker.daemon = True
+        worker.start()
+
+    def _get_chunk_size(self):
+        """Size the next segment to last about CHUNK_SECONDS."""
+        rate = self._rate / max(1, self.workers)
+        if rate:
+            self.chunk_size = int(max(MIN_CHUNK_SIZE, min(
+                MAX_CHUNK_SIZE, rate * CHUNK_SECONDS)))
+
+        # Near the end, share out what is left so connections end together
+        unclaimed = sum(segment.remaining for segment in self._pending)
+        return int(max(MIN_CHUNK_SIZE, min(
+            self.chunk_size, unclaimed // self.controller.connections)))
+
+    def _take(self):
+        """Take the next segment to download (lock held)."""
+        if self._pending:
+            pending = self._pending[0]
+            size = self._get_chunk_size()
+            if pending.remaining <= size:
+                segment = self._pending.pop(0)
+            else:
+                segment = Segment(pending.offset, pending.offset + size)
+                pending.offset = segment.end
+            self._active.append(segment)
+            return segment
+
+        if not self._active:
+            return None
+
+        # Nothing left to hand out: halve the largest segment downloading
+        largest = max(self._active, key=lambda segment: segment.remaining)
+        if largest.remaining < 2 * MIN_CHUNK_SIZE:
+            return None
+        segment = Segment(largest.offset + largest.remaining // 2, largest.end)
+        largest.end = segment.offset
+        self._active.append(segment)
+        return segment
+
+    def _work(self, slot, segment, response):
+        """Download segments until there are none (or too many workers)."""
+        fd = os.open(self.destination, os.O_WRONLY)
+        buffer_ = bytearray(self.buffer_size)
+        try:
+            while True:
+                with self._lock:
+                    if segment is None:
+                        if (self.error is not None or
+                                self.workers > self.controller.connections):
+                            return
+                        segment = self._take()
+                        if segment is None:
+                            return
+
+                delay = None
+                try:
+                    self._receive(slot, segment, response, fd, buffer_)
+                except (EnvironmentError, httplib.HTTPException) as error:
+                    delay = self._fail(segment, error)
+                finally:
+                    # e.g. a local error, or stopped by another's error
+                    self.breaker.release_trial()
+                if delay is not None:
+                    self.policy.sleep(delay)
+                segment = response = None
+        finally:
+            os.close(fd)
+            with self._lock:
+                self.workers -= 1
+                self._slots.discard(slot)
+                self._lock.notify_all()
+
+    def _receive(self, slot, segment, response, fd, buffer_):
+        """Download one segment into the file over connection `slot`."""
+        if response is None:
+            self.breaker.check()
+            headers = {
+                'Range': 'bytes=%d-%d' % (segment.offset, segment.end - 1)}
+            if self.validator:
+                headers['If-Range'] = self.validator
+            response = gensystem_transfer.open_url(self.url, headers)
+
+        try:
+            content_range = get_content_range(response)
+            if content_range is None or content_range[0] != segment.offset:
+                raise RangeNotHonoured(
+                    "Range of %s was NOT honoured." % self.url)
+
+            view = memoryview(buffer_)
+            read_into = gensystem_transfer.get_body_reader(
+                response, self.flow)
+            while True:
+                with self._lock:
+                    wanted = min(len(buffer_), segment.remaining)
+                    if wanted <= 0 or self.error is not None:
+                        self._active.remove(segment)
+                        break
+
+                count = read_into(view[:wanted])
+                if not count:
+                    raise gensystem_retry.TransferError(
+                        "Download of %s was cut short." % self.url)
+
+                with self._lock:
+                    # Another connection may have taken the end meanwhile
+                    count = min(count, segment.remaining)
+                    offset = segment.offset
+                    segment.offset += count
+
+                gensystem_posix.pwrite(fd, buffer_, count, offset)
+                with self._lock:
+                    self._record(offset, count)
+                    self._record_part(slot, count)
+        finally:
+            response.close()
+
+        if not segment.remaining:
+            self.breaker.record_success()
+
+    def _record(self, offset, count):
+        """Record bytes written at `offset` (lock held)."""
+        self.transferred += count
+        self._window_bytes += count
+        self._failures = 0
+
+        # Merge into the sorted, disjoint list of written ranges
+        index = bisect.bisect(self._written, [offset, offset + count])
+        self._written.insert(index, [offset, offset + count])
+        merged = []
+        for written in self._written:
+            if merged and written[0] <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], written[1])
+            else:
+                merged.append(written)
+        self._written = merged
+
+        ready = merged[0][1] if merged[0][0] == 0 else 0
+        if ready != self.ready:
+            self.ready = ready
+            if self.ready_hook is not None:
+                self.ready_hook(ready)
+        if self.hook is not None:
+            self.hook(1, self.transferred, self.total)
+        if self.transferred >= self.total:
+            self._lock.notify_all()
+
+    def _record_part(self, slot, count):
+        """Report bytes received over connection `slot` (lock held)."""
+        if self.part_hook is None:
+            return
+
+        self._received[slot] = self._received.get(slot, 0) + count
+        if slot not in self._part_hooks:
+            self._part_hooks[slot] = self.part_hook('#%d' % slot)
+        self._part_hooks[slot](1, self._received[slot], None)
+
+    def _fail(self, segment, error):
+        """Put a failed segment back and back off.
+
+        Returns:
+            float: Seconds to wait before the next request.
+
+        """
+        with self._lock:
+            if segment in self._active:
+                self._active.remove(segment)
+            if segment.remaining > 0:
+                self._pending.append(segment)
+                self._pending.sort(key=lambda pending: pending.offset)
+            self._lock.notify_all()
+
+            if isinstance(error, RangeNotHonoured) or (
+                    not gensystem_retry.is_retryable(error)):
+                # e.g. replaced on the mirror; no segment retry will help
+                self.error = self.error or error
+                return 0
+
+            self.breaker.record_failure()
+            self._failures += 1
+            self.controller.back_off(
+                getattr(error, 'code', None) in THROTTLE_STATUSES)
+            if self._failures >= self.policy.attempts:
+                self.error = self.error or gensystem_retry.RetriesExhausted(
+                    "Download of %s failed (%s)." % (self.url, error))
+                return 0
+
+            gensystem_metrics.count('retries', mirror=self.mirror)
+            return self.policy.get_delay(self._failures - 1, error)
+
+
+def load_tuning(mirror):
+    """Get the best setting remembered for a mirror.
+
+    Args:
+        mirror (str): Mirror host.
+
+    Returns:
+        dict: Remembered connections, chunk_size and throughput (empty if
+        nothing is remembered).
+
+    """
+    return gensystem_cache.load_json(TUNING_FILE, {}).get(mirror, {})
+
+
+def save_tuning(mirror, connections, chunk_size, throughput):
+    """Remember the best setting found for a mirror.
+
+    Args:
+        mirror (str): Mirror host.
+        connections (int): Best number of connections.
+        chunk_size (int): Last segment size used.
+        throughput (float): Throughput (bytes/s) with `connections`.
+
+    """
+    tuning = gensystem_cache.load_json(TUNING_FILE, {})
+    tuning[mirror] = {
+        'connections': connections, 'chunk_size': chunk_size,
+        'throughput': throughput, 'updated': time.time()}
+    gensystem_cache.save_json(TUNING_FILE, tuning)
+
+
+def fetch(url, destination, hook=None, ready_hook=None,
+          max_connections=MAX_CONNECTIONS, policy=None, head=None,
+          part_hook=None):
+    """Download `url` to `destination` over a tuned number of connections.
+
+    Args:
+        url (str): URL of file to download.
+        destination (str): Path on file system to save downloaded file.
+        hook (Optional[fn]): Hook taking (blocks, block_size, total),
+            called with the bytes downloaded so far.
+        ready_hook (Optional[fn]): Function called with the bytes from the
+            start of the file that are written, as they grow.
+        max_connections (Optional[int]): Most connections to use.
+        policy (Optional[gensystem.retry.RetryPolicy]): How failed
+            requests are retried.
+        head (Optional[Head]): Start of the file, already fetched.
+        part_hook (Optional[fn]): Function returning a hook for each
+            connection (see SegmentedDownload).
+
+    Returns:
+        int: Number of bytes downloaded.
+
+    Raises:
+        IOError: When the download fails.
+
+    """
+    mirror = gensystem_metrics.get_mirror(url)
+    tuning = load_tuning(mirror)
+    controller = AimdController(
+        tuning.get('connections', INITIAL_CONNECTIONS), max_connections)
+    download = SegmentedDownload(
+        url, destination, hook, ready_hook, controller,
+        tuning.get('chunk_size', INITIAL_CHUNK_SIZE), policy=policy,
+        head=head, part_hook=part_hook)
+    transferred = download.run()
+
+    # Downloads too short to measure teach us nothing
+    if controller.updates:
+        save_tuning(
+            mirror, controller.best_connections, download.chunk_size,
+            controller.best_throughput)
+
+    return transferred
@@ -0,0 +1,482 @@
+"""Serve a caching Gentoo mirror on the local network.
+
+Clients point gensystem at the server with ``-m``. Files are fetched from
+the upstream mirror on first request and kept in a cache directory; all
+clients asking for a file while it is being fetched share one upstream
+transfer and are streamed the bytes as they arrive. Block maps for delta
+updates (<file>.blockmap, see gensystem.delta) are made for cached files
+when the upstream mirror has none.
+
+"""
+
+import BaseHTTPServer
+import json
+import os
+import posixpath
+import re
+import socket
+import SocketServer
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+
+import gensystem.delta as gensystem_delta
+import gensystem.posix as gensystem_posix
+import gensystem.retry as gensystem_retry
+
+CHUNK_SIZE = 256 * 1024
+LISTING_TTL = 300
+SERVED_PREFIXES = ('releases/', 'snapshots/')
+RANGE_REGEX = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class Fill(object):
+
+    """An upstream transfer into the cache that clients can follow."""
+
+    def __init__(self, path):
+        """Start tracking a transfer into `path`.
+
+        Args:
+            path (str): Partial file the transfer is written to.
+
+        """
+        self.path = path
+        self.size = None
+        self.written = 0
+        self.started = False
+        self.done = False
+        self.error = None
+        self.redirect = None
+        self.condition = threading.Condition()
+
+    def wait(self, offset):
+        """Wait until bytes past `offset` are written or the fill ends.
+
+        Args:
+            offset (int): Offset the caller has already streamed up to.
+
+        Returns:
+            int: Number of bytes written so far.
+
+        """
+        with self.condition:
+            while self.written <= offset and not self.done:
+                self.condition.wait()
+            return self.written
+
+
+class CachingMirror(object):
+
+    """Upstream mirror fronted by a local cache with request coalescing."""
+
+    def __init__(self, upstream, cache_dir, listing_ttl=LISTING_TTL):
+        """Cache `upstream` in `cache_dir`.
+
+        Args:
+            upstream (str): Base URL of the upstream mirror.
+            cache_dir (str): Directory cached files are kept in.
+            listing_ttl (Optional[int]): Seconds listings stay cached.
+
+        """
+        self.upstream = upstream.rstrip('/') + '/'
+        self.cache_dir = cache_dir
+        self.listing_ttl = listing_ttl
+        self.upstream_requests = 0
+        self._lock = threading.Lock()
+        self._fills = {}
+        self._listings = {}
+        self._listing_locks = {}
+        self._block_map_locks = {}
+
+    def _open_upstream(self, path):
+        """Open `path` on the upstream mirror."""
+        with self._lock:
+            self.upstream_requests += 1
+        return gensystem_retry.call(urllib2.urlopen, self.upstream + path)
+
+    def get_listing(self, path):
+        """Get a (short-lived) cached page that changes upstream.
+
+        Concurrent requests for the same page wait for one upstream fetch.
+
+        Args:
+            path (str): Path of a directory listing or release pointer.
+
+        Returns:
+            tuple: HTTP status code and body.
+
+        """
+        with self._lock:
+            lock = self._listing_locks.setdefault(path, threading.Lock())
+
+        with lock:
+            expires, status, body = self._listings.get(path, (0, None, None))
+            if expires > time.time():
+                return status, body
+
+            try:
+                status, body = 200, self._open_upstream(path).read()
+            except urllib2.HTTPError as error:
+                status, body = error.code, ''
+            except (urllib2.URLError, EnvironmentError):
+                return 502, ''
+
+            self._listings[path] = (
+                time.time() + self.listing_ttl, status, body)
+            return status, body
+
+    def get_block_map(self, path):
+        """Get the block map of a file (see gensystem.delta).
+
+        A block map the upstream mirror has is used as is. Otherwise (and
+        Gentoo mirrors publish none) one is made from the cached file,
+        caching it first if need be. Either is kept next to the file.
+
+        Args:
+            path (str): Path of the file's block map, i.e. the file's path
+                with gensystem.delta.BLOCK_MAP_SUFFIX appended.
+
+        Returns:
+            tuple: HTTP status code and body.
+
+        """
+        cache_path = os.path.join(self.cache_dir, path)
+        with self._lock:
+            lock = self._block_map_locks.setdefault(path, threading.Lock())
+
+        with lock:
+            if os.path.isfile(cache_path):
+                with open(cache_path, 'r') as block_map_file:
+                    return 200, block_map_file.read()
+
+            try:
+                body = self._open_upstream(path).read()
+            except urllib2.HTTPError as error:
+                if error.code != 404:
+                    return error.code, ''
+                body = None
+            except (urllib2.URLError, EnvironmentError):
+                return 502, ''
+
+            if body is None:
+                cached = self.get_file(
+                    path[:-len(gensystem_delta.BLOCK_MAP_SUFFIX)])
+                if isinstance(cached, Fill):
+                    with cached.condition:
+                        while not cached.done:
+                            cached.condition.wait()
+                    if cached.redirect is not None:
+                        return 404, ''
+                    if cached.error is not None:
+                        return getattr(cached.error, 'code', 502), ''
+                    cached = cached.path
+
+                body = json.dumps(gensystem_delta.make_block_map(cached))
+
+            if not os.path.isdir(os.path.dirname(cache_path)):
+                try:
+                    os.makedirs(os.path.dirname(cache_path))
+                except OSError:
+                    pass  # Made by a concurrent fill
+            temp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+            with open(temp_path, 'w') as block_map_file:
+                block_map_file.write(body)
+            os.rename(temp_path, cache_path)
+            return 200, body
+
+    def get_file(self, path):
+        """Get a cached file, or the fill that is caching it.
+
+        Args:
+            path (str): Path of a file on the mirror.
+
+        Returns:
+            object: Cached file path (str) or a Fill to follow.
+
+        """
+        cache_path = os.path.join(self.cache_dir, path)
+        with self._lock:
+            if os.path.isfile(cache_path):
+                return cache_path
+
+            fill = self._fills.get(path)
+            if fill is None:
+                fill = Fill(cache_path + '.part')
+                self._fills[path] = fill
+                thread = threading.Thread(
+                    target=self._fill, args=(path, cache_path, fill))
+                thread.daemon = True
+                thread.start()
+
+        return fill
+
+    def _fill(self, path, cache_path, fill):
+        """Transfer `path` from upstream into the cache."""
+        try:
+            response = self._open_upstream(path)
+            if response.geturl().endswith('/'):
+                # A directory asked for without its slash, never cache it
+                fill.redirect = '/%s/' % path
+                return
+            size = response.info().getheader('Content-Length')
+
+            if not os.path.isdir(os.path.dirname(cache_path)):
+                try:
+                    os.makedirs(os.path.dirname(cache_path))
+                except OSError:
+                    pass  # Made by a concurrent fill
+
+            with open(fill.path, 'wb') as cache_file:
+                with fill.condition:
+                    fill.size = int(size) if size else None
+                    fill.started = True
+                    fill.condition.notify_all()
+
+                while True:
+                    data = response.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    cache_file.write(data)
+                    cache_file.flush()
+                    with fill.condition:
+                        fill.written += len(data)
+                        fill.condition.notify_all()
+
+            if fill.size is not None and fill.written != fill.size:
+                raise gensystem_retry.TransferError(
+                    "Upstream transfer of %s was cut short." % path)
+
+            with fill.condition:
+                os.rename(fill.path, cache_path)
+                fill.path = cache_path
+        except (urllib2.URLError, EnvironmentError, ValueError) as error:
+            fill.error = error
+        finally:
+            with self._lock:
+                del self._fills[path]
+            with fill.condition:
+                fill.done = True
+                fill.condition.notify_all()
+
+
+def get_range(header, size):
+    """Get the byte range requested by a Range header.
+
+    Only single ranges are supported; anything else is ignored and the
+    whole file served, as HTTP allows.
+
+    Args:
+        header (str): Value of the Range header or None.
+        size (int): Size of the file being requested.
+
+    Returns:
+        tuple: Start and end (exclusive) offsets or None for the whole file.
+
+    Raises:
+        ValueError: When the range cannot be satisfied.
+
+    """
+    match = RANGE_REGEX.match(header or '')
+    if match is None:
+        return None
+
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # Suffix range, e.g. the last 500 bytes
+        start, end = max(size - int(end), 0), size
+    else:
+        start = int(start)
+        end = min(int(end) + 1, size) if end else size
+
+    if start >= size or start >= end:
+        raise ValueError("Range not satisfiable.")
+
+    return start, end
+
+
+class MirrorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """Serve mirror paths from a CachingMirror."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        """Keep the server quiet unless it was asked to be verbose."""
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+    def do_HEAD(self):
+        """Serve headers for a mirror path."""
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        """Serve a mirror path."""
+        request_path = urllib.unquote(urlparse.urlparse(self.path).path)
+        path = posixpath.normpath(request_path).lstrip('/')
+        if request_path.endswith('/'):
+            path += '/'
+
+        if '..' in path.split('/') or not path.startswith(SERVED_PREFIXES):
+            self.send_error(404)
+            return
+
+        mirror = self.server.mirror
+        volatile = (
+            path.endswith('/') or
+            posixpath.basename(path).startswith('latest-'))
+        try:
+            if volatile:
+                status, body = mirror.get_listing(path)
+                self._send_listing(status, body, head)
+                return
+            if path.endswith(gensystem_delta.BLOCK_MAP_SUFFIX):
+                status, body = mirror.get_block_map(path)
+                self._send_listing(status, body, head)
+                return
+
+            cached = mirror.get_file(path)
+            if isinstance(cached, Fill):
+                self._send_fill(cached, head)
+            else:
+                self._send_cached(cached, head)
+        except socket.error:
+            self.close_connection = 1  # Client went away
+
+    def _send_listing(self, status, body, head):
+        """Send a listing, block map (or its error status) from memory."""
+        if status != 200:
+            self.send_error(status)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def _send_headers(self, size, head):
+        """Send headers for a file honouring any Range request.
+
+        Returns:
+            tuple: Start and end offsets to send, or None if nothing is.
+
+        """
+        try:
+            requested = get_range(self.headers.getheader('Range'), size)
+        except ValueError:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+
+        start, end = requested or (0, size)
+        self.send_response(206 if requested else 200)
+        if requested:
+            self.send_header(
+                'Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size))
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        return None if head else (start, end)
+
+    def _send_cached(self, cache_path, head):
+        """Send a completely cached file using sendfile."""
+        with open(cache_path, 'rb') as cache_file:
+            size = os.fstat(cache_file.fileno()).st_size
+            offsets = self._send_headers(size, head)
+            if offsets is None:
+                return
+
+            self.wfile.flush()
+            offset, end = offsets
+            while offset < end:
+                sent = gensystem_posix.sendfile(
+                    self.connection.fileno(), cache_file.fileno(), offset,
+                    end - offset)
+                if sent == 0:
+                    break
+                offset += sent
+
+    def _send_fill(self, fill, head):
+        """Stream a file to the client while it is being cached."""
+        with fill.condition:
+            while not fill.started and not fill.done:
+                fill.condition.wait()
+
+            if fill.redirect is not None:
+                self.send_response(301)
+                self.send_header('Location', fill.redirect)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if fill.error is not None and not fill.started:
+                self.send_error(getattr(fill.error, 'code', 502))
+                return
+            # Open while holding the condition so a rename cannot race us
+            fill_file = open(fill.path, 'rb')
+
+        with fill_file:
+            if fill.size is not None:
+                offsets = self._send_headers(fill.size, head)
+                if offsets is None:
+                    return
+                offset, end = offsets
+            else:
+                # Size unknown so ranges cannot be honoured, end with close
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.close_connection = 1
+                if head:
+                    return
+                offset, end = 0, None
+
+            self.wfile.flush()
+            while end is None or offset < end:
+                written = fill.wait(offset)
+                if written <= offset:
+                    if fill.error is not None:
+                        # Cannot finish the body, drop the connection
+                        self.close_connection = 1
+                    break
+                if end is not None:
+                    written = min(written, end)
+                sent = gensystem_posix.sendfile(
+                    self.connection.fileno(), fill_file.fileno(), offset,
+                    written - offset)
+                if sent == 0:
+                    break
+                offset += sent
+
+
+class MirrorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    """Threaded HTTP server for a CachingMirror."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, mirror, verbose=False):
+        """Serve `mirror` on `address`.
+
+        Args:
+            address (tuple): Host and port to bind to.
+            mirror (CachingMirror): Mirror to serve.
+            verbose (Optional[bool]): Whether to log every request.
+
+        """
+        BaseHTTPServer.HTTPServer.__init__(
+            self, address, MirrorRequestHandler)
+        self.mirror = mirror
+        self.verbose = verbose
@@ -0,0 +1,44 @@
+"""Read numeric settings from the environment (and the control file).
+
+A setting that is not a positive integer, e.g. GENSYSTEM_BUFFER_SIZE=1M,
+is ignored rather than stopping gensystem before it starts. This module
+imports nothing from gensystem, so the modules reading their settings at
+import time (transfer, segments, retry, bandwidth) can all use it.
+
+"""
+
+import os
+
+
+def to_positive_int(value, default=None):
+    """Get a setting's value as a positive integer.
+
+    Args:
+        value (object): Value set, e.g. '65536' or 65536.
+        default (Optional[int]): Value if it is not a positive integer.
+
+    Returns:
+        int: The value, or `default`.
+
+    """
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        return default
+
+    return number if number > 0 else default
+
+
+def get_positive_int(name, default=None):
+    """Get a positive integer set in the environment.
+
+    Args:
+        name (str): Name of the environment variable.
+        default (Optional[int]): Value if it is unset or not a positive
+            integer.
+
+    Returns:
+        int: The value, or `default`.
+
+    """
+    return to_positive_int(os.environ.get(name), default)
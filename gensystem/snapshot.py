@@ -0,0 +1,127 @@
+"""Fetch the Portage tree snapshot to install along with a stage tarball.
+
+Mirrors keep the latest snapshot of the Gentoo repository in snapshots/
+as portage-latest.tar.xz and portage-latest.tar.bz2 (the xz one is used
+when Python has lzma), next to an .md5sum file listing its MD5. Snapshots
+have no DIGESTS, so the MD5 is what the snapshot is verified against; it
+is hashed as it streams, like the stage tarball.
+
+"""
+
+import hashlib
+import os
+
+import gensystem.install as gensystem_install
+import gensystem.mirror as gensystem_mirror
+import gensystem.retry as gensystem_retry
+import gensystem.temp as gensystem_temp
+import gensystem.transfer as gensystem_transfer
+import gensystem.utils as gensystem_utils
+
+SNAPSHOTS_PATH = 'snapshots/'
+SNAPSHOT_NAME = 'portage-latest.tar.%s'
+CHECKSUM_SUFFIX = '.md5sum'
+
+
+def get_snapshot_url(mirror):
+    """Get the URL of the latest Portage snapshot on a mirror.
+
+    Args:
+        mirror (str): Gentoo (base) mirror.
+
+    Returns:
+        str: URL of the snapshot.
+
+    """
+    compression = 'xz' if gensystem_install.lzma is not None else 'bz2'
+    return '%s/%s%s' % (
+        mirror.rstrip('/'), SNAPSHOTS_PATH, SNAPSHOT_NAME % compression)
+
+
+def get_md5_digest(checksum_path, download_file):
+    """Get the MD5 listed for a file in an md5sum file.
+
+    Args:
+        checksum_path (str): Path to the md5sum file.
+        download_file (str): Name of the file to get the hash for.
+
+    Returns:
+        str: Hex MD5 of `download_file` or None if not listed.
+
+    """
+    with open(checksum_path, 'r') as checksum_file:
+        for line in checksum_file:
+            fields = line.split()
+            if len(fields) == 2 and fields[1].lstrip('*') == download_file:
+                return fields[0].lower()
+
+    return None
+
+
+class Snapshot(object):
+
+    """The latest Portage snapshot on a mirror, hashed as it is read."""
+
+    def __init__(self, mirror, hook=None):
+        """Prepare to fetch the snapshot from `mirror`.
+
+        Args:
+            mirror (str): Gentoo (base) mirror.
+            hook (Optional[fn]): Function called with the bytes read so far
+                and the size of the snapshot.
+
+        """
+        self.url = get_snapshot_url(mirror)
+        self.name = os.path.basename(self.url)
+        self.hook = hook
+        self.hasher = hashlib.md5()
+        self.valid_md5 = None
+        self.size = None
+
+    def fetch_checksum(self):
+        """Download the snapshot's MD5.
+
+        Returns:
+            str: Hex MD5 of the snapshot, or None if it could not be found.
+
+        """
+        checksum_url = self.url + CHECKSUM_SUFFIX
+        with gensystem_temp.temp_directory() as temp_dir:
+            checksum_file = os.path.join(temp_dir, self.name + CHECKSUM_SUFFIX)
+            downloaded, _ = gensystem_utils.download_small_file(
+                checksum_url, checksum_file, 'snapshot_checksum',
+                gensystem_mirror.get_alternate_url(checksum_url))
+            if downloaded:
+                self.valid_md5 = get_md5_digest(checksum_file, self.name)
+
+        return self.valid_md5
+
+    def open(self):
+        """Start downloading the snapshot.
+
+        Returns:
+            tuple: File-like object of the snapshot, hashing what is read
+            from it, and its decompressor (see install.install_stage).
+
+        Raises:
+            IOError: When the request fails.
+
+        """
+        response = gensystem_retry.call(
+            gensystem_transfer.open_url, self.url)
+        self.size = response.length
+        return (
+            gensystem_install.HashingReader(
+                response, self.hasher, self._report),
+            gensystem_install.get_decompressor(self.name))
+
+    def _report(self, transferred):
+        """Pass the bytes read so far and the size on to the hook."""
+        if self.hook is not None:
+            self.hook(transferred, self.size)
+
+    def is_verified(self):
+        """Check whether the snapshot read matches its MD5."""
+        return (
+            self.valid_md5 is not None and
+            self.hasher.hexdigest() == self.valid_md5)
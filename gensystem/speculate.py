@@ -0,0 +1,295 @@
+"""Start fetching what an interactive download will need before it is chosen.
+
+`gensystem download -i` asks for an architecture, a country, a mirror and
+a media file in turn, and the network would sit idle while the user reads
+each list. A Speculation works on the answers given so far instead:
+
+* once the country is chosen, the hosts of its mirrors are resolved (see
+  gensystem.connect.prefetch);
+* once the mirror is chosen, the URL of every media file it offers is
+  found, and the DIGESTS and first HEAD_SIZE bytes of the LIKELY_MEDIA
+  are fetched as soon as its URL is known.
+
+When the media file is chosen, speculation for any other media is
+cancelled. The download starts right away from what is at hand: the URL,
+the head of the file (if it has arrived, otherwise the download probes as
+usual) and the DIGESTS, which are waited for only when verifying.
+
+"""
+
+import contextlib
+import httplib
+import socket
+import threading
+
+import gensystem.connect as gensystem_connect
+import gensystem.media as gensystem_media
+import gensystem.metrics as gensystem_metrics
+import gensystem.retry as gensystem_retry
+import gensystem.segments as gensystem_segments
+import gensystem.transfer as gensystem_transfer
+
+LIKELY_MEDIA = 'stage3'
+HEAD_SIZE = 1024 * 1024
+READ_SIZE = 64 * 1024
+TIMEOUT = 30
+WAIT = 1.0
+# What a speculative task may fail with, to be found out again when (and
+# if) the work is done for real
+ERRORS = (RuntimeError, EnvironmentError, httplib.HTTPException)
+
+
+class Cancelled(Exception):
+
+    """Speculative work was cancelled before it finished."""
+
+
+class Task(threading.Thread):
+
+    """Work started in the background on the chance it is wanted."""
+
+    def __init__(self, function, *args):
+        """Start calling `function` with the task and `args`.
+
+        Args:
+            function (fn): Function taking the task (to check whether it
+                was cancelled, and to report connections to abort) and
+                `args`.
+
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self._function = function
+        self._args = args
+        self._connection = None
+        self.start()
+
+    def run(self):
+        """Do the work, keeping what it returned or failed with."""
+        try:
+            self.result = self._function(self, *self._args)
+        except ERRORS + (Cancelled,) as error:
+            self.error = error
+
+    def get(self):
+        """Wait for the work to finish.
+
+        Returns:
+            object: What the work returned.
+
+        Raises:
+            Cancelled: When the work was cancelled.
+            Exception: What the work failed with.
+
+        """
+        while self.is_alive():
+            self.join(WAIT)
+        if self.cancelled:
+            raise Cancelled()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def cancel(self):
+        """Stop the work, aborting any request it is making."""
+        self.cancelled = True
+        sock = getattr(self._connection, 'sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass  # Already closed
+
+    def set_connection(self, connection):
+        """Remember the connection in use, so it can be aborted."""
+        self._connection = connection
+        if self.cancelled:
+            self.cancel()
+
+
+def find_url(task, mirror, arch, media_file):
+    """Find the URL of a media file (see media.get_media_file_url)."""
+    return gensystem_media.get_media_file_url(mirror, arch, media_file)
+
+
+def read_digests(task, url_task):
+    """Read the DIGESTS of the media whose URL `url_task` finds.
+
+    Returns:
+        str: Body of the DIGESTS file.
+
+    """
+    response = gensystem_transfer.open_url(
+        url_task.get() + '.DIGESTS', timeout=TIMEOUT,
+        on_connection=task.set_connection)
+    with contextlib.closing(response):
+        return response.read()
+
+
+def read_head(task, url_task, size=HEAD_SIZE):
+    """Read the first bytes of the media whose URL `url_task` finds.
+
+    Returns:
+        gensystem.segments.Head: Start of the file, or None if the mirror
+        does not serve byte ranges.
+
+    Raises:
+        Cancelled: When the task is cancelled while reading.
+
+    """
+    response = gensystem_transfer.open_url(
+        url_task.get(), {'Range': 'bytes=0-%d' % (size - 1)}, TIMEOUT,
+        task.set_connection)
+    with contextlib.closing(response):
+        content_range = gensystem_segments.get_content_range(response)
+        if content_range is None or content_range[0] != 0:
+            return None
+
+        end = content_range[1]
+        data = []
+        read = 0
+        while read < end:
+            if task.cancelled:
+                raise Cancelled()
+            chunk = response.read(min(READ_SIZE, end - read))
+            if not chunk:
+                raise gensystem_retry.TransferError(
+                    "Head of %s was cut short." % response.url)
+            data.append(chunk)
+            read += len(chunk)
+
+        return gensystem_segments.Head(
+            ''.join(data), content_range[2],
+            response.getheader('ETag') or response.getheader('Last-Modified'))
+
+
+class Prefetched(object):
+
+    """What was fetched for the media chosen before it was chosen."""
+
+    def __init__(self, head=None, digests=None):
+        """Describe what was fetched.
+
+        Args:
+            head (Optional[gensystem.segments.Head]): Start of the media.
+            digests (Optional[Task]): Task reading the media's DIGESTS.
+
+        """
+        self.head = head
+        self._digests = digests
+
+    def get_digests(self):
+        """Get the body of the media's DIGESTS, waiting for it if need be.
+
+        Returns:
+            str: Body of the DIGESTS file, or None if it was not fetched.
+
+        """
+        if self._digests is None:
+            return None
+        try:
+            return self._digests.get()
+        except ERRORS + (Cancelled,):
+            return None
+
+
+class Speculation(object):
+
+    """Work started on the answers of an interactive download so far."""
+
+    def __init__(self, arch, likely_media=LIKELY_MEDIA):
+        """Prepare to speculate for a download for `arch`.
+
+        Args:
+            arch (str): Name of the architecture chosen, e.g. amd64.
+            likely_media (Optional[str]): Media file most likely chosen.
+
+        """
+        self.arch = arch
+        self.likely_media = likely_media
+        self.mirror = None
+        self._urls = {}
+        self._digests = None
+        self._head = None
+
+    def choose_country(self, mirrors):
+        """Resolve the hosts of the mirrors of the country chosen.
+
+        Args:
+            mirrors (list): Base URLs of the country's mirrors.
+
+        """
+        gensystem_connect.prefetch(mirrors)
+
+    def choose_mirror(self, mirror, media_files):
+        """Find the media files on the mirror chosen.
+
+        Args:
+            mirror (str): Base URL of the mirror.
+            media_files (list): Media files the user may choose from.
+
+        """
+        self.cancel()
+        self.mirror = mirror
+        for media_file in media_files:
+            self._urls[media_file] = Task(
+                find_url, mirror, self.arch, media_file)
+
+        likely = self._urls.get(self.likely_media)
+        if likely is not None:
+            self._digests = Task(read_digests, likely)
+            self._head = Task(read_head, likely, HEAD_SIZE)
+
+    def choose_media(self, media_file):
+        """Take what was speculated for the media file chosen.
+
+        Args:
+            media_file (str): Media file chosen.
+
+        Returns:
+            tuple: URL of the media file and what was prefetched for it
+            (see Prefetched).
+
+        Raises:
+            RuntimeError: When the media file cannot be found.
+
+        """
+        url_task = self._urls.pop(media_file, None)
+        prefetched = Prefetched()
+        if media_file == self.likely_media and self._head is not None:
+            if self._head.is_alive():
+                # Waiting could hold the download up; it will probe instead
+                self._head.cancel()
+            head = self._take(self._head, 'head')
+            prefetched = Prefetched(head, self._digests)
+            self._digests = self._head = None
+        self.cancel()
+
+        if url_task is None:
+            gensystem_metrics.count('speculation_misses', kind='url')
+            return gensystem_media.get_media_file_url(
+                self.mirror, self.arch, media_file), prefetched
+        gensystem_metrics.count('speculation_hits', kind='url')
+        return url_task.get(), prefetched
+
+    def cancel(self):
+        """Cancel all speculative work."""
+        for task in self._urls.values() + [self._digests, self._head]:
+            if task is not None:
+                task.cancel()
+        self._urls = {}
+        self._digests = self._head = None
+
+    def _take(self, task, kind):
+        """Get what a finished task fetched, or None if it did not."""
+        try:
+            result = task.get()
+        except ERRORS + (Cancelled,):
+            result = None
+        gensystem_metrics.count(
+            'speculation_hits' if result is not None else 'speculation_misses',
+            kind=kind)
+        return result
@@ -1,7 +1,32 @@
 """Helper functions to simplify writing unit tests."""
 
+import BaseHTTPServer
 import contextlib
+import SocketServer
 import StringIO
+import threading
+
+import mock
+
+import gensystem.temp as gensystem_temp
+
+
+@contextlib.contextmanager
+def isolated_cache(path=None):
+    """Keep gensystem's cache out of the user's for the test.
+
+    Args:
+        path (Optional[str]): Cache directory to use (default: a new
+            temporary directory, removed afterwards).
+
+    Yields:
+        str: The cache directory.
+
+    """
+    with gensystem_temp.temp_directory() as temp_dir:
+        cache_dir = path or temp_dir
+        with mock.patch('gensystem.cache.CACHE_DIR', cache_dir):
+            yield cache_dir
 
 
 @contextlib.contextmanager
@@ -16,3 +41,62 @@ def mock_open(contents):
         yield string_io
     finally:
         string_io.close()
+
+
+class FakeUpstreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """Serve files from the server's `files` dict ({path: contents})."""
+
+    def log_message(self, format, *args):
+        """Keep test output quiet."""
+
+    def do_GET(self):
+        """Serve a file, holding the body back until `gate` is set."""
+        self.server.requests.append(self.path)
+        contents = self.server.files.get(self.path)
+        if contents is None and self.path + '/' in self.server.files:
+            # Directories are redirected to their slashed path like Apache
+            self.send_response(301)
+            self.send_header('Location', self.path + '/')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if contents is None:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(contents)))
+        self.end_headers()
+        self.wfile.write(contents[:len(contents) // 2])
+        self.server.gate.wait()
+        self.wfile.write(contents[len(contents) // 2:])
+
+
+@contextlib.contextmanager
+def fake_upstream(files):
+    """Run a local HTTP server standing in for an upstream mirror.
+
+    Yields:
+        BaseHTTPServer.HTTPServer: Server with `url`, `requests` (paths
+        requested) and `gate` (threading.Event, set by default) attributes.
+
+    """
+    server = SocketServer.ThreadingTCPServer(
+        ('127.0.0.1', 0), FakeUpstreamHandler)
+    server.daemon_threads = True
+    server.files = files
+    server.requests = []
+    server.gate = threading.Event()
+    server.gate.set()
+    server.url = 'http://127.0.0.1:%d/' % server.server_address[1]
+
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.gate.set()
+        server.shutdown()
+        server.server_close()
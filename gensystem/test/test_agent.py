@@ -0,0 +1,108 @@
+"""Unit tests for gensystem agent."""
+
+import contextlib
+import os
+import StringIO
+import sys
+import threading
+
+import mock
+
+import gensystem.agent as gensystem_agent
+import gensystem.temp as gensystem_temp
+
+
+@contextlib.contextmanager
+def running_agent(handler, path):
+    """Serve `handler` at `path` on a thread while the block runs."""
+    agent = gensystem_agent.Agent(handler, path, log=StringIO.StringIO())
+    agent.bind()
+    thread = threading.Thread(target=agent.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield agent
+    finally:
+        agent.shutdown()
+        thread.join(10)
+
+
+def test_forward_streams_output_and_exit_code():
+    """Test a command runs in the agent's process, in the client's cwd."""
+    seen = []
+
+    def handler(argv):
+        seen.append((argv, os.getcwd()))
+        print 'downloading', ' '.join(argv)
+        print >> sys.stderr, 'warning'
+        return 3
+
+    with gensystem_temp.temp_directory() as temp_dir:
+        path = os.path.join(temp_dir, 'agent.sock')
+        stdout, stderr = StringIO.StringIO(), StringIO.StringIO()
+        with running_agent(handler, path):
+            code = gensystem_agent.forward(
+                ['download', '-f', 'stage3'], path, stdout, stderr)
+
+        assert not os.path.exists(path)
+
+    assert code == 3
+    assert seen == [(['download', '-f', 'stage3'], os.getcwd())]
+    assert stdout.getvalue() == 'downloading download -f stage3\n'
+    assert stderr.getvalue() == 'warning\n'
+
+
+def test_forward_falls_back_without_agent():
+    """Test nothing is forwarded when no agent (or another) answers."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        path = os.path.join(temp_dir, 'agent.sock')
+        assert gensystem_agent.forward(['download'], path) is None
+
+        with running_agent(lambda argv: 0, path):
+            with mock.patch.dict(os.environ, {'GENSYSTEM_RETRIES': '1'}):
+                assert gensystem_agent.forward(['download'], path) is None
+            assert gensystem_agent.forward(
+                ['download'], path, StringIO.StringIO()) == 0
+
+
+def test_handler_exits_and_errors_end_the_command():
+    """Test SystemExit and errors of a command become its exit code."""
+    def handler(argv):
+        if argv == ['bad']:
+            sys.exit(2)
+        raise ValueError('broken')
+
+    with gensystem_temp.temp_directory() as temp_dir:
+        path = os.path.join(temp_dir, 'agent.sock')
+        stderr = StringIO.StringIO()
+        with running_agent(handler, path):
+            assert gensystem_agent.forward(['bad'], path) == 2
+            assert gensystem_agent.forward(
+                ['worse'], path, stderr=stderr) == 1
+
+    assert 'ValueError: broken' in stderr.getvalue()
+    assert not isinstance(sys.stdout, gensystem_agent.StreamWriter)
+
+
+def test_warm_state_expires():
+    """Test remembered values are looked up again after the TTL."""
+    now = [0.0]
+    expired = []
+    state = gensystem_agent.WarmState(60, clock=lambda: now[0])
+    state.add_listener(lambda: expired.append(now[0]))
+    lookups = []
+
+    def lookup(value):
+        lookups.append(value)
+        return value
+
+    assert state.get('country', lookup, 'DE') == 'DE'
+    assert state.get('country', lookup, 'FR') == 'DE'
+    assert state.get('missing', lookup, None) is None
+    assert not state.expire()
+
+    now[0] = 61.0
+    assert state.expire()
+    assert state.get('country', lookup, 'FR') == 'FR'
+    assert lookups == ['DE', None, 'FR']
+    assert expired == [61.0]
@@ -0,0 +1,139 @@
+"""Unit tests for gensystem bandwidth."""
+
+import json
+import os
+import threading
+import time
+
+import mock
+
+import gensystem.bandwidth as gensystem_bandwidth
+import gensystem.temp as gensystem_temp
+
+READ_SIZE = 8 * 1024
+
+
+def read_for(scheduler, flow, seconds, read, mirror=None):
+    """Read through a scheduler for some seconds, counting the bytes."""
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        scheduler.acquire(READ_SIZE, mirror, flow)
+        read[flow.name] = read.get(flow.name, 0) + READ_SIZE
+
+
+def test_flows_share_by_priority():
+    """Test a flow of priority 3 gets about three times the bandwidth."""
+    read = {}
+    with gensystem_temp.temp_directory() as temp_dir:
+        scheduler = gensystem_bandwidth.Scheduler(
+            400 * 1024, control_file=os.path.join(temp_dir, 'missing'))
+        readers = [
+            threading.Thread(target=read_for, args=(
+                scheduler, gensystem_bandwidth.Flow(name, priority), 1.5,
+                read))
+            for name, priority in (('stage3', 3), ('minimal', 1))]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+
+    assert 2.0 < read['stage3'] / float(read['minimal']) < 4.5
+    # Burst plus the rate for the time taken, give or take a read
+    assert sum(read.values()) < 400 * 1024 * 1.85
+
+
+def test_finished_flows_are_forgotten():
+    """Test the scheduler does not keep a finish tag per past flow."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        scheduler = gensystem_bandwidth.Scheduler(
+            100 * 1024 * 1024, control_file=os.path.join(temp_dir, 'missing'))
+        for number in range(100):
+            flow = gensystem_bandwidth.Flow('stage3-%d' % number, None)
+            for _ in range(3):
+                scheduler.acquire(READ_SIZE, flow_=flow)
+
+    assert len(scheduler._finish_tags) <= 1
+
+
+def test_mirror_cap_paces_only_that_mirror():
+    """Test reads from a capped mirror wait and others do not."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        scheduler = gensystem_bandwidth.Scheduler(
+            mirror_rates={'slow.example': 100 * 1024},
+            control_file=os.path.join(temp_dir, 'missing'))
+        started = time.time()
+        for _ in range(100):
+            scheduler.acquire(READ_SIZE, 'fast.example')
+        fast = time.time() - started
+        for _ in range(13):
+            scheduler.acquire(READ_SIZE, 'slow.example')
+        slow = time.time() - started - fast
+
+    assert fast < 0.1
+    # 104k at 100k/s less the 25k burst
+    assert slow > 0.6
+
+
+def test_limits_reload_from_control_file():
+    """Test limits and priorities follow the control file."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        control_file = os.path.join(temp_dir, 'bandwidth.json')
+        scheduler = gensystem_bandwidth.Scheduler(control_file=control_file)
+        scheduler.acquire(READ_SIZE)
+        assert scheduler.rate is None
+
+        with open(control_file, 'w') as control:
+            json.dump({
+                'rate': 1000000, 'mirrors': {'slow.example': 5000},
+                'priorities': {'stage3': 4}}, control)
+        scheduler.request_reload()
+        scheduler.acquire(READ_SIZE)
+
+        assert scheduler.rate == 1000000
+        assert scheduler.mirror_rates == {'slow.example': 5000}
+        assert scheduler.priorities == {'stage3': 4}
+
+        # A damaged control file leaves the limits as they were
+        with open(control_file, 'w') as control:
+            control.write('{')
+        scheduler.request_reload()
+        scheduler.acquire(READ_SIZE)
+        assert scheduler.rate == 1000000
+
+
+def test_flow_is_kept_per_thread():
+    """Test the flow set in a thread applies to it alone."""
+    seen = []
+    with gensystem_bandwidth.flow('stage3', 4):
+        thread = threading.Thread(
+            target=lambda: seen.append(gensystem_bandwidth.get_flow()))
+        thread.start()
+        thread.join()
+        assert gensystem_bandwidth.get_flow() == ('stage3', 4)
+
+    assert seen == [gensystem_bandwidth.DEFAULT_FLOW]
+    assert gensystem_bandwidth.get_flow() == gensystem_bandwidth.DEFAULT_FLOW
+
+
+def test_invalid_rates_are_no_limit():
+    """Test a negative or malformed rate does not stall every read."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        control_file = os.path.join(temp_dir, 'bandwidth.json')
+        with mock.patch.dict(os.environ, {'GENSYSTEM_RATE_LIMIT': '-1'}):
+            assert gensystem_bandwidth.get_rate_limit() is None
+        scheduler = gensystem_bandwidth.Scheduler(
+            -1, {'slow.example': 0}, control_file=control_file)
+        assert scheduler.rate is None and scheduler.mirror_rates == {}
+
+        with open(control_file, 'w') as control:
+            json.dump({'rate': -5, 'mirrors': {
+                'slow.example': -1, 'odd.example': '1M',
+                'capped.example': 100000}}, control)
+        scheduler.request_reload()
+        started = time.time()
+        for _ in range(10):
+            scheduler.acquire(READ_SIZE, 'slow.example')
+
+    assert time.time() - started < 1
+    assert scheduler.rate is None
+    assert scheduler.mirror_rates == {'capped.example': 100000}
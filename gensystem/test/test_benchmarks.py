@@ -0,0 +1,100 @@
+"""Unit tests for gensystem benchmarks."""
+
+import os
+import time
+
+import mock
+
+import gensystem.benchmarks.runner as benchmarks_runner
+import gensystem.benchmarks.suite as benchmarks_suite
+import gensystem.cache as gensystem_cache
+import gensystem.catalog as gensystem_catalog
+import gensystem.media as gensystem_media
+import gensystem.mirror as gensystem_mirror
+import gensystem.temp as gensystem_temp
+import gensystem.test.helpers as test_helpers
+
+
+def make_results(throughput, peak_memory):
+    """Make results holding one benchmark."""
+    return {'benchmarks': {'choices': {
+        'seconds': 1, 'runs': 3, 'throughput': {'choices/s': throughput},
+        'peak_memory': peak_memory}}}
+
+
+def test_fixtures_parse():
+    """Test the recorded mirrors page parses like the real one."""
+    with benchmarks_suite.serving_webpage(
+            benchmarks_suite.get_fixture('mirrors.html')):
+        mirrors = gensystem_mirror.get_mirrors_from_web()
+
+    assert mirrors['USA']
+    assert all(
+        url.startswith('http://')
+        for country in mirrors.values() for url in country.values())
+
+
+def test_measure():
+    """Test a benchmark reports throughput and peak memory."""
+    result = benchmarks_runner.measure(
+        benchmarks_runner.get_benchmark('parse_digests'), min_time=0,
+        min_runs=2)
+
+    assert result['runs'] == 2
+    assert result['throughput']['lookups/s'] > 0
+    assert result['peak_memory'] > 0
+
+
+def test_measure_ignores_users_catalog():
+    """Test a fresh catalog in the user's cache does not skip the scan."""
+    catalog = {'updated': time.time(), 'media': {'amd64': {
+        gensystem_catalog.get_variant('amd64', 'stage3'): {
+            'path': 'releases/amd64/autobuilds/stage3.tar.bz2'}}}}
+
+    with test_helpers.isolated_cache(), mock.patch(
+            'gensystem.media.get_media_folder',
+            wraps=gensystem_media.get_media_folder) as get_media_folder:
+        gensystem_cache.save_json(gensystem_catalog.CATALOG_FILE, catalog)
+        assert gensystem_catalog.get_media('amd64', 'stage3')
+
+        result = benchmarks_runner.measure(
+            benchmarks_runner.get_benchmark('scan_listing'), min_time=0,
+            min_runs=2)
+
+    assert get_media_folder.call_count == result['runs']
+
+
+def test_measure_sparse_download():
+    """Test synthetic downloads are sparse files of the asked size."""
+    with gensystem_temp.temp_directory() as work_dir:
+        benchmarks_suite.setup_verify_download(work_dir, 1)
+        stat = os.stat(os.path.join(
+            work_dir, 'stage3-amd64-20160414.tar.bz2'))
+
+    assert stat.st_size == 1024 * 1024
+    assert stat.st_blocks == 0
+
+
+def test_compare_flags_regressions():
+    """Test slower or bigger results beyond the threshold regress."""
+    baseline = make_results(1000, 100)
+
+    comparisons = benchmarks_runner.compare(
+        make_results(950, 105), baseline, threshold=10)
+    assert not any(comparison['regression'] for comparison in comparisons)
+
+    comparisons = benchmarks_runner.compare(
+        make_results(800, 150), baseline, threshold=10)
+    assert [(comparison['metric'], comparison['change'])
+            for comparison in comparisons] == [
+        ('choices/s', -20.0), ('peak_memory', -50.0)]
+    assert all(comparison['regression'] for comparison in comparisons)
+
+
+def test_save_and_load_results():
+    """Test results survive being stored as a baseline."""
+    results = make_results(1000, 100)
+    with gensystem_temp.temp_directory() as temp_dir:
+        path = os.path.join(temp_dir, 'baseline.json')
+        benchmarks_runner.save_results(results, path)
+        assert benchmarks_runner.load_results(path) == results
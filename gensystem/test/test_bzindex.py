@@ -0,0 +1,121 @@
+"""Unit tests for gensystem bzindex."""
+
+import bz2
+import filecmp
+import os
+import random
+import tarfile
+
+import mock
+
+import gensystem.bzindex as gensystem_bzindex
+import gensystem.metrics as gensystem_metrics
+import gensystem.temp as gensystem_temp
+
+MEMBER_SIZE = 60 * 1024
+MEMBERS = 12
+
+
+def make_tarball(temp_dir):
+    """Make a .tar.bz2 of many blocks (100k each at level 1).
+
+    Returns:
+        tuple: Path of the tarball and of the tree it holds.
+
+    """
+    tree = os.path.join(temp_dir, 'tree')
+    randomness = random.Random(4)
+    for number in range(MEMBERS):
+        directory = os.path.join(tree, 'etc' if number < 2 else 'usr/lib')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'file%d' % number), 'wb') as data:
+            data.write(''.join(
+                chr(randomness.randint(0, 255))
+                for _ in range(MEMBER_SIZE)))
+    os.link(os.path.join(tree, 'etc', 'file0'),
+            os.path.join(tree, 'usr', 'lib', 'link0'))
+
+    plain = os.path.join(temp_dir, 'stage3.tar')
+    with tarfile.open(plain, 'w') as tar:
+        tar.add(tree, arcname='.')
+    tarball = plain + '.bz2'
+    with open(plain, 'rb') as data, open(tarball, 'wb') as compressed:
+        compressed.write(bz2.compress(data.read(), 1))
+    return tarball, tree
+
+
+def test_index_finds_blocks_and_members():
+    """Test every block and member is indexed, and the index is kept."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        tarball, _ = make_tarball(temp_dir)
+        index = gensystem_bzindex.get_index(tarball)
+        assert gensystem_bzindex.load_index(tarball) == index
+
+        with open(tarball, 'rb') as compressed:
+            data = ''.join(
+                gensystem_bzindex.decode_block(compressed, start, end)
+                for start, end, _ in index['blocks'])
+        with open(tarball[:-len('.bz2')], 'rb') as plain:
+            assert data == plain.read()
+
+        # A changed tarball is indexed again
+        os.utime(tarball, (0, 0))
+        assert gensystem_bzindex.load_index(tarball) is None
+
+    assert len(index['blocks']) > 5
+    names = [member[0] for member in index['members']]
+    assert './etc/file0' in names
+    assert ['./usr/lib/link0', './etc/file0'] in [
+        [member[0], member[3]] for member in index['members']
+        if member[3] is not None]
+
+
+@mock.patch('gensystem.metrics.RECORDER', gensystem_metrics.Recorder())
+def test_extract_decodes_only_blocks_needed():
+    """Test extracting a path decompresses only the blocks holding it."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        tarball, tree = make_tarball(temp_dir)
+        target = os.path.join(temp_dir, 'target')
+        os.mkdir(target)
+        extracted, missing, errors = gensystem_bzindex.extract(
+            tarball, target, ['/etc/file1', 'missing'])
+
+        assert filecmp.cmp(
+            os.path.join(tree, 'etc', 'file1'),
+            os.path.join(target, 'etc', 'file1'), shallow=False)
+        assert not os.path.exists(os.path.join(target, 'usr'))
+
+    assert (extracted, missing, errors) == (1, ['missing'], [])
+    decoded = gensystem_metrics.RECORDER.counters[
+        ('bzindex_blocks_decoded', ())]
+    assert decoded < MEMBERS * MEMBER_SIZE // 2
+
+
+def test_parallel_extract_matches_tree():
+    """Test extracting everything in parts gives the whole tree back."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        tarball, tree = make_tarball(temp_dir)
+        target = os.path.join(temp_dir, 'target')
+        os.mkdir(target)
+        units = gensystem_bzindex.split_members(
+            gensystem_bzindex.get_index(tarball)['members'], 4)
+        _, missing, errors = gensystem_bzindex.extract(
+            tarball, target, threads=4)
+
+        for directory in ('etc', 'usr/lib'):
+            comparison = filecmp.dircmp(
+                os.path.join(tree, directory),
+                os.path.join(target, directory))
+            assert comparison.left_list == comparison.right_list
+            assert not filecmp.cmpfiles(
+                comparison.left, comparison.right, comparison.common_files,
+                shallow=False)[1]
+        assert os.stat(os.path.join(target, 'usr', 'lib')).st_mode == (
+            os.stat(os.path.join(tree, 'usr', 'lib')).st_mode)
+        assert os.path.samefile(
+            os.path.join(target, 'etc', 'file0'),
+            os.path.join(target, 'usr', 'lib', 'link0'))
+
+    assert (missing, errors) == ([], [])
+    assert len(units) == 4
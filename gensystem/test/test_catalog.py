@@ -0,0 +1,111 @@
+"""Unit tests for gensystem catalog."""
+
+import os
+
+import mock
+
+import gensystem.benchmarks.fake_mirror as fake_mirror
+import gensystem.catalog as gensystem_catalog
+import gensystem.temp as gensystem_temp
+import gensystem.test.helpers as test_helpers
+
+FOLDER = '/releases/amd64/autobuilds/current-stage3-amd64/'
+STAGE3 = 'stage3-amd64-20160414.tar.bz2'
+
+
+def pre_listing(rows):
+    """Make an Apache <pre> listing of (name, date) rows."""
+    return '<pre>%s</pre>' % ''.join(
+        '<a href="%s">%s</a>  %s  -\n' % (name, name, date)
+        for name, date in rows)
+
+
+def test_get_links():
+    """Test links are read with their rows, navigation links are not."""
+    links = gensystem_catalog.get_links(
+        '<a href="?C=M;O=A">Date</a><a href="../">Parent</a>' + pre_listing(
+            [('amd64/', '14-Apr-2016 10:00')]) +
+        '<table><tr><td><a href="x86/">x86/</a></td><td>2016-04-07</td>'
+        '</tr></table>')
+    assert links == {
+        'amd64/': '14-Apr-2016 10:00 -', 'x86/': '2016-04-07'}
+
+
+def test_get_variant():
+    """Test media files named before the catalog map to variants."""
+    assert gensystem_catalog.get_variant('amd64', 'stage3') == 'stage3-amd64'
+    assert gensystem_catalog.get_variant('x86', 'minimal') == (
+        'install-x86-minimal')
+    assert gensystem_catalog.get_variant('arm', 'stage3-armv7a') == (
+        'stage3-armv7a')
+
+
+def test_crawl_catalogs_every_arch():
+    """Test the newest build of every variant of every arch is found."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        fake_mirror.make_layout(temp_dir, 'stage3', 2048, stamp='20160407')
+        fake_mirror.make_layout(temp_dir, 'stage3', 1024)
+        fake_mirror.make_layout(temp_dir, 'hardened', 512)
+        arm = os.path.join(
+            temp_dir, 'releases/arm/autobuilds/current-stage3-armv7a')
+        os.makedirs(arm)
+        with open(os.path.join(arm, 'stage3-armv7a-20160410.tar.bz2'),
+                  'wb') as media:
+            media.write('arm')
+
+        with fake_mirror.shaped_mirror(temp_dir) as mirror:
+            catalog = gensystem_catalog.Crawl(mirror.url).run()
+
+    media = catalog['media']
+    assert sorted(media) == ['amd64', 'arm']
+    assert media['amd64']['stage3-amd64'] == {
+        'stamp': '20160414', 'size': 1024,
+        'path': FOLDER.lstrip('/') + STAGE3,
+        'digests': FOLDER.lstrip('/') + STAGE3 + '.DIGESTS'}
+    assert media['amd64']['stage3-amd64-hardened']['size'] == 512
+    assert media['arm']['stage3-armv7a']['digests'] is None
+    assert gensystem_catalog.get_media(
+        'amd64', 'hardened', catalog)['stamp'] == '20160414'
+    assert gensystem_catalog.get_variants(catalog) == [
+        'stage3-amd64', 'stage3-amd64-hardened', 'stage3-armv7a']
+
+
+def test_recrawl_skips_unchanged_folders():
+    """Test folders whose rows did not change are not requested again."""
+    files = {
+        '/releases/': pre_listing([('amd64/', '14-Apr-2016 10:00')]),
+        '/releases/amd64/autobuilds/': pre_listing(
+            [('current-stage3-amd64/', '14-Apr-2016 10:00')]),
+        FOLDER: pre_listing([(STAGE3, '14-Apr-2016 10:00')]),
+        FOLDER + STAGE3: 'x' * 100}
+    with test_helpers.fake_upstream(files) as upstream:
+        catalog = gensystem_catalog.Crawl(upstream.url).run()
+        assert len(upstream.requests) == 4
+
+        del upstream.requests[:]
+        crawl = gensystem_catalog.Crawl(upstream.url, catalog)
+        assert crawl.run()['media'] == catalog['media']
+        assert upstream.requests == [
+            '/releases/', '/releases/amd64/autobuilds/']
+        assert crawl.unchanged == 1
+
+        # A new build changes the folder's row
+        del upstream.requests[:]
+        files['/releases/amd64/autobuilds/'] = pre_listing(
+            [('current-stage3-amd64/', '21-Apr-2016 10:00')])
+        catalog = gensystem_catalog.Crawl(upstream.url, catalog).run()
+        assert upstream.requests[-1] == FOLDER
+        assert catalog['media']['amd64']['stage3-amd64']['size'] == 100
+
+
+def test_old_catalog_is_ignored():
+    """Test a catalog older than the most age allowed is not used."""
+    with test_helpers.isolated_cache():
+        with test_helpers.fake_upstream({
+                '/releases/': pre_listing([])}) as upstream:
+            catalog, _, saved = gensystem_catalog.update(upstream.url)
+
+        assert saved
+        assert gensystem_catalog.load() == catalog
+        with mock.patch('time.time', return_value=catalog['updated'] + 60):
+            assert gensystem_catalog.load(max_age=30) == {}
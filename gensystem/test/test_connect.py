@@ -0,0 +1,105 @@
+"""Unit tests for gensystem connect."""
+
+import socket
+
+import mock
+import pytest
+
+import gensystem.connect as gensystem_connect
+import gensystem.test.helpers as test_helpers
+
+V4 = (socket.AF_INET, ('192.0.2.1', 80))
+V4_2 = (socket.AF_INET, ('192.0.2.2', 80))
+V6 = (socket.AF_INET6, ('2001:db8::1', 80, 0, 0))
+V6_2 = (socket.AF_INET6, ('2001:db8::2', 80, 0, 0))
+
+
+def test_addresses_are_interleaved():
+    """Test families alternate, the resolver's first family first."""
+    reachability = gensystem_connect.Reachability()
+    assert gensystem_connect.order_addresses(
+        'mirror.org', [V6, V6_2, V4, V4_2], reachability) == [
+            V6, V4, V6_2, V4_2]
+
+
+def test_family_that_worked_goes_first():
+    """Test a family that failed for a host is tried after the other."""
+    reachability = gensystem_connect.Reachability({
+        'mirror.org': {'ipv6': False, 'ipv4': True}})
+    assert gensystem_connect.order_addresses(
+        'mirror.org', [V6, V4, V6_2], reachability) == [V4, V6, V6_2]
+    assert gensystem_connect.order_addresses(
+        'other.org', [V6, V4], reachability) == [V6, V4]
+
+
+def test_resolve_is_cached():
+    """Test a host is resolved once per process."""
+    results = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', V4[1])] * 2
+    with mock.patch('socket.getaddrinfo', return_value=results) as lookup:
+        try:
+            assert gensystem_connect.resolve('cached.org', 80) == [V4]
+            assert gensystem_connect.resolve('cached.org', 80) == [V4]
+        finally:
+            gensystem_connect.forget_resolutions()
+
+    assert lookup.call_count == 1
+
+
+def test_failed_resolutions_are_not_cached():
+    """Test a failed lookup is tried again."""
+    with mock.patch('socket.getaddrinfo', side_effect=socket.gaierror(
+            -2, 'Name or service not known')) as lookup:
+        for _ in range(2):
+            with pytest.raises(socket.error):
+                gensystem_connect.resolve('missing.org', 80)
+
+    assert lookup.call_count == 2
+
+
+def test_prefetch_resolves_hosts():
+    """Test hosts of URLs are resolved in the background."""
+    with mock.patch('gensystem.connect.resolve') as resolve:
+        for worker in gensystem_connect.prefetch([
+                'http://one.org/gentoo/', 'https://two.org:8443/',
+                'http://one.org/other/', 'rsync://three.org/']):
+            worker.join()
+
+    assert sorted(call[0] for call in resolve.call_args_list) == [
+        ('one.org', 80), ('two.org', 8443)]
+
+
+def test_race_skips_refused_address():
+    """Test a refused address loses the race to the next one."""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    # Nothing listens on this address any more, so it is refused
+    closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    closed.bind(('127.0.0.1', 0))
+    refused = closed.getsockname()
+    closed.close()
+
+    addresses = [
+        (socket.AF_INET, refused), (socket.AF_INET, server.getsockname())]
+    with mock.patch('gensystem.connect.resolve', lambda host, port: list(
+            addresses)):
+        sock = gensystem_connect.create_connection(('mirror.org', 80), 5)
+
+    assert sock.getpeername() == server.getsockname()
+    assert sock.gettimeout() == 5
+    sock.close()
+    server.close()
+
+
+def test_race_is_remembered():
+    """Test a family beaten by the other is tried last next time."""
+    reachability = gensystem_connect.Reachability()
+    with test_helpers.isolated_cache():
+        gensystem_connect.record_race(
+            reachability, 'mirror.org', socket.AF_INET,
+            [socket.AF_INET6, socket.AF_INET])
+        saved = gensystem_connect.Reachability.load()
+
+    assert saved.hosts == {'mirror.org': {'ipv4': True, 'ipv6': False}}
+    assert gensystem_connect.order_addresses(
+        'mirror.org', [V6, V4], saved) == [V4, V6]
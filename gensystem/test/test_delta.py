@@ -0,0 +1,139 @@
+"""Unit tests for gensystem delta."""
+
+import hashlib
+import json
+import os
+import random
+
+import mock
+import pytest
+
+import gensystem.benchmarks.fake_mirror as fake_mirror
+import gensystem.delta as gensystem_delta
+import gensystem.metrics as gensystem_metrics
+import gensystem.temp as gensystem_temp
+
+BLOCK_SIZE = 1024
+
+
+def make_data(size, seed):
+    """Make reproducible incompressible data."""
+    generator = random.Random(seed)
+    return ''.join(chr(generator.randint(0, 255)) for _ in range(size))
+
+
+def write(path, data):
+    """Write data to a file, returning its path."""
+    with open(path, 'wb') as written:
+        written.write(data)
+    return path
+
+
+def test_find_blocks_at_any_offset():
+    """Test blocks are found in a seed where they were shifted."""
+    old = make_data(20 * BLOCK_SIZE, 1)
+    # Bytes inserted, changed and removed, shifting the rest
+    new = 'inserted' + old[:5000] + make_data(3000, 2) + old[9000:-700]
+    with gensystem_temp.temp_directory() as temp_dir:
+        block_map = gensystem_delta.make_block_map(
+            write(os.path.join(temp_dir, 'new'), new), BLOCK_SIZE)
+        found = gensystem_delta.find_blocks(
+            write(os.path.join(temp_dir, 'old'), old), block_map)
+
+    assert len(block_map['blocks']) == 19
+    for index, offset in found.items():
+        length = min(BLOCK_SIZE, len(new) - index * BLOCK_SIZE)
+        assert old[offset:offset + length] == new[
+            index * BLOCK_SIZE:index * BLOCK_SIZE + length]
+    # Only the blocks overlapping a change, and the short last one, differ
+    assert len(found) == 13
+
+
+def test_weak_checksum_rolls():
+    """Test the rolling checksum matches Adler-32 at every offset."""
+    data = make_data(3 * BLOCK_SIZE, 3)
+    wanted = dict(
+        (gensystem_delta.get_weak_checksum(data[offset:offset + BLOCK_SIZE]),
+         [offset])
+        for offset in (1, 700, 1500))
+    offsets = []
+    position = 0
+    while True:
+        position = gensystem_delta._roll(
+            data, position, len(data), BLOCK_SIZE, wanted)
+        if position is None:
+            break
+        offsets.append(position)
+        position += 1
+
+    assert offsets == [1, 700, 1500]
+
+
+def test_get_runs():
+    """Test blocks are grouped into runs, fetched runs limited in length."""
+    runs = gensystem_delta.get_runs(8, {0: 0, 1: 10, 5: 20}, max_run=2)
+    assert runs == [
+        (0, 2, True), (2, 4, False), (4, 5, False), (5, 6, True),
+        (6, 8, False)]
+
+
+def test_find_seed():
+    """Test the newest older build of the same media file is the seed."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        for name in (
+                'stage3-amd64-20160331.tar.bz2',
+                'stage3-amd64-20160407.tar.bz2',
+                'stage3-amd64-20160414.tar.bz2',
+                'stage3-amd64-hardened-20160410.tar.bz2'):
+            write(os.path.join(temp_dir, name), '')
+
+        assert gensystem_delta.find_seed(os.path.join(
+            temp_dir, 'stage3-amd64-20160414.tar.bz2')) == os.path.join(
+                temp_dir, 'stage3-amd64-20160407.tar.bz2')
+        assert gensystem_delta.find_seed(os.path.join(
+            temp_dir, 'stage3-amd64-20160331.tar.bz2')) is None
+
+
+def update_from(old, new):
+    """Rebuild `new` from `old`, serving `new` and its block map.
+
+    Returns:
+        tuple: Whether it was rebuilt intact, bytes reused and counters.
+
+    """
+    recorder = gensystem_metrics.Recorder()
+    with gensystem_temp.temp_directory() as temp_dir, mock.patch(
+            'gensystem.metrics.RECORDER', recorder):
+        path = write(os.path.join(temp_dir, 'new.tar.bz2'), new)
+        with open(path + gensystem_delta.BLOCK_MAP_SUFFIX, 'w') as mapped:
+            json.dump(gensystem_delta.make_block_map(path, BLOCK_SIZE), mapped)
+        seed = write(os.path.join(temp_dir, 'old.tar.bz2'), old)
+        rebuilt = os.path.join(temp_dir, 'rebuilt')
+        with fake_mirror.shaped_mirror(temp_dir) as mirror:
+            sha512, reused = gensystem_delta.update(
+                mirror.url + 'new.tar.bz2', rebuilt, seed)
+        with open(rebuilt, 'rb') as rebuilt_file:
+            intact = rebuilt_file.read() == new
+
+    assert sha512 == hashlib.sha512(new).hexdigest()
+    return intact, reused, recorder.counters
+
+
+def test_update_fetches_only_missing_blocks():
+    """Test a file is rebuilt from the seed and the blocks it lacks."""
+    old = make_data(40 * BLOCK_SIZE, 4)
+    new = old[:10000] + make_data(2000, 5) + old[10000:] + 'appended'
+    intact, reused, counters = update_from(old, new)
+
+    assert intact
+    fetched = sum(
+        value for (name, _), value in counters.items()
+        if name == 'delta_fetched_bytes')
+    assert reused + fetched == len(new)
+    assert fetched <= 5 * BLOCK_SIZE
+
+
+def test_update_needs_a_related_seed():
+    """Test a seed sharing nothing is refused (a download is faster)."""
+    with pytest.raises(gensystem_delta.DeltaError):
+        update_from(make_data(4 * BLOCK_SIZE, 6), make_data(4 * BLOCK_SIZE, 7))
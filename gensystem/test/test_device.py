@@ -0,0 +1,95 @@
+"""Unit tests for gensystem device."""
+
+import hashlib
+import os
+
+import mock
+import pytest
+
+import gensystem.benchmarks.fake_mirror as fake_mirror
+import gensystem.device as gensystem_device
+import gensystem.retry as gensystem_retry
+import gensystem.temp as gensystem_temp
+
+SIZE = 1024 * 1024 + 100
+WRITE_SIZE = 64 * 1024
+
+
+def write(temp_dir, shape=None):
+    """Write a fake minimal ISO to a file from a shaped mirror.
+
+    Returns:
+        tuple: The ISO, the target, what write returned and the mirror.
+
+    """
+    path = fake_mirror.make_layout(temp_dir, 'minimal', SIZE)
+    with open(path, 'rb') as media:
+        data = media.read()
+    target = os.path.join(temp_dir, 'usb.img')
+    with fake_mirror.shaped_mirror(temp_dir, shape, [path]) as mirror:
+        written = gensystem_device.write(
+            mirror.url + fake_mirror.get_media_path('minimal'), target,
+            write_size=WRITE_SIZE)
+    return data, target, written, mirror
+
+
+def test_write_hashes_inline_and_reads_back():
+    """Test media is written to the target and hashed on the way."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        data, target, (sha512, written), _ = write(temp_dir)
+        with open(target, 'rb') as usb:
+            assert usb.read() == data
+        assert gensystem_device.read_back(target, written) == sha512
+
+        with pytest.raises(IOError):
+            gensystem_device.read_back(target, written + 1)
+
+    assert sha512 == hashlib.sha512(data).hexdigest()
+    assert written == SIZE
+
+
+@mock.patch.object(gensystem_retry.POLICY, 'sleep')
+def test_write_resumes_after_reset(m_sleep):
+    """Test a reset download resumes after the last byte written."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        data, target, (sha512, written), mirror = write(
+            temp_dir, fake_mirror.Shape(resets=1))
+        with open(target, 'rb') as usb:
+            assert usb.read() == data
+
+    assert sha512 == hashlib.sha512(data).hexdigest()
+    assert mirror.stats['resets'] == 1
+    assert mirror.stats['media_sent'] < 2 * SIZE
+
+
+def test_get_mounted():
+    """Test filesystems on a device or its partitions are found."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        mounts = os.path.join(temp_dir, 'mounts')
+        with open(mounts, 'w') as mounts_file:
+            mounts_file.write(
+                'proc /proc proc rw 0 0\n'
+                '/dev/sdb1 /media/usb vfat rw 0 0\n'
+                '/dev/sdb10 /media/other ext4 rw 0 0\n'
+                '/dev/nvme0n1p2 / ext4 rw 0 0\n')
+
+        assert gensystem_device.get_mounted('/dev/sdb', mounts) == [
+            '/media/usb', '/media/other']
+        assert gensystem_device.get_mounted('/dev/nvme0n1', mounts) == ['/']
+        assert gensystem_device.get_mounted('/dev/sdc', mounts) == []
+        assert gensystem_device.get_mounted(
+            '/dev/sdb', os.path.join(temp_dir, 'missing')) == []
+
+
+def test_unwritable_target_is_not_retried():
+    """Test a target that cannot be opened fails without retries."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        path = fake_mirror.make_layout(temp_dir, 'minimal', SIZE)
+        target = os.path.join(temp_dir, 'missing', 'usb.img')
+        with fake_mirror.shaped_mirror(temp_dir, media=[path]) as mirror:
+            with pytest.raises(gensystem_device.TargetError):
+                gensystem_device.write(
+                    mirror.url + fake_mirror.get_media_path('minimal'),
+                    target)
+
+    assert mirror.stats['media_requests'] == 1
@@ -0,0 +1,92 @@
+"""Unit tests for gensystem digests."""
+
+import hashlib
+import os
+import time
+
+import mock
+
+import gensystem.digests as gensystem_digests
+import gensystem.metrics as gensystem_metrics
+import gensystem.temp as gensystem_temp
+import gensystem.test.helpers as test_helpers
+
+CONTENTS = 'stage3 ' * 1000
+
+
+def write(path, data, age=60):
+    """Write data to a file last modified `age` seconds ago."""
+    with open(path, 'wb') as written:
+        written.write(data)
+    modified = time.time() - age
+    os.utime(path, (modified, modified))
+    return path
+
+
+def hash_file(path, force=False):
+    """Hash a file, returning its digest, bytes read and memo hits."""
+    recorder = gensystem_metrics.Recorder()
+    with mock.patch('gensystem.metrics.RECORDER', recorder):
+        digest, read = gensystem_digests.hash_file(path, force=force)
+    return digest, read, sum(recorder.counters.values())
+
+
+def test_unchanged_file_is_not_hashed_again():
+    """Test a file hashed before gets its digest back without a read."""
+    with gensystem_temp.temp_directory() as temp_dir, \
+            test_helpers.isolated_cache():
+        path = write(os.path.join(temp_dir, 'stage3'), CONTENTS)
+        digest = hashlib.sha512(CONTENTS).hexdigest()
+
+        assert hash_file(path) == (digest, len(CONTENTS), 0)
+        assert hash_file(path) == (digest, 0, 1)
+        # Unless a full hash is forced
+        assert hash_file(path, force=True) == (digest, len(CONTENTS), 0)
+
+
+def test_changed_files_are_hashed_again():
+    """Test files rewritten in place or replaced miss the memo."""
+    with gensystem_temp.temp_directory() as temp_dir, \
+            test_helpers.isolated_cache():
+        path = write(os.path.join(temp_dir, 'stage3'), CONTENTS)
+        hash_file(path)
+        stat = os.stat(path)
+
+        # Same size, same inode, only the times differ
+        write(path, CONTENTS.upper(), age=30)
+        assert os.stat(path).st_ino == stat.st_ino
+        assert hash_file(path) == (
+            hashlib.sha512(CONTENTS.upper()).hexdigest(), len(CONTENTS), 0)
+
+        # Renamed over with the times of the original
+        replacement = write(os.path.join(temp_dir, 'new'), CONTENTS.lower())
+        os.utime(replacement, (stat.st_atime, stat.st_mtime))
+        os.rename(replacement, path)
+        assert hash_file(path) == (
+            hashlib.sha512(CONTENTS.lower()).hexdigest(), len(CONTENTS), 0)
+
+
+def test_recently_modified_file_is_not_trusted():
+    """Test a file modified as it was hashed is hashed again next time."""
+    with gensystem_temp.temp_directory() as temp_dir, \
+            test_helpers.isolated_cache():
+        path = write(os.path.join(temp_dir, 'stage3'), CONTENTS, age=0)
+
+        assert hash_file(path)[1] == len(CONTENTS)
+        assert hash_file(path)[1] == len(CONTENTS)
+        with mock.patch(
+                'time.time', return_value=os.stat(path).st_mtime + 10):
+            hash_file(path)
+        assert hash_file(path)[1] == 0
+
+
+def test_file_changed_while_hashed_is_not_recorded():
+    """Test a digest is not remembered for a file changed since its stat."""
+    with gensystem_temp.temp_directory() as temp_dir, \
+            test_helpers.isolated_cache():
+        path = write(os.path.join(temp_dir, 'stage3'), CONTENTS)
+        stat = os.stat(path)
+        write(path, CONTENTS + 'appended')
+
+        assert not gensystem_digests.record(path, 'digest', stat)
+        assert gensystem_digests.lookup(path) is None
@@ -0,0 +1,102 @@
+"""Unit tests for gensystem freshness."""
+
+import os
+import time
+
+import mock
+
+import gensystem.benchmarks.fake_mirror as fake_mirror
+import gensystem.freshness as gensystem_freshness
+import gensystem.temp as gensystem_temp
+import gensystem.test.helpers as test_helpers
+
+
+def make_index(stamps):
+    """Make a freshness index of amd64 stage3 stamps by mirror."""
+    return {
+        'checked': time.time(),
+        'mirrors': dict(
+            (mirror, {'amd64/stage3': {
+                'stamp': stamp, 'seconds': 0.1,
+                'error': None if stamp else 'timed out'}})
+            for mirror, stamp in stamps.items())}
+
+
+def test_check_mirrors():
+    """Test the newest build of each mirror is found, or its error."""
+    with gensystem_temp.temp_directory() as fresh_dir, \
+            gensystem_temp.temp_directory() as stale_dir:
+        fake_mirror.make_layout(fresh_dir, 'stage3', 1024, stamp='20160414')
+        fake_mirror.make_layout(fresh_dir, 'stage3', 1024, stamp='20160407')
+        fake_mirror.make_layout(stale_dir, 'stage3', 1024, stamp='20160331')
+        with fake_mirror.shaped_mirror(fresh_dir) as fresh, \
+                fake_mirror.shaped_mirror(stale_dir) as stale:
+            index = gensystem_freshness.check_mirrors(
+                [fresh.url, stale.url, 'http://127.0.0.1:1/'],
+                [('amd64', 'stage3')])
+
+    results = dict(
+        (mirror, builds['amd64/stage3'])
+        for mirror, builds in index['mirrors'].items())
+    assert results[fresh.url]['stamp'] == '20160414'
+    assert results[stale.url]['stamp'] == '20160331'
+    assert results['http://127.0.0.1:1/']['error']
+    assert not gensystem_freshness.is_stale(
+        index, fresh.url, 'amd64', 'stage3')
+    assert gensystem_freshness.is_stale(index, stale.url, 'amd64', 'stage3')
+    assert gensystem_freshness.is_stale(
+        index, 'http://127.0.0.1:1/', 'amd64', 'stage3')
+
+
+def test_check_catalogued_arch():
+    """Test builds of architectures gensystem has no names for are checked."""
+    folder = 'releases/x86/autobuilds/current-stage3-i686'
+    catalog = {'updated': time.time(), 'media': {'x86': {'stage3-i686': {
+        'stamp': '20160407', 'size': 1024, 'digests': None,
+        'path': '%s/stage3-i686-20160407.tar.bz2' % folder}}}}
+    with gensystem_temp.temp_directory() as temp_dir, mock.patch(
+            'gensystem.catalog.load', return_value=catalog):
+        os.makedirs(os.path.join(temp_dir, folder))
+        for name in ('stage3-i686-20160414.tar.bz2',
+                     'stage3-i686-hardened-20160421.tar.bz2'):
+            open(os.path.join(temp_dir, folder, name), 'w').close()
+
+        assert gensystem_freshness.get_media_files('x86') == ['stage3-i686']
+        with fake_mirror.shaped_mirror(temp_dir) as mirror:
+            index = gensystem_freshness.check_mirrors(
+                [mirror.url], [('x86', 'stage3-i686'), ('x86', 'minimal')])
+
+    results = index['mirrors'][mirror.url]
+    assert results['x86/stage3-i686']['stamp'] == '20160414'
+    assert 'not catalogued' in results['x86/minimal']['error']
+
+
+def test_unknown_mirrors_are_not_stale():
+    """Test mirrors (and builds) never checked are given the benefit."""
+    index = make_index({'http://a.org/': '20160414'})
+    assert not gensystem_freshness.is_stale(
+        index, 'http://b.org/', 'amd64', 'stage3')
+    assert not gensystem_freshness.is_stale(
+        index, 'http://a.org/', 'x86', 'stage3')
+
+
+def test_filter_fresh():
+    """Test stale mirrors are left out, unless every mirror is stale."""
+    mirrors = {'A': 'http://a.org/', 'B': 'http://b.org/'}
+    index = make_index({'http://a.org/': '20160414', 'http://b.org/': None})
+    assert gensystem_freshness.filter_fresh(
+        mirrors, 'amd64', 'stage3', index) == {'A': 'http://a.org/'}
+
+    index = make_index({'http://a.org/': None, 'http://b.org/': None})
+    assert gensystem_freshness.filter_fresh(
+        mirrors, 'amd64', 'stage3', index) == mirrors
+
+
+def test_old_index_is_ignored():
+    """Test an index older than the most age allowed is not used."""
+    index = make_index({'http://a.org/': '20160414'})
+    with test_helpers.isolated_cache():
+        gensystem_freshness.save_index(index)
+        assert gensystem_freshness.load_index() == index
+        with mock.patch('time.time', return_value=index['checked'] + 60):
+            assert gensystem_freshness.load_index(max_age=30) == {}
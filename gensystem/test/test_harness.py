@@ -0,0 +1,103 @@
+"""Unit tests for gensystem benchmark fake mirrors and harness."""
+
+import os
+import time
+import urllib2
+
+import pytest
+
+import gensystem.benchmarks.fake_mirror as fake_mirror
+import gensystem.benchmarks.harness as benchmarks_harness
+import gensystem.temp as gensystem_temp
+import gensystem.transfer as gensystem_transfer
+
+SIZE = 256 * 1024
+
+
+def serve_layout(temp_dir, shape):
+    """Lay out a stage3 and serve it with a fake mirror of `shape`."""
+    path = fake_mirror.make_layout(temp_dir, 'stage3', SIZE)
+    url = fake_mirror.get_media_path('stage3')
+    return fake_mirror.shaped_mirror(temp_dir, shape, [path]), url
+
+
+def test_layout_and_listing():
+    """Test the fake mirror lists autobuilds like a real mirror."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        server, path = serve_layout(temp_dir, fake_mirror.Shape())
+        with server as mirror:
+            folder = mirror.url + os.path.dirname(path)
+            response = urllib2.urlopen(folder)
+            listing = response.read()
+
+    assert response.geturl() == folder + '/'
+    assert 'href="stage3-amd64-20160414.tar.bz2"' in listing
+    assert 'href="stage3-amd64-20160414.tar.bz2.DIGESTS"' in listing
+
+
+@pytest.mark.parametrize('ranges,status', [(True, 206), (False, 200)])
+def test_ranges(ranges, status):
+    """Test Range requests are honoured only when shaped to be."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        server, path = serve_layout(
+            temp_dir, fake_mirror.Shape(ranges=ranges))
+        with server as mirror:
+            response = gensystem_transfer.open_url(
+                mirror.url + path, {'Range': 'bytes=10-19'})
+            body = response.read()
+
+    assert response.status == status
+    assert len(body) == (10 if ranges else SIZE)
+
+
+def test_faults_are_injected_into_media_only():
+    """Test errors and resets hit media requests, as many as shaped."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        server, path = serve_layout(
+            temp_dir, fake_mirror.Shape(errors=1, resets=1))
+        destination = os.path.join(temp_dir, 'stage3')
+        with server as mirror:
+            urllib2.urlopen(mirror.url + path + '.DIGESTS').read()
+            with pytest.raises(urllib2.HTTPError):
+                gensystem_transfer.fetch(mirror.url + path, destination)
+            with pytest.raises(EnvironmentError):
+                gensystem_transfer.fetch(mirror.url + path, destination)
+            fetched = gensystem_transfer.fetch(
+                mirror.url + path, destination)
+
+    assert fetched == SIZE
+    assert mirror.stats['media_requests'] == 3
+    assert mirror.stats['errors'] == mirror.stats['resets'] == 1
+
+
+def test_bandwidth_cap():
+    """Test a capped mirror sends no faster than its cap."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        server, path = serve_layout(
+            temp_dir, fake_mirror.Shape(total_bandwidth=SIZE * 4))
+        with server as mirror:
+            started = time.time()
+            gensystem_transfer.fetch(
+                mirror.url + path, os.path.join(temp_dir, 'stage3'))
+            elapsed = time.time() - started
+
+    assert elapsed >= 0.2
+
+
+def test_run_download():
+    """Test the harness downloads and verifies media end to end."""
+    result = benchmarks_harness.run_download(fake_mirror.Shape(), size=0.25)
+
+    assert result['success']
+    assert result['throughput'] > 0
+    assert result['mirror']['media_requests'] == 1
+    assert result['mirror']['media_sent'] == SIZE
+
+
+def test_run_download_records_failures():
+    """Test a failed download is recorded rather than raised."""
+    result = benchmarks_harness.run_download(
+        fake_mirror.Shape(errors=1, error_status=404), size=0.25)
+
+    assert not result['success']
+    assert result['mirror']['errors'] == 1
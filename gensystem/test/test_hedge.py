@@ -0,0 +1,101 @@
+"""Unit tests for gensystem hedge."""
+
+import os
+
+import mock
+import pytest
+
+import gensystem.benchmarks.fake_mirror as fake_mirror
+import gensystem.hedge as gensystem_hedge
+import gensystem.metrics as gensystem_metrics
+import gensystem.temp as gensystem_temp
+import gensystem.test.helpers as test_helpers
+
+
+def test_get_percentile():
+    """Test percentiles are taken by nearest rank."""
+    samples = range(1, 101)
+    assert gensystem_hedge.get_percentile(samples, 95) == 95
+    assert gensystem_hedge.get_percentile(samples, 0) == 1
+    assert gensystem_hedge.get_percentile([], 95) is None
+
+
+def test_delay_follows_latencies():
+    """Test the hedging delay is a percentile of recent latencies."""
+    tracker = gensystem_hedge.LatencyTracker()
+    assert tracker.get_delay('listing') == gensystem_hedge.DEFAULT_DELAY
+    for _ in range(gensystem_hedge.MIN_SAMPLES):
+        tracker.record('listing', 0.2)
+    assert tracker.get_delay('listing') == 0.2
+    tracker.record('listing', 100)
+    assert tracker.get_delay('listing') == gensystem_hedge.MAX_DELAY
+
+
+def test_budget_caps_hedges():
+    """Test hedges are limited to a burst plus a share of requests."""
+    budget = gensystem_hedge.Budget(ratio=0.5, burst=1)
+    assert budget.spend()
+    assert not budget.spend()
+    budget.record_request()
+    budget.record_request()
+    assert budget.spend()
+    assert not budget.spend()
+
+
+def read_from(shapes, budget):
+    """Read a DIGESTS file from the first of two shaped fake mirrors.
+
+    Returns whether the second mirror answered first, the counters and the
+    latency tracker.
+
+    """
+    recorder = gensystem_metrics.Recorder()
+    tracker = gensystem_hedge.LatencyTracker({'digests': [0.01] * 5})
+    with gensystem_temp.temp_directory() as temp_dir, mock.patch(
+            'gensystem.metrics.RECORDER', recorder), \
+            test_helpers.isolated_cache():
+        path = fake_mirror.get_media_path('stage3') + '.DIGESTS'
+        fake_mirror.make_layout(temp_dir, 'stage3', 1024)
+        with fake_mirror.shaped_mirror(temp_dir, shapes[0]) as slow:
+            with fake_mirror.shaped_mirror(temp_dir, shapes[1]) as fast:
+                url, body = gensystem_hedge.read(
+                    slow.url + path, 'digests', fast.url + path, budget,
+                    tracker)
+        with open(os.path.join(temp_dir, path)) as digests:
+            assert body == digests.read()
+
+    return url.startswith(fast.url), recorder.counters, tracker
+
+
+def test_slow_read_is_hedged():
+    """Test a slow request is raced by a second mirror, which wins."""
+    hedge_won, counters, tracker = read_from(
+        [fake_mirror.Shape(latency=2), fake_mirror.Shape()],
+        gensystem_hedge.Budget())
+
+    assert hedge_won
+    assert counters[('hedges_sent', (('kind', 'digests'),))] == 1
+    assert counters[('hedges_won', (('kind', 'digests'),))] == 1
+    assert tracker.samples['digests'][-1] < 2
+
+
+def test_hedges_are_budgeted():
+    """Test no hedge is sent once the budget is spent."""
+    hedge_won, counters, _ = read_from(
+        [fake_mirror.Shape(latency=0.3), fake_mirror.Shape()],
+        gensystem_hedge.Budget(ratio=0, burst=0))
+
+    assert not hedge_won
+    assert counters[('hedges_denied', (('kind', 'digests'),))] == 1
+    assert ('hedges_won', (('kind', 'digests'),)) not in counters
+
+
+def test_failed_reads_raise():
+    """Test the first request's error is raised when every request fails."""
+    tracker = gensystem_hedge.LatencyTracker()
+    with gensystem_temp.temp_directory() as temp_dir, \
+            test_helpers.isolated_cache():
+        with fake_mirror.shaped_mirror(temp_dir) as mirror:
+            with pytest.raises(IOError):
+                gensystem_hedge.read(
+                    mirror.url + 'missing', 'digests', tracker=tracker)
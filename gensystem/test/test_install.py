@@ -0,0 +1,195 @@
+"""Unit tests for gensystem install."""
+
+import bz2
+import hashlib
+import os
+import Queue
+import StringIO
+import tarfile
+
+import pytest
+
+import gensystem.benchmarks.harness as benchmarks_harness
+import gensystem.install as gensystem_install
+import gensystem.temp as temp
+import gensystem.test.helpers as test_helpers
+
+
+def make_tarball(files):
+    """Make an uncompressed tarball holding `files` ({name: contents})."""
+    tarball = StringIO.StringIO()
+    with tarfile.open(fileobj=tarball, mode='w') as tar:
+        for name, contents in sorted(files.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(contents)
+            tar.addfile(info, StringIO.StringIO(contents))
+
+    return tarball.getvalue()
+
+
+TEST_FILES = {
+    'etc/portage/make.conf': 'CFLAGS="-O2"\n',
+    'bin/busybox': 'x' * 100000}
+
+
+def test_multi_stream_bz2_decompressor():
+    """Test MultiStreamBZ2Decompressor joins concatenated streams."""
+    compressed = bz2.compress('first ') + bz2.compress('second')
+    decompressor = gensystem_install.MultiStreamBZ2Decompressor()
+    decompressed = ''.join(
+        decompressor.decompress(compressed[i:i + 7])
+        for i in range(0, len(compressed), 7))
+    assert decompressed == 'first second'
+
+
+def test_queue_reader_reads_across_chunks():
+    """Test QueueReader reads sizes that span queued chunks."""
+    chunks = Queue.Queue()
+    for chunk in ['abc', 'defg', None]:
+        chunks.put(chunk)
+
+    reader = gensystem_install.QueueReader(chunks)
+    assert reader.read(2) == 'ab'
+    assert reader.read(4) == 'cdef'
+    assert reader.read() == 'g'
+    assert reader.read(1) == ''
+
+
+def test_get_decompressor():
+    """Test get_decompressor picks by file name."""
+    assert isinstance(
+        gensystem_install.get_decompressor('stage3.tar.bz2'),
+        gensystem_install.MultiStreamBZ2Decompressor)
+    assert gensystem_install.get_decompressor('stage3.tar') is None
+    assert pytest.raises(
+        RuntimeError, gensystem_install.get_decompressor, 'stage3.tar.lz')
+
+
+def test_install_stage_fans_out_to_every_target():
+    """Test install_stage extracts one stream into several targets."""
+    compressed = bz2.compress(make_tarball(TEST_FILES))
+    hasher = hashlib.sha512()
+    with temp.temp_directory() as temp_dir:
+        targets = [os.path.join(temp_dir, name) for name in 'abc']
+        errors = gensystem_install.install_stage(
+            gensystem_install.HashingReader(
+                StringIO.StringIO(compressed), hasher),
+            targets, gensystem_install.get_decompressor('stage3.tar.bz2'),
+            chunk_size=4096, queue_chunks=1)
+
+        assert errors == {}
+        for target in targets:
+            for name, contents in TEST_FILES.items():
+                with open(os.path.join(target, name)) as extracted:
+                    assert extracted.read() == contents
+
+    assert hasher.hexdigest() == hashlib.sha512(compressed).hexdigest()
+
+
+def test_install_stage_hardlinks_later_targets():
+    """Test install_stage populates later targets with hardlinks."""
+    with temp.temp_directory() as temp_dir:
+        first, second = [os.path.join(temp_dir, name) for name in 'ab']
+        errors = gensystem_install.install_stage(
+            StringIO.StringIO(make_tarball(TEST_FILES)), [first, second],
+            link='hardlink')
+
+        assert errors == {}
+        for name in TEST_FILES:
+            assert os.path.samefile(
+                os.path.join(first, name), os.path.join(second, name))
+
+
+def test_install_stage_bad_target_does_not_block_others():
+    """Test a failing extractor is drained instead of stalling the tee."""
+    with temp.temp_directory() as temp_dir:
+        good = os.path.join(temp_dir, 'good')
+        bad = os.path.join(temp_dir, 'bad')
+        os.makedirs(bad)
+        # A file where a directory is needed makes extraction fail
+        open(os.path.join(bad, 'etc'), 'w').close()
+
+        errors = gensystem_install.install_stage(
+            StringIO.StringIO(make_tarball(TEST_FILES)), [bad, good],
+            chunk_size=512, queue_chunks=1)
+
+        assert bad in errors and good not in errors
+        assert os.path.exists(os.path.join(good, 'etc/portage/make.conf'))
+
+
+SNAPSHOT_FILES = {
+    'portage/profiles/repo_name': 'gentoo\n',
+    'portage/sys-apps/portage/Manifest': 'DIST portage.tar.bz2\n'}
+
+
+def test_install_with_snapshot_fills_repository():
+    """Test the snapshot lands in each target's repository directory."""
+    with temp.temp_directory() as temp_dir:
+        targets = [os.path.join(temp_dir, name) for name in 'ab']
+        errors = gensystem_install.install_with_snapshot(
+            (StringIO.StringIO(make_tarball(TEST_FILES)), None),
+            (StringIO.StringIO(bz2.compress(make_tarball(SNAPSHOT_FILES))),
+             gensystem_install.get_decompressor('portage-latest.tar.bz2')),
+            targets, chunk_size=512, queue_chunks=1)
+
+        assert errors == {}
+        for target in targets:
+            assert os.path.exists(os.path.join(target, 'bin/busybox'))
+            repository = os.path.join(
+                target, gensystem_install.REPOSITORY_DIR)
+            with open(os.path.join(repository, 'profiles/repo_name')) as name:
+                assert name.read() == 'gentoo\n'
+            assert not os.path.exists(os.path.join(repository, 'portage'))
+
+
+def test_install_with_snapshot_reports_bad_snapshot():
+    """Test a broken snapshot fails the targets but not the stage."""
+    with temp.temp_directory() as temp_dir:
+        first, second = [os.path.join(temp_dir, name) for name in 'ab']
+        errors = gensystem_install.install_with_snapshot(
+            (StringIO.StringIO(make_tarball(TEST_FILES)), None),
+            (StringIO.StringIO('not a tarball' * 100),
+             gensystem_install.get_decompressor('portage-latest.tar.bz2')),
+            [first, second], link='hardlink')
+
+        assert errors[first].startswith('Portage snapshot: ')
+        assert errors[second] == "Not linked, %s failed." % first
+        assert os.path.exists(os.path.join(first, 'bin/busybox'))
+
+
+def test_strip_members_strips_names_and_hardlinks():
+    """Test strip_members drops the top directory of names and links."""
+    tarball = StringIO.StringIO()
+    with tarfile.open(fileobj=tarball, mode='w') as tar:
+        for name in ('portage', 'portage/a'):
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.DIRTYPE if name == 'portage' else (
+                tarfile.REGTYPE)
+            tar.addfile(info, StringIO.StringIO(''))
+        info = tarfile.TarInfo('portage/b')
+        info.type = tarfile.LNKTYPE
+        info.linkname = 'portage/a'
+        tar.addfile(info)
+    tarball.seek(0)
+
+    with tarfile.open(fileobj=tarball, mode='r|') as tar:
+        members = [
+            (member.name, member.linkname)
+            for member in gensystem_install.strip_members(tar, 1)]
+
+    assert members == [('a', ''), ('b', 'a')]
+
+
+def test_install_system_reports_corrupt_tarball():
+    """Test the gensystem command fails cleanly on a corrupt tarball."""
+    cli = benchmarks_harness.load_cli()
+
+    with temp.temp_directory() as temp_dir, \
+            test_helpers.isolated_cache():
+        tarball = os.path.join(temp_dir, 'stage3-amd64.tar.bz2')
+        with open(tarball, 'wb') as corrupt:
+            corrupt.write('BZh9' + 'x' * 1000)
+
+        assert not cli.install_system(
+            'stage3', [os.path.join(temp_dir, 'root')], tarball=tarball,
+            progress_mode='none')
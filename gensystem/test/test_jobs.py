@@ -0,0 +1,134 @@
+"""Unit tests for gensystem jobs."""
+
+import hashlib
+import io
+import os
+import tarfile
+import threading
+
+import mock
+import pytest
+
+import gensystem.benchmarks.fake_mirror as fake_mirror
+import gensystem.jobs as gensystem_jobs
+import gensystem.temp as gensystem_temp
+import gensystem.test.helpers as test_helpers
+
+SIZE = 512 * 1024
+
+
+def test_download_job_reports_progress_and_result():
+    """Test a download job downloads, verifies and reports as it goes."""
+    events = []
+    with gensystem_temp.temp_directory() as temp_dir, \
+            test_helpers.isolated_cache(), \
+            mock.patch('gensystem.catalog.load', return_value={}):
+        path = fake_mirror.make_layout(temp_dir, 'stage3', SIZE)
+        with open(path, 'rb') as media:
+            sha512 = hashlib.sha512(media.read()).hexdigest()
+        directory = os.path.join(temp_dir, 'media')
+        os.mkdir(directory)
+
+        with fake_mirror.shaped_mirror(temp_dir) as mirror, \
+                gensystem_jobs.JobRunner(listener=lambda job, event: (
+                    events.append((job.id, event, job.phase)))) as runner:
+            job = runner.submit_download(
+                'stage3', mirror=mirror.url, directory=directory)
+            download = job.result(timeout=60)
+            # Saved and verified already, nothing is downloaded again
+            again = runner.submit_download(
+                'stage3', mirror=mirror.url, directory=directory).result(60)
+
+    assert download.sha512 == sha512
+    assert download.size == SIZE
+    assert download.path == os.path.join(directory, os.path.basename(path))
+    assert again == download
+    assert job.snapshot()['state'] == 'succeeded'
+    assert (job.id, 'progress', 'downloading') in events
+    assert events[-1][1] == 'state'
+    assert not [event for event in events if event[2] == 'downloading' and (
+        event[0] != job.id)]
+
+
+def test_failed_job_raises_job_error():
+    """Test an error of a job is kept and raised by result."""
+    with gensystem_temp.temp_directory() as temp_dir, \
+            test_helpers.isolated_cache():
+        path = os.path.join(temp_dir, 'minimal.iso')
+        with open(path, 'wb') as media:
+            media.write('not the media')
+        with open(path + '.DIGESTS', 'wb') as digests:
+            digests.write('# SHA512 HASH\n%s  minimal.iso\n' % ('0' * 128))
+
+        with gensystem_jobs.JobRunner() as runner:
+            job = runner.submit_verify(path)
+            with pytest.raises(gensystem_jobs.JobError):
+                job.result(timeout=60)
+            missing = runner.submit_verify(os.path.join(temp_dir, 'missing'))
+            with pytest.raises(gensystem_jobs.JobError):
+                missing.result(timeout=60)
+
+    assert job.snapshot()['state'] == 'failed'
+    assert 'did NOT verify' in job.snapshot()['error']
+
+
+def test_pending_jobs_can_be_cancelled():
+    """Test jobs queued behind a busy worker can be cancelled."""
+    started, release = threading.Event(), threading.Event()
+
+    def block(job):
+        started.set()
+        release.wait(60)
+        return 'done'
+
+    with gensystem_jobs.JobRunner(workers=1) as runner:
+        busy = runner._submit('test', block, ())
+        queued = runner._submit('test', block, ())
+        started.wait(60)
+        assert queued.cancel()
+        assert not busy.cancel()
+        release.set()
+
+    assert busy.result() == 'done'
+    with pytest.raises(gensystem_jobs.JobCancelled):
+        queued.result()
+
+
+def test_worker_outlives_a_job_raising_anything():
+    """Test an unexpected exception fails the job, not the worker."""
+    def broken(job):
+        raise KeyError('stage3')
+
+    with gensystem_jobs.JobRunner(workers=1) as runner:
+        failed = runner._submit('test', broken, ())
+        after = runner._submit('test', lambda job: 'done', ())
+        with pytest.raises(gensystem_jobs.JobError):
+            failed.result(timeout=60)
+        assert after.result(timeout=60) == 'done'
+
+    assert failed.snapshot()['state'] == 'failed'
+    assert 'KeyError' in failed.snapshot()['error']
+
+
+def test_install_job_installs_local_tarball():
+    """Test an install job extracts a local tarball into every target."""
+    with gensystem_temp.temp_directory() as temp_dir, \
+            test_helpers.isolated_cache():
+        tarball = os.path.join(temp_dir, 'stage3.tar')
+        with tarfile.open(tarball, 'w') as tar:
+            info = tarfile.TarInfo('etc/hostname')
+            info.size = 7
+            tar.addfile(info, io.BytesIO('gentoo\n'))
+        targets = [os.path.join(temp_dir, name) for name in ('a', 'b')]
+        for target in targets:
+            os.mkdir(target)
+
+        with gensystem_jobs.JobRunner() as runner:
+            install = runner.submit_install(
+                targets, tarball=tarball).result(timeout=60)
+
+        for target in targets:
+            with open(os.path.join(target, 'etc', 'hostname')) as hostname:
+                assert hostname.read() == 'gentoo\n'
+
+    assert install.targets == targets
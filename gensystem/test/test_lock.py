@@ -0,0 +1,163 @@
+"""Unit tests for gensystem lock."""
+
+import errno
+import hashlib
+import os
+import threading
+
+import mock
+
+import gensystem.benchmarks.harness as benchmarks_harness
+import gensystem.lock as gensystem_lock
+import gensystem.temp as temp
+import gensystem.test.helpers as test_helpers
+
+TEST_CONTENTS = 'gentoo' * 100000
+
+
+def test_download_lock_single_owner():
+    """Test only one lock for a destination can be acquired at a time."""
+    with temp.temp_directory() as temp_dir:
+        destination = os.path.join(temp_dir, 'stage3.tar.bz2')
+        owner = gensystem_lock.DownloadLock(destination, temp_dir)
+        follower = gensystem_lock.DownloadLock(destination, temp_dir)
+
+        assert owner.acquire()
+        assert not follower.acquire()
+        assert follower.is_held()
+
+        owner.release(complete=True)
+        assert not follower.is_held()
+        assert follower.read_state()['state'] == 'complete'
+        owner.close()
+        follower.close()
+
+
+def test_lock_is_kept_in_the_users_cache():
+    """Test lock files are the user's, next to the download if need be."""
+    with temp.temp_directory() as temp_dir:
+        destination = os.path.join(temp_dir, 'stage3.tar.bz2')
+        cache_dir = os.path.join(temp_dir, 'cache')
+        with test_helpers.isolated_cache(cache_dir):
+            lock = gensystem_lock.DownloadLock(destination)
+            lock.close()
+            assert os.path.dirname(lock.path) == os.path.join(
+                cache_dir, gensystem_lock.LOCK_DIR)
+            assert os.stat(lock.path).st_mode & 0777 == 0600
+
+            # A cache directory that cannot be written
+            with mock.patch('gensystem.lock.LOCK_DIR', 'other'), mock.patch(
+                    'os.makedirs', side_effect=OSError(
+                        errno.EACCES, 'Permission denied')):
+                lock = gensystem_lock.DownloadLock(destination)
+                lock.close()
+            assert lock.path == destination + '.lock'
+
+
+def test_download_in_progress_is_followed_not_verified():
+    """Test a file another process is downloading is not hashed first."""
+    cli = benchmarks_harness.load_cli()
+
+    with temp.temp_directory() as temp_dir, test_helpers.isolated_cache(), (
+            benchmarks_harness.working_directory(temp_dir)):
+        # Preallocated by the owner, so it exists before it is complete
+        with open('stage3.tar.bz2', 'wb') as media:
+            media.truncate(len(TEST_CONTENTS))
+        owner = gensystem_lock.DownloadLock('stage3.tar.bz2')
+        assert owner.acquire()
+
+        with mock.patch.object(cli, 'verify_existing') as verify_existing:
+            with mock.patch.object(
+                    cli, 'download_digest', return_value=False), mock.patch(
+                    'gensystem.lock.follow', return_value='0' * 128) as follow:
+                cli.download_and_verify(
+                    'http://mirror/stage3.tar.bz2', progress_mode='none')
+        owner.close()
+
+    assert not verify_existing.called
+    assert follow.called
+
+
+def test_follow_hashes_growing_file():
+    """Test follow reads the owner's download as it grows."""
+    with temp.temp_directory() as temp_dir:
+        destination = os.path.join(temp_dir, 'stage3.tar.bz2')
+        owner = gensystem_lock.DownloadLock(destination, temp_dir)
+        follower = gensystem_lock.DownloadLock(destination, temp_dir)
+        assert owner.acquire()
+        written = threading.Event()
+
+        def download():
+            with open(destination, 'wb') as download_file:
+                download_file.write(TEST_CONTENTS[:1000])
+                download_file.flush()
+                written.wait()
+                download_file.write(TEST_CONTENTS[1000:])
+            owner.release(complete=True)
+
+        progress = []
+        thread = threading.Thread(target=download)
+        thread.start()
+
+        def hook(blocks, block_size, total):
+            progress.append(block_size)
+            written.set()
+
+        owner.wrap_hook()(1, 0, len(TEST_CONTENTS))
+        sha512 = gensystem_lock.follow(
+            destination, follower, hook, poll_interval=0.01)
+        thread.join()
+
+        assert sha512 == hashlib.sha512(TEST_CONTENTS).hexdigest()
+        assert progress[-1] == len(TEST_CONTENTS)
+        owner.close()
+        follower.close()
+
+
+def test_follow_detects_dead_owner():
+    """Test follow gives up when the owner dies so it can take over."""
+    with temp.temp_directory() as temp_dir:
+        destination = os.path.join(temp_dir, 'stage3.tar.bz2')
+        owner = gensystem_lock.DownloadLock(destination, temp_dir)
+        follower = gensystem_lock.DownloadLock(destination, temp_dir)
+        assert owner.acquire()
+
+        # Closing without release is what a crash looks like
+        owner.close()
+        assert gensystem_lock.follow(
+            destination, follower, poll_interval=0.01) is None
+        assert follower.acquire()
+        follower.close()
+
+
+def test_follow_reads_only_ready_part():
+    """Test follow does not read past what the owner records as ready."""
+    with temp.temp_directory() as temp_dir:
+        destination = os.path.join(temp_dir, 'stage3.tar.bz2')
+        owner = gensystem_lock.DownloadLock(destination, temp_dir)
+        follower = gensystem_lock.DownloadLock(destination, temp_dir)
+        assert owner.acquire()
+        with open(destination, 'wb') as download_file:
+            download_file.write(TEST_CONTENTS)
+        owner.wrap_hook()(1, 0, len(TEST_CONTENTS))
+        owner.record_ready(1000)
+
+        progress = []
+        followed = threading.Event()
+
+        def hook(blocks, block_size, total):
+            progress.append(block_size)
+            followed.set()
+
+        thread = threading.Thread(target=lambda: progress.append(
+            gensystem_lock.follow(
+                destination, follower, hook, poll_interval=0.01)))
+        thread.start()
+        followed.wait()
+        owner.release(complete=True)
+        thread.join()
+
+        assert progress[0] == 1000
+        assert progress[-1] == hashlib.sha512(TEST_CONTENTS).hexdigest()
+        owner.close()
+        follower.close()
@@ -1,43 +1,60 @@
 """Unit tests for gensystem media."""
 
-import bs4
 import mock
 import pytest
 
 import gensystem.media as gensystem_media
 
 
-@mock.patch('gensystem.utils.soupify')
-def test_get_media_file_url_success(m_soupify):
+@mock.patch('gensystem.catalog.load', return_value={})
+@mock.patch('gensystem.utils.read_hedged')
+def test_get_media_file_url_success(m_read_hedged, m_load):
     """Test get_media_file_url sucessfully gets a gentoo media URL."""
-    fake_soupified = mock.MagicMock()
-    fake_soupified.find_all.return_value = [
-        bs4.BeautifulSoup('<a href="stage3-20151225.tar.bz2">test</a>').a]
-    m_soupify.return_value = fake_soupified
+    m_read_hedged.side_effect = lambda url, kind, hedge_url: (
+        url, '<a href="stage3-amd64-20151225.tar.bz2">test</a>')
 
     media_url = gensystem_media.get_media_file_url(
         'http://test.com/mirror', 'amd64', 'stage3')
     assert media_url == (
         'http://test.com/mirror/releases/amd64/'
-        'autobuilds/current-stage3-amd64/stage3-20151225.tar.bz2')
+        'autobuilds/current-stage3-amd64/stage3-amd64-20151225.tar.bz2')
 
 
-@mock.patch('gensystem.utils.soupify')
-def test_get_media_file_url_fail(m_soupify):
+@mock.patch('gensystem.catalog.load', return_value={})
+@mock.patch('gensystem.utils.read_hedged')
+def test_get_media_file_url_fail(m_read_hedged, m_load):
     """Test get_media_file_url failing to get a gentoo media URL."""
-    fake_soupified = mock.MagicMock()
-
     # No links were found
-    fake_soupified.find_all.return_value = []
-    m_soupify.return_value = fake_soupified
+    m_read_hedged.return_value = ('http://test.com/mirror', '<b>None</b>')
     assert pytest.raises(
         RuntimeError, gensystem_media.get_media_file_url,
         'http://test.com/mirror', 'amd64', 'stage3')
 
-    # Something besides a link was somehow captured
-    fake_soupified.find_all.return_value = [
-        bs4.BeautifulSoup('<b>This is not a link.</b>').b]
-    m_soupify.return_value = fake_soupified
+    # Only links to files that go with the media file
+    m_read_hedged.return_value = ('http://test.com/mirror', (
+        '<a href="stage3-amd64-20151225.tar.bz2.DIGESTS">DIGESTS</a>'))
     assert pytest.raises(
         RuntimeError, gensystem_media.get_media_file_url,
         'http://test.com/mirror', 'amd64', 'stage3')
+
+
+@mock.patch('gensystem.catalog.load')
+@mock.patch('gensystem.utils.read_hedged')
+def test_get_media_file_url_from_catalog(m_read_hedged, m_load):
+    """Test catalogued media is looked up without reading listings."""
+    m_load.return_value = {'media': {'arm': {'stage3-armv7a': {
+        'stamp': '20151225', 'size': 1024, 'digests': None,
+        'path': 'releases/arm/autobuilds/current-stage3-armv7a/'
+                'stage3-armv7a-20151225.tar.bz2'}}}}
+
+    media_url = gensystem_media.get_media_file_url(
+        'http://test.com/mirror', 'arm', 'stage3-armv7a')
+    assert media_url == (
+        'http://test.com/mirror/releases/arm/autobuilds/'
+        'current-stage3-armv7a/stage3-armv7a-20151225.tar.bz2')
+    assert not m_read_hedged.called
+
+    # Neither catalogued nor known to gensystem
+    assert pytest.raises(
+        RuntimeError, gensystem_media.get_media_file_url,
+        'http://test.com/mirror', 'arm', 'stage3')
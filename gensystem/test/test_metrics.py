@@ -0,0 +1,125 @@
+"""Unit tests for gensystem metrics."""
+
+import json
+import os
+
+import gensystem.metrics as gensystem_metrics
+import gensystem.temp as gensystem_temp
+
+
+class FakeClock(object):
+
+    """Clock that moves one second every time it is read."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+def test_spans_nest():
+    """Test spans opened inside other spans become their children."""
+    recorder = gensystem_metrics.Recorder(FakeClock())
+    with recorder.span('gensystem'):
+        with recorder.span('get_public_ip'):
+            pass
+        with recorder.span('download_file', mirror='mirror') as span:
+            span.set(bytes=100)
+
+    root, = recorder.spans
+    assert [child.name for child in root.children] == [
+        'get_public_ip', 'download_file']
+    assert root.children[1].attributes == {'mirror': 'mirror', 'bytes': 100}
+    assert root.children[0].duration == 1
+    assert recorder.get_phase_durations()['gensystem'] == 5
+
+
+def test_recorder_can_keep_only_counters():
+    """Test a recorder not keeping spans still times them and counts."""
+    recorder = gensystem_metrics.Recorder(FakeClock(), keep_spans=False)
+    for _ in range(3):
+        with recorder.span('job') as root:
+            with recorder.span('download_file'):
+                recorder.count('downloaded_bytes', 100)
+
+    assert recorder.spans == []
+    assert root.children[0].duration == 1
+    assert recorder.counters == {('downloaded_bytes', ()): 300}
+
+
+def test_span_records_errors():
+    """Test a span records the error that ended it."""
+    recorder = gensystem_metrics.Recorder(FakeClock())
+    try:
+        with recorder.span('geoip'):
+            raise RuntimeError('no database')
+    except RuntimeError:
+        pass
+
+    assert recorder.spans[0].attributes['error'] == 'no database'
+    assert recorder.spans[0].end is not None
+
+
+def test_mirror_throughput_and_counters():
+    """Test transfer spans add up to throughput by mirror."""
+    recorder = gensystem_metrics.Recorder(FakeClock())
+    for _ in range(2):
+        with recorder.span('download_file', mirror='a.org') as span:
+            span.set(bytes=500)
+        recorder.count('downloaded_bytes', 500, mirror='a.org')
+
+    assert recorder.get_mirror_throughput() == {
+        'a.org': {'bytes': 1000, 'seconds': 2, 'throughput': 500}}
+    assert recorder.counters == {
+        ('downloaded_bytes', (('mirror', 'a.org'),)): 1000}
+
+
+def test_write_report():
+    """Test the JSON report holds spans, phases, counters and mirrors."""
+    recorder = gensystem_metrics.Recorder(FakeClock())
+    with recorder.span('verify_download'):
+        recorder.count('verified_bytes', 42)
+
+    with gensystem_temp.temp_directory() as temp_dir:
+        path = os.path.join(temp_dir, 'report.json')
+        recorder.write_report(path, success=True)
+        report = json.load(open(path))
+
+    assert report['success'] is True
+    assert report['spans'][0]['name'] == 'verify_download'
+    assert report['phases'] == {'verify_download': 1}
+    assert report['counters'] == [
+        {'name': 'verified_bytes', 'labels': {}, 'value': 42}]
+
+
+def test_write_prometheus():
+    """Test the Prometheus textfile has gauges with escaped labels."""
+    recorder = gensystem_metrics.Recorder(FakeClock())
+    with recorder.span('download_file', mirror='a.org') as span:
+        span.set(bytes=10)
+    recorder.count('downloaded_bytes', 10, mirror='say "hi"\\')
+
+    with gensystem_temp.temp_directory() as temp_dir:
+        path = os.path.join(temp_dir, 'gensystem.prom')
+        recorder.write_prometheus(path, success=False)
+        lines = open(path).read().splitlines()
+        assert os.listdir(temp_dir) == ['gensystem.prom']
+
+    assert 'gensystem_last_run_success 0.0' in lines
+    assert (
+        'gensystem_phase_duration_seconds{phase="download_file"} 1.0'
+        in lines)
+    assert (
+        'gensystem_mirror_throughput_bytes_per_second{mirror="a.org"} 10.0'
+        in lines)
+    assert (
+        'gensystem_downloaded_bytes{mirror="say \\"hi\\"\\\\"} 10.0' in lines)
+    assert '# TYPE gensystem_downloaded_bytes gauge' in lines
+
+
+def test_get_mirror():
+    """Test mirrors are labelled by host."""
+    assert gensystem_metrics.get_mirror(
+        'http://gentoo.osuosl.org/releases/x') == 'gentoo.osuosl.org'
@@ -2,11 +2,16 @@
 
 """Unit tests for gensystem mirror."""
 
+import os
+import time
+
 import bs4
 import mock
 import pytest
 
+import gensystem.cache as gensystem_cache
 import gensystem.mirror as gensystem_mirror
+import gensystem.temp as gensystem_temp
 import gensystem.test.helpers as test_helpers
 
 TEST_GENTOO_ORG = """
@@ -110,3 +115,85 @@ def test_get_mirrors_from_json_failure(m_open):
     m_open.side_effect = IOError('Forced IOError')
     assert pytest.raises(
         RuntimeError, gensystem_mirror.get_mirrors_from_json)
+
+
+def test_get_alternate_url():
+    """Test the same file is found on a neighbouring HTTP mirror."""
+    mirrors = {
+        'Canada': {
+            'One (http)': 'http://one.ca/gentoo',
+            'Two (http)': 'http://two.ca/gentoo/',
+            'Two (rsync)': 'rsync://two.ca/gentoo/'},
+        'Chile': {'Lone (http)': 'http://lone.cl/gentoo/'}}
+
+    assert gensystem_mirror.get_alternate_url(
+        'http://one.ca/gentoo/releases/file', mirrors) == (
+            'http://two.ca/gentoo/releases/file')
+    assert gensystem_mirror.get_alternate_url(
+        'http://lone.cl/gentoo/releases/file', mirrors) is None
+    assert gensystem_mirror.get_alternate_url(
+        'http://unknown.org/file', mirrors) is None
+
+
+@mock.patch('gensystem.mirror.get_mirrors_from_web')
+def test_refresh_replaces_stale_mirror_list(m_get_mirrors_from_web):
+    """Test a stale mirror list is replaced for the next run."""
+    m_get_mirrors_from_web.return_value = {
+        'Canada': {'One (http)': 'http://one.ca/gentoo/'}, 'Chile': {}}
+    with test_helpers.isolated_cache():
+        assert gensystem_mirror.is_stale()
+        assert gensystem_mirror.refresh()
+        assert gensystem_mirror.get_mirrors() == {
+            'Canada': {'One (http)': 'http://one.ca/gentoo/'}}
+
+        # Fresh now, so nothing is fetched (nor started) again
+        assert not gensystem_mirror.refresh()
+        with mock.patch('subprocess.Popen') as m_popen:
+            assert not gensystem_mirror.refresh_in_background()
+        assert not m_popen.called
+
+    assert m_get_mirrors_from_web.call_count == 1
+
+
+@mock.patch('gensystem.mirror.get_mirrors_from_web')
+def test_refresh_is_locked_and_failure_waits(m_get_mirrors_from_web):
+    """Test one refresh at a time, and a failed one is not retried soon."""
+    m_get_mirrors_from_web.side_effect = RuntimeError('gentoo.org is down')
+    with test_helpers.isolated_cache():
+        with gensystem_mirror.refresh_lock() as locked:
+            assert locked
+            assert not gensystem_mirror.refresh()
+        assert not m_get_mirrors_from_web.called
+
+        assert not gensystem_mirror.refresh()
+        assert not gensystem_mirror.is_stale()
+        assert gensystem_mirror.is_stale(now=(
+            time.time() + gensystem_mirror.RETRY_INTERVAL))
+        # The bundled list is used until a refresh succeeds
+        assert gensystem_mirror.get_mirrors() == (
+            gensystem_mirror.get_mirrors_from_json())
+
+        with mock.patch('subprocess.Popen') as m_popen:
+            with mock.patch('time.time', return_value=(
+                    time.time() + gensystem_mirror.RETRY_INTERVAL)):
+                assert gensystem_mirror.refresh_in_background()
+        assert m_popen.call_args[0][0][1:] == ['-m', 'gensystem.mirror']
+
+
+def test_no_refresh_without_a_writable_cache():
+    """Test no refresh is started when it could not be saved."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        cache_dir = os.path.join(temp_dir, 'cache')
+        with test_helpers.isolated_cache(cache_dir):
+            assert gensystem_cache.is_writable()
+            with open(os.path.join(temp_dir, 'file'), 'w'):
+                pass
+            with test_helpers.isolated_cache(os.path.join(
+                    temp_dir, 'file', 'cache')):
+                assert not gensystem_cache.is_writable()
+
+            with mock.patch('os.access', return_value=False), mock.patch(
+                    'subprocess.Popen') as m_popen:
+                assert gensystem_mirror.is_stale()
+                assert not gensystem_mirror.refresh_in_background()
+            assert not m_popen.called
@@ -0,0 +1,62 @@
+"""Unit tests for gensystem posix."""
+
+import os
+
+import gensystem.posix as gensystem_posix
+import gensystem.temp as temp
+
+
+def test_pwrite_at_offsets():
+    """Test pwrite writes part of a buffer at explicit offsets."""
+    with temp.temp_directory() as temp_dir:
+        path = os.path.join(temp_dir, 'file')
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+        gensystem_posix.pwrite(fd, bytearray('worldXXX'), 5, 5)
+        gensystem_posix.pwrite(fd, bytearray('hello'), 5, 0)
+        os.close(fd)
+
+        with open(path) as written:
+            assert written.read() == 'helloworld'
+
+
+def test_fallocate_keeps_size():
+    """Test fallocate reserves space without growing the file."""
+    with temp.temp_directory() as temp_dir:
+        path = os.path.join(temp_dir, 'file')
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+        gensystem_posix.fallocate(fd, 0, 1024 * 1024)
+        os.close(fd)
+
+        assert os.path.getsize(path) == 0
+
+
+def test_sendfile_to_file():
+    """Test sendfile copies a range between files."""
+    with temp.temp_directory() as temp_dir:
+        source = os.path.join(temp_dir, 'source')
+        target = os.path.join(temp_dir, 'target')
+        with open(source, 'w') as source_file:
+            source_file.write('0123456789')
+
+        with open(source) as source_file, open(target, 'w') as target_file:
+            sent = gensystem_posix.sendfile(
+                target_file.fileno(), source_file.fileno(), 3, 4)
+
+        assert sent == 4
+        with open(target) as target_file:
+            assert target_file.read() == '3456'
+
+
+def test_drop_cache():
+    """Test dropping the cached pages of a synced file keeps its data."""
+    with temp.temp_directory() as temp_dir:
+        path = os.path.join(temp_dir, 'file')
+        with open(path, 'wb') as written:
+            written.write('data' * 1024)
+            written.flush()
+            os.fsync(written.fileno())
+            assert gensystem_posix.drop_cache(written.fileno(), 0, 4096) in (
+                True, False)
+
+        with open(path) as written:
+            assert written.read() == 'data' * 1024
@@ -0,0 +1,123 @@
+"""Unit tests for gensystem progress."""
+
+import json
+import StringIO
+
+import gensystem.progress as gensystem_progress
+
+
+class FakeClock(object):
+
+    """Clock that only moves when told to."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RecordingRenderer(object):
+
+    """Renderer remembering what it was asked to render."""
+
+    def __init__(self):
+        self.rendered = []
+
+    def render(self, snapshot, event):
+        self.rendered.append((event, snapshot))
+
+
+def test_format_size_and_eta():
+    """Test sizes and ETAs are formatted for humans."""
+    assert gensystem_progress.format_size(512) == '512.0 B'
+    assert gensystem_progress.format_size(12300000) == '12.3 MB'
+    assert gensystem_progress.format_eta(3725) == '1:02:05'
+    assert gensystem_progress.format_eta(None) == '--:--:--'
+
+
+def test_progress_coalesces_updates():
+    """Test many updates within one refresh interval render once."""
+    clock = FakeClock()
+    renderer = RecordingRenderer()
+    progress = gensystem_progress.Progress(
+        'stage3', renderer, interval=0.5, clock=clock)
+
+    for transferred in range(0, 100000, 1000):
+        progress.update(transferred, 1000000)
+    assert len(renderer.rendered) == 1
+
+    clock.now += 1
+    progress.update(500000, 1000000)
+    progress.finish()
+    events = [event for event, _ in renderer.rendered]
+    assert events == ['progress', 'progress', 'done']
+
+
+def test_progress_rate_and_eta_per_source():
+    """Test throughput and ETA are tracked overall and per source."""
+    clock = FakeClock()
+    renderer = RecordingRenderer()
+    progress = gensystem_progress.Progress(
+        'stage3', renderer, interval=0, clock=clock)
+
+    clock.now += 2
+    progress.update(2000000, 5000000, source='mirror-a')
+    progress.update(1000000, 5000000, source='mirror-b')
+    _, snapshot = renderer.rendered[-1]
+
+    assert snapshot['transferred'] == 3000000
+    assert snapshot['total'] == 10000000
+    assert snapshot['rate'] == 1500000
+    assert round(snapshot['eta'], 3) == round(7000000 / 1500000.0, 3)
+    assert [source['source'] for source in snapshot['sources']] == [
+        'mirror-a', 'mirror-b']
+
+
+def test_progress_parts_are_not_added_up():
+    """Test parts of a source are shown but counted once, by the source."""
+    clock = FakeClock()
+    renderer = RecordingRenderer()
+    progress = gensystem_progress.Progress(
+        'stage3', renderer, interval=0, clock=clock)
+
+    clock.now += 2
+    progress.part_hook('#1')(1, 1000000, None)
+    progress.part_hook('#2')(1, 2000000, None)
+    progress.hook()(1, 3000000, 5000000)
+    _, snapshot = renderer.rendered[-1]
+
+    assert snapshot['transferred'] == 3000000
+    assert snapshot['total'] == 5000000
+    assert snapshot['rate'] == 1500000
+    assert [
+        (source['source'], source['rate'])
+        for source in snapshot['sources']] == [
+            ('#1', 500000), ('#2', 1000000)]
+
+
+def test_json_renderer_emits_ndjson():
+    """Test the JSON renderer writes one event per line."""
+    stream = StringIO.StringIO()
+    progress = gensystem_progress.Progress(
+        'stage3', gensystem_progress.get_renderer('json', stream),
+        clock=FakeClock())
+    progress.hook()(1, 4096, 8192)
+    progress.finish(success=False)
+
+    events = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [event['event'] for event in events] == ['progress', 'failed']
+    assert events[0]['transferred'] == 4096
+    assert events[0]['total'] == 8192
+
+
+def test_bar_renderer():
+    """Test the bar renderer draws progress, rate and ETA on one line."""
+    stream = StringIO.StringIO()
+    renderer = gensystem_progress.get_renderer('bar', stream)
+    renderer.render({
+        'name': 'stage3', 'transferred': 50, 'total': 100, 'rate': 25.0,
+        'eta': 2, 'elapsed': 2, 'sources': []}, 'progress')
+
+    assert stream.getvalue() == (
+        '\rProgress: [##########          ] 50%  25.0 B/s  ETA 0:00:02')
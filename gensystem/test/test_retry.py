@@ -0,0 +1,156 @@
+"""Unit tests for gensystem retry."""
+
+import errno
+import mimetools
+import socket
+import StringIO
+import urllib2
+
+import mock
+import pytest
+
+import gensystem.retry as gensystem_retry
+
+
+class FakeClock(object):
+
+    """Clock that only moves when told to."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def http_error(code, headers=''):
+    """Make an HTTPError with a status and raw headers."""
+    return urllib2.HTTPError(
+        'http://mirror.org/file', code, 'Error',
+        mimetools.Message(StringIO.StringIO(headers)), None)
+
+
+def test_is_retryable():
+    """Test only failures that may pass when repeated are retried."""
+    assert gensystem_retry.is_retryable(socket.error("Connection reset."))
+    assert gensystem_retry.is_retryable(
+        gensystem_retry.TransferError("Cut short."))
+    assert gensystem_retry.is_retryable(urllib2.URLError("No route."))
+    assert gensystem_retry.is_retryable(http_error(503))
+    assert gensystem_retry.is_retryable(http_error(429))
+    assert not gensystem_retry.is_retryable(http_error(404))
+    assert not gensystem_retry.is_retryable(ValueError("Bug."))
+    assert not gensystem_retry.is_retryable(
+        OSError(errno.ENOSPC, "No space left on device"))
+    assert not gensystem_retry.is_retryable(
+        IOError(errno.ENOENT, "No such file or directory"))
+    assert not gensystem_retry.is_retryable(
+        gensystem_retry.CircuitOpenError("Open."))
+
+
+def test_delays_are_jittered_and_capped():
+    """Test delays grow exponentially up to the cap, times the jitter."""
+    policy = gensystem_retry.RetryPolicy(
+        base_delay=1, max_delay=10, random=lambda: 0.5)
+    assert [policy.get_delay(retry) for retry in range(5)] == [
+        0.5, 1, 2, 4, 5]
+
+
+def test_delay_honours_retry_after():
+    """Test a Retry-After header sets the least delay (up to the cap)."""
+    policy = gensystem_retry.RetryPolicy(
+        base_delay=1, max_delay=10, random=lambda: 0)
+    assert policy.get_delay(0, http_error(503, 'Retry-After: 3\n\n')) == 3
+    assert policy.get_delay(0, http_error(503, 'Retry-After: 60\n\n')) == 10
+    assert policy.get_delay(0, http_error(503)) == 0
+
+
+def test_call_retries_until_success():
+    """Test failed attempts are repeated after a delay."""
+    sleep = mock.Mock()
+    function = mock.Mock(side_effect=[socket.error("Reset."), 'data'])
+    policy = gensystem_retry.RetryPolicy(3, sleep=sleep)
+    assert policy.call(function, 'http://retried.org/file') == 'data'
+    assert function.call_count == 2
+    assert sleep.call_count == 1
+
+
+def test_call_gives_up():
+    """Test the last error is raised once attempts run out."""
+    function = mock.Mock(side_effect=socket.error("Reset."))
+    policy = gensystem_retry.RetryPolicy(3, sleep=mock.Mock())
+    with pytest.raises(socket.error):
+        policy.call(function, 'http://down.org/file')
+    assert function.call_count == 3
+
+
+def test_call_does_not_retry_missing_files():
+    """Test a 404 is raised at once."""
+    function = mock.Mock(side_effect=http_error(404))
+    policy = gensystem_retry.RetryPolicy(3, sleep=mock.Mock())
+    with pytest.raises(urllib2.HTTPError):
+        policy.call(function, 'http://missing.org/file')
+    assert function.call_count == 1
+
+
+def test_breaker_opens_and_recovers():
+    """Test a breaker opens after failures and lets a trial through later."""
+    clock = FakeClock()
+    breaker = gensystem_retry.CircuitBreaker(
+        'mirror.org', threshold=2, cool_down=60, clock=clock)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    with pytest.raises(gensystem_retry.CircuitOpenError):
+        breaker.check()
+
+    clock.now += 60
+    assert breaker.allow()
+    assert not breaker.allow()  # One trial at a time
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+    clock.now += 60
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+
+
+def test_trial_ended_by_local_error_lets_another_through():
+    """Test a trial that says nothing of the mirror does not hold it shut."""
+    clock = FakeClock()
+    breaker = gensystem_retry.CircuitBreaker(
+        'mirror.org', threshold=1, cool_down=10, clock=clock)
+    breaker.record_failure()
+    clock.now += 10
+    policy = gensystem_retry.RetryPolicy(sleep=mock.Mock())
+
+    with mock.patch.dict(gensystem_retry._breakers, {'mirror.org': breaker}):
+        for error in (OSError(errno.ENOSPC, 'No space'), KeyboardInterrupt()):
+            with pytest.raises(type(error)):
+                policy.call(
+                    mock.Mock(side_effect=error), 'http://mirror.org/file')
+            assert breaker.state == 'half-open'
+            assert breaker.allow()
+            breaker.release_trial()
+
+        assert policy.call(
+            mock.Mock(return_value='data'), 'http://mirror.org/file') == 'data'
+    assert breaker.state == 'closed'
+
+
+def test_open_breaker_stops_requests():
+    """Test requests to a mirror whose breaker is open are not sent."""
+    function = mock.Mock(side_effect=socket.error("Reset."))
+    policy = gensystem_retry.RetryPolicy(
+        gensystem_retry.FAILURE_THRESHOLD + 5, sleep=mock.Mock())
+    try:
+        with pytest.raises(gensystem_retry.CircuitOpenError):
+            policy.call(function, 'http://flapping.org/file')
+        assert function.call_count == gensystem_retry.FAILURE_THRESHOLD
+        with pytest.raises(gensystem_retry.CircuitOpenError):
+            policy.call(function, 'http://flapping.org/other')
+        assert function.call_count == gensystem_retry.FAILURE_THRESHOLD
+    finally:
+        gensystem_retry.reset_breakers()
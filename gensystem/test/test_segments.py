@@ -0,0 +1,300 @@
+"""Unit tests for gensystem segments."""
+
+import errno
+import os
+
+import mock
+import pytest
+
+import gensystem.benchmarks.fake_mirror as fake_mirror
+import gensystem.cache as gensystem_cache
+import gensystem.metrics as gensystem_metrics
+import gensystem.retry as gensystem_retry
+import gensystem.segments as gensystem_segments
+import gensystem.temp as gensystem_temp
+import gensystem.test.helpers as test_helpers
+
+SIZE = 1024 * 1024
+NO_DELAY = gensystem_retry.RetryPolicy(sleep=lambda seconds: None)
+
+
+class FakeResponse(object):
+
+    """Response with just a status and headers."""
+
+    def __init__(self, status, headers):
+        self.status = status
+        self.headers = headers
+
+    def getheader(self, name):
+        return self.headers.get(name)
+
+
+def test_controller_adds_connections_while_they_help():
+    """Test connections are added while throughput keeps improving."""
+    controller = gensystem_segments.AimdController(1, max_connections=4)
+    assert controller.update(100) == 2
+    assert controller.update(200) == 3
+    assert controller.update(300) == 4
+    assert controller.update(400) == 4
+
+
+def test_controller_falls_back_when_connections_do_not_help():
+    """Test the count returns to the best setting after a useless add."""
+    controller = gensystem_segments.AimdController(2)
+    controller.update(100)
+    assert controller.connections == 3
+    controller.update(101)
+    assert controller.connections == 2
+    assert controller.best_connections == 2
+
+
+def test_controller_backs_off():
+    """Test errors halve the count and throttling caps it."""
+    controller = gensystem_segments.AimdController(8, max_connections=8)
+    assert controller.back_off() == 4
+    assert controller.max_connections == 8
+    assert controller.back_off(throttled=True) == 2
+    assert controller.max_connections == 2
+    controller.update(1000)
+    assert controller.connections == 2
+
+
+def test_get_content_range():
+    """Test partial responses are told apart from ignored ranges."""
+    assert gensystem_segments.get_content_range(FakeResponse(
+        206, {'Content-Range': 'bytes 0-99/1000'})) == (0, 100, 1000)
+    assert gensystem_segments.get_content_range(FakeResponse(
+        200, {'Content-Length': '1000'})) is None
+
+
+def download(temp_dir, shape, **kwargs):
+    """Download a fake stage3 in small segments from a shaped mirror."""
+    path = fake_mirror.make_layout(temp_dir, 'stage3', SIZE)
+    destination = os.path.join(temp_dir, 'stage3')
+    ready = []
+    with fake_mirror.shaped_mirror(temp_dir, shape, [path]) as mirror:
+        segmented = gensystem_segments.SegmentedDownload(
+            mirror.url + fake_mirror.get_media_path('stage3'), destination,
+            ready_hook=ready.append, chunk_size=64 * 1024, **kwargs)
+        transferred = segmented.run()
+
+    with open(path, 'rb') as expected, open(destination, 'rb') as actual:
+        assert actual.read() == expected.read()
+    return transferred, mirror, ready
+
+
+@mock.patch('gensystem.segments.MIN_CHUNK_SIZE', 16 * 1024)
+@mock.patch('gensystem.segments.WINDOW', 0.05)
+def test_segmented_download():
+    """Test a file is downloaded in segments over several connections."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        transferred, mirror, ready = download(
+            temp_dir, fake_mirror.Shape(total_bandwidth=SIZE * 4))
+
+    assert transferred == SIZE
+    assert mirror.stats['media_requests'] > 2
+    assert ready == sorted(ready)
+    assert ready[-1] == SIZE
+
+
+def test_connections_report_as_parts():
+    """Test each connection reports the bytes it received."""
+    received = {}
+
+    def part_hook(name):
+        def hook(blocks, block_size, total):
+            received[name] = blocks * block_size
+        return hook
+
+    with gensystem_temp.temp_directory() as temp_dir:
+        download(
+            temp_dir, fake_mirror.Shape(total_bandwidth=SIZE * 4),
+            controller=gensystem_segments.AimdController(
+                4, max_connections=4),
+            part_hook=part_hook)
+
+    assert len(received) > 1
+    assert sum(received.values()) == SIZE
+
+
+def test_download_starts_from_head():
+    """Test a head fetched earlier is written, not downloaded again."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        path = fake_mirror.make_layout(temp_dir, 'stage3', SIZE)
+        with open(path, 'rb') as media:
+            data = media.read()
+        destination = os.path.join(temp_dir, 'stage3')
+        url_path = fake_mirror.get_media_path('stage3')
+        with fake_mirror.shaped_mirror(temp_dir, media=[path]) as mirror:
+            transferred = gensystem_segments.SegmentedDownload(
+                mirror.url + url_path, destination,
+                head=gensystem_segments.Head(data[:SIZE // 4], SIZE, None)
+            ).run()
+            with open(destination, 'rb') as download:
+                assert download.read() == data
+            sent = mirror.stats['media_sent']
+
+            # A head of a file replaced since is thrown away by If-Range
+            gensystem_segments.SegmentedDownload(
+                mirror.url + url_path, destination, policy=NO_DELAY,
+                head=gensystem_segments.Head('x' * 1024, SIZE, 'yesterday')
+            ).run()
+            with open(destination, 'rb') as download:
+                assert download.read() == data
+
+    assert transferred == SIZE
+    assert sent == SIZE - SIZE // 4
+
+
+def test_download_without_ranges():
+    """Test mirrors ignoring Range are downloaded over one connection."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        transferred, mirror, _ = download(
+            temp_dir, fake_mirror.Shape(ranges=False))
+
+    assert transferred == SIZE
+    assert mirror.stats['media_requests'] == 1
+
+
+def test_segments_are_retried():
+    """Test segments cut short by a reset are downloaded again."""
+    controller = gensystem_segments.AimdController(4)
+    with gensystem_temp.temp_directory() as temp_dir:
+        transferred, mirror, _ = download(
+            temp_dir, fake_mirror.Shape(resets=2), controller=controller,
+            policy=NO_DELAY)
+
+    assert transferred == SIZE
+    assert mirror.stats['resets'] == 2
+    assert controller.connections == 1
+
+
+def test_busy_mirror_is_retried():
+    """Test a download starts once a busy mirror stops answering 503."""
+    controller = gensystem_segments.AimdController(4)
+    policy = gensystem_retry.RetryPolicy(sleep=lambda seconds: None)
+    with gensystem_temp.temp_directory() as temp_dir:
+        transferred, mirror, _ = download(
+            temp_dir, fake_mirror.Shape(errors=2), controller=controller,
+            policy=policy)
+
+    assert transferred == SIZE
+    assert mirror.stats['errors'] == 2
+    assert controller.max_connections == 1
+
+
+def test_failing_mirror_opens_breaker():
+    """Test segments stop being requested from a mirror that keeps failing."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        with pytest.raises(gensystem_retry.CircuitOpenError):
+            download(temp_dir, fake_mirror.Shape(resets=100), policy=(
+                gensystem_retry.RetryPolicy(10, sleep=lambda seconds: None)))
+
+
+def test_local_errors_leave_breaker_closed():
+    """Test a bad destination or full disk is not blamed on the mirror."""
+    sleep = mock.Mock()
+    policy = gensystem_retry.RetryPolicy(10, sleep=sleep)
+    with gensystem_temp.temp_directory() as temp_dir:
+        path = fake_mirror.make_layout(temp_dir, 'stage3', SIZE)
+        with fake_mirror.shaped_mirror(temp_dir, media=[path]) as mirror:
+            url = mirror.url + fake_mirror.get_media_path('stage3')
+            breaker = gensystem_retry.get_breaker(
+                gensystem_metrics.get_mirror(url))
+            try:
+                with pytest.raises(OSError):
+                    gensystem_segments.SegmentedDownload(
+                        url, os.path.join(temp_dir, 'missing', 'stage3'),
+                        chunk_size=64 * 1024, policy=policy).run()
+                with mock.patch(
+                        'gensystem.posix.pwrite', side_effect=OSError(
+                            errno.ENOSPC, os.strerror(errno.ENOSPC))):
+                    with pytest.raises(OSError):
+                        gensystem_segments.SegmentedDownload(
+                            url, os.path.join(temp_dir, 'stage3'),
+                            chunk_size=64 * 1024, policy=policy).run()
+
+                assert breaker.state == 'closed' and breaker.failures == 0
+                assert not [
+                    call for call in sleep.call_args_list if call[0][0]]
+                # The mirror is still used
+                assert gensystem_segments.SegmentedDownload(
+                    url, os.path.join(temp_dir, 'stage3'),
+                    chunk_size=64 * 1024, policy=policy).run() == SIZE
+            finally:
+                gensystem_retry.reset_breakers()
+
+
+def test_half_open_download_uses_every_connection():
+    """Test segments are not refused while the trial's download runs."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        path = fake_mirror.make_layout(temp_dir, 'stage3', SIZE)
+        with open(path, 'rb') as media:
+            data = media.read()
+        with fake_mirror.shaped_mirror(temp_dir, media=[path]) as mirror:
+            url = mirror.url + fake_mirror.get_media_path('stage3')
+            breaker = gensystem_retry.get_breaker(
+                gensystem_metrics.get_mirror(url))
+            try:
+                for _ in range(breaker.threshold):
+                    breaker.record_failure()
+                breaker.opened_at -= breaker.cool_down
+
+                # Not the head: a trial request must answer first
+                assert gensystem_segments.SegmentedDownload(
+                    url, os.path.join(temp_dir, 'stage3'),
+                    controller=gensystem_segments.AimdController(
+                        4, max_connections=4),
+                    chunk_size=64 * 1024, policy=NO_DELAY,
+                    head=gensystem_segments.Head(data[:1024], SIZE, None)
+                ).run() == SIZE
+                assert breaker.state == 'closed'
+            finally:
+                gensystem_retry.reset_breakers()
+
+
+def test_local_error_ends_trial():
+    """Test a trial segment failing locally lets another trial through."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        path = fake_mirror.make_layout(temp_dir, 'stage3', SIZE)
+        destination = os.path.join(temp_dir, 'stage3')
+        with open(destination, 'wb') as download:
+            download.truncate(SIZE)
+        with fake_mirror.shaped_mirror(temp_dir, media=[path]) as mirror:
+            url = mirror.url + fake_mirror.get_media_path('stage3')
+            breaker = gensystem_retry.get_breaker(
+                gensystem_metrics.get_mirror(url))
+            try:
+                for _ in range(breaker.threshold):
+                    breaker.record_failure()
+                breaker.opened_at -= breaker.cool_down
+                # One connection of a download the breaker opened during
+                download = gensystem_segments.SegmentedDownload(
+                    url, destination, policy=NO_DELAY)
+                segment = gensystem_segments.Segment(0, SIZE)
+                download.workers, download.error = 1, None
+                download._active, download._pending = [segment], []
+                download._failures, download._slots = 0, set([1])
+                with mock.patch(
+                        'gensystem.posix.pwrite', side_effect=OSError(
+                            errno.ENOSPC, os.strerror(errno.ENOSPC))):
+                    download._work(1, segment, None)
+
+                assert download.error.errno == errno.ENOSPC
+                assert breaker.state == 'half-open'
+                assert breaker.allow()
+            finally:
+                gensystem_retry.reset_breakers()
+
+
+def test_tuning_is_remembered():
+    """Test the best setting for a mirror is saved and loaded."""
+    with test_helpers.isolated_cache():
+        gensystem_segments.save_tuning('mirror.org', 5, 1024, 10.0)
+        tuning = gensystem_segments.load_tuning('mirror.org')
+        assert gensystem_segments.load_tuning('other.org') == {}
+        assert gensystem_cache.load_json('missing.json', 1) == 1
+
+    assert tuning['connections'] == 5
+    assert tuning['chunk_size'] == 1024
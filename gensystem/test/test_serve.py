@@ -0,0 +1,116 @@
+"""Unit tests for gensystem serve."""
+
+import contextlib
+import threading
+import urllib2
+
+import pytest
+
+import gensystem.delta as gensystem_delta
+import gensystem.serve as gensystem_serve
+import gensystem.temp as temp
+import gensystem.test.helpers as test_helpers
+
+STAGE3_PATH = '/releases/amd64/autobuilds/current-stage3-amd64/stage3.tar.bz2'
+LISTING_PATH = '/releases/amd64/autobuilds/current-stage3-amd64/'
+TEST_FILES = {
+    STAGE3_PATH: ''.join(chr(i % 251) for i in range(300000)),
+    LISTING_PATH: '<a href="stage3.tar.bz2">stage3.tar.bz2</a>'}
+
+
+@contextlib.contextmanager
+def caching_mirror():
+    """Run a caching mirror in front of a fake upstream."""
+    with test_helpers.fake_upstream(TEST_FILES) as upstream:
+        with temp.temp_directory() as cache_dir:
+            mirror = gensystem_serve.CachingMirror(upstream.url, cache_dir)
+            server = gensystem_serve.MirrorServer(('127.0.0.1', 0), mirror)
+            thread = threading.Thread(
+                target=server.serve_forever, args=(0.05,))
+            thread.daemon = True
+            thread.start()
+            try:
+                yield upstream, 'http://127.0.0.1:%d' % server.server_port
+            finally:
+                server.shutdown()
+                server.server_close()
+
+
+def test_get_range():
+    """Test get_range parses single byte ranges."""
+    assert gensystem_serve.get_range(None, 100) is None
+    assert gensystem_serve.get_range('bytes=10-19', 100) == (10, 20)
+    assert gensystem_serve.get_range('bytes=90-', 100) == (90, 100)
+    assert gensystem_serve.get_range('bytes=-5', 100) == (95, 100)
+    assert gensystem_serve.get_range('bytes=0-4,8-9', 100) is None
+    assert pytest.raises(
+        ValueError, gensystem_serve.get_range, 'bytes=100-', 100)
+
+
+def test_serve_caches_files():
+    """Test a file is fetched upstream once, then served from cache."""
+    with caching_mirror() as (upstream, url):
+        for _ in range(2):
+            body = urllib2.urlopen(url + STAGE3_PATH).read()
+            assert body == TEST_FILES[STAGE3_PATH]
+
+        assert upstream.requests == [STAGE3_PATH]
+
+
+def test_serve_coalesces_concurrent_requests():
+    """Test concurrent clients share a single upstream transfer."""
+    bodies = []
+
+    def fetch():
+        bodies.append(urllib2.urlopen(url + STAGE3_PATH).read())
+
+    with caching_mirror() as (upstream, url):
+        upstream.gate.clear()
+        clients = [threading.Thread(target=fetch) for _ in range(3)]
+        for client in clients:
+            client.start()
+        # Let every client attach to the fill before upstream finishes
+        while len(upstream.requests) < 1:
+            pass
+        upstream.gate.set()
+        for client in clients:
+            client.join()
+
+        assert bodies == [TEST_FILES[STAGE3_PATH]] * 3
+        assert upstream.requests == [STAGE3_PATH]
+
+
+def test_serve_range_request():
+    """Test Range requests get partial content."""
+    with caching_mirror() as (_, url):
+        request = urllib2.Request(
+            url + STAGE3_PATH, headers={'Range': 'bytes=1000-1999'})
+        response = urllib2.urlopen(request)
+        assert response.getcode() == 206
+        assert response.read() == TEST_FILES[STAGE3_PATH][1000:2000]
+
+
+def test_serve_makes_block_maps():
+    """Test block maps missing upstream are made from the cached file."""
+    with caching_mirror() as (upstream, url):
+        for _ in range(2):
+            block_map = gensystem_delta.load_block_map(urllib2.urlopen(
+                url + STAGE3_PATH + gensystem_delta.BLOCK_MAP_SUFFIX).read())
+
+        assert block_map['size'] == len(TEST_FILES[STAGE3_PATH])
+        assert upstream.requests == [
+            STAGE3_PATH + gensystem_delta.BLOCK_MAP_SUFFIX, STAGE3_PATH]
+
+
+def test_serve_listing_and_rejected_paths():
+    """Test listings are proxied and paths outside releases/ are not."""
+    with caching_mirror() as (_, url):
+        listing = urllib2.urlopen(url + LISTING_PATH).read()
+        assert listing == TEST_FILES[LISTING_PATH]
+        # Without the slash, as get_media_file_url asks for it
+        listing = urllib2.urlopen(url + LISTING_PATH[:-1]).read()
+        assert listing == TEST_FILES[LISTING_PATH]
+
+        for path in ('/distfiles/x', '/releases/../etc/passwd'):
+            with pytest.raises(urllib2.HTTPError):
+                urllib2.urlopen(url + path)
@@ -0,0 +1,26 @@
+"""Unit tests for gensystem settings."""
+
+import os
+
+import mock
+
+import gensystem.settings as gensystem_settings
+
+
+def test_to_positive_int():
+    """Test only positive integers are taken as set."""
+    assert gensystem_settings.to_positive_int('65536') == 65536
+    assert gensystem_settings.to_positive_int(4, 8) == 4
+    for value in ('1M', '', None, '0', '-1', 0, -1, [4]):
+        assert gensystem_settings.to_positive_int(value, 8) == 8
+
+
+def test_get_positive_int():
+    """Test a malformed setting falls back to the default."""
+    with mock.patch.dict(os.environ, {'GENSYSTEM_RETRIES': 'five'}):
+        assert gensystem_settings.get_positive_int(
+            'GENSYSTEM_RETRIES', 5) == 5
+    with mock.patch.dict(os.environ, {'GENSYSTEM_RETRIES': '2'}):
+        assert gensystem_settings.get_positive_int(
+            'GENSYSTEM_RETRIES', 5) == 2
+    assert gensystem_settings.get_positive_int('GENSYSTEM_UNSET') is None
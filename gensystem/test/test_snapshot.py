@@ -0,0 +1,33 @@
+"""Unit tests for gensystem snapshot."""
+
+import os
+
+import mock
+
+import gensystem.snapshot as gensystem_snapshot
+import gensystem.temp as gensystem_temp
+
+
+def test_get_snapshot_url_follows_lzma_support():
+    """Test the xz snapshot is only chosen when lzma is available."""
+    with mock.patch('gensystem.install.lzma', None):
+        assert gensystem_snapshot.get_snapshot_url('http://mirror/') == (
+            'http://mirror/snapshots/portage-latest.tar.bz2')
+    with mock.patch('gensystem.install.lzma', object()):
+        assert gensystem_snapshot.get_snapshot_url('http://mirror') == (
+            'http://mirror/snapshots/portage-latest.tar.xz')
+
+
+def test_get_md5_digest():
+    """Test the MD5 of the snapshot is read from its md5sum file."""
+    with gensystem_temp.temp_directory() as temp_dir:
+        checksum_path = os.path.join(temp_dir, 'portage-latest.tar.bz2.md5sum')
+        with open(checksum_path, 'w') as checksum_file:
+            checksum_file.write(
+                '0123456789ABCDEF0123456789abcdef  portage-latest.tar.bz2\n')
+
+        assert gensystem_snapshot.get_md5_digest(
+            checksum_path, 'portage-latest.tar.bz2') == (
+                '0123456789abcdef0123456789abcdef')
+        assert gensystem_snapshot.get_md5_digest(
+            checksum_path, 'portage-latest.tar.xz') is None
@@ -0,0 +1,67 @@
+"""Unit tests for gensystem speculate."""
+
+import mock
+
+import gensystem.benchmarks.fake_mirror as fake_mirror
+import gensystem.speculate as gensystem_speculate
+import gensystem.temp as gensystem_temp
+import gensystem.test.helpers as test_helpers
+
+SIZE = 256 * 1024
+
+
+def speculate(media_chosen, head_size=SIZE // 4):
+    """Speculate on a fake mirror until `media_chosen` is chosen.
+
+    Returns:
+        tuple: The stage3 laid out, the URL and what was prefetched.
+
+    """
+    with gensystem_temp.temp_directory() as temp_dir, \
+            test_helpers.isolated_cache(), mock.patch(
+                'gensystem.catalog.load', return_value={}), mock.patch(
+                'gensystem.speculate.HEAD_SIZE', head_size):
+        path = fake_mirror.make_layout(temp_dir, 'stage3', SIZE)
+        fake_mirror.make_layout(temp_dir, 'minimal', SIZE)
+        with open(path, 'rb') as media:
+            data = media.read()
+        with open(path + '.DIGESTS', 'rb') as digests:
+            data_digests = digests.read()
+
+        with fake_mirror.shaped_mirror(temp_dir) as mirror:
+            speculation = gensystem_speculate.Speculation('amd64')
+            speculation.choose_mirror(mirror.url, ['stage3', 'minimal'])
+            # The user takes a while to choose
+            speculation._head.join()
+            speculation._digests.join()
+            url, prefetched = speculation.choose_media(media_chosen)
+            digests = prefetched.get_digests()
+
+    return (data, data_digests), url, prefetched.head, digests
+
+
+def test_likely_media_is_fetched_while_choosing():
+    """Test the URL, head and DIGESTS of the likely media are at hand."""
+    (data, data_digests), url, head, digests = speculate('stage3')
+
+    assert url.endswith(fake_mirror.get_media_path('stage3'))
+    assert head.data == data[:SIZE // 4]
+    assert head.total == SIZE
+    assert digests == data_digests
+
+
+def test_other_media_gets_nothing_prefetched():
+    """Test speculation on the likely media is dropped for another choice."""
+    _, url, head, digests = speculate('minimal')
+
+    assert url.endswith(fake_mirror.get_media_path('minimal'))
+    assert head is None
+    assert digests is None
+
+
+def test_cancelled_task_gives_nothing():
+    """Test a cancelled task stops and what it did is not used."""
+    task = gensystem_speculate.Task(lambda task: 'done')
+    task.join()
+    task.cancel()
+    assert gensystem_speculate.Prefetched(None, task).get_digests() is None
@@ -0,0 +1,69 @@
+"""Unit tests for gensystem transcode."""
+
+import bz2
+import io
+import os
+import tarfile
+import time
+
+import gensystem.install as gensystem_install
+import gensystem.temp as gensystem_temp
+import gensystem.test.helpers as test_helpers
+import gensystem.transcode as gensystem_transcode
+
+
+def write_tarball(path, hostname):
+    """Write a .tar.bz2 holding etc/hostname."""
+    raw = io.BytesIO()
+    with tarfile.open(fileobj=raw, mode='w') as tar:
+        info = tarfile.TarInfo('etc/hostname')
+        info.size = len(hostname)
+        tar.addfile(info, io.BytesIO(hostname))
+    with open(path, 'wb') as tarball:
+        tarball.write(bz2.compress(raw.getvalue()))
+
+
+def test_copy_is_used_until_the_original_changes():
+    """Test the copy is tied to the SHA512 of the original."""
+    with gensystem_temp.temp_directory() as temp_dir, \
+            test_helpers.isolated_cache():
+        path = os.path.join(temp_dir, 'stage3-amd64-20160414.tar.bz2')
+        write_tarball(path, 'first\n')
+        assert gensystem_transcode.find_copy(path) is None
+
+        copy = gensystem_transcode.transcode(path, use_zstd=False)
+        assert copy.endswith('.tar') and os.path.dirname(copy) == temp_dir
+        assert gensystem_transcode.find_copy(path) == copy
+        with tarfile.open(copy) as tar:
+            assert tar.extractfile('etc/hostname').read() == 'first\n'
+
+        # A new release under the same name
+        time.sleep(0.01)
+        write_tarball(path, 'second\n')
+        assert gensystem_transcode.find_copy(path) is None
+        new_copy = gensystem_transcode.transcode(path, use_zstd=False)
+
+        assert new_copy != copy
+        assert gensystem_transcode.get_copies(path) == [new_copy]
+        assert not [
+            name for name in os.listdir(temp_dir) if name.endswith('.part')]
+
+
+def test_install_from_copy():
+    """Test open_tarball reads a copy as install_stage expects."""
+    with gensystem_temp.temp_directory() as temp_dir, \
+            test_helpers.isolated_cache():
+        path = os.path.join(temp_dir, 'stage3.tar.bz2')
+        write_tarball(path, 'gentoo\n')
+        copy = gensystem_transcode.transcode(path, use_zstd=False)
+        target = os.path.join(temp_dir, 'target')
+
+        source, decompressor = gensystem_transcode.open_tarball(copy)
+        with source:
+            errors = gensystem_install.install_stage(
+                source, [target], decompressor)
+
+        assert errors == {}
+        assert decompressor is None
+        with open(os.path.join(target, 'etc', 'hostname')) as hostname:
+            assert hostname.read() == 'gentoo\n'
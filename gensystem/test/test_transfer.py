@@ -0,0 +1,53 @@
+"""Unit tests for gensystem transfer."""
+
+import os
+import urllib2
+
+import pytest
+
+import gensystem.temp as temp
+import gensystem.test.helpers as test_helpers
+import gensystem.transfer as gensystem_transfer
+
+TEST_CONTENTS = ''.join(chr(i % 253) for i in range(1000000))
+
+
+def test_fetch_writes_file_in_buffers():
+    """Test fetch downloads a file, reporting progress per buffer."""
+    progress = []
+    with test_helpers.fake_upstream({'/file': TEST_CONTENTS}) as upstream:
+        with temp.temp_directory() as temp_dir:
+            destination = os.path.join(temp_dir, 'file')
+            fetched = gensystem_transfer.fetch(
+                upstream.url + 'file', destination,
+                lambda blocks, size, total: progress.append((size, total)),
+                buffer_size=65536)
+
+            assert fetched == len(TEST_CONTENTS)
+            with open(destination, 'rb') as downloaded:
+                assert downloaded.read() == TEST_CONTENTS
+
+    assert progress[0] == (0, len(TEST_CONTENTS))
+    assert progress[-1] == (len(TEST_CONTENTS), len(TEST_CONTENTS))
+    assert len(progress) == 1 + len(TEST_CONTENTS) // 65536 + 1
+
+
+def test_fetch_follows_redirects():
+    """Test fetch follows a redirect to the real file."""
+    files = {'/dir/': 'listing'}
+    with test_helpers.fake_upstream(files) as upstream:
+        with temp.temp_directory() as temp_dir:
+            destination = os.path.join(temp_dir, 'listing')
+            gensystem_transfer.fetch(upstream.url + 'dir', destination)
+            with open(destination, 'rb') as downloaded:
+                assert downloaded.read() == 'listing'
+
+
+def test_fetch_missing_file():
+    """Test fetch raises HTTPError for a missing file."""
+    with test_helpers.fake_upstream({}) as upstream:
+        with temp.temp_directory() as temp_dir:
+            with pytest.raises(urllib2.HTTPError) as error:
+                gensystem_transfer.fetch(
+                    upstream.url + 'missing', os.path.join(temp_dir, 'x'))
+            assert error.value.code == 404
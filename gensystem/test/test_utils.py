@@ -7,6 +7,7 @@ import mock
 import nose
 import pytest
 
+import gensystem.retry as gensystem_retry
 import gensystem.utils as gensystem_utils
 import gensystem.test.helpers as test_helpers
 
@@ -21,23 +22,40 @@ def test_soupify_sucess():
 
 
 @mock.patch(
-    'urllib2.urlopen', lambda url: StringIO.StringIO('<html>Fake</html>'))
+    'gensystem.transfer.open_url',
+    lambda url: StringIO.StringIO('<html>Fake</html>'))
 def test_read_webpage_success():
     """Test read_webpage sucessfully reads a URL."""
     webpage = gensystem_utils.read_webpage('http://!FakeURL.com')
     assert webpage == '<html>Fake</html>'
 
 
-@mock.patch('urllib2.urlopen')
-def test_read_webpage_raises_exception_on_failure(m_urlopen):
-    """Test read_webpage raises an exception when urlopen fails."""
-    m_urlopen.side_effect = urllib2.URLError("Forced URLError.")
+@mock.patch.object(gensystem_retry.POLICY, 'sleep')
+@mock.patch('gensystem.transfer.open_url')
+def test_read_webpage_raises_exception_on_failure(m_open_url, m_sleep):
+    """Test read_webpage raises an exception when requests fail."""
+    m_open_url.side_effect = urllib2.URLError("Forced URLError.")
     assert pytest.raises(
-        RuntimeError, gensystem_utils.read_webpage, ('http://!FakeURL.com',))
+        RuntimeError, gensystem_utils.read_webpage, 'http://!FailURL.com')
+    assert m_open_url.call_count == gensystem_retry.POLICY.attempts
+    assert m_sleep.call_count == gensystem_retry.POLICY.attempts - 1
+
+
+@mock.patch.object(gensystem_retry.POLICY, 'sleep')
+@mock.patch('gensystem.transfer.open_url')
+def test_read_webpage_retries(m_open_url, m_sleep):
+    """Test read_webpage retries until a request succeeds."""
+    m_open_url.side_effect = [
+        urllib2.URLError("Forced URLError."),
+        StringIO.StringIO('<html>Fake</html>')]
+    webpage = gensystem_utils.read_webpage('http://!RetryURL.com')
+    assert webpage == '<html>Fake</html>'
+    assert m_sleep.call_count == 1
 
 
 @mock.patch.object(
-    gensystem_utils, 'read_webpage', lambda url: '{"ip":"127.0.0.1"}')
+    gensystem_utils, 'read_hedged',
+    lambda url, kind: (url, '{"ip":"127.0.0.1"}'))
 def test_get_public_ip_success():
     """Test get_public_ip success."""
     public_ip = gensystem_utils.get_public_ip()
@@ -45,7 +63,7 @@ def test_get_public_ip_success():
 
 
 @mock.patch.object(
-    gensystem_utils, 'read_webpage', lambda url: 'I SHOULD BE JSON')
+    gensystem_utils, 'read_hedged', lambda url, kind: (url, 'NOT JSON'))
 def test_get_public_ip_failure():
     """Test get_public_ip failure."""
     public_ip = gensystem_utils.get_public_ip()
@@ -170,22 +188,23 @@ def test_format_choice_more_than_10_choices():
     assert formatted_choice == '[11]'
 
 
-@mock.patch('urllib.urlretrieve')
+@mock.patch('gensystem.segments.fetch')
 @mock.patch('os.path.exists', lambda path: True)
-def test_download_file_success(m_urlretrieve):
+def test_download_file_success(m_fetch):
     """Test download_file succeeding."""
-    m_urlretrieve.return_value = ('/tmp/fake/path', 'HTTPMessage Object')
+    m_fetch.return_value = 1024
     downloaded, _ = gensystem_utils.download_file(
         'http://!FakeURL.com/file.tar.gz', '/tmp/fake/path', 'fake_function')
     assert downloaded
-    m_urlretrieve.assert_called_once_with(
-        'http://!FakeURL.com/file.tar.gz', '/tmp/fake/path', 'fake_function')
+    m_fetch.assert_called_once_with(
+        'http://!FakeURL.com/file.tar.gz', '/tmp/fake/path', 'fake_function',
+        None, head=None, part_hook=None)
 
 
-@mock.patch('urllib.urlretrieve')
-def test_download_file_failure(m_urlretrieve):
+@mock.patch('gensystem.segments.fetch')
+def test_download_file_failure(m_fetch):
     """Test download_file failing."""
-    m_urlretrieve.side_effect = IOError('Forced IOError')
+    m_fetch.side_effect = IOError('Forced IOError')
     downloaded, error = gensystem_utils.download_file(
         'http://!FakeURL.com/file.tar.gz', '/tmp/fake/path')
     assert not downloaded
@@ -198,7 +217,8 @@ def test_verify_download_success(m_open, m_sha512):
     """Test verify_download succeeding."""
     open_digest = test_helpers.mock_open(
         '# SHA512 HASH\n1234567890 fake.tar.bz2')
-    m_open.side_effect = [open_digest, StringIO.StringIO('Download File')]
+    m_open.side_effect = [
+        open_digest, test_helpers.mock_open('Download File')]
     m_hexdigest = mock.Mock()
     m_hexdigest.hexdigest.return_value = '1234567890'
     m_sha512.return_value = m_hexdigest
@@ -214,7 +234,8 @@ def test_verify_download_failure(m_open, m_sha512):
     """Test verify_download failing."""
     open_digest = test_helpers.mock_open(
         '# SHA512 HASH\n1234567890 fake.tar.bz2')
-    m_open.side_effect = [open_digest, StringIO.StringIO('Download File')]
+    m_open.side_effect = [
+        open_digest, test_helpers.mock_open('Download File')]
     m_hexdigest = mock.Mock()
     m_hexdigest.hexdigest.return_value = '0987654321'
     m_sha512.return_value = m_hexdigest
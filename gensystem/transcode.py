@@ -0,0 +1,204 @@
+"""Keep a fast-decompressing copy of a stage tarball for repeated installs.
+
+A .tar.bz2 is slow to decompress, and a stage3 installed again and again
+pays for it every time. After a verified download, the tarball can be
+transcoded once into a copy that is quicker to read:
+
+* .tar.zst, compressed by zstd(1) on every core, when zstd is installed;
+* otherwise .tar, no compression at all (about three times the size).
+
+The original stays, as the file that can be verified against DIGESTS. The
+copy is named after it and the first DIGEST_LENGTH hex digits of its
+SHA512, e.g. stage3-amd64-20160414.tar.bz2.1f2e...9a.tar.zst, so it is
+only used while the original is unchanged. Copies of earlier versions
+are removed when a new one is made. The SHA512 of the original comes
+from the digest memo (see gensystem.digests), so looking for a copy does
+not usually read the original.
+
+"""
+
+import distutils.spawn
+import os
+import re
+import subprocess
+
+import gensystem.digests as gensystem_digests
+import gensystem.install as gensystem_install
+import gensystem.metrics as gensystem_metrics
+
+ZSTD = distutils.spawn.find_executable('zstd')
+ZSTD_LEVEL = 3
+ZSTD_EXTENSION = '.tar.zst'
+TAR_EXTENSION = '.tar'
+DIGEST_LENGTH = 32
+COPY_REGEX = r'^%s\.[0-9a-f]{%d}(\.tar|\.tar\.zst)$'
+
+
+def get_copies(path):
+    """Get the transcoded copies of a tarball, whatever version they are of.
+
+    Args:
+        path (str): Path of the original tarball.
+
+    Returns:
+        list: Paths of the copies.
+
+    """
+    directory, name = os.path.split(path)
+    regex = re.compile(COPY_REGEX % (re.escape(name), DIGEST_LENGTH))
+    try:
+        names = os.listdir(directory or '.')
+    except OSError:
+        return []
+
+    return [
+        os.path.join(directory, copy) for copy in sorted(names)
+        if regex.match(copy)]
+
+
+def get_copy_path(path, sha512, extension):
+    """Get the path of the copy of a tarball with SHA512 `sha512`."""
+    return '%s.%s%s' % (path, sha512[:DIGEST_LENGTH], extension)
+
+
+def find_copy(path):
+    """Find a copy of a tarball transcoded from it as it is now.
+
+    Args:
+        path (str): Path of the original tarball.
+
+    Returns:
+        str: Path of the copy, or None if there is none that can be read.
+
+    """
+    copies = get_copies(path)
+    if not copies:
+        return None  # Nothing to hash the original for
+
+    sha512, _ = gensystem_digests.hash_file(path)
+    for extension in (ZSTD_EXTENSION, TAR_EXTENSION):
+        copy = get_copy_path(path, sha512, extension)
+        if copy in copies and (extension != ZSTD_EXTENSION or ZSTD):
+            return copy
+
+    return None
+
+
+def transcode(path, use_zstd=None, chunk_size=gensystem_install.CHUNK_SIZE):
+    """Make a fast-decompressing copy of a tarball next to it.
+
+    Copies of earlier versions of the tarball are removed.
+
+    Args:
+        path (str): Path of the original tarball.
+        use_zstd (Optional[bool]): Whether to compress the copy with zstd
+            (default: if zstd is installed).
+        chunk_size (Optional[int]): Bytes read at a time.
+
+    Returns:
+        str: Path of the copy.
+
+    Raises:
+        EnvironmentError: When the tarball cannot be read or the copy
+            cannot be written.
+        RuntimeError: When the tarball's compression is not supported.
+
+    """
+    use_zstd = bool(ZSTD) if use_zstd is None else use_zstd
+    decompressor = gensystem_install.get_decompressor(path)
+    sha512, _ = gensystem_digests.hash_file(path)
+    copy = get_copy_path(
+        path, sha512, ZSTD_EXTENSION if use_zstd else TAR_EXTENSION)
+    partial = copy + '.part'
+
+    with gensystem_metrics.span('transcode', zstd=use_zstd):
+        try:
+            _write_copy(path, partial, decompressor, use_zstd, chunk_size)
+        except Exception:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        os.rename(partial, copy)
+
+    for stale in get_copies(path):
+        if stale != copy:
+            os.remove(stale)
+    return copy
+
+
+def _write_copy(path, partial, decompressor, use_zstd, chunk_size):
+    """Write the decompressed tarball to `partial` (see transcode)."""
+    with open(path, 'rb') as original, open(partial, 'wb') as output:
+        process = None
+        if use_zstd:
+            process = subprocess.Popen(
+                [ZSTD, '-q', '-T0', '-%d' % ZSTD_LEVEL, '-c'],
+                stdin=subprocess.PIPE, stdout=output)
+            output = process.stdin
+        try:
+            for data in iter(lambda: original.read(chunk_size), ''):
+                if decompressor is not None:
+                    data = decompressor.decompress(data)
+                output.write(data)
+        finally:
+            if process is not None:
+                process.stdin.close()
+                process.wait()
+        if process is not None and process.returncode != 0:
+            raise IOError("zstd failed (exit code %d)." % process.returncode)
+
+
+class ZstdReader(object):
+
+    """File-like object reading a .zst file decompressed by zstd(1)."""
+
+    def __init__(self, path):
+        """Start decompressing `path`.
+
+        Raises:
+            OSError: When zstd cannot be run.
+
+        """
+        self.process = subprocess.Popen(
+            [ZSTD or 'zstd', '-q', '-d', '-c', path], stdout=subprocess.PIPE)
+
+    def read(self, size=-1):
+        """Read up to `size` decompressed bytes.
+
+        Raises:
+            IOError: When zstd fails.
+
+        """
+        data = self.process.stdout.read(size)
+        if not data and size != 0 and self.process.wait() != 0:
+            raise IOError(
+                "zstd failed (exit code %d)." % self.process.returncode)
+        return data
+
+    def close(self):
+        """Stop decompressing."""
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        self.process.wait()
+
+
+def open_tarball(path):
+    """Open a tarball, or its copy, for install.install_stage.
+
+    Args:
+        path (str): Path of a tarball or of a copy of one.
+
+    Returns:
+        tuple: File-like object of the tarball and its decompressor.
+
+    Raises:
+        EnvironmentError: When it cannot be opened.
+        RuntimeError: When its compression is not supported.
+
+    """
+    if path.endswith(ZSTD_EXTENSION):
+        return ZstdReader(path), None
+
+    decompressor = gensystem_install.get_decompressor(path)
+    return open(path, 'rb'), decompressor
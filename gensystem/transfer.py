@@ -0,0 +1,227 @@
+"""Transfer files from mirrors straight to disk.
+
+Response bodies are received into one reusable buffer with recv_into and
+written out with pwrite, so no per-block Python strings are made, and the
+destination is preallocated once its size is known.
+
+"""
+
+import errno
+import httplib
+import os
+import socket
+import urllib
+import urllib2
+import urlparse
+
+import gensystem.bandwidth as gensystem_bandwidth
+import gensystem.connect as gensystem_connect
+import gensystem.metrics as gensystem_metrics
+import gensystem.posix as gensystem_posix
+import gensystem.retry as gensystem_retry
+import gensystem.settings as gensystem_settings
+
+BUFFER_SIZE = gensystem_settings.get_positive_int(
+    'GENSYSTEM_BUFFER_SIZE', 1024 * 1024)
+MAX_REDIRECTS = 5
+TIMEOUT = 60
+
+
+def _connect(url, timeout):
+    """Make an (unconnected) HTTP connection for `url`, honouring proxies.
+
+    Connections race the host's IPv6 and IPv4 addresses (see
+    gensystem.connect).
+
+    Returns:
+        tuple: The connection and the request target to send it.
+
+    """
+    connection, target = _make_connection(url, timeout)
+    connection._create_connection = gensystem_connect.create_connection
+    return connection, target
+
+
+def _make_connection(url, timeout):
+    """Make the httplib connection for `url` (see _connect)."""
+    parsed = urlparse.urlsplit(url)
+    if parsed.scheme not in ('http', 'https'):
+        raise IOError("Unsupported URL scheme for %s." % url)
+
+    connection_class = (
+        httplib.HTTPSConnection if parsed.scheme == 'https'
+        else httplib.HTTPConnection)
+    target = urlparse.urlunsplit(
+        ('', '', parsed.path or '/', parsed.query, ''))
+
+    proxy = urllib.getproxies().get(parsed.scheme)
+    if proxy and not urllib.proxy_bypass(parsed.hostname):
+        proxy_host = urlparse.urlsplit(proxy).netloc
+        if parsed.scheme == 'https':
+            connection = connection_class(proxy_host, timeout=timeout)
+            connection.set_tunnel(parsed.hostname, parsed.port)
+            return connection, target
+        return httplib.HTTPConnection(proxy_host, timeout=timeout), url
+
+    return connection_class(parsed.netloc, timeout=timeout), target
+
+
+def open_url(url, headers=None, timeout=TIMEOUT, on_connection=None):
+    """Send a GET request for `url`, following redirects.
+
+    Headers are read unbuffered, so the socket is left positioned at the
+    start of the body and it can be received straight into a buffer.
+
+    Args:
+        url (str): URL to request.
+        headers (Optional[dict]): Extra request headers.
+        timeout (Optional[float]): Socket timeout in seconds.
+        on_connection (Optional[fn]): Function called with each
+            httplib.HTTPConnection made, e.g. to abort it from elsewhere.
+
+    Returns:
+        httplib.HTTPResponse: Response, with the final URL as `url`.
+
+    Raises:
+        IOError: When the request fails (urllib2.HTTPError on bad status).
+
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+        connection, target = _connect(url, timeout)
+        if on_connection is not None:
+            on_connection(connection)
+        try:
+            connection.request('GET', target, headers=headers or {})
+            response = connection.getresponse()
+        except httplib.HTTPException as error:
+            connection.close()
+            raise gensystem_retry.TransferError(
+                "Could NOT talk to %s (%r)." % (url, error))
+
+        location = response.getheader('Location')
+        if response.status in (301, 302, 303, 307, 308) and location:
+            response.close()
+            url = urlparse.urljoin(url, location)
+            continue
+        if response.status >= 400:
+            response.close()
+            raise urllib2.HTTPError(
+                url, response.status, response.reason, response.msg, None)
+
+        response.url = url
+        return response
+
+    raise gensystem_retry.TransferError("Too many redirects for %s." % url)
+
+
+def get_body_reader(response, flow=None):
+    """Get a function reading a response body into a buffer.
+
+    Bytes read are paid for through the bandwidth scheduler (see
+    gensystem.bandwidth), so reads wait their turn when limits are set.
+
+    Args:
+        response (httplib.HTTPResponse): Response from open_url.
+        flow (Optional[gensystem.bandwidth.Flow]): Flow the body is read
+            for (default: the calling thread's).
+
+    Returns:
+        fn: Function taking a memoryview and returning bytes read into it
+        (0 at the end of the body).
+
+    """
+    mirror = gensystem_metrics.get_mirror(getattr(response, 'url', ''))
+    flow = flow or gensystem_bandwidth.get_flow()
+    sock = getattr(response.fp, '_sock', None)
+    if response.chunked or response.length is None or (
+            not hasattr(sock, 'recv_into')):
+        def read_into(view):
+            data = response.read(len(view))
+            view[:len(data)] = data
+            return len(data)
+    else:
+        def read_into(view):
+            remaining = min(len(view), response.length)
+            while remaining:
+                try:
+                    count = sock.recv_into(view, remaining)
+                except socket.error as error:
+                    if error.errno == errno.EINTR:
+                        continue
+                    raise
+                response.length -= count
+                return count
+            return 0
+
+    def paced_read_into(view):
+        count = read_into(view)
+        if count:
+            gensystem_bandwidth.acquire(count, mirror, flow)
+        return count
+
+    return paced_read_into
+
+
+def fetch(url, destination, hook=None, buffer_size=BUFFER_SIZE,
+          response=None):
+    """Download `url` to `destination`.
+
+    Args:
+        url (str): URL of file to download.
+        destination (str): Path on file system to save downloaded file.
+        hook (Optional[fn]): Hook taking (blocks, block_size, total),
+            called as blocks of `buffer_size` are written.
+        buffer_size (Optional[int]): Bytes received per write.
+        response (Optional[httplib.HTTPResponse]): Response for `url`
+            already opened with open_url (e.g. while probing it).
+
+    Returns:
+        int: Number of bytes downloaded.
+
+    Raises:
+        IOError: When the download fails or is cut short.
+
+    """
+    response = response or open_url(url)
+    total = response.length
+    buffer_ = bytearray(buffer_size)
+    view = memoryview(buffer_)
+    read_into = get_body_reader(response)
+    offset = 0
+
+    fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    try:
+        if total:
+            gensystem_posix.fallocate(fd, 0, total)
+        if hook is not None:
+            hook(1, 0, total or -1)
+
+        while True:
+            # Fill the whole buffer so every write is a large one
+            filled = 0
+            while filled < buffer_size:
+                count = read_into(view[filled:])
+                if not count:
+                    break
+                filled += count
+            if not filled:
+                break
+
+            gensystem_posix.pwrite(fd, buffer_, filled, offset)
+            offset += filled
+            if hook is not None:
+                hook(1, offset, total or -1)
+
+        if total is not None and offset != total:
+            raise gensystem_retry.TransferError(
+                "Download of %s was cut short (%d of %d bytes)." % (
+                    url, offset, total))
+    except EnvironmentError:
+        # Release blocks reserved past what was actually written
+        os.ftruncate(fd, offset)
+        raise
+    finally:
+        os.close(fd)
+        response.close()
+
+    return offset
@@ -1,14 +1,20 @@
 """Utilities for working with gensystem."""
 
-import hashlib
+import contextlib
+import httplib
 import json
 import os
 import pygeoip
-import urllib
-import urllib2
 
 from bs4 import BeautifulSoup
 
+import gensystem.digests as gensystem_digests
+import gensystem.hedge as gensystem_hedge
+import gensystem.metrics as gensystem_metrics
+import gensystem.retry as gensystem_retry
+import gensystem.transfer as gensystem_transfer
+import gensystem.segments as gensystem_segments
+
 PUBLIC_IP_API = 'https://api.ipify.org?format=json'
 GEOIP_FILE = os.environ.get(
     'GEOIP_FILE',
@@ -17,7 +23,9 @@ GEOIP_FILE = os.environ.get(
 
 
 def read_webpage(url_path):
-    """Read a response from a urlopen request for a web page.
+    """Read a web page.
+
+    Failed requests are retried as gensystem.retry's policy allows.
 
     Args:
         url_path (str): Full path to a URL to read.
@@ -26,15 +34,40 @@ def read_webpage(url_path):
         str: String representation of `url_path`.
 
     Raises:
-        RuntimeError: When urllib2 cannot communicate with `url_path`.
+        RuntimeError: When `url_path` cannot be read.
 
     """
+    def read(url):
+        with contextlib.closing(gensystem_transfer.open_url(url)) as response:
+            return response.read()
+
     try:
-        response = urllib2.urlopen(url_path)
-    except urllib2.URLError:
+        return gensystem_retry.call(read, url_path)
+    except (EnvironmentError, httplib.HTTPException):
         raise RuntimeError("Could NOT talk to %s." % url_path)
 
-    return response.read()
+
+def read_hedged(url_path, kind, hedge_url=None):
+    """Read a small web page, hedging a slow request (see gensystem.hedge).
+
+    Args:
+        url_path (str): Full path to a URL to read.
+        kind (str): Kind of page (e.g. listing).
+        hedge_url (Optional[str]): Same page elsewhere, e.g. on another
+            mirror (default: `url_path` again).
+
+    Returns:
+        tuple: URL that answered first (after redirects) and its body.
+
+    Raises:
+        RuntimeError: When the page cannot be read.
+
+    """
+    try:
+        return gensystem_retry.call(
+            gensystem_hedge.read, url_path, kind, hedge_url)
+    except (EnvironmentError, httplib.HTTPException):
+        raise RuntimeError("Could NOT talk to %s." % url_path)
 
 
 def soupify(url_path):
@@ -58,10 +91,12 @@ def get_public_ip():
         str: Public IP address of current machine or None.
 
     """
-    try:
-        public_ip = json.loads(read_webpage(PUBLIC_IP_API))['ip']
-    except (RuntimeError, ValueError, KeyError):
-        public_ip = None
+    with gensystem_metrics.span('get_public_ip'):
+        try:
+            _, response = read_hedged(PUBLIC_IP_API, 'public_ip')
+            public_ip = json.loads(response)['ip']
+        except (RuntimeError, ValueError, KeyError):
+            public_ip = None
 
     return public_ip
 
@@ -76,10 +111,11 @@ def get_country_code_by_ip(ip):
         str: Country code of provided IP address.
 
     """
-    try:
-        code = pygeoip.GeoIP(GEOIP_FILE).country_code_by_addr(ip)
-    except Exception:
-        code = None
+    with gensystem_metrics.span('geoip'):
+        try:
+            code = pygeoip.GeoIP(GEOIP_FILE).country_code_by_addr(ip)
+        except Exception:
+            code = None
 
     return code
 
@@ -211,49 +247,116 @@ def format_choice(choice, ten_or_more_choices=False):
     return choice_format % str(choice)
 
 
-def download_file(url, destination, hook=None):
+def download_file(
+        url, destination, hook=None, ready_hook=None, head=None,
+        part_hook=None):
     """Download a file and save it to disk.
 
     Args:
         url (str): URL of file to download.
         destination (str): Path on file system to save downloaded file.
         hook (Optional[fn]): Function to call to report progress or None.
+        ready_hook (Optional[fn]): Function called with the bytes from the
+            start of the file that are written (see segments.fetch).
+        head (Optional[gensystem.segments.Head]): Start of the file,
+            already fetched.
+        part_hook (Optional[fn]): Function returning a hook for each
+            connection (see segments.SegmentedDownload).
+
+    Returns:
+        tuple: Whether file was downloaded and the error if failure or None.
+
+    """
+    mirror = gensystem_metrics.get_mirror(url)
+    with gensystem_metrics.span(
+            'download_file', url=url, mirror=mirror) as span:
+        try:
+            downloaded = gensystem_segments.fetch(
+                url, destination, hook, ready_hook, head=head,
+                part_hook=part_hook)
+        except (EnvironmentError, httplib.HTTPException) as error:
+            span.set(error=str(error))
+            return False, str(error)
+
+        span.set(bytes=downloaded)
+        gensystem_metrics.count('downloaded_bytes', downloaded, mirror=mirror)
+
+    return os.path.exists(destination), None
+
+
+def download_small_file(url, destination, kind, hedge_url=None):
+    """Download a small file (e.g. DIGESTS), hedging a slow request.
+
+    Args:
+        url (str): URL of file to download.
+        destination (str): Path on file system to save downloaded file.
+        kind (str): Kind of file (e.g. digests).
+        hedge_url (Optional[str]): Same file elsewhere, e.g. on another
+            mirror.
 
     Returns:
         tuple: Whether file was downloaded and the error if failure or None.
 
     """
     try:
-        urllib.urlretrieve(url, destination, hook)
-    except IOError as error:
+        _, contents = read_hedged(url, kind, hedge_url)
+        with open(destination, 'wb') as downloaded:
+            downloaded.write(contents)
+    except (RuntimeError, EnvironmentError) as error:
         return False, str(error)
 
-    return os.path.exists(destination), None
+    return True, None
 
 
-def verify_download(download_path, digest_path):
-    """Verify a gentoo download as being not corrupted.
+def get_sha512_digest(digest_path, download_file):
+    """Get the SHA512 hash listed for a file in a gentoo DIGESTS file.
 
     Args:
-        download_path (str): Path to download file.
         digest_path (str): Path to digest file.
+        download_file (str): Name of the file to get the hash for.
 
     Returns:
-        bool: Whether download was verified (not corrupted).
+        str: Hex SHA512 hash of `download_file` or None if not listed.
 
     """
-    valid_sha512 = None
-    download_file = os.path.basename(download_path)
-
     with open(digest_path, 'r') as digest_file:
         for line in digest_file:
             if line.startswith('# SHA512 HASH'):
                 hash_line = digest_file.next().strip()
                 if hash_line.endswith(download_file):
-                    valid_sha512 = hash_line.split()[0]
-                    break
+                    return hash_line.split()[0]
 
-    hasher = hashlib.sha512()
-    hasher.update(open(download_path).read())
+    return None
 
-    return hasher.hexdigest() == valid_sha512
+
+def verify_download(download_path, digest_path, sha512=None, force=False):
+    """Verify a gentoo download as being not corrupted.
+
+    A download unchanged since it was last hashed is not hashed again (see
+    gensystem.digests).
+
+    Args:
+        download_path (str): Path to download file.
+        digest_path (str): Path to digest file.
+        sha512 (Optional[str]): Hex SHA512 of the download if already
+            computed (e.g. while following another process's download).
+        force (Optional[bool]): Whether to hash the download even if it
+            is unchanged since it was last hashed.
+
+    Returns:
+        bool: Whether download was verified (not corrupted).
+
+    """
+    with gensystem_metrics.span(
+            'verify_download', file=os.path.basename(download_path)) as span:
+        valid_sha512 = get_sha512_digest(
+            digest_path, os.path.basename(download_path))
+
+        if sha512 is None:
+            sha512, hashed = gensystem_digests.hash_file(
+                download_path, force=force)
+            span.set(bytes=hashed)
+            gensystem_metrics.count('verified_bytes', hashed)
+
+        span.set(verified=sha512 == valid_sha512)
+        return sha512 == valid_sha512